@@ -6,15 +6,59 @@ utilities package -- 音楽生成プロジェクト全体で利用されるコ
     - core_music_utils:
         - MIN_NOTE_DURATION_QL
         - get_time_signature_object
+        - get_meter_info / MeterInfo (拍子ディスクリプタのキャッシュ)
         - sanitize_chord_label
         - get_music21_chord_object (sanitize_chord_label を内部で使用)
+    - chord_timeline:
+        - ChordTimeline (曲全体のコード進行を一度だけ解析して共有)
+    - metric_weights:
+        - MetricWeightTable / get_metric_weight_table (拍子ごとの拍の強さ表、キャッシュ済み)
+        - metric_weights (オフセット列の一括参照)
+        - metric_velocity_factors (ベロシティのアクセント係数)
+    - harmonic_context:
+        - HarmonicContext (ブロック × 128 音の許容ピッチ重み行列とブロックごとのマスク。with_range でパートの音域をかける)
+        - weight_row / key_weight_row / row_pc_mask / WEIGHT_CHORD_TONE / WEIGHT_TENSION / WEIGHT_SCALE / WEIGHT_AVOID / WEIGHT_OUTSIDE
+    - rhythm_library_compiler:
+        - load_rhythm_library (検証 + .rlib への自動コンパイル + mmap 読み込み)
+        - load_rhythm_library_data / rhythm_library_digest (メモリ上の辞書から。ファイル I/O なし)
+        - compile_rhythm_library / compile_rhythm_library_file / validate_rhythm_library
+        - CompiledRhythmLibrary / RhythmPatternArrays / pattern_event_arrays
+        - RhythmLibraryError
+    - rhythm_tiler:
+        - tile_pattern / tile_pattern_events (パターンをブロックに敷き詰める: stretch / repeat / bar)
+        - bar_spans / resolve_tiling_policy / TiledPattern / TILE_STRETCH / TILE_REPEAT / TILE_BAR
+    - section_dedup:
+        - plan_section_repeats / SectionRepeatPlan (繰り返しセクションの検出)
+        - place_section_repeats (代表セクションを時間をずらしてコピー)
+        - section_spans / section_fingerprint / SectionSpan
+    - part_params:
+        - PartParams / intern_part_params (ブロックごとのパートパラメータを不変オブジェクトとして共有)
+        - strip_lookup_tables / interned_count
+    - composer_config:
+        - compile_config (DEFAULT_CONFIG + 設定ファイル/CLI の上書きを生成前に検証してコンパイル)
+        - ComposerConfig / PartConfig / SectionDedupConfig (不変の型付き設定) / ConfigError / LOOKUP_TABLE_KEYS
+    - event_buffer:
+        - NoteEventBuffer (ノートイベントを配列で溜め、最後に一度だけ Part に書き出す。from_stream で生成済みのパートから作れる)
+    - score_exporter:
+        - render_formats / export_score / write_outputs (Score を一度だけ走査し、midi/stems/json/musicxml をまとめて書き出す)
+        - collect_score_events / ScoreEventIndex / TrackEvents / midi_file_bytes / event_list / parse_formats / EXPORT_FORMATS
+    - audio_renderer:
+        - render_audio / render_wav / wav_bytes (ScoreEventIndex を簡易シンセでステレオ WAV に。トラックごとにプロセス並列)
+        - SynthVoice / DrumVoice / voice_for_program / drum_voice_table
+        - stream_audio / stream_wav (ブロックごとに鳴っているノートだけを合成して順に返す/書く。メモリ一定で最初の音がすぐ出る)
+        - LiveEventIndex (作曲中に生成し終わったパートのトラックを受け取り、ストリーム側が先に準備しておく)
+    - tempo_map:
+        - TempoMap / MeterMap (区分的なテンポ/拍子マップ。拍 ↔ 秒 ↔ tick を O(log n)、配列はまとめて変換)
+        - build_timing_maps (ブロックの tempo / time_signature から作る) / insert_timing_marks
     - scale_registry:
         - build_scale_object
         - ScaleRegistry (クラス)
+        - ScaleInfo / get_scale_info (12 トニック × 全モードの事前計算済み整数テーブル)
     - humanizer:
         - generate_fractional_noise
         - apply_humanization_to_element
         - apply_humanization_to_part
+        - humanize_event_arrays
         - HUMANIZATION_TEMPLATES
         - NUMPY_AVAILABLE
 """
@@ -22,27 +66,152 @@ utilities package -- 音楽生成プロジェクト全体で利用されるコ
 from .core_music_utils import (
     MIN_NOTE_DURATION_QL,
     get_time_signature_object,
+    get_meter_info,
+    MeterInfo,
     sanitize_chord_label,
     get_music21_chord_object # これも公開すると便利
 )
 
+from .chord_timeline import ChordTimeline
+
+from .metric_weights import (
+    MetricWeightTable,
+    get_metric_weight_table,
+    metric_weights,
+    metric_velocity_factors,
+)
+
+from .harmonic_context import (
+    HarmonicContext,
+    weight_row,
+    key_weight_row,
+    row_pc_mask,
+    WEIGHT_CHORD_TONE,
+    WEIGHT_TENSION,
+    WEIGHT_SCALE,
+    WEIGHT_AVOID,
+    WEIGHT_OUTSIDE,
+)
+
+from .rhythm_library_compiler import (
+    load_rhythm_library,
+    load_rhythm_library_data,
+    rhythm_library_digest,
+    compile_rhythm_library,
+    compile_rhythm_library_file,
+    validate_rhythm_library,
+    CompiledRhythmLibrary,
+    RhythmPatternArrays,
+    pattern_event_arrays,
+    RhythmLibraryError,
+)
+
+from .rhythm_tiler import (
+    tile_pattern,
+    tile_pattern_events,
+    bar_spans,
+    resolve_tiling_policy,
+    TiledPattern,
+    TILE_STRETCH,
+    TILE_REPEAT,
+    TILE_BAR,
+)
+
+from .section_dedup import (
+    plan_section_repeats,
+    place_section_repeats,
+    section_spans,
+    section_fingerprint,
+    SectionRepeatPlan,
+    SectionSpan,
+)
+
+from .part_params import (
+    PartParams,
+    intern_part_params,
+    strip_lookup_tables,
+    interned_count,
+)
+
+from .composer_config import (
+    compile_config,
+    ComposerConfig,
+    PartConfig,
+    SectionDedupConfig,
+    ConfigError,
+    LOOKUP_TABLE_KEYS,
+)
+
+from .event_buffer import NoteEventBuffer
+
+from .score_exporter import (
+    render_formats,
+    export_score,
+    write_outputs,
+    collect_score_events,
+    ScoreEventIndex,
+    TrackEvents,
+    midi_file_bytes,
+    event_list,
+    parse_formats,
+    EXPORT_FORMATS,
+)
+
+from .audio_renderer import (
+    render_audio,
+    render_wav,
+    wav_bytes,
+    stream_audio,
+    stream_wav,
+    LiveEventIndex,
+    SynthVoice,
+    DrumVoice,
+    voice_for_program,
+    drum_voice_table,
+)
+
+from .tempo_map import (
+    TempoMap,
+    MeterMap,
+    build_timing_maps,
+    insert_timing_marks,
+)
+
 from .scale_registry import (
     build_scale_object,
-    ScaleRegistry
+    ScaleRegistry,
+    ScaleInfo,
+    get_scale_info,
 )
 
 from .humanizer import (
     generate_fractional_noise,
     apply_humanization_to_element,
     apply_humanization_to_part,
+    humanize_event_arrays,
     HUMANIZATION_TEMPLATES,
     NUMPY_AVAILABLE,
 )
 
 __all__ = [
-    "MIN_NOTE_DURATION_QL", "get_time_signature_object", "sanitize_chord_label", "get_music21_chord_object",
-    "build_scale_object", "ScaleRegistry",
-    "generate_fractional_noise", "apply_humanization_to_element", "apply_humanization_to_part",
+    "MIN_NOTE_DURATION_QL", "get_time_signature_object", "get_meter_info", "MeterInfo", "sanitize_chord_label", "get_music21_chord_object",
+    "ChordTimeline",
+    "MetricWeightTable", "get_metric_weight_table", "metric_weights", "metric_velocity_factors",
+    "HarmonicContext", "weight_row", "key_weight_row", "row_pc_mask",
+    "WEIGHT_CHORD_TONE", "WEIGHT_TENSION", "WEIGHT_SCALE", "WEIGHT_AVOID", "WEIGHT_OUTSIDE",
+    "load_rhythm_library", "load_rhythm_library_data", "rhythm_library_digest", "compile_rhythm_library", "compile_rhythm_library_file", "validate_rhythm_library",
+    "CompiledRhythmLibrary", "RhythmPatternArrays", "pattern_event_arrays", "RhythmLibraryError",
+    "tile_pattern", "tile_pattern_events", "bar_spans", "resolve_tiling_policy", "TiledPattern", "TILE_STRETCH", "TILE_REPEAT", "TILE_BAR",
+    "plan_section_repeats", "place_section_repeats", "section_spans", "section_fingerprint", "SectionRepeatPlan", "SectionSpan",
+    "PartParams", "intern_part_params", "strip_lookup_tables", "interned_count",
+    "compile_config", "ComposerConfig", "PartConfig", "SectionDedupConfig", "ConfigError", "LOOKUP_TABLE_KEYS",
+    "NoteEventBuffer",
+    "render_formats", "export_score", "write_outputs", "collect_score_events", "ScoreEventIndex", "TrackEvents",
+    "midi_file_bytes", "event_list", "parse_formats", "EXPORT_FORMATS",
+    "render_audio", "render_wav", "wav_bytes", "stream_audio", "stream_wav", "LiveEventIndex", "SynthVoice", "DrumVoice", "voice_for_program", "drum_voice_table",
+    "TempoMap", "MeterMap", "build_timing_maps", "insert_timing_marks",
+    "build_scale_object", "ScaleRegistry", "ScaleInfo", "get_scale_info",
+    "generate_fractional_noise", "apply_humanization_to_element", "apply_humanization_to_part", "humanize_event_arrays",
     "HUMANIZATION_TEMPLATES", "NUMPY_AVAILABLE",
 ]
 # --- END OF FILE utilities/__init__.py ---
\ No newline at end of file
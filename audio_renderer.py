@@ -0,0 +1,472 @@
+# --- START OF FILE utilities/audio_renderer.py ---
+"""audio_renderer.py
+生成したパートを DAW なしで確認するための簡易オフライン・シンセサイザー (WAV 書き出し)。
+
+- 入力は score_exporter の ScoreEventIndex (トラックごとのノート + TempoMap)。秒への変換は TempoMap.seconds_array でまとめて行う
+- 音色は GM プログラムの楽器ファミリーごとの SynthVoice (倍音の振幅から作る1周期のウェーブテーブル + ADSR)
+- ドラムは GM_DRUM_MAP (drum_generator) の名前ごとの DrumVoice (ピッチが下がるサイン波のバースト + ノイズ)
+- 波形はピッチごと、エンベロープは長さ (ENVELOPE_STEP_SEC 単位) ごと、ドラムは音色ごとに一度だけ NumPy で配列として作り、
+  各ノートは「波形 × エンベロープ × 音量」をトラックのバッファの該当区間に足すだけにする
+- トラックごとにプロセスを分けて並列に合成し (max_workers=1 なら同じプロセス)、パンを振ってステレオにミックスする
+- stream_audio / stream_wav はブロック (既定 2048 フレーム) ごとに、その区間で鳴っているノートだけを合成して順に返す/書く。
+  メモリは曲の長さによらず一定で、最初のブロックはすぐに出る (長い曲の試聴用。stdout や書き足していく WAV に書ける)
+- LiveEventIndex を渡すと、作曲中にパートが生成されるたびにそのトラックの音色と最初の先読み区間を用意しておき、
+  全パートが揃ったら (close) すぐに書き始める (書き出し処理の完了は待たない)
+- NumPy 必須 (なければ RuntimeError)
+"""
+import io
+import logging
+import os
+import struct
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+NUMPY_AVAILABLE = False
+np = None
+try:
+    import numpy
+    np = numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    logger.warning("AudioRenderer: NumPy not found. Audio rendering is disabled.")
+
+DEFAULT_SAMPLE_RATE = 44100
+WAVETABLE_SIZE = 4096
+ENVELOPE_STEP_SEC = 0.005 # エンベロープはノートの長さをこの単位に丸めて共有する
+HEADROOM_DB = -1.0
+DEFAULT_BLOCK_FRAMES = 2048 # ストリーミング時の1ブロックのフレーム数
+STREAM_MASTER_GAIN = 0.35 # ストリーミング時はピーク正規化ができないので固定ゲイン + ソフトクリップ
+STREAM_LOOKAHEAD_SEC = 2.0 # ストリーミング時にノートを秒/サンプルへ変換する先読みの長さ
+_NOISE_SEED = 20240613
+
+
+class SynthVoice(NamedTuple):
+    """旋律楽器の音色。harmonics は第1倍音からの振幅。sustain はアタック/ディケイ後の音量 (0 なら減衰音)。"""
+    harmonics: Tuple[float, ...]
+    attack: float
+    decay: float
+    sustain: float
+    release: float
+    gain: float = 1.0
+
+
+class DrumVoice(NamedTuple):
+    """ドラムの音色。トーンは freq_start から freq_end へ pitch_decay 秒で下がるサイン波。bright=True のノイズは高域寄り。"""
+    freq_start: float
+    freq_end: float
+    pitch_decay: float
+    tone: float
+    noise: float
+    decay: float
+    bright: bool = False
+    gain: float = 1.0
+
+
+# GM プログラム番号の範囲 (開始, 終了) → 音色
+PROGRAM_VOICES: Tuple[Tuple[int, int, SynthVoice], ...] = (
+    (0, 7, SynthVoice((1.0, 0.5, 0.3, 0.2, 0.1, 0.05), 0.005, 1.2, 0.15, 0.25)),            # ピアノ
+    (8, 15, SynthVoice((1.0, 0.0, 0.4, 0.0, 0.2), 0.002, 0.5, 0.0, 0.3)),                     # 鍵盤打楽器
+    (16, 23, SynthVoice((1.0, 1.0, 0.5, 0.5, 0.25, 0.25), 0.01, 0.1, 1.0, 0.05, 0.7)),        # オルガン
+    (24, 31, SynthVoice((1.0, 0.6, 0.35, 0.2, 0.12, 0.08), 0.003, 0.6, 0.05, 0.15)),          # ギター
+    (32, 39, SynthVoice((1.0, 0.5, 0.15, 0.05), 0.005, 0.9, 0.3, 0.1, 1.4)),                  # ベース
+    (40, 51, SynthVoice((1.0, 0.5, 0.33, 0.25, 0.2, 0.16, 0.14), 0.08, 0.3, 0.8, 0.3, 0.6)),  # 弦楽器/アンサンブル
+    (52, 55, SynthVoice((1.0, 0.3, 0.1, 0.05), 0.04, 0.2, 0.9, 0.15, 1.2)),                   # 声
+    (56, 79, SynthVoice((1.0, 0.4, 0.6, 0.2, 0.3), 0.03, 0.2, 0.85, 0.1, 0.8)),               # 金管/木管/笛
+    (80, 127, SynthVoice((1.0, 0.5, 0.33, 0.25, 0.2), 0.01, 0.3, 0.7, 0.2, 0.7)),             # シンセなど
+)
+DEFAULT_VOICE = PROGRAM_VOICES[0][2]
+
+# GM_DRUM_MAP の名前 → 音色 (別名 "bd"/"sd"/"hat" も GM_DRUM_MAP 経由で同じ番号になる)
+DRUM_VOICES: Dict[str, DrumVoice] = {
+    "kick": DrumVoice(150.0, 50.0, 0.03, 1.0, 0.05, 0.25, gain=1.6),
+    "snare": DrumVoice(220.0, 180.0, 0.02, 0.4, 0.7, 0.15),
+    "rim": DrumVoice(800.0, 800.0, 0.01, 0.5, 0.3, 0.03, bright=True),
+    "claps": DrumVoice(1000.0, 1000.0, 0.01, 0.0, 0.8, 0.12, bright=True),
+    "chh": DrumVoice(0.0, 0.0, 0.01, 0.0, 0.5, 0.04, bright=True),
+    "phh": DrumVoice(0.0, 0.0, 0.01, 0.0, 0.4, 0.03, bright=True),
+    "ohh": DrumVoice(0.0, 0.0, 0.01, 0.0, 0.45, 0.3, bright=True),
+    "crash": DrumVoice(0.0, 0.0, 0.01, 0.0, 0.5, 1.2, bright=True),
+    "ride": DrumVoice(3000.0, 3000.0, 0.01, 0.15, 0.35, 0.6, bright=True),
+    "lt": DrumVoice(110.0, 85.0, 0.08, 0.9, 0.1, 0.3),
+    "mt": DrumVoice(150.0, 120.0, 0.08, 0.9, 0.1, 0.3),
+    "ht": DrumVoice(200.0, 160.0, 0.08, 0.9, 0.1, 0.25),
+}
+DEFAULT_DRUM_VOICE = DrumVoice(0.0, 0.0, 0.01, 0.0, 0.4, 0.05, bright=True)
+_GM_DRUM_NUMBERS = {"kick": 36, "snare": 38, "rim": 37, "claps": 39, "chh": 42, "phh": 44, "ohh": 46,
+                    "crash": 49, "ride": 51, "lt": 41, "mt": 45, "ht": 50} # drum_generator を読めない場合の GM 番号
+
+
+def _require_numpy() -> None:
+    if not NUMPY_AVAILABLE or np is None: raise RuntimeError("Audio rendering needs NumPy.")
+
+def voice_for_program(program: int) -> SynthVoice:
+    for lo, hi, voice in PROGRAM_VOICES:
+        if lo <= program <= hi: return voice
+    return DEFAULT_VOICE
+
+@lru_cache(maxsize=1)
+def drum_voice_table() -> Dict[int, DrumVoice]:
+    """MIDI 番号 → DrumVoice。番号は GM_DRUM_MAP (drum_generator) から引く。"""
+    try:
+        from generator.drum_generator import GM_DRUM_MAP
+        numbers = {name: midi_val for name, midi_val in GM_DRUM_MAP.items() if name in DRUM_VOICES}
+    except ImportError:
+        numbers = _GM_DRUM_NUMBERS
+    return {midi_val: DRUM_VOICES[name] for name, midi_val in numbers.items()}
+
+@lru_cache(maxsize=32)
+def _wavetable(harmonics: Tuple[float, ...]) -> Any:
+    phase = np.arange(WAVETABLE_SIZE, dtype=np.float64) * (2.0 * np.pi / WAVETABLE_SIZE)
+    table = sum(amp * np.sin((h + 1) * phase) for h, amp in enumerate(harmonics) if amp)
+    return (table / max(1e-9, float(np.abs(table).max()))).astype(np.float32)
+
+
+# --- 合成 ---
+def _oscillator(table: Any, freq: float, n_samples: int, sample_rate: int) -> Any:
+    # 固定小数点 (小数部 16bit) の位相でウェーブテーブルを引く
+    inc = int(round(freq * WAVETABLE_SIZE / sample_rate * 65536))
+    return table[(np.arange(n_samples, dtype=np.int64) * inc >> 16) & (WAVETABLE_SIZE - 1)]
+
+def _adsr(voice: SynthVoice, t: Any, dur_sec: Any) -> Any:
+    # ADSR: アタックで立ち上がり、ディケイで sustain へ指数的に近づき、ノートオフ後は release 秒で直線的に消える
+    # t (ノート頭からの秒) と dur_sec は float32 のスカラーか同じ形の配列
+    held = np.minimum(t, dur_sec)
+    rise = np.minimum(np.float32(1.0), held / np.float32(voice.attack))
+    fall = np.float32(voice.sustain) + np.float32(1.0 - voice.sustain) * np.exp(-np.maximum(np.float32(0.0), held - np.float32(voice.attack)) / np.float32(voice.decay))
+    tail = np.clip(np.float32(1.0) - (t - dur_sec) / np.float32(voice.release), 0.0, 1.0)
+    return (rise * fall * tail).astype(np.float32)
+
+def _envelope(voice: SynthVoice, dur_sec: float, sample_rate: int) -> Any:
+    t = np.arange(max(1, int((dur_sec + voice.release) * sample_rate)), dtype=np.float32) / np.float32(sample_rate)
+    return _adsr(voice, t, np.float32(dur_sec))
+
+def _drum_hit(midi_val: int, voice: DrumVoice, sample_rate: int) -> Any:
+    n = max(1, int(voice.decay * 6.0 * sample_rate)) # exp(-6) で打ち切る
+    t = np.arange(n, dtype=np.float64) / sample_rate
+    # f(t) = f1 + (f0 - f1) exp(-t/τ) を積分した位相
+    phase = voice.freq_end * t + (voice.freq_start - voice.freq_end) * voice.pitch_decay * (1.0 - np.exp(-t / voice.pitch_decay))
+    noise = np.random.default_rng(_NOISE_SEED + midi_val).uniform(-1.0, 1.0, n) # 再現性のため番号ごとに固定シード
+    if voice.bright: noise = np.diff(noise, append=noise[:1]) * 0.5 # 差分で高域を強調
+    sig = voice.tone * np.sin(2.0 * np.pi * phase) + voice.noise * noise
+    return (sig * np.exp(-t / voice.decay) * voice.gain).astype(np.float32)
+
+def _render_tonal(out: Any, start_samples: Any, durs: Any, midis: Any, amps: Any, voice: SynthVoice, sample_rate: int) -> None:
+    table = _wavetable(voice.harmonics)
+    dur_bins = np.rint(durs / ENVELOPE_STEP_SEC).astype(np.int64)
+    envelopes = {b: _envelope(voice, b * ENVELOPE_STEP_SEC, sample_rate) for b in np.unique(dur_bins).tolist()}
+    longest: Dict[int, int] = {}
+    for m, b in zip(midis.tolist(), dur_bins.tolist()):
+        longest[m] = max(longest.get(m, 0), len(envelopes[b]))
+    oscillators = {m: _oscillator(table, 440.0 * 2.0 ** ((m - 69) / 12.0), n, sample_rate) for m, n in longest.items()}
+    for start, b, m, amp in zip(start_samples.tolist(), dur_bins.tolist(), midis.tolist(), amps.tolist()):
+        env = envelopes[b]; n = min(len(env), len(out) - start)
+        if n <= 0: continue
+        seg = oscillators[m][:n] * env[:n]; seg *= np.float32(amp)
+        out[start:start + n] += seg
+
+def _render_drums(out: Any, start_samples: Any, midis: Any, amps: Any, sample_rate: int) -> None:
+    table = drum_voice_table()
+    hits = {m: _drum_hit(m, table.get(m, DEFAULT_DRUM_VOICE), sample_rate) for m in np.unique(midis).tolist()}
+    for start, m, amp in zip(start_samples.tolist(), midis.tolist(), amps.tolist()):
+        hit = hits[m]; n = min(len(hit), len(out) - start)
+        if n > 0: out[start:start + n] += hit[:n] * np.float32(amp)
+
+def _render_track_task(task: Tuple[Any, ...]) -> Any:
+    """1トラックをモノラルで合成する (プロセスプールのワーカーから呼ぶのでモジュール直下に置く)。"""
+    starts, durs, midis, vels, program, is_percussion, n_samples, sample_rate = task
+    out = np.zeros(n_samples, dtype=np.float32)
+    if not len(starts): return out
+    start_samples = np.maximum(0, np.rint(starts * sample_rate).astype(np.int64))
+    amps = (vels.astype(np.float64) / 127.0) ** 1.5
+    if is_percussion: _render_drums(out, start_samples, midis, amps, sample_rate)
+    else:
+        voice = voice_for_program(program)
+        _render_tonal(out, start_samples, durs, midis, amps * voice.gain, voice, sample_rate)
+    return out
+
+
+def _track_tasks(index: Any, sample_rate: int) -> Tuple[List[Tuple[Any, ...]], int]:
+    tmap = index.tempo_map
+    tail = max([v.release for _, _, v in PROGRAM_VOICES] + [v.decay * 6.0 for v in DRUM_VOICES.values()])
+    n_samples = int((tmap.seconds(index.duration_ql) + tail + 0.1) * sample_rate) + 1
+    tasks = []
+    for track in index.tracks:
+        arr = np.array([n[:4] for n in track.notes], dtype=np.float64).reshape(-1, 4)
+        starts = np.asarray(tmap.seconds_array(arr[:, 0]))
+        durs = np.maximum(0.0, np.asarray(tmap.seconds_array(arr[:, 0] + arr[:, 1])) - starts)
+        tasks.append((starts, durs, arr[:, 2].astype(np.int64), arr[:, 3], track.program, track.is_percussion, n_samples, sample_rate))
+    return tasks, n_samples
+
+def _pans(tracks: Sequence[Any]) -> List[float]:
+    # ドラム/ベースは中央、それ以外は左右に交互に振る (-1.0 = 左, 1.0 = 右)
+    pans: List[float] = []; k = 0
+    for track in tracks:
+        if track.is_percussion or 32 <= track.program <= 39: pans.append(0.0); continue
+        pans.append((0.35 + 0.15 * (k // 2 % 2)) * (-1.0 if k % 2 == 0 else 1.0)); k += 1
+    return pans
+
+def render_audio(index: Any, sample_rate: int = DEFAULT_SAMPLE_RATE, max_workers: Optional[int] = None) -> Any:
+    """ScoreEventIndex をステレオ (n_samples, 2) の float32 配列に合成する。トラックごとにプロセスを分ける (既定は CPU 数まで)。"""
+    _require_numpy()
+    tasks, n_samples = _track_tasks(index, sample_rate)
+    workers = min(len(tasks), max_workers or os.cpu_count() or 1)
+    if workers <= 1:
+        tracks = [_render_track_task(task) for task in tasks]
+    else:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                tracks = list(pool.map(_render_track_task, tasks))
+        except (OSError, RuntimeError) as e: # プロセスを作れない環境 (サンドボックスなど) では同じプロセスで合成する
+            logger.warning(f"AudioRenderer: Process pool unavailable ({e}). Rendering tracks serially.")
+            tracks = [_render_track_task(task) for task in tasks]
+    mix = np.zeros((n_samples, 2), dtype=np.float32)
+    for mono, pan in zip(tracks, _pans(index.tracks)):
+        angle = (pan + 1.0) * np.pi / 4.0 # 等パワーのパン
+        mix[:, 0] += mono * np.float32(np.cos(angle)); mix[:, 1] += mono * np.float32(np.sin(angle))
+    peak = float(np.abs(mix).max()) if n_samples else 0.0
+    if peak > 0: mix *= np.float32(10 ** (HEADROOM_DB / 20.0) / peak)
+    return mix
+
+def wav_bytes(audio: Any, sample_rate: int = DEFAULT_SAMPLE_RATE) -> bytes:
+    """float の (n_samples, channels) 配列 → 16bit PCM の WAV。"""
+    _require_numpy()
+    pcm = np.clip(np.rint(np.asarray(audio) * 32767.0), -32768, 32767).astype("<i2")
+    channels = 1 if pcm.ndim == 1 else pcm.shape[1]
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav_file:
+        wav_file.setnchannels(channels); wav_file.setsampwidth(2); wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+    return buf.getvalue()
+
+def render_wav(index: Any, sample_rate: int = DEFAULT_SAMPLE_RATE, max_workers: Optional[int] = None) -> bytes:
+    return wav_bytes(render_audio(index, sample_rate, max_workers), sample_rate)
+
+
+# --- ストリーミング (ブロック単位) ---
+_EVENT_FIELDS = ("starts", "ends", "durs", "incs", "amps", "gains_l", "gains_r", "voice")
+
+def _pan_gains(pan: float) -> Tuple[float, float]:
+    angle = (pan + 1.0) * np.pi / 4.0 # 等パワーのパン
+    return float(np.cos(angle)), float(np.sin(angle))
+
+def _empty_events() -> Dict[str, Any]:
+    return {f: np.zeros(0, dtype=np.int64 if f in ("starts", "ends", "incs", "voice") else np.float64) for f in _EVENT_FIELDS}
+
+def _take(events: Dict[str, Any], sel: Any) -> Dict[str, Any]:
+    return {f: events[f][sel] for f in _EVENT_FIELDS}
+
+def _concat(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    return {f: np.concatenate((a[f], b[f])) for f in _EVENT_FIELDS}
+
+
+class LiveEventIndex:
+    """
+    作曲中に生成し終わったパートのトラックを受け取る、stream_audio / stream_wav 用の索引 (スレッド間で共有する)。
+    set_timing(tempo_map, meter_map) → add_tracks(tracks) (パートごと) → close() の順に呼ぶ。
+    ストリーム側は届いたトラックを先に準備し、ブロックを書き始めるのは close の後 (後から届くパートも同じ区間で鳴るため)。
+    """
+    def __init__(self):
+        self.tempo_map: Any = None
+        self.meter_map: Any = None
+        self._tracks: List[Any] = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def set_timing(self, tempo_map: Any, meter_map: Any) -> None:
+        with self._cond: self.tempo_map, self.meter_map = tempo_map, meter_map
+
+    def add_tracks(self, tracks: Sequence[Any]) -> None:
+        with self._cond:
+            if self._closed: raise RuntimeError("LiveEventIndex is already closed.")
+            if self.tempo_map is None: raise RuntimeError("LiveEventIndex.set_timing must be called before add_tracks.")
+            self._tracks.extend(tracks); self._cond.notify_all()
+
+    def close(self) -> None:
+        """これ以上トラックは来ない (何度呼んでもよい)。"""
+        with self._cond: self._closed = True; self._cond.notify_all()
+
+    @property
+    def tracks(self) -> Tuple[Any, ...]:
+        with self._cond: return tuple(self._tracks)
+
+    def wait_tracks(self, known: int) -> Tuple[List[Any], bool]:
+        """known 本目以降のトラックが届くか close されるまで待ち、(新しいトラック, close 済みか) を返す。"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or len(self._tracks) > known)
+            return self._tracks[known:], self._closed
+
+
+class _EventFeed:
+    """トラックのノートを先読み区間 (STREAM_LOOKAHEAD_SEC) ずつサンプル位置に変換し、開始順の配列で渡す (曲全体を一度に変換しない)。"""
+    __slots__ = ("index", "sample_rate", "tracks", "pans", "cursors", "pending", "voices", "voice_midis", "voice_ids", "tables", "hits", "loaded_until", "done")
+
+    def __init__(self, index: Any, sample_rate: int):
+        self.index = index; self.sample_rate = sample_rate
+        self.tracks: List[Any] = []; self.pans: List[Tuple[float, float]] = []; self.cursors: List[int] = []
+        self.pending = _empty_events() # 最初の先読み区間のうち、トラックが届いた時点で変換済みの分
+        self.voices: List[Any] = []; self.voice_midis: List[int] = []; self.voice_ids: Dict[Any, int] = {}
+        self.tables: Dict[int, Any] = {}; self.hits: Dict[int, Any] = {} # 音色ごとのウェーブテーブル/ドラムの1打 (初めて使うときに作る)
+        self.loaded_until = 0 # このサンプル位置より前に始まるノートは変換済み
+        self.done = True
+
+    def wait_all_tracks(self) -> None:
+        """全トラックを取り込む。LiveEventIndex なら close されるまで、届いたトラックから順に準備しながら待つ。"""
+        wait = getattr(self.index, "wait_tracks", None)
+        if wait is None: self._add_tracks(self.index.tracks)
+        else:
+            closed = False
+            while not closed:
+                new_tracks, closed = wait(len(self.tracks)); self._add_tracks(new_tracks)
+        self.done = not any(t.notes for t in self.tracks)
+
+    def _add_tracks(self, tracks: Sequence[Any]) -> None:
+        if not tracks: return
+        first = len(self.tracks)
+        self.tracks.extend(tracks); self.cursors.extend([0] * len(tracks))
+        self.pans = [_pan_gains(p) for p in _pans(self.tracks)]
+        # 最初の先読み区間のノートはここで変換しておく (音色の波形もこのとき作られる)
+        ql_end = self._window_end()[1]
+        for t_idx in range(first, len(self.tracks)):
+            notes = self.tracks[t_idx].notes; c1 = 0
+            while c1 < len(notes) and notes[c1][0] < ql_end: c1 += 1
+            self.cursors[t_idx] = c1
+            if c1:
+                converted = self._convert(t_idx, notes[:c1]); self.pending = _concat(self.pending, converted)
+                for vid in set(converted["voice"].tolist()): self.waveform(vid)
+
+    def _window_end(self) -> Tuple[float, float]:
+        """次の先読み区間の終わり (秒, ql)。"""
+        sec_end = (self.loaded_until + STREAM_LOOKAHEAD_SEC * self.sample_rate) / self.sample_rate
+        return sec_end, self.index.tempo_map.offset_at(sec_end)
+
+    def _voice_id(self, key: Any, voice: Any, midi_val: int = 0) -> int:
+        vid = self.voice_ids.get(key)
+        if vid is None:
+            vid = self.voice_ids[key] = len(self.voices); self.voices.append(voice); self.voice_midis.append(midi_val)
+        return vid
+
+    def waveform(self, vid: int) -> Any:
+        voice = self.voices[vid]
+        if isinstance(voice, SynthVoice):
+            if vid not in self.tables: self.tables[vid] = _wavetable(voice.harmonics)
+            return self.tables[vid]
+        if vid not in self.hits: self.hits[vid] = _drum_hit(self.voice_midis[vid], voice, self.sample_rate)
+        return self.hits[vid]
+
+    def _convert(self, track_idx: int, notes: Sequence[Tuple[Any, ...]]) -> Dict[str, Any]:
+        track = self.tracks[track_idx]; tmap = self.index.tempo_map; sr = self.sample_rate
+        arr = np.array([n[:4] for n in notes], dtype=np.float64).reshape(-1, 4)
+        starts = np.asarray(tmap.seconds_array(arr[:, 0]))
+        durs = np.maximum(0.0, np.asarray(tmap.seconds_array(arr[:, 0] + arr[:, 1])) - starts)
+        midis = arr[:, 2].astype(np.int64)
+        amps = (arr[:, 3] / 127.0) ** 1.5
+        if track.is_percussion:
+            drum_table = drum_voice_table()
+            vid = np.array([self._voice_id(("drum", m), drum_table.get(m, DEFAULT_DRUM_VOICE), m) for m in midis.tolist()], dtype=np.int64)
+            lengths = np.array([self.voices[v].decay * 6.0 for v in vid.tolist()])
+            amps = amps * np.array([self.voices[v].gain for v in vid.tolist()])
+            incs = np.zeros(len(midis), dtype=np.int64)
+        else:
+            voice = voice_for_program(track.program)
+            vid = np.full(len(midis), self._voice_id(voice, voice), dtype=np.int64)
+            lengths = durs + voice.release
+            amps = amps * voice.gain
+            incs = np.rint(440.0 * 2.0 ** ((midis - 69) / 12.0) * WAVETABLE_SIZE / sr * 65536).astype(np.int64)
+        start_samples = np.maximum(0, np.rint(starts * sr).astype(np.int64))
+        gain_l, gain_r = self.pans[track_idx]
+        return {"starts": start_samples, "ends": start_samples + np.maximum(1, (lengths * sr).astype(np.int64)), "durs": durs,
+                "incs": incs, "amps": amps, "gains_l": np.full(len(midis), gain_l), "gains_r": np.full(len(midis), gain_r), "voice": vid}
+
+    def next_chunk(self) -> Dict[str, Any]:
+        """次の先読み区間に始まるノート (開始サンプル順)。"""
+        sec_end, ql_end = self._window_end()
+        chunk = self.pending; remaining = False; self.pending = _empty_events()
+        for t_idx, track in enumerate(self.tracks):
+            c0 = c1 = self.cursors[t_idx]; notes = track.notes
+            while c1 < len(notes) and notes[c1][0] < ql_end: c1 += 1
+            self.cursors[t_idx] = c1
+            if c1 < len(notes): remaining = True
+            if c1 > c0: chunk = _concat(chunk, self._convert(t_idx, notes[c0:c1]))
+        self.loaded_until = max(self.loaded_until, int(sec_end * self.sample_rate) - 1) # 丸め誤差の分だけ控えめに
+        self.done = not remaining
+        return _take(chunk, np.argsort(chunk["starts"], kind="stable"))
+
+
+def stream_audio(index: Any, sample_rate: int = DEFAULT_SAMPLE_RATE, block_frames: int = DEFAULT_BLOCK_FRAMES,
+                 master_gain: float = STREAM_MASTER_GAIN) -> Iterator[Any]:
+    """
+    ScoreEventIndex を block_frames ずつのステレオ float32 配列 (block_frames, 2) として順に返す。
+    ノートは先読み区間ずつ変換し、各ブロックではその区間で鳴っているノートだけを合成するので、
+    曲の長さによらずメモリは一定で最初のブロックもすぐに出る。
+    全体のピークが分からないので、正規化の代わりに master_gain と tanh のソフトクリップで音量を揃える。
+    index が LiveEventIndex なら、届いたトラックを準備しながら close を待ってから最初のブロックを返す。
+    """
+    _require_numpy()
+    feed = _EventFeed(index, sample_rate)
+    feed.wait_all_tracks()
+    queue = _empty_events(); active = _empty_events()
+    sr = np.float32(sample_rate); b0 = 0
+    while True:
+        b1 = b0 + block_frames
+        while not feed.done and feed.loaded_until < b1: queue = _concat(queue, feed.next_chunk())
+        # このブロックで始まるノートを加え、鳴り終わったノートを外す
+        n_new = int(np.searchsorted(queue["starts"], b1, side="left"))
+        if n_new:
+            active = _concat(active, _take(queue, slice(0, n_new))); queue = _take(queue, slice(n_new, None))
+            active = _take(active, np.argsort(active["voice"], kind="stable")) # 音色ごとに連続させて、合成をスライスで済ませる
+        active = _take(active, active["ends"] > b0)
+        if not len(active["starts"]) and not len(queue["starts"]) and feed.done: return
+        block = np.zeros((block_frames, 2), dtype=np.float32)
+        if len(active["starts"]):
+            seg_start = np.maximum(active["starts"], b0); lengths = np.minimum(active["ends"], b1) - seg_start
+            note_idx = np.repeat(np.arange(len(lengths)), lengths)
+            first = np.cumsum(lengths) - lengths
+            pos = np.arange(int(lengths.sum()), dtype=np.int64) - first[note_idx] + (seg_start - b0)[note_idx] # ブロック内の位置
+            local = pos + b0 - active["starts"][note_idx] # ノート頭からのサンプル位置
+            sig = np.empty(len(pos), dtype=np.float32)
+            voice_ids, group_first = np.unique(active["voice"], return_index=True)
+            group_bounds = np.append(first[group_first], len(pos)).tolist()
+            for k, vid in enumerate(voice_ids.tolist()):
+                sel = slice(group_bounds[k], group_bounds[k + 1]); voice = feed.voices[vid]; wave_arr = feed.waveform(vid); loc = local[sel]
+                if isinstance(voice, SynthVoice):
+                    sig[sel] = wave_arr[(loc * active["incs"][note_idx[sel]] >> 16) & (WAVETABLE_SIZE - 1)] * _adsr(voice, loc.astype(np.float32) / sr, active["durs"][note_idx[sel]].astype(np.float32))
+                else:
+                    sig[sel] = wave_arr[np.minimum(loc, len(wave_arr) - 1)]
+            sig *= active["amps"][note_idx].astype(np.float32)
+            block[:, 0] = np.bincount(pos, weights=sig * active["gains_l"][note_idx], minlength=block_frames)[:block_frames]
+            block[:, 1] = np.bincount(pos, weights=sig * active["gains_r"][note_idx], minlength=block_frames)[:block_frames]
+        yield np.tanh(block * np.float32(master_gain))
+        b0 = b1
+
+def _wav_header(sample_rate: int, channels: int, n_frames: Optional[int]) -> bytes:
+    # n_frames が分からない (パイプに書く) 場合はサイズ欄を最大値にしておく
+    data_size = n_frames * channels * 2 if n_frames is not None else 0xFFFFFFFF - 36
+    return (b"RIFF" + struct.pack("<I", min(0xFFFFFFFF, 36 + data_size)) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16)
+            + b"data" + struct.pack("<I", data_size))
+
+def stream_wav(index: Any, fp: BinaryIO, sample_rate: int = DEFAULT_SAMPLE_RATE, block_frames: int = DEFAULT_BLOCK_FRAMES,
+               master_gain: float = STREAM_MASTER_GAIN) -> int:
+    """
+    stream_audio のブロックを 16bit WAV として fp (ファイルや sys.stdout.buffer) に順に書き、書いたフレーム数を返す。
+    fp がシークできればヘッダーのサイズを最後に書き直す (できなければサイズ欄は最大値のまま)。
+    """
+    seekable = False
+    try:
+        header_pos = fp.tell(); seekable = fp.seekable()
+    except (AttributeError, OSError):
+        pass
+    fp.write(_wav_header(sample_rate, 2, None))
+    n_frames = 0
+    for block in stream_audio(index, sample_rate, block_frames, master_gain):
+        fp.write(np.clip(np.rint(block * 32767.0), -32768, 32767).astype("<i2").tobytes())
+        fp.flush(); n_frames += len(block)
+    if seekable:
+        end_pos = fp.tell(); fp.seek(header_pos); fp.write(_wav_header(sample_rate, 2, n_frames)); fp.seek(end_pos)
+    return n_frames
+# --- END OF FILE utilities/audio_renderer.py ---
@@ -3,29 +3,23 @@ from __future__ import annotations
 """bass_generator.py – streamlined rewrite
 Generates a **bass part** for the modular composer pipeline.
 The heavy lifting (walking line, root-fifth, etc.) is delegated to
-generator.bass_utils.generate_bass_measure so that this class
-mainly decides **which style to use when**.
+generator.bass_utils.generate_bass_pitches (integer MIDI numbers) so that
+this class mainly decides **which style to use when**; music21 Notes are
+only created when the pitches are placed on the rhythm pattern.
 """
 from typing import Sequence, Dict, Any, Optional, List, Union
 import random
 import logging
 
-from music21 import stream, harmony, note, tempo, meter, instrument as m21instrument, key # keyを追加
+from music21 import stream, harmony, note, volume, instrument as m21instrument, key # keyを追加
 
 # ユーティリティのインポート
-try:
-    from .bass_utils import generate_bass_measure # 同じディレクトリなので相対インポート
-    from utilities.core_music_utils import get_time_signature_object, sanitize_chord_label, MIN_NOTE_DURATION_QL
-    from utilities.humanizer import apply_humanization_to_part, HUMANIZATION_TEMPLATES
-except ImportError as e:
-    logger_fallback = logging.getLogger(__name__ + ".fallback_utils")
-    logger_fallback.error(f"BassGenerator: Failed to import required modules: {e}")
-    # ダミー関数でフォールバック
-    def generate_bass_measure(*args, **kwargs) -> List[note.Note]: return []
-    def apply_humanization_to_part(part, *args, **kwargs) -> stream.Part: return part # type: ignore
-    def get_time_signature_object(ts_str: Optional[str]) -> meter.TimeSignature: return meter.TimeSignature("4/4")
-    MIN_NOTE_DURATION_QL = 0.125
-    HUMANIZATION_TEMPLATES = {}
+from .bass_utils import generate_bass_pitches, walking_lookahead_line, chord_tones_from_symbol, pc_to_midi, DEFAULT_LOOKAHEAD_BLOCKS, DEFAULT_BEAM_WIDTH # 同じディレクトリなので相対インポート
+from utilities.core_music_utils import get_meter_info, MIN_NOTE_DURATION_QL
+from utilities.humanizer import apply_humanization_to_part
+from utilities.tempo_map import MeterMap
+from utilities.chord_timeline import ChordTimeline
+from utilities.rhythm_tiler import tile_pattern_events, resolve_tiling_policy, TILE_STRETCH # NumPy がなくても動く (ループ版)
 
 
 logger = logging.getLogger(__name__)
@@ -45,7 +39,7 @@ class BassGenerator:
         self.default_instrument = default_instrument
         self.global_tempo = global_tempo
         self.global_time_signature_str = global_time_signature
-        self.global_time_signature_obj = get_time_signature_object(global_time_signature)
+        self.global_meter = get_meter_info(global_time_signature)
         self.global_key_tonic = global_key_tonic
         self.global_key_mode = global_key_mode
         self.rng = rng or random.Random()
@@ -72,87 +66,114 @@ class BassGenerator:
         if intensity in {"medium"}: return "root_fifth"
         return "walking"
 
-    def compose(self, processed_blocks: Sequence[Dict[str, Any]]) -> stream.Part:
+    def _block_meter(self, blk_data: Dict[str, Any]) -> Any:
+        return get_meter_info(blk_data.get("time_signature") or self.global_time_signature_str)
+
+    def _tile_block_rhythm(self, blk_data: Dict[str, Any], bass_params: Dict[str, Any]) -> Any:
+        """ブロックのリズムパターンをブロック長とブロックの拍子の小節長で敷き詰める。"""
+        rhythm_key = bass_params.get("rhythm_key", "bass_quarter_notes")
+        rhythm_details = self.rhythm_library.get(rhythm_key, self.rhythm_library.get("bass_quarter_notes"))
+        # 既定はパターン全体 (reference_duration_ql) をブロック長に伸縮。"rhythm_tiling" で repeat / bar も選べる
+        return tile_pattern_events(
+            rhythm_details.get("pattern", []), blk_data.get("q_length", 4.0), resolve_tiling_policy(bass_params.get("rhythm_tiling"), TILE_STRETCH),
+            reference_duration_ql=rhythm_details.get("reference_duration_ql", 4.0), bar_ql=self._block_meter(blk_data).bar_ql,
+            min_duration_ql=MIN_NOTE_DURATION_QL / 2)
+
+    def _precompute_lookahead_lines(self, processed_blocks: Sequence[Dict[str, Any]], block_tones: Sequence[Any],
+                                    weights: Any, block_rhythms: Sequence[Any]) -> Dict[int, List[int]]:
+        """
+        'walking_lookahead' スタイルのブロックを、隣り合うブロックの連なり (run) ごとに一本のラインとして先に計算する
+        (ブロックindex -> MIDI 番号リスト)。run の最後は直後のブロックのコードへアプローチする。
+        1ブロックの音数はブロック長と拍子で敷き詰めたリズムのイベント数に合わせる (最終音がアプローチ音になるように)。
+        weights は HarmonicContext の (ブロック数 × 128) 重み行列で、run ごとに行をスライスして渡す。
+        """
+        runs: List[List[int]] = []
+        for i, blk_data in enumerate(processed_blocks):
+            bass_params = blk_data.get("part_params", {}).get("bass", {})
+            if not (bass_params and block_tones[i] is not None and self._select_style(bass_params, blk_data.get("musical_intent", {})) == "walking_lookahead"):
+                continue
+            if runs and runs[-1][-1] == i - 1: runs[-1].append(i)
+            else: runs.append([i])
+        lines: Dict[int, List[int]] = {}
+        for run in runs:
+            params_list = [processed_blocks[i]["part_params"]["bass"] for i in run]
+            after_idx = run[-1] + 1
+            tones_after = block_tones[after_idx] if after_idx < len(block_tones) else None
+            try:
+                line = walking_lookahead_line(
+                    [block_tones[i] for i in run],
+                    weights[run[0]:run[-1] + 1],
+                    [bp.get("octave", bp.get("bass_target_octave", 2)) for bp in params_list],
+                    lookahead=[bp.get("lookahead_blocks", DEFAULT_LOOKAHEAD_BLOCKS) for bp in params_list],
+                    beam_width=[bp.get("beam_width", DEFAULT_BEAM_WIDTH) for bp in params_list],
+                    notes_per_block=[len(block_rhythms[i].offsets) for i in run],
+                    rng=self.rng, tones_after=tones_after)
+            except Exception as e_wl:
+                logger.error(f"BassGenerator: Error in walking_lookahead_line: {e_wl}. Falling back to per-block styles.")
+                continue
+            lines.update(zip(run, line))
+        return lines
+
+    def _block_chord_tones(self, chord_timeline: ChordTimeline) -> List[Any]:
+        """ブロックごとの ChordTones。ChordTimeline のパース済みコードを使い、同じコードオブジェクトは一度だけ変換する。"""
+        tones_by_id: Dict[int, Any] = {}
+        block_tones: List[Any] = []
+        for cs in chord_timeline.chords:
+            if cs is None: block_tones.append(None); continue
+            if id(cs) not in tones_by_id: tones_by_id[id(cs)] = chord_tones_from_symbol(cs)
+            block_tones.append(tones_by_id[id(cs)])
+        return block_tones
+
+    def compose(self, processed_blocks: Sequence[Dict[str, Any]], chord_timeline: Optional[ChordTimeline] = None) -> stream.Part:
         bass_part = stream.Part(id="Bass")
         bass_part.insert(0, self.default_instrument)
-        bass_part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-        bass_part.insert(0, self.global_time_signature_obj.clone())
         # グローバルキーをパートの最初に設定 (または最初のブロックのキー)
         first_block_tonic = processed_blocks[0].get("tonic_of_section", self.global_key_tonic) if processed_blocks else self.global_key_tonic
         first_block_mode = processed_blocks[0].get("mode", self.global_key_mode) if processed_blocks else self.global_key_mode
         bass_part.insert(0, key.Key(first_block_tonic, first_block_mode))
 
         current_total_offset = 0.0
+        if chord_timeline is None: chord_timeline = ChordTimeline.from_blocks(processed_blocks)
+        block_tones = self._block_chord_tones(chord_timeline)
+        weights = chord_timeline.harmonic_context().weights # (ブロック数 × 128) の重み行列 (曲全体で一度だけ作られる)
+        block_rhythms = [self._tile_block_rhythm(blk_data, blk_data.get("part_params", {}).get("bass", {})) if blk_data.get("part_params", {}).get("bass") and block_tones[i] is not None else None
+                         for i, blk_data in enumerate(processed_blocks)]
+        lookahead_lines = self._precompute_lookahead_lines(processed_blocks, block_tones, weights, block_rhythms)
 
         for i, blk_data in enumerate(processed_blocks):
+            block_q_length = blk_data.get("q_length", 4.0)
+            block_offset = blk_data.get("offset", current_total_offset)
+            current_total_offset = block_offset + block_q_length
             bass_params = blk_data.get("part_params", {}).get("bass", {})
-            if not bass_params:
-                current_total_offset += blk_data.get("q_length", 0.0)
+            tones_now = block_tones[i]
+            if not bass_params or tones_now is None:
                 continue
 
-            chord_label_str = blk_data.get("chord_label", "C")
-            block_q_length = blk_data.get("q_length", 4.0)
             musical_intent = blk_data.get("musical_intent", {})
-            
             selected_style = self._select_style(bass_params, musical_intent)
-            
-            cs_now = get_music21_chord_object(chord_label_str) # sanitize_chord_label は内部で呼ばれる
-            if cs_now is None:
-                current_total_offset += block_q_length
-                continue
-
-            cs_next = None
-            if i + 1 < len(processed_blocks):
-                cs_next = get_music21_chord_object(processed_blocks[i+1].get("chord_label"))
-            if cs_next is None: cs_next = cs_now
+            tones_next = block_tones[i + 1] if i + 1 < len(block_tones) else None
 
-            tonic = blk_data.get("tonic_of_section", self.global_key_tonic)
-            mode = blk_data.get("mode", self.global_key_mode)
             target_octave = bass_params.get("octave", bass_params.get("bass_target_octave", 2))
             base_velocity = bass_params.get("velocity", bass_params.get("bass_velocity", 70))
+            root_midi = pc_to_midi(tones_now.root, target_octave)
 
-            # --- bass_utils を使って1小節分のベース音符ピッチリストを取得 ---
-            # generate_bass_measure はピッチのリストを返すように bass_utils を修正した想定
-            measure_pitches_template: List[pitch.Pitch] = []
+            # --- bass_utils で1ブロック分のピッチ (MIDI 番号) を取得 ---
             try:
-                # generate_bass_measure が List[note.Note] を返す場合、ピッチだけ取り出す
-                temp_notes = generate_bass_measure(style=selected_style, cs_now=cs_now, cs_next=cs_next, tonic=tonic, mode=mode, octave=target_octave)
-                measure_pitches_template = [n.pitch for n in temp_notes if isinstance(n, note.Note)]
+                if i in lookahead_lines: measure_midis: List[int] = lookahead_lines[i]
+                else: measure_midis = generate_bass_pitches(selected_style, tones_now, tones_next, weights[i], target_octave, self.rng)
             except Exception as e_gbm:
-                logger.error(f"BassGenerator: Error in generate_bass_measure for style '{selected_style}': {e_gbm}. Using root note.")
-                measure_pitches_template = [cs_now.root().transpose((target_octave - cs_now.root().octave) * 12)] * 4
-
+                logger.error(f"BassGenerator: Error in generate_bass_pitches for style '{selected_style}': {e_gbm}. Using root note.")
+                measure_midis = [root_midi] * 4
+            if not measure_midis: measure_midis = [root_midi] # ピッチ候補がなければルート音
 
             # --- リズムパターンに基づいてノートを配置 ---
-            rhythm_key = bass_params.get("rhythm_key", "bass_quarter_notes")
-            rhythm_details = self.rhythm_library.get(rhythm_key, self.rhythm_library.get("bass_quarter_notes"))
-            
-            pattern_events = rhythm_details.get("pattern", [])
-            pattern_ref_duration = rhythm_details.get("reference_duration_ql", 4.0) # パターンの基準長
-
-            pitch_idx = 0
-            for event_data in pattern_events:
-                event_offset_ratio = event_data.get("offset", 0.0) / pattern_ref_duration
-                event_duration_ratio = event_data.get("duration", 1.0) / pattern_ref_duration
-                
-                abs_event_offset = current_total_offset + (event_offset_ratio * block_q_length)
-                actual_event_duration = event_duration_ratio * block_q_length
-                
-                if actual_event_duration < MIN_NOTE_DURATION_QL / 2: continue
-
-                if measure_pitches_template:
-                    current_pitch = measure_pitches_template[pitch_idx % len(measure_pitches_template)]
-                    pitch_idx += 1
-                else: # ピッチ候補がなければルート音
-                    current_pitch = cs_now.root().transpose((target_octave - cs_now.root().octave) * 12)
-
-                n = note.Note(current_pitch)
+            tiled = block_rhythms[i]
+            for pitch_idx, (event_offset, actual_event_duration, vel_factor, _, _) in enumerate(tiled.rows()):
+                # ここで初めて music21 の Note (と Pitch) を作る
+                n = note.Note(measure_midis[pitch_idx % len(measure_midis)])
                 n.quarterLength = actual_event_duration
-                vel_factor = event_data.get("velocity_factor", 1.0)
-                n.volume = m21instrument.Volume(velocity=int(base_velocity * vel_factor))
-                bass_part.insert(abs_event_offset, n)
-
-            current_total_offset += block_q_length
+                n.volume = volume.Volume(velocity=max(1, min(127, int(base_velocity * vel_factor))))
+                bass_part.insert(block_offset + event_offset, n)
 
         # --- パート全体にヒューマナイゼーションを適用 ---
         # modular_composer から渡されるパラメータに基づいて適用
@@ -166,12 +187,11 @@ class BassGenerator:
                 if (k.startswith("bass_humanize_") or k.startswith("humanize_")) and not k.endswith("_template") and not k.endswith("humanize")
             }
             logger.info(f"BassGenerator: Applying humanization with template '{h_template}' and params {h_custom}")
-            bass_part = apply_humanization_to_part(bass_part, template_name=h_template, custom_params=h_custom)
+            bass_part = apply_humanization_to_part(bass_part, template_name=h_template, custom_params=h_custom,
+                                                   meter_map=MeterMap.from_blocks(processed_blocks, self.global_meter.ts_str))
             # IDやグローバル要素が失われる可能性があるので再設定
             bass_part.id = "Bass"
-            if not bass_part.getElementsByClass(instrument.Instrument).first(): bass_part.insert(0, self.default_instrument)
-            if not bass_part.getElementsByClass(tempo.MetronomeMark).first(): bass_part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-            if not bass_part.getElementsByClass(meter.TimeSignature).first(): bass_part.insert(0, self.global_time_signature_obj.clone())
+            if not bass_part.getElementsByClass(m21instrument.Instrument).first(): bass_part.insert(0, self.default_instrument)
             if not bass_part.getElementsByClass(key.Key).first(): bass_part.insert(0, key.Key(first_block_tonic, first_block_mode))
 
 
@@ -1,42 +1,282 @@
-# --- START OF FILE generator/bass_utils.py (インポート修正版) ---
+# --- START OF FILE generator/bass_utils.py (整数ピッチクラス版) ---
 from __future__ import annotations
 """bass_utils.py
 Low-level helpers for *bass line generation*.
-... (docstringは変更なし) ...
+
+ベースラインのスタイルはすべて整数 MIDI 番号と HarmonicContext の重み行列の行 (128 音分) の上で計算し、
+ブロックごとにピッチ (MIDI 番号) のリストを返す。music21 の Pitch / Note は
+呼び出し側 (BassGenerator) がノートを実体化するときにだけ作る。
 """
 
-from typing import List, Sequence, Optional # Optional を追加
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Union # Optional を追加
+from functools import lru_cache
 import random as _rand # random を _rand としてインポート (melody_utils との整合性)
 import logging
 
-from music21 import note, pitch, harmony, interval
+from music21 import note, pitch, harmony
+
+logger = logging.getLogger(__name__)
+
+NUMPY_AVAILABLE = False
+np = None
+try:
+    import numpy
+    np = numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    logger.warning("BassUtils: NumPy not found. 'walking_lookahead' falls back to the one-bar walking line.")
 
 # utilities パッケージからスケール関連機能をインポート
 try:
     # ScaleRegistry クラスの get 静的メソッドを使用
     from utilities.scale_registry import ScaleRegistry as SR
+    from utilities.core_music_utils import get_music21_chord_object
 except ImportError:
     logger.error("BassUtils: Could not import ScaleRegistry from utilities. Scale-aware functions might fail.")
     # フォールバック用のダミーScaleRegistry
     class SR:
         @staticmethod
-        def get(tonic_str: Optional[str], mode_str: Optional[str]) -> pitch.Pitch: # 戻り値を scale.ConcreteScale にすべき
+        def get(tonic_str: Optional[str], mode_str: Optional[str]):
             from music21 import scale as m21_scale, pitch as m21_pitch # music21のインポートをここで行う
             logger.warning("BassUtils: Using dummy ScaleRegistry.get(). This may not produce correct scales.")
             return m21_scale.MajorScale(m21_pitch.Pitch(tonic_str or "C"))
-        # mode_tensions や avoid_degrees もダミーが必要ならここに追加
+    def get_music21_chord_object(chord_label_str: Optional[str]) -> Optional[harmony.ChordSymbol]:
+        try: return harmony.ChordSymbol(chord_label_str) if chord_label_str else None
+        except Exception: return None
 
-logger = logging.getLogger(__name__)
+from utilities.harmonic_context import WEIGHT_CHORD_TONE, WEIGHT_OUTSIDE, key_weight_row, weight_row
 
-# --- (以降の関数定義は変更なし、SR.get の呼び出しは既に適切) ---
 
-# approach_note 関数 (変更なし)
-def approach_note(cur_root: pitch.Pitch, next_root: pitch.Pitch, direction: int | None = None) -> pitch.Pitch:
+class ChordTones(NamedTuple):
+    """ベース生成に必要なコード情報を整数だけで保持する。"""
+    root: int   # ルートのピッチクラス (0-11)
+    third: int  # 3度のピッチクラス (なければルート)
+    fifth: int  # 5度のピッチクラス (なければルート)
+    mask: int   # 構成音の 12bit ピッチクラスマスク
+    has_fifth: bool
+
+
+def pc_to_midi(pc: int, octave: int) -> int:
+    """ピッチクラスを music21 のオクターブ番号 (C4 = 60) の MIDI 番号にする。"""
+    return pc % 12 + 12 * (octave + 1)
+
+def pcs_to_mask(pcs: Sequence[int]) -> int:
+    mask = 0
+    for pc in pcs: mask |= 1 << (pc % 12)
+    return mask
+
+
+def chord_tones_from_symbol(cs: harmony.ChordSymbol) -> ChordTones:
+    root_pc = cs.root().pitchClass
+    third_pc = cs.third.pitchClass if cs.third else root_pc # thirdがない場合へのフォールバック
+    fifth_pc = cs.fifth.pitchClass if cs.fifth else root_pc # fifthがない場合へのフォールバック
+    return ChordTones(root_pc, third_pc, fifth_pc, pcs_to_mask([p.pitchClass for p in cs.pitches]), cs.fifth is not None)
+
+@lru_cache(maxsize=512)
+def chord_tones_from_label(chord_label: Optional[str]) -> Optional[ChordTones]:
+    """コードラベルから ChordTones を取得 (ラベルごとに一度だけパース)。休符・パース不能なら None。"""
+    cs = get_music21_chord_object(chord_label)
+    return chord_tones_from_symbol(cs) if cs is not None else None
+
+def key_weights_for(tones: ChordTones, tonic: Optional[str], mode: Optional[str]) -> Sequence[float]:
+    """HarmonicContext を持たない呼び出し用に、コードとキーから 128 音分の重みの行を作る。"""
+    return key_weight_row(tones.mask, tonic, mode)
+
+
+def _in_key(weights_row: Sequence[float], midi: int) -> bool:
+    """重みの行でスケール音 (またはコードトーン) か。音域外の MIDI 番号は False。"""
+    return 0 <= midi < len(weights_row) and weights_row[midi] > WEIGHT_OUTSIDE
+
+
+# --- 整数ベースのスタイル関数: (now, nxt, weights_row, octave, rng) -> MIDI 番号のリスト (1小節 = 4拍) ---
+def _approach_midi(cur_midi: int, next_midi: int, direction: Optional[int] = None) -> int:
     if direction is None:
-        direction = 1 if next_root.midi - cur_root.midi > 0 else -1
-    return cur_root.transpose(direction)
+        direction = 1 if next_midi - cur_midi > 0 else -1
+    return cur_midi + direction
+
+def _root_only_ints(now: ChordTones, nxt: ChordTones, weights_row: Sequence[float], octave: int, rng) -> List[int]:
+    return [pc_to_midi(now.root, octave)] * 4
+
+def _root_fifth_ints(now: ChordTones, nxt: ChordTones, weights_row: Sequence[float], octave: int, rng) -> List[int]:
+    root = pc_to_midi(now.root, octave)
+    # fifth が存在しないコード (例: C(no5)) はルートのオクターブ上で代用
+    fifth = pc_to_midi(now.fifth, octave) if now.has_fifth else root + 12
+    return [root, fifth, root, fifth]
+
+def _walking_ints(now: ChordTones, nxt: ChordTones, weights_row: Sequence[float], octave: int, rng) -> List[int]:
+    beat1 = pc_to_midi(now.root, octave)
+    root_next = pc_to_midi(nxt.root, octave)
+    beat2 = pc_to_midi(rng.choice((now.third, now.fifth)), octave)
+    beat3 = beat2 + (2 if root_next - beat2 > 0 else -2)
+    if not _in_key(weights_row, beat3):
+        beat3 = beat2
+    beat4 = _approach_midi(beat3, root_next)
+    return [beat1, beat2, beat3, beat4]
+
+def _octave_pump_ints(now: ChordTones, nxt: ChordTones, weights_row: Sequence[float], octave: int, rng) -> List[int]:
+    root = pc_to_midi(now.root, octave)
+    return [root, root + 12, root, root + 12]
+
+def _chromatic_approach_ints(now: ChordTones, nxt: ChordTones, weights_row: Sequence[float], octave: int, rng) -> List[int]:
+    root = pc_to_midi(now.root, octave)
+    fifth = pc_to_midi(now.fifth, octave) if now.has_fifth else root + 12
+    third = pc_to_midi(now.third, octave)
+    root_next = pc_to_midi(nxt.root, octave)
+    # 4拍目は次のルートへの半音アプローチ (3拍目から見て次のルートの手前側から入る)
+    beat4 = root_next - 1 if root_next >= third else root_next + 1
+    return [root, fifth, third, beat4]
+
+# --- ビームサーチによる先読みウォーキング (walking_lookahead) ---
+DEFAULT_LOOKAHEAD_BLOCKS = 4
+DEFAULT_BEAM_WIDTH = 64
+
+def _interval_score_table() -> List[float]:
+    """直前の音からの音程 (半音数の絶対値) ごとのスコア。順次進行を好み、同音連打と大跳躍を嫌う。"""
+    table = []
+    for iv in range(128):
+        if iv == 0: table.append(-1.5)
+        elif iv <= 2: table.append(1.0)
+        elif iv <= 4: table.append(0.5)
+        elif iv == 5: table.append(0.0)
+        elif iv == 6: table.append(-1.0)
+        elif iv == 7: table.append(-0.3)
+        else: table.append(-1.0 - 0.25 * (iv - 7))
+    return table
+
+def _static_step_scores(cands, tones_seq: Sequence[ChordTones], tones_after: Optional[ChordTones], weights, centers: Sequence[int], notes_per_block: Sequence[int], noise):
+    """
+    各ステップ (ブロック×拍) で、直前の音に依存しない部分のスコアを (steps, candidates) 行列で返す。
+    weights は (ブロック数 × 128) の重み行列で、候補 (連続した MIDI 番号) の音域 lo:hi だけを引く。
+    """
+    pcs = cands % 12
+    lo, hi = int(cands[0]), int(cands[-1])
+    rows = []
+    for b, tones in enumerate(tones_seq):
+        w = weights[b, lo:hi + 1]
+        in_chord = w >= WEIGHT_CHORD_TONE
+        in_scale = w > WEIGHT_OUTSIDE
+        is_root = pcs == tones.root
+        range_pen = -0.08 * np.abs(cands - centers[b]) - 0.5 * np.maximum(0, np.abs(cands - centers[b]) - 9)
+        nxt = tones_seq[b + 1] if b + 1 < len(tones_seq) else (tones_after or tones)
+        d = (pcs - nxt.root) % 12
+        dist_next_root = np.minimum(d, 12 - d)
+        n_notes = notes_per_block[b]
+        for k in range(n_notes):
+            if k == 0: # 1拍目: ルート最優先、非コードトーンは強く減点
+                row = np.where(is_root, 3.0, np.where(in_chord, 1.0, -3.0))
+            elif k == n_notes - 1: # 最終拍: 次のルートへの半音/全音アプローチ
+                row = np.where(dist_next_root == 1, 2.5,
+                      np.where(in_scale, np.where(dist_next_root == 2, 1.5, 0.5), -1.5))
+                row = row - np.where(dist_next_root == 0, 1.0, 0.0)
+            elif k % 2 == 0: # 強拍 (4拍なら3拍目): コードトーン
+                row = np.where(in_chord, 1.5, np.where(in_scale, 0.0, -2.0))
+            else: # 弱拍: スケール音なら可
+                row = np.where(in_chord, 1.0, np.where(in_scale, 0.5, -2.0))
+            rows.append(row + range_pen + noise[len(rows)])
+    return np.vstack(rows)
+
+def _per_block(value: Union[int, Sequence[int]], n_blocks: int) -> List[int]:
+    return [int(value)] * n_blocks if isinstance(value, int) else [int(v) for v in value]
+
+def walking_lookahead_line(
+    tones_seq: Sequence[ChordTones],
+    weights,
+    octaves: Union[int, Sequence[int]] = 3,
+    lookahead: Union[int, Sequence[int]] = DEFAULT_LOOKAHEAD_BLOCKS,
+    beam_width: Union[int, Sequence[int]] = DEFAULT_BEAM_WIDTH,
+    notes_per_block: Union[int, Sequence[int]] = 4,
+    rng: Optional[_rand.Random] = None,
+    tones_after: Optional[ChordTones] = None,
+) -> List[List[int]]:
+    """
+    連続するブロック列全体のウォーキングラインをビームサーチで求め、ブロックごとの MIDI 番号リストを返す。
+    各ブロックでは先の lookahead ブロック分を beam_width 本のビームで探索し、最良ビームの先頭ブロックだけを確定する
+    (receding horizon)。スコア (強拍のコードトーン、順次進行、音域、次のルートへのアプローチ) はビーム全体で一括計算する。
+    weights は tones_seq と同じ長さの重みの行 (HarmonicContext.weights のスライスなど、128 音分)。
+    octaves / lookahead / beam_width / notes_per_block はブロックごとのシーケンスでもよい。
+    NumPy がない場合は1小節先読みの walking を順に並べる。
+    """
+    n_blocks = len(tones_seq)
+    if n_blocks == 0: return []
+    rng = rng or _rand
+    octs = _per_block(octaves, n_blocks)
+    if not NUMPY_AVAILABLE or np is None:
+        return [_walking_ints(tones_seq[i], tones_seq[i + 1] if i + 1 < n_blocks else (tones_after or tones_seq[i]), weights[i], octs[i], rng) for i in range(n_blocks)]
+
+    lookaheads = [max(1, v) for v in _per_block(lookahead, n_blocks)]
+    beam_widths = [max(1, v) for v in _per_block(beam_width, n_blocks)]
+    counts = [max(1, v) for v in _per_block(notes_per_block, n_blocks)]
+    block_starts = [0]
+    for c in counts: block_starts.append(block_starts[-1] + c) # ブロック i のステップは block_starts[i]:block_starts[i+1]
+    centers = [pc_to_midi(7, o) for o in octs] # 各ブロックの音域の中心 (ルートのオクターブの G 付近)
+    cands = np.arange(max(0, 12 * (min(octs) + 1) - 4), min(127, 12 * (max(octs) + 1) + 20) + 1, dtype=np.int64)
+    np_rng = np.random.default_rng(rng.randrange(2 ** 32))
+    noise = np_rng.uniform(-0.3, 0.3, size=(block_starts[-1], len(cands))) # 同点時のばらつき
+    static = _static_step_scores(cands, tones_seq, tones_after, np.asarray(weights), centers, counts, noise)
+    iv_table = np.asarray(_interval_score_table())
+    n_cands = len(cands)
+
+    line: List[List[int]] = []
+    last_pitch: Optional[int] = None
+    for i in range(n_blocks):
+        first_step = block_starts[i]
+        last_step = block_starts[min(n_blocks, i + lookaheads[i])]
+        beam_width = beam_widths[i]
+        scores = np.zeros(1)
+        history = np.zeros((1, 0), dtype=np.int64)
+        last = np.full(1, last_pitch if last_pitch is not None else -1, dtype=np.int64)
+        for step in range(first_step, last_step):
+            total = scores[:, None] + static[step][None, :]
+            if step > 0 and (step > first_step or last_pitch is not None):
+                total = total + iv_table[np.abs(cands[None, :] - last[:, None])]
+            flat = total.ravel()
+            if flat.size > beam_width:
+                keep = np.argpartition(-flat, beam_width - 1)[:beam_width]
+            else:
+                keep = np.arange(flat.size)
+            parent, choice = np.divmod(keep, n_cands)
+            scores = flat[keep]
+            last = cands[choice]
+            history = np.concatenate([history[parent], last[:, None]], axis=1)
+        best = history[int(np.argmax(scores))]
+        committed = [int(m) for m in best[:counts[i]]]
+        line.append(committed)
+        last_pitch = committed[-1]
+    return line
+
+def _walking_lookahead_ints(now: ChordTones, nxt: ChordTones, weights_row: Sequence[float], octave: int, rng) -> List[int]:
+    # 単一ブロック呼び出し用 (先読みは次のコードのみ)。曲全体の先読みは walking_lookahead_line を使う
+    return walking_lookahead_line([now], [weights_row], octave, lookahead=1, rng=rng, tones_after=nxt)[0]
+
+STYLE_DISPATCH_INT: Dict[str, Callable[..., List[int]]] = {
+    "root_only": _root_only_ints,
+    "root_fifth": _root_fifth_ints,
+    "walking": _walking_ints,
+    "octave_pump": _octave_pump_ints,
+    "chromatic_approach": _chromatic_approach_ints,
+    "walking_lookahead": _walking_lookahead_ints,
+}
+
+def generate_bass_pitches(
+    style: str,
+    now: ChordTones,
+    nxt: Optional[ChordTones],
+    weights_row: Sequence[float],
+    octave: int = 3,
+    rng: Optional[_rand.Random] = None,
+) -> List[int]:
+    """1ブロック分のベースピッチ (MIDI 番号) を返す。weights_row はブロックの重みの行 (HarmonicContext.weights[blk_idx])。未知のスタイルは root_only。"""
+    func = STYLE_DISPATCH_INT.get(style, _root_only_ints)
+    return func(now, nxt if nxt is not None else now, weights_row, octave, rng or _rand)
+
+
+# --- music21 オブジェクトを受け取る従来 API (内部は整数エンジン) ---
+def _midis_to_pitches(midis: Sequence[int]) -> List[pitch.Pitch]:
+    return [pitch.Pitch(midi=m) for m in midis]
+
+def approach_note(cur_root: pitch.Pitch, next_root: pitch.Pitch, direction: int | None = None) -> pitch.Pitch:
+    return pitch.Pitch(midi=_approach_midi(cur_root.midi, next_root.midi, direction))
 
-# walking_quarters 関数 (SR.get の呼び出しは既に適切)
 def walking_quarters(
     cs_now: harmony.ChordSymbol,
     cs_next: harmony.ChordSymbol,
@@ -44,56 +284,26 @@ def walking_quarters(
     mode: str,
     octave: int = 3,
 ) -> List[pitch.Pitch]:
-    scl = SR.get(tonic, mode) # ここはOK
-    # ... (以降のロジックは変更なし) ...
-    degrees = [cs_now.root().pitchClass,
-               cs_now.third.pitchClass if cs_now.third else cs_now.root().pitchClass, # thirdがない場合へのフォールバック
-               cs_now.fifth.pitchClass if cs_now.fifth else cs_now.root().pitchClass] # fifthがない場合へのフォールバック
-
-    root_now = cs_now.root().transpose((octave - cs_now.root().octave) * 12)
-    root_next = cs_next.root().transpose((octave - cs_next.root().octave) * 12)
-
-    beat1 = root_now
-    
-    options_b2 = [p for p in cs_now.pitches if p.pitchClass in degrees[1:]]
-    if not options_b2: # 3rdや5thがない場合 (ルートのみのコードなど)
-        options_b2 = [cs_now.root()] # ルート音を候補にする
-    beat2_raw = _rand.choice(options_b2) if options_b2 else cs_now.root() # 更にフォールバック
-    beat2 = beat2_raw.transpose((octave - beat2_raw.octave) * 12)
-
-    step_int = +2 if root_next.midi - beat2.midi > 0 else -2
-    beat3 = beat2.transpose(step_int)
-    
-    # scl.getPitches() は music21.scale.ConcreteScale のメソッド
-    # SR.get が正しい ConcreteScale インスタンスを返す必要がある
-    scale_pitches_classes = [p.pitchClass for p in scl.getPitches()] if hasattr(scl, 'getPitches') else []
-    if not scale_pitches_classes or beat3.pitchClass not in scale_pitches_classes:
-        beat3 = beat2
+    tones_now = chord_tones_from_symbol(cs_now)
+    return _midis_to_pitches(_walking_ints(tones_now, chord_tones_from_symbol(cs_next), key_weights_for(tones_now, tonic, mode), octave, _rand))
 
-    beat4 = approach_note(beat3, root_next)
-    return [beat1, beat2, beat3, beat4]
-
-
-# root_fifth_half 関数 (変更なし)
 def root_fifth_half(
     cs: harmony.ChordSymbol,
     octave: int = 3,
 ) -> List[pitch.Pitch]:
-    root = cs.root().transpose((octave - cs.root().octave) * 12)
-    # fifth が存在しないコード (例: C(no5)) の場合のエラーを避ける
-    fifth_pitch = cs.fifth
-    if fifth_pitch is None: # 5度がない場合はルート音のオクターブ上など代替案
+    tones = chord_tones_from_symbol(cs)
+    if not tones.has_fifth:
         logger.warning(f"BassUtils (root_fifth): Chord {cs.figure} has no fifth. Using octave root as substitute.")
-        fifth_pitch = cs.root().transpose(12) # ルートのオクターブ上
-    fifth = fifth_pitch.transpose((octave - fifth_pitch.octave) * 12)
-    return [root, fifth, root, fifth]
+    return _midis_to_pitches(_root_fifth_ints(tones, tones, weight_row(tones.mask, 0xFFF), octave, _rand))
 
-# STYLE_DISPATCH と generate_bass_measure (変更なし)
-STYLE_DISPATCH = {
-    "root_only": lambda cs_now, cs_next, **k: [cs_now.root().transpose((k.get("octave",3) - cs_now.root().octave) * 12)] * 4,
-    "root_fifth": root_fifth_half,
-    "walking": walking_quarters,
-}
+# STYLE_DISPATCH と generate_bass_measure (従来の呼び出し形式)
+def _legacy_style(func: Callable[..., List[int]]) -> Callable[..., List[pitch.Pitch]]:
+    def call(cs_now, cs_next, tonic="C", mode="major", octave=3, **k):
+        now = chord_tones_from_symbol(cs_now)
+        return _midis_to_pitches(func(now, chord_tones_from_symbol(cs_next or cs_now), key_weights_for(now, tonic, mode), octave, _rand))
+    return call
+
+STYLE_DISPATCH = {name: _legacy_style(func) for name, func in STYLE_DISPATCH_INT.items()}
 
 def generate_bass_measure(
     style: str,
@@ -103,13 +313,15 @@ def generate_bass_measure(
     mode: str,
     octave: int = 3,
 ) -> List[note.Note]:
-    func = STYLE_DISPATCH.get(style, STYLE_DISPATCH["root_only"])
-    # cs_next が None になる可能性を考慮 (リストの最後など)
-    # generate_bass_measure を呼び出す BassGenerator.compose で cs_next が None の場合の処理が必要
-    pitches = func(cs_now=cs_now, cs_next=cs_next, tonic=tonic, mode=mode, octave=octave)
+    # cs_next が None の場合 (リストの最後など) は現在のコードを使う
+    tones_now = chord_tones_from_symbol(cs_now)
+    midis = generate_bass_pitches(
+        style, tones_now,
+        chord_tones_from_symbol(cs_next) if cs_next is not None else None,
+        key_weights_for(tones_now, tonic, mode), octave)
     notes_out = []
-    for p_obj in pitches:
-        n = note.Note(p_obj)
+    for midi_val in midis:
+        n = note.Note(midi_val)
         n.quarterLength = 1.0
         notes_out.append(n)
     return notes_out
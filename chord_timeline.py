@@ -0,0 +1,149 @@
+# --- START OF FILE utilities/chord_timeline.py ---
+"""chord_timeline.py
+曲全体のコード進行 (processed_blocks) を一度だけ解析し、全ジェネレータで共有するためのタイムライン。
+
+- ブロックの開始/終了オフセット、コードラベル、パース済み ChordSymbol、セクション番号、トニック/モードを配列で保持
+- 同じラベルのコードは一度だけパースし、同じ ChordSymbol を参照する (呼び出し側で変更しないこと。変更が必要なら chord_copy を使う)
+- prev/next は O(1)、オフセット → ブロック番号の検索は bisect による O(log n)
+- harmonic_context() でブロック × 128 音の許容ピッチ重み行列 (HarmonicContext) を一度だけ作って共有する
+"""
+import copy
+import logging
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from music21 import harmony
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .core_music_utils import get_music21_chord_object
+except ImportError:
+    from core_music_utils import get_music21_chord_object # type: ignore
+
+
+class ChordTimeline:
+    __slots__ = ("starts", "ends", "labels", "chords", "section_index", "section_names",
+                 "tonics", "modes", "_chord_by_label", "_harmonic_context")
+
+    def __init__(self,
+                 starts: Sequence[float],
+                 ends: Sequence[float],
+                 labels: Sequence[Optional[str]],
+                 section_index: Sequence[int],
+                 section_names: Sequence[Optional[str]],
+                 tonics: Sequence[str],
+                 modes: Sequence[str]):
+        n = len(starts)
+        if not (len(ends) == len(labels) == len(section_index) == len(tonics) == len(modes) == n):
+            raise ValueError("ChordTimeline: all per-block sequences must have the same length.")
+        self.starts: Tuple[float, ...] = tuple(float(s) for s in starts)
+        self.ends: Tuple[float, ...] = tuple(float(e) for e in ends)
+        self.labels: Tuple[Optional[str], ...] = tuple(labels)
+        self.section_index: Tuple[int, ...] = tuple(int(i) for i in section_index)
+        self.section_names: Tuple[Optional[str], ...] = tuple(section_names)
+        self.tonics: Tuple[str, ...] = tuple(tonics)
+        self.modes: Tuple[str, ...] = tuple(modes)
+        # ラベルごとに一度だけパース (None は休符またはパース不能)
+        self._chord_by_label: Dict[Optional[str], Optional[harmony.ChordSymbol]] = {}
+        for lbl in self.labels:
+            if lbl not in self._chord_by_label:
+                self._chord_by_label[lbl] = get_music21_chord_object(lbl) if lbl else None
+        self.chords: Tuple[Optional[harmony.ChordSymbol], ...] = tuple(self._chord_by_label[lbl] for lbl in self.labels)
+        self._harmonic_context = None
+        logger.debug(f"ChordTimeline: {n} blocks, {len(self._chord_by_label)} distinct chord labels parsed.")
+
+    @classmethod
+    def from_blocks(cls, processed_blocks: Sequence[Dict[str, Any]],
+                    default_tonic: str = "C", default_mode: str = "major") -> "ChordTimeline":
+        """prepare_processed_stream の出力 (ブロック辞書のリスト) からタイムラインを作る。"""
+        starts: List[float] = []; ends: List[float] = []; labels: List[Optional[str]] = []
+        section_index: List[int] = []; section_names: List[Optional[str]] = []
+        tonics: List[str] = []; modes: List[str] = []
+        current_offset = 0.0
+        for blk in processed_blocks:
+            start = float(blk.get("offset", current_offset))
+            q_len = float(blk.get("q_length", 0.0))
+            sec_name = blk.get("section_name")
+            if not section_names or section_names[-1] != sec_name:
+                section_names.append(sec_name)
+            starts.append(start); ends.append(start + q_len)
+            labels.append(blk.get("chord_label"))
+            section_index.append(len(section_names) - 1)
+            tonics.append(blk.get("tonic_of_section", default_tonic))
+            modes.append(blk.get("mode", default_mode))
+            current_offset = start + q_len
+        return cls(starts, ends, labels, section_index, section_names, tonics, modes)
+
+    def select(self, indices: Sequence[int]) -> "ChordTimeline":
+        """指定したブロックだけ (この順) のタイムライン。パース済みコードはそのまま共有する (再パースしない)。"""
+        sub = ChordTimeline.__new__(ChordTimeline)
+        for name in ("starts", "ends", "labels", "chords", "section_index", "tonics", "modes"):
+            values = getattr(self, name)
+            setattr(sub, name, tuple(values[i] for i in indices))
+        sub.section_names = self.section_names
+        sub._chord_by_label = self._chord_by_label
+        sub._harmonic_context = None
+        return sub
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def total_length(self) -> float:
+        return self.ends[-1] if self.ends else 0.0
+
+    # --- ブロック単位のアクセス ---
+    def chord_at(self, idx: int) -> Optional[harmony.ChordSymbol]:
+        """ブロック idx のパース済みコード (共有オブジェクト)。休符なら None。"""
+        return self.chords[idx]
+
+    def chord_copy(self, idx: int) -> Optional[harmony.ChordSymbol]:
+        """テンション追加などで変更する場合のためのコピー。"""
+        cs = self.chords[idx]
+        return copy.deepcopy(cs) if cs is not None else None
+
+    def key_at(self, idx: int) -> Tuple[str, str]:
+        return self.tonics[idx], self.modes[idx]
+
+    def section_name_at(self, idx: int) -> Optional[str]:
+        return self.section_names[self.section_index[idx]]
+
+    def prev_index(self, idx: int) -> Optional[int]:
+        return idx - 1 if idx > 0 else None
+
+    def next_index(self, idx: int) -> Optional[int]:
+        return idx + 1 if idx + 1 < len(self.starts) else None
+
+    def prev_chord(self, idx: int) -> Optional[harmony.ChordSymbol]:
+        return self.chords[idx - 1] if idx > 0 else None
+
+    def next_chord(self, idx: int) -> Optional[harmony.ChordSymbol]:
+        return self.chords[idx + 1] if idx + 1 < len(self.chords) else None
+
+    def harmonic_context(self):
+        """曲全体の HarmonicContext (初回呼び出し時に一度だけ作る)。"""
+        if self._harmonic_context is None:
+            try:
+                from .harmonic_context import HarmonicContext
+            except ImportError:
+                from harmonic_context import HarmonicContext # type: ignore
+            self._harmonic_context = HarmonicContext.from_timeline(self)
+        return self._harmonic_context
+
+    # --- 時間 → ブロック ---
+    def index_at(self, offset: float) -> Optional[int]:
+        """offset を含むブロックの番号 (O(log n))。曲の範囲外またはブロック間の隙間なら None。"""
+        idx = bisect_right(self.starts, offset) - 1
+        if idx < 0 or offset >= self.ends[idx]:
+            return None
+        return idx
+
+    def chord_at_offset(self, offset: float) -> Optional[harmony.ChordSymbol]:
+        idx = self.index_at(offset)
+        return self.chords[idx] if idx is not None else None
+
+    def section_at(self, offset: float) -> Optional[str]:
+        idx = self.index_at(offset)
+        return self.section_name_at(idx) if idx is not None else None
+# --- END OF FILE utilities/chord_timeline.py ---
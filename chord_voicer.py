@@ -1,54 +1,16 @@
 # --- START OF FILE generators/chord_voicer.py (修正案) ---
-import music21
 from typing import List, Dict, Optional, Tuple, Any, Sequence
 from music21 import (stream, note, harmony, pitch, meter, duration,
-                     instrument as m21instrument, interval, tempo, key,
-                     chord as m21chord.Chord, volume as m21volume)
+                     instrument as m21instrument, interval, key,
+                     chord as m21chord, volume as m21volume)
 import random
 import logging
+import re
 
 logger = logging.getLogger(__name__) # __name__ を使うのが一般的
 
-# --- core_music_utils からのインポート試行 ---
-try:
-    # PYTHONPATHが通っていればこれでOKなはず
-    from .core_music_utils import get_time_signature_object, sanitize_chord_label
-    logger.info("ChordVoicer: Successfully imported from .core_music_utils.")
-except ImportError as e_import_core:
-    # Colab環境などで PYTHONPATH の問題がある場合、または generators/ が sys.path にない場合
-    try:
-        from core_music_utils import get_time_signature_object, sanitize_chord_label # 相対インポートなしで試す
-        logger.info("ChordVoicer: Successfully imported core_music_utils (without relative path).")
-    except ImportError as e_import_direct:
-        logger.warning(f"ChordVoicer: Could not import from .core_music_utils (Error: {e_import_core}) "
-                       f"nor directly from core_music_utils (Error: {e_import_direct}). "
-                       "Using basic fallbacks for get_time_signature_object and sanitize_chord_label.")
-        # --- フォールバック定義 ---
-        def get_time_signature_object(ts_str: Optional[str]) -> meter.TimeSignature:
-            if not ts_str: ts_str = "4/4"
-            try: return meter.TimeSignature(ts_str)
-            except meter.MeterException:
-                logger.warning(f"CV Fallback GTSO: Invalid TS '{ts_str}'. Default 4/4.")
-                return meter.TimeSignature("4/4")
-            except Exception as e_ts_fb:
-                 logger.error(f"CV Fallback GTSO: Unexpected error '{ts_str}': {e_ts_fb}. Defaulting to 4/4.", exc_info=True)
-                 return meter.TimeSignature("4/4")
-
-        def sanitize_chord_label(label: str) -> str:
-            logger.warning(f"CV Fallback sanitize_chord_label used for '{label}'. This is a basic version.")
-            # これはあくまで基本的なフォールバック。core_music_utils.py の方がずっと高機能。
-            label = str(label) # Ensure it's a string
-            label = label.replace('maj7', 'M7').replace('mi7', 'm7').replace('min7', 'm7')
-            label = label.replace('Maj7', 'M7').replace('Mi7', 'm7').replace('Min7', 'm7') # Case variations
-            # 簡易的な 'Bb' -> 'B-'
-            if len(label) > 1 and label[1] == 'b' and label[0] in 'ABCDEFGabcdefg':
-                 if not (len(label) > 2 and label[2].isalpha()): # "Ebm" のようなケースでないことを確認
-                    label = label[0] + '-' + label[2:]
-            # 不完全な括弧
-            if label.count('(') > label.count(')') and label.endswith('('):
-                label = label[:-1]
-            return label
-        # --- フォールバック定義ここまで ---
+from utilities.core_music_utils import get_time_signature_object
+from utilities.chord_timeline import ChordTimeline
 
 DEFAULT_CHORD_TARGET_OCTAVE_BOTTOM: int = 3
 VOICING_STYLE_CLOSED = "closed"
@@ -179,12 +141,10 @@ class ChordVoicer:
                  #エラー時は元のピッチリストを維持する
         return voiced_pitches_list
 
-    def compose(self, processed_chord_stream: List[Dict]) -> stream.Part:
+    def compose(self, processed_chord_stream: List[Dict], chord_timeline: Optional[Any] = None) -> stream.Part:
         chord_part = stream.Part(id="ChordVoicerPart")
         try:
             chord_part.insert(0, self.default_instrument) # 初期化時にエラーがあれば m21instrument.Instrument()など
-            chord_part.append(tempo.MetronomeMark(number=self.global_tempo))
-            chord_part.append(self.global_time_signature_obj)
         except Exception as e_init_part:
             logger.error(f"CV.compose: Error setting up initial part elements: {e_init_part}", exc_info=True)
             # 致命的ではないので処理は続行
@@ -195,6 +155,7 @@ class ChordVoicer:
         logger.info(f"CV.compose: Processing {len(processed_chord_stream)} blocks.")
 
         current_key_obj: Optional[key.Key] = None # 必要であればセクションごとの調情報を扱う
+        if chord_timeline is None: chord_timeline = ChordTimeline.from_blocks(processed_chord_stream)
 
         for blk_idx, blk_data in enumerate(processed_chord_stream):
             offset_ql = float(blk_data.get("offset", 0.0))
@@ -217,18 +178,10 @@ class ChordVoicer:
                 logger.info(f"CV Block {blk_idx+1} is explicitly a Rest due to label: '{chord_label_original}'.")
                 is_block_effectively_rest = True
             else:
-                sanitized_label = sanitize_chord_label(chord_label_original) # From core_music_utils
-                try:
-                    cs_obj = harmony.ChordSymbol(sanitized_label)
-                    # ChordSymbol("Rest") の場合や、何らかの理由でピッチが生成されない場合
-                    if not cs_obj.pitches:
-                        logger.info(f"CV: ChordSymbol '{sanitized_label}' (orig: '{chord_label_original}') resulted in no pitches. Treating as Rest.")
-                        is_block_effectively_rest = True
-                except music21.harmony.HarmonyException as he:
-                    logger.error(f"CV: HarmonyException creating ChordSymbol for '{sanitized_label}' (orig: '{chord_label_original}'): {he}. Treating as Rest.")
-                    is_block_effectively_rest = True
-                except Exception as e_cs_create: # Includes AccidentalException etc.
-                    logger.error(f"CV: General Exception creating ChordSymbol for '{sanitized_label}' (orig: '{chord_label_original}'): {e_cs_create}. Treating as Rest.", exc_info=False) # exc_info=True for more detail if needed
+                # パース済みコードは全パートで共有しているので、テンションを足す場合だけコピーする
+                cs_obj = chord_timeline.chord_copy(blk_idx) if blk_data.get("tensions_to_add") else chord_timeline.chord_at(blk_idx)
+                if cs_obj is None:
+                    logger.info(f"CV Block {blk_idx+1}: Chord '{chord_label_original}' could not be parsed or has no pitches. Treating as Rest.")
                     is_block_effectively_rest = True
             
             if is_block_effectively_rest:
@@ -0,0 +1,151 @@
+# --- START OF FILE utilities/composer_config.py ---
+"""composer_config.py
+DEFAULT_CONFIG と設定ファイル/CLI の上書きを、生成前に一度だけ検証して不変の型付きオブジェクトにまとめる。
+
+- compile_config(defaults, *overrides): defaults (DEFAULT_CONFIG) の構造がそのままスキーマになる。
+  defaults にないキーや型の合わない値は ConfigError (どのキーかは ConfigError.path)
+- 感情 → スタイルなどの対応表 (LOOKUP_TABLE_KEYS) は行の追加を許す。それ以外の dict はキーが固定
+- 結果は ComposerConfig / PartConfig / SectionDedupConfig (NamedTuple なので不変で __dict__ を持たない)。
+  パートのデフォルト値は PartParams (part_params.py) として共有する
+- to_dict() で従来の入れ子 dict に戻せる (ログ出力や JSON 保存用)
+"""
+import logging
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, NamedTuple, Optional, Tuple
+
+from music21 import meter
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .part_params import PartParams, intern_part_params
+except ImportError:
+    from part_params import PartParams, intern_part_params # type: ignore
+
+# 行 (感情名など) を自由に追加できる対応表
+LOOKUP_TABLE_KEYS = frozenset({
+    "emotion_to_rh_style_keyword", "emotion_to_lh_style_keyword", "style_keyword_to_rhythm_key",
+    "intensity_to_velocity_ranges", "emotion_to_style_key", "intensity_to_base_velocity",
+    "emotion_mode_to_style_map", "style_map", "rhythm_key_map",
+})
+
+
+class ConfigError(ValueError):
+    """設定の検証エラー。path は "default_part_parameters.piano.default_rh_target_octave" のようなキーの位置。"""
+    def __init__(self, message: str, path: Optional[str] = None):
+        self.path = path
+        super().__init__(f"{path}: {message}" if path else message)
+
+
+class SectionDedupConfig(NamedTuple):
+    enabled: bool = True
+    rehumanize_repeats: bool = True
+    rehumanize_template: Optional[str] = None
+
+
+class PartConfig(NamedTuple):
+    """1パートの設定。params はデフォルト値と対応表 (DEFAULT_CONFIG の default_part_parameters[name])。"""
+    name: str
+    enabled: bool
+    params: PartParams
+
+    @property
+    def instrument(self) -> str:
+        return self.params.get("instrument", "Piano")
+
+    @property
+    def rhythm_category(self) -> str:
+        return self.params.get("default_rhythm_category", f"{self.name}_patterns")
+
+    def table(self, key: str) -> Mapping[str, Any]:
+        """対応表 (なければ空)。"""
+        return self.params.get(key) or MappingProxyType({})
+
+
+class ComposerConfig(NamedTuple):
+    global_tempo: float
+    global_time_signature: str
+    global_key_tonic: str
+    global_key_mode: str
+    parts: Mapping[str, PartConfig]
+    section_dedup: SectionDedupConfig
+    output_filename_template: str
+
+    @property
+    def enabled_parts(self) -> Tuple[str, ...]:
+        return tuple(name for name, part in self.parts.items() if part.enabled)
+
+    def part(self, name: str) -> PartConfig:
+        try:
+            return self.parts[name]
+        except KeyError:
+            raise ConfigError(f"Unknown part '{name}'.", "default_part_parameters") from None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "global_tempo": self.global_tempo, "global_time_signature": self.global_time_signature,
+            "global_key_tonic": self.global_key_tonic, "global_key_mode": self.global_key_mode,
+            "parts_to_generate": {name: part.enabled for name, part in self.parts.items()},
+            "default_part_parameters": {name: part.params.to_dict() for name, part in self.parts.items()},
+            "section_dedup": self.section_dedup._asdict(),
+            "output_filename_template": self.output_filename_template,
+        }
+
+
+def _check_value(path: str, value: Any, default: Any) -> Any:
+    # デフォルト値の型に合わせて検証する (数値は int/float を区別しない。bool は数値として扱わない)
+    if default is None: return value
+    if isinstance(default, bool): ok = isinstance(value, bool)
+    elif isinstance(default, (int, float)): ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif isinstance(default, str): ok = isinstance(value, str)
+    elif isinstance(default, (list, tuple)): ok = isinstance(value, (list, tuple))
+    elif isinstance(default, Mapping): ok = isinstance(value, Mapping)
+    else: ok = True
+    if not ok: raise ConfigError(f"expected {type(default).__name__}, got {type(value).__name__} ({value!r}).", path)
+    return value
+
+def _merge(path: str, base: Mapping[str, Any], override: Any, open_keys: bool = False) -> Dict[str, Any]:
+    if not isinstance(override, Mapping): raise ConfigError(f"expected an object, got {type(override).__name__}.", path or None)
+    merged = dict(base)
+    for key, value in override.items():
+        key_path = f"{path}.{key}" if path else str(key)
+        if key not in base:
+            if not open_keys: raise ConfigError("unknown key.", key_path)
+            merged[key] = value; continue
+        default = base[key]
+        if isinstance(default, Mapping):
+            merged[key] = _merge(key_path, default, value, open_keys or key in LOOKUP_TABLE_KEYS)
+        else:
+            merged[key] = _check_value(key_path, value, default)
+    return merged
+
+def _validate_globals(merged: Dict[str, Any]) -> None:
+    if merged["global_tempo"] <= 0: raise ConfigError(f"must be positive, got {merged['global_tempo']!r}.", "global_tempo")
+    try:
+        meter.TimeSignature(merged["global_time_signature"])
+    except Exception as e:
+        raise ConfigError(f"invalid time signature {merged['global_time_signature']!r} ({e}).", "global_time_signature") from None
+    unknown_parts = set(merged["parts_to_generate"]) - set(merged["default_part_parameters"])
+    if unknown_parts: raise ConfigError(f"no default_part_parameters for {sorted(unknown_parts)}.", "parts_to_generate")
+
+def compile_config(defaults: Mapping[str, Any], *overrides: Optional[Mapping[str, Any]]) -> ComposerConfig:
+    """defaults に overrides を順に重ねて検証し、ComposerConfig を作る (None の上書きは無視)。defaults はコンパイル済みでもよい。"""
+    if isinstance(defaults, ComposerConfig): defaults = defaults.to_dict()
+    merged: Dict[str, Any] = _merge("", {}, defaults, open_keys=True)
+    for override in overrides:
+        if override is None: continue
+        if isinstance(override, ComposerConfig): override = override.to_dict()
+        merged = _merge("", merged, override)
+    _validate_globals(merged)
+    enabled = merged["parts_to_generate"]
+    parts = {name: PartConfig(name, bool(enabled.get(name, False)), intern_part_params(part_defaults))
+             for name, part_defaults in merged["default_part_parameters"].items()}
+    dedup = merged.get("section_dedup", {})
+    return ComposerConfig(
+        global_tempo=merged["global_tempo"], global_time_signature=merged["global_time_signature"],
+        global_key_tonic=merged["global_key_tonic"], global_key_mode=merged["global_key_mode"],
+        parts=MappingProxyType(parts),
+        section_dedup=SectionDedupConfig(**{k: dedup[k] for k in SectionDedupConfig._fields if k in dedup}),
+        output_filename_template=merged["output_filename_template"],
+    )
+# --- END OF FILE utilities/composer_config.py ---
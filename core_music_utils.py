@@ -2,7 +2,9 @@
 import music21
 import logging
 from music21 import meter, harmony, pitch, chord as m21chord
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
+from dataclasses import dataclass
+from functools import lru_cache
 import re
 
 logger = logging.getLogger(__name__)
@@ -20,6 +22,52 @@ def get_time_signature_object(ts_str: Optional[str]) -> meter.TimeSignature:
         logger.error(f"CoreUtils: Unexpected error creating TimeSignature from '{ts_str}': {e_ts}. Defaulting to 4/4.", exc_info=True)
         return meter.TimeSignature("4/4")
 
+@dataclass(frozen=True)
+class MeterInfo:
+    """
+    拍子の不変ディスクリプタ。ジェネレータの内側のループでは music21 の TimeSignature ではなく
+    これらの float を読む。music21 オブジェクトはストリームに挿入するときだけ to_time_signature() で作る。
+    """
+    ts_str: str          # 正規化済みの拍子文字列 (例: "4/4", "6/8")
+    numerator: int
+    denominator: int
+    bar_ql: float        # 1小節の長さ (quarterLength)
+    beat_ql: float       # 1拍の長さ (6/8 なら付点4分 = 1.5)
+    beat_count: int      # 1小節の拍数 (6/8 なら 2)
+
+    def to_time_signature(self) -> meter.TimeSignature:
+        return meter.TimeSignature(self.ts_str)
+
+    def beat_strengths(self, subdivision: int = 1) -> Tuple[float, ...]:
+        """
+        1拍を subdivision 分割したグリッドごとの拍の強さ (長さ beat_count * subdivision)。
+        値は metric_weights のメトリック・ウェイト表から引く (小節頭 1.0、拍 0.5、裏拍は階層ごとに半減)。
+        """
+        return _meter_beat_strengths(self.ts_str, self.beat_ql, self.beat_count, max(1, int(subdivision)))
+
+
+@lru_cache(maxsize=256)
+def _meter_beat_strengths(ts_str: str, beat_ql: float, beat_count: int, subdivision: int) -> Tuple[float, ...]:
+    """MeterInfo.beat_strengths の実体。MeterInfo は frozen なのでキャッシュはインスタンスではなくここに持つ。"""
+    from .metric_weights import get_metric_weight_table, DEFAULT_TICKS_PER_QUARTER # 循環インポートを避けるためここで
+    table = get_metric_weight_table(ts_str, DEFAULT_TICKS_PER_QUARTER * subdivision)
+    step_ql = beat_ql / subdivision
+    return tuple(table.weight_at(pos * step_ql) for pos in range(beat_count * subdivision))
+
+
+@lru_cache(maxsize=64)
+def get_meter_info(ts_str: Optional[str]) -> MeterInfo:
+    """拍子文字列から MeterInfo を取得する (拍子ごとに一度だけ music21 でパースしてキャッシュ)。"""
+    ts_obj = get_time_signature_object(ts_str)
+    return MeterInfo(
+        ts_str=ts_obj.ratioString,
+        numerator=int(ts_obj.numerator),
+        denominator=int(ts_obj.denominator),
+        bar_ql=float(ts_obj.barDuration.quarterLength),
+        beat_ql=float(ts_obj.beatDuration.quarterLength),
+        beat_count=int(ts_obj.beatCount),
+    )
+
 def _expand_tension_block_core(seg: str) -> str: # 名前を少し変更して衝突を避ける
     seg = seg.strip().lower()
     if not seg: return ""
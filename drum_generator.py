@@ -1,28 +1,19 @@
 # --- START OF FILE generator/drum_generator.py (ヒューマナイズ外部化版) ---
 import music21
-from typing import List, Dict, Optional, Tuple, Any, Sequence, Union
-from music21 import stream, note, tempo, meter, instrument as m21instrument, volume, duration, pitch
+from typing import List, Dict, Optional, Tuple, Any, Sequence, Union, cast
+from music21 import stream, note, instrument as m21instrument, volume, duration, pitch
 import random
 import logging
-# import numpy as np # humanizer.py に移管
 # import copy      # humanizer.py に移管
 
 # ユーティリティのインポート
-try:
-    from utilities.core_music_utils import get_time_signature_object, MIN_NOTE_DURATION_QL
-    # ドラムヒット個別に適用するので apply_humanization_to_element を使う
-    from utilities.humanizer import apply_humanization_to_element, HUMANIZATION_TEMPLATES
-except ImportError:
-    logger_fallback = logging.getLogger(__name__ + ".fallback_utils")
-    logger_fallback.warning("DrumGen: Could not import from utilities. Using fallbacks.")
-    MIN_NOTE_DURATION_QL = 0.125
-    def get_time_signature_object(ts_str: Optional[str]) -> meter.TimeSignature:
-        if not ts_str: ts_str = "4/4"; return meter.TimeSignature(ts_str)
-        try: return meter.TimeSignature(ts_str)
-        except: return meter.TimeSignature("4/4")
-    # ダミーのヒューマナイズ関数
-    def apply_humanization_to_element(element, template_name=None, custom_params=None): return element
-    HUMANIZATION_TEMPLATES = {}
+from utilities.core_music_utils import get_meter_info, MIN_NOTE_DURATION_QL
+# ドラムヒット個別に適用するので apply_humanization_to_element を使う (NumPy がない場合のフォールバック)
+# NumPy がある場合はブロック単位で humanize_event_arrays を使う
+from utilities.humanizer import apply_humanization_to_element, humanize_event_arrays, HUMANIZATION_TEMPLATES, NUMPY_AVAILABLE, np
+from utilities.rhythm_library_compiler import pattern_event_arrays
+from utilities.metric_weights import metric_velocity_factors
+from utilities.rhythm_tiler import tile_pattern, bar_spans, TILE_BAR # NumPy がなくても動く (ループ版)
 
 
 logger = logging.getLogger(__name__)
@@ -32,6 +23,47 @@ GM_DRUM_MAP = {"kick":36, "bd":36, "snare":38, "sd":38, "chh":42, "phh":44, "ohh
 DEFAULT_DRUM_PATTERNS_LIB = {"default_drum_pattern": {"description":"Default simple kick/snare","time_signature":"4/4","pattern":[{"instrument":"kick","offset":0.0,"velocity":90,"duration":0.1},{"instrument":"snare","offset":1.0,"velocity":90,"duration":0.1},{"instrument":"kick","offset":2.0,"velocity":90,"duration":0.1},{"instrument":"snare","offset":3.0,"velocity":90,"duration":0.1}]},"no_drums":{"description":"Silence","time_signature":"4/4","pattern":[]}}
 
 
+def _resolve_drum_midi(drum_sound_name: str) -> Optional[int]:
+    return GM_DRUM_MAP.get(drum_sound_name.lower().replace(" ","_").replace("-","_"))
+
+
+class _DrumEventTemplate:
+    """
+    1小節分のドラムパターン (またはフィル) をコンパイルしたイベント配列。
+    (スタイル, フィル, 小節長, ベースベロシティ, アクセント深さ) ごとに一度だけ作り、ブロック内の小節へタイル状に敷き詰める。
+    metric_accent_depth > 0 なら拍子のメトリック・ウェイトでベロシティにアクセントを付ける。
+    """
+    __slots__ = ("midis", "offsets", "durations", "velocities")
+
+    def __init__(self, pattern_events: List[Dict[str, Any]], measure_duration_ql: float, base_velocity: int,
+                 metric_accent_depth: float = 0.0, ts_str: str = "4/4"):
+        # イベントは配列で受け取る (コンパイル済みライブラリなら mmap 上のビューそのまま)
+        events = pattern_event_arrays(pattern_events)
+        # 楽器名は文字列コードごとに一度だけ解決する (末尾の -1 は楽器名なし = MISSING_CODE 用)
+        used_codes = set(events.instruments.tolist())
+        code_midis: List[int] = []
+        for code, name in enumerate(events.strings):
+            midi_val = _resolve_drum_midi(name) if code in used_codes and name else None
+            if midi_val is None and code in used_codes and name: logger.warning(f"DrumGen: Sound '{name}' not in GM_DRUM_MAP. Skip.")
+            code_midis.append(midi_val if midi_val is not None else -1)
+        midis = np.array(code_midis + [-1], dtype=np.int64)[events.instruments]
+        # ベロシティ規則: velocity > velocity_factor * base_velocity > base_velocity
+        velocities = np.where(~np.isnan(events.velocities), np.trunc(np.nan_to_num(events.velocities)),
+                              np.where(~np.isnan(events.velocity_factors), np.trunc(base_velocity * np.nan_to_num(events.velocity_factors)), base_velocity))
+        # 1小節分 (半端な小節なら小節末で切る) をタイリングエンジンで配置し、鳴らせる楽器のイベントだけ残す
+        tiled = tile_pattern(events.offsets, events.durations_or(0.125), measure_duration_ql, TILE_BAR,
+                             bar_ql=measure_duration_ql, min_duration_ql=MIN_NOTE_DURATION_QL / 8)
+        keep = midis[tiled.event_index] >= 0
+        source = tiled.event_index[keep]
+        velocities = velocities[source]
+        self.midis = midis[source]
+        self.offsets = tiled.offsets[keep]
+        self.durations = np.maximum(MIN_NOTE_DURATION_QL / 4, tiled.durations[keep])
+        if metric_accent_depth and self.offsets.size:
+            velocities = np.rint(velocities * metric_velocity_factors(self.offsets, metric_accent_depth, ts_str))
+        self.velocities = np.clip(velocities, 1, 127).astype(np.int64)
+
+
 class DrumGenerator:
     def __init__(self,
                  drum_pattern_library: Optional[Dict[str, Dict[str, Any]]] = None,
@@ -49,7 +81,56 @@ class DrumGenerator:
         if hasattr(self.default_instrument, 'midiChannel'): self.default_instrument.midiChannel = 9
         self.global_tempo = global_tempo
         self.global_time_signature_str = global_time_signature
-        self.global_time_signature_obj = get_time_signature_object(global_time_signature)
+        self.global_meter = get_meter_info(global_time_signature)
+        self._event_templates: Dict[Tuple[str, Optional[str], float, int, float, str], _DrumEventTemplate] = {}
+
+    def _get_event_template(
+        self, style_key: str, fill_key: Optional[str], pattern_events: List[Dict[str, Any]],
+        measure_duration_ql: float, base_velocity: int, metric_accent_depth: float = 0.0, ts_str: str = "4/4"
+    ) -> _DrumEventTemplate:
+        template_key = (style_key, fill_key, measure_duration_ql, base_velocity, metric_accent_depth, ts_str)
+        template = self._event_templates.get(template_key)
+        if template is None:
+            template = _DrumEventTemplate(pattern_events, measure_duration_ql, base_velocity, metric_accent_depth, ts_str)
+            self._event_templates[template_key] = template
+        return template
+
+    def _tile_block_events(
+        self, style_key: str, style_def: Dict[str, Any], main_pattern_events: List[Dict[str, Any]],
+        measure_plan: List[Tuple[float, float, Optional[str]]], block_offset_ql: float, base_velocity: int,
+        metric_accent_depth: float = 0.0, ts_str: str = "4/4"
+    ) -> Tuple[Any, Any, Any, Any]:
+        """
+        ブロック内の小節計画 (相対開始位置, 小節長, フィルキー) から、同じテンプレートを使う小節をまとめ、
+        小節開始オフセットのブロードキャストで全ヒットの配列を作る。戻り値は時間順にソート済み。
+        """
+        measures_by_template: Dict[Tuple[Optional[str], float], List[float]] = {}
+        for measure_start_rel, measure_dur, fill_key in measure_plan:
+            measures_by_template.setdefault((fill_key, measure_dur), []).append(block_offset_ql + measure_start_rel)
+        midi_chunks = []; offset_chunks = []; duration_chunks = []; velocity_chunks = []
+        for (fill_key, measure_dur), starts in measures_by_template.items():
+            pattern_events = style_def.get("fill_ins", {}).get(fill_key, []) if fill_key else main_pattern_events
+            template = self._get_event_template(style_key, fill_key, pattern_events, measure_dur, base_velocity, metric_accent_depth, ts_str)
+            if template.midis.size == 0: continue
+            starts_arr = np.asarray(starts, dtype=np.float64)
+            offset_chunks.append((starts_arr[:, None] + template.offsets[None, :]).ravel())
+            midi_chunks.append(np.tile(template.midis, len(starts)))
+            duration_chunks.append(np.tile(template.durations, len(starts)))
+            velocity_chunks.append(np.tile(template.velocities, len(starts)))
+        if not offset_chunks:
+            empty_f = np.zeros(0, dtype=np.float64); empty_i = np.zeros(0, dtype=np.int64)
+            return empty_i, empty_f, empty_f, empty_i
+        offsets = np.concatenate(offset_chunks)
+        order = np.argsort(offsets, kind="stable")
+        return (np.concatenate(midi_chunks)[order], offsets[order],
+                np.concatenate(duration_chunks)[order], np.concatenate(velocity_chunks)[order])
+
+    def _insert_hit_arrays(self, target_part: stream.Part, midis: Any, offsets: Any, durations: Any, velocities: Any):
+        for midi_val, offset_val, dur_val, vel_val in zip(midis.tolist(), offsets.tolist(), durations.tolist(), velocities.tolist()):
+            hit = note.Note(midi_val, quarterLength=dur_val)
+            hit.volume = volume.Volume(velocity=vel_val)
+            target_part.coreInsert(offset_val, hit)
+        target_part.coreElementsChanged()
 
 
     def _create_drum_hit(self, drum_sound_name: str, velocity_val: int, duration_ql_val: float = 0.125) -> Optional[note.Note]:
@@ -66,7 +147,8 @@ class DrumGenerator:
     def _apply_drum_pattern_to_measure(
         self, target_part: stream.Part, pattern_events: List[Dict[str, Any]],
         measure_abs_start_offset: float, measure_duration_ql: float, base_velocity: int,
-        humanize_params_for_hit: Optional[Dict[str, Any]] = None # ★ ヒューマナイズパラメータを受け取る
+        humanize_params_for_hit: Optional[Dict[str, Any]] = None, # ★ ヒューマナイズパラメータを受け取る
+        metric_accent_depth: float = 0.0, ts_str: str = "4/4"
     ):
         # (このメソッドのロジックは変更なし、humanize_params_for_hit を apply_humanization_to_element に渡す)
         if not pattern_events: return
@@ -77,6 +159,7 @@ class DrumGenerator:
             event_velocity = event_def.get("velocity"); event_velocity_factor = event_def.get("velocity_factor")
             if not instrument_name: continue
             final_velocity = int(event_velocity) if event_velocity is not None else (int(base_velocity * float(event_velocity_factor)) if event_velocity_factor is not None else base_velocity)
+            if metric_accent_depth: final_velocity = int(round(final_velocity * float(metric_velocity_factors([event_offset_in_pattern], metric_accent_depth, ts_str)[0])))
             final_velocity = max(1, min(127, final_velocity))
             if event_offset_in_pattern < measure_duration_ql:
                 actual_hit_duration_ql = min(event_duration_ql, measure_duration_ql - event_offset_in_pattern)
@@ -98,8 +181,6 @@ class DrumGenerator:
         drum_part = stream.Part(id="Drums")
         # (初期設定は変更なし)
         drum_part.insert(0, self.default_instrument)
-        drum_part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-        drum_part.insert(0, self.global_time_signature_obj.clone())
 
         if not processed_chord_stream: return drum_part
         logger.info(f"DrumGen: Starting for {len(processed_chord_stream)} blocks.")
@@ -108,13 +189,14 @@ class DrumGenerator:
         for blk_idx, blk_data in enumerate(processed_chord_stream):
             # (パラメータ取得は変更なし)
             block_offset_ql = float(blk_data.get("offset", 0.0))
-            block_duration_ql = float(blk_data.get("q_length", self.global_time_signature_obj.barDuration.quarterLength))
+            block_duration_ql = float(blk_data.get("q_length", self.global_meter.bar_ql))
             drum_params = blk_data.get("part_params", {}).get("drums", {}) # "drums" に修正
             style_key = drum_params.get("drum_style_key", "default_drum_pattern")
             base_velocity = int(drum_params.get("drum_base_velocity", 80)) # "drum_base_velocity" に修正
             fill_interval = drum_params.get("drum_fill_interval_bars", 0)
             fill_options = drum_params.get("drum_fill_keys", [])
             block_fill_key = drum_params.get("drum_fill_key_override")
+            metric_accent_depth = float(drum_params.get("drum_metric_accent", 0.0)) # 拍の強さに応じたベロシティのアクセント
 
             # ★ ヒューマナイズ設定をここで解決 ★
             humanize_this_block = drum_params.get("humanize", True) # modular_composerから渡される想定
@@ -138,41 +220,51 @@ class DrumGenerator:
                 style_def = self.drum_pattern_library.get("default_drum_pattern", DEFAULT_DRUM_PATTERNS_LIB["default_drum_pattern"])
             
             main_pattern_events = style_def.get("pattern", [])
-            pattern_ts_str = style_def.get("time_signature", self.global_time_signature_str)
-            p_ts_obj = get_time_signature_object(pattern_ts_str)
-            p_bar_dur = p_ts_obj.barDuration.quarterLength
+            # 小節の長さとアクセントはブロックの拍子で決める (パターンの拍子は、ブロックに拍子がない場合の既定)
+            pattern_ts_str = blk_data.get("time_signature") or style_def.get("time_signature") or self.global_time_signature_str
+            p_bar_dur = get_meter_info(pattern_ts_str).bar_ql
             if p_bar_dur <= 0: continue
 
-            current_block_time_ql = 0.0
             if blk_data.get("is_first_in_section", False): measures_since_last_fill = 0
 
-            while current_block_time_ql < block_duration_ql - MIN_NOTE_DURATION_QL / 4:
-                measure_start_abs = block_offset_ql + current_block_time_ql
-                current_measure_iter_dur = min(p_bar_dur, block_duration_ql - current_block_time_ql)
-                if current_measure_iter_dur < MIN_NOTE_DURATION_QL: break
-
-                pattern_to_apply = main_pattern_events; applied_fill = False
+            # --- 小節ごとのパターン (メイン or フィル) を先に決める (スカラー処理のみ) ---
+            # 小節の区切りはタイリングエンジンと同じ規則 (最後の半端な小節も含む)
+            measure_plan: List[Tuple[float, float, Optional[str]]] = []
+            for current_block_time_ql, current_measure_iter_dur in bar_spans(block_duration_ql, p_bar_dur, MIN_NOTE_DURATION_QL):
+                applied_fill_key: Optional[str] = None
                 is_eff_last_measure = (current_block_time_ql + p_bar_dur >= block_duration_ql - MIN_NOTE_DURATION_QL)
 
                 if block_fill_key and is_eff_last_measure:
-                    fill_def = style_def.get("fill_ins", {}).get(block_fill_key)
-                    if fill_def: pattern_to_apply = fill_def; applied_fill = True
-                elif not applied_fill and fill_interval > 0 and fill_options and \
+                    if style_def.get("fill_ins", {}).get(block_fill_key): applied_fill_key = block_fill_key
+                elif fill_interval > 0 and fill_options and \
                      (measures_since_last_fill + 1) % fill_interval == 0 and \
                      (current_measure_iter_dur >= p_bar_dur - MIN_NOTE_DURATION_QL / 2):
                     chosen_f_key = random.choice(fill_options)
-                    fill_def = style_def.get("fill_ins", {}).get(chosen_f_key)
-                    if fill_def: pattern_to_apply = fill_def; applied_fill = True
-                
-                self._apply_drum_pattern_to_measure(
-                    drum_part, pattern_to_apply, measure_start_abs,
-                    current_measure_iter_dur, base_velocity,
-                    humanize_params_for_hits_in_block # ★ ヒューマナイズパラメータを渡す
-                )
-                
-                if applied_fill: measures_since_last_fill = 0
+                    if style_def.get("fill_ins", {}).get(chosen_f_key): applied_fill_key = chosen_f_key
+
+                measure_plan.append((current_block_time_ql, current_measure_iter_dur, applied_fill_key))
+
+                if applied_fill_key: measures_since_last_fill = 0
                 elif current_measure_iter_dur >= p_bar_dur - MIN_NOTE_DURATION_QL/2: measures_since_last_fill +=1
-                current_block_time_ql += current_measure_iter_dur
+
+            if NUMPY_AVAILABLE:
+                # --- テンプレートをブロック全体にタイルし、ブロック単位で一括ヒューマナイズ ---
+                midis, offsets, durations, velocities = self._tile_block_events(
+                    style_key, style_def, main_pattern_events, measure_plan, block_offset_ql, base_velocity,
+                    metric_accent_depth, pattern_ts_str)
+                if midis.size == 0: continue
+                if humanize_params_for_hits_in_block:
+                    offsets, durations, velocities = humanize_event_arrays(offsets, durations, velocities, custom_params=humanize_params_for_hits_in_block, ts_str=pattern_ts_str, bar_offset=block_offset_ql)
+                self._insert_hit_arrays(drum_part, midis, offsets, durations, velocities)
+            else:
+                for measure_start_rel, measure_dur, applied_fill_key in measure_plan:
+                    pattern_to_apply = style_def.get("fill_ins", {}).get(applied_fill_key) if applied_fill_key else main_pattern_events
+                    self._apply_drum_pattern_to_measure(
+                        drum_part, pattern_to_apply, block_offset_ql + measure_start_rel,
+                        measure_dur, base_velocity,
+                        humanize_params_for_hits_in_block, # ★ ヒューマナイズパラメータを渡す
+                        metric_accent_depth, pattern_ts_str
+                    )
         
         logger.info(f"DrumGen: Finished. Part has {len(drum_part.flatten().notesAndRests)} elements.")
         return drum_part
@@ -0,0 +1,153 @@
+# --- START OF FILE utilities/event_buffer.py ---
+"""event_buffer.py
+パート1本分のノートイベントを配列のまま溜めておくバッファ。
+
+- ジェネレータはイベント (オフセット・デュレーション・MIDI 番号・ベロシティ・和音グループ・アーティキュレーション) を
+  配列単位で追加し、music21 のオブジェクトは to_part で最後に一度だけ作る
+- 同じグループ番号のイベントは1つの Chord になる (グループ -1 は単音)
+- humanize はイベント列全体に一括で適用し、和音は構成音を同じだけずらす
+"""
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from music21 import articulations, chord as m21chord, note, stream, volume as m21volume
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .humanizer import humanize_event_arrays, NUMPY_AVAILABLE, np
+except ImportError:
+    from humanizer import humanize_event_arrays, NUMPY_AVAILABLE, np # type: ignore
+
+NO_GROUP = -1
+
+# アーティキュレーション番号 → music21 のクラス (0 はなし)
+ARTICULATION_NONE = 0
+ARTICULATION_STACCATO = 1
+ARTICULATION_STACCATISSIMO = 2
+ARTICULATION_ACCENT = 3
+ARTICULATION_CLASSES: Dict[int, Any] = {
+    ARTICULATION_STACCATO: articulations.Staccato,
+    ARTICULATION_STACCATISSIMO: articulations.Staccatissimo,
+    ARTICULATION_ACCENT: articulations.Accent,
+}
+
+
+class NoteEventBuffer:
+    """ノートイベントの配列バッファ。NumPy 必須。"""
+    __slots__ = ("_chunks", "_next_group", "_arrays")
+
+    def __init__(self):
+        if not NUMPY_AVAILABLE or np is None:
+            raise RuntimeError("NoteEventBuffer requires NumPy.")
+        self._chunks: List[Tuple[Any, ...]] = []
+        self._next_group = 0
+        self._arrays: Optional[Tuple[Any, ...]] = None
+
+    def __len__(self) -> int:
+        return len(self.arrays()[0])
+
+    @classmethod
+    def from_stream(cls, source: stream.Stream) -> "NoteEventBuffer":
+        """生成済みの Part / Score のノートと和音をイベントにする (ベロシティがなければ 64)。"""
+        def velocity_of(n_obj: note.Note) -> int:
+            return int(n_obj.volume.velocity) if n_obj.volume is not None and n_obj.volume.velocity is not None else 64
+        buffer = cls()
+        for el in source.flatten().notes:
+            if isinstance(el, m21chord.Chord) and el.notes:
+                members = list(el.notes)
+                buffer.add_events(np.full(len(members), float(el.offset)), float(el.quarterLength), [int(n.pitch.midi) for n in members],
+                                  [velocity_of(n) for n in members], group=buffer.new_group() if len(members) > 1 else NO_GROUP)
+            elif isinstance(el, note.Note):
+                buffer.add_events(float(el.offset), float(el.quarterLength), int(el.pitch.midi), velocity_of(el))
+        return buffer
+
+    def new_group(self) -> int:
+        """和音1つ分のグループ番号を払い出す。"""
+        self._next_group += 1
+        return self._next_group - 1
+
+    def add_events(self, offsets: Any, durations: Any, midis: Any, velocities: Any,
+                   articulation: int = ARTICULATION_NONE, group: int = NO_GROUP) -> None:
+        """同じ長さの配列でイベントを追加する (スカラーは全イベントに適用)。group を指定すると全イベントで1つの和音になる。"""
+        offs = np.atleast_1d(np.asarray(offsets, dtype=np.float64))
+        n = offs.shape[0]
+        if n == 0: return
+        self._chunks.append((
+            offs,
+            np.broadcast_to(np.asarray(durations, dtype=np.float64), (n,)).copy(),
+            np.broadcast_to(np.asarray(midis, dtype=np.int64), (n,)).copy(),
+            np.clip(np.broadcast_to(np.rint(np.asarray(velocities, dtype=np.float64)), (n,)), 1, 127).astype(np.int64),
+            np.full(n, group, dtype=np.int64),
+            np.full(n, articulation, dtype=np.int8),
+        ))
+        self._arrays = None
+
+    def add_chord(self, offset: float, duration_ql: float, midis: Sequence[int], velocity: Any,
+                  articulation: int = ARTICULATION_NONE) -> None:
+        """同時に鳴る和音を1つ追加する。"""
+        if len(midis) == 0: return
+        self.add_events(np.full(len(midis), float(offset)), duration_ql, midis, velocity, articulation,
+                        self.new_group() if len(midis) > 1 else NO_GROUP)
+
+    def arrays(self) -> Tuple[Any, Any, Any, Any, Any, Any]:
+        """(offsets, durations, midis, velocities, groups, articulations) を連結した配列で返す。"""
+        if self._arrays is None:
+            if self._chunks:
+                self._arrays = tuple(np.concatenate(cols) for cols in zip(*self._chunks))
+            else:
+                self._arrays = (np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8))
+            self._chunks = [self._arrays] if len(self._arrays[0]) else []
+        return self._arrays
+
+    def humanize(self, template_name: Optional[str] = None, custom_params: Optional[Dict[str, Any]] = None,
+                 ts_str: Optional[str] = "4/4", meter_map: Optional[Any] = None) -> None:
+        """humanize_event_arrays をバッファ全体に一度だけ適用する。和音の構成音は先頭音と同じだけずらす。"""
+        offs, durs, midis, vels, groups, arts = self.arrays()
+        if len(offs) == 0: return
+        order = np.argsort(offs, kind="stable")
+        new_offs = np.empty_like(offs); new_durs = np.empty_like(durs); new_vels = np.empty_like(vels)
+        new_offs[order], new_durs[order], new_vels[order] = humanize_event_arrays(
+            offs[order], durs[order], vels[order], template_name=template_name, custom_params=custom_params, ts_str=ts_str, meter_map=meter_map)
+        grouped = groups != NO_GROUP
+        if grouped.any():
+            _, first_idx, inverse = np.unique(groups[grouped], return_index=True, return_inverse=True)
+            shift = (new_offs - offs)[grouped]
+            scale = (new_durs / np.maximum(durs, 1e-9))[grouped]
+            new_offs[grouped] = offs[grouped] + shift[first_idx][inverse]
+            new_durs[grouped] = durs[grouped] * scale[first_idx][inverse]
+        self._arrays = (new_offs, new_durs, midis, new_vels, groups, arts)
+        self._chunks = [self._arrays]
+
+    def to_part(self, target_part: stream.Part) -> stream.Part:
+        """バッファのイベントを Note / Chord にして target_part に挿入する (オフセット順)。"""
+        offs, durs, midis, vels, groups, arts = self.arrays()
+        if len(offs) == 0: return target_part
+        order = np.lexsort((midis, groups, offs))
+        chord_members: Dict[int, List[int]] = {}
+        for i in order.tolist():
+            g = int(groups[i])
+            if g != NO_GROUP:
+                chord_members.setdefault(g, []).append(i)
+                continue
+            n_obj = note.Note(int(midis[i]), quarterLength=float(durs[i]))
+            n_obj.volume = m21volume.Volume(velocity=int(vels[i]))
+            art_cls = ARTICULATION_CLASSES.get(int(arts[i]))
+            if art_cls is not None: n_obj.articulations = [art_cls()]
+            target_part.coreInsert(float(offs[i]), n_obj)
+        for members in chord_members.values():
+            first = members[0]
+            # 整数から Chord を作ると異名同音の簡略化探索が走るので、Note から組み立てる
+            chord_notes = []
+            for i in members:
+                n_in_ch = note.Note(int(midis[i]))
+                n_in_ch.volume = m21volume.Volume(velocity=int(vels[i]))
+                chord_notes.append(n_in_ch)
+            ch = m21chord.Chord(chord_notes, quarterLength=float(durs[first]))
+            art_cls = ARTICULATION_CLASSES.get(int(arts[first]))
+            if art_cls is not None: ch.articulations = [art_cls()]
+            target_part.coreInsert(float(offs[first]), ch)
+        target_part.coreElementsChanged()
+        return target_part
+# --- END OF FILE utilities/event_buffer.py ---
@@ -0,0 +1,262 @@
+# --- START OF FILE generator/fretboard_index.py ---
+"""fretboard_index.py
+ギターの指板 (6/7 弦 × 24 フレット) のポジション索引。
+
+- チューニングごとに 弦 × フレット の MIDI 番号/ピッチクラス表を一度だけ作る
+- ピッチクラス集合 (12bit マスク) + ルートごとに、フレットのストレッチ・指の本数・ミュート弦の制約を満たす
+  押さえ方 (シェイプ) を列挙し、弾きやすさの順に並べて小さな配列 (array) で保持する
+- 一度解決したピッチクラス集合は辞書から O(1) で引ける (同じコードは曲中で二度と列挙しない)
+- シェイプのピッチは弦の順 (低音弦 → 高音弦) で返すので、ストロークの順序は実際の弦の並びに従う
+- optimize_fingering: 進行全体でブロックごとの候補シェイプに動的計画法をかけ、手の移動が最小になる並びを選ぶ
+"""
+import logging
+from array import array
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+NUMPY_AVAILABLE = False
+np = None
+try:
+    import numpy
+    np = numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    logger.warning("FretboardIndex: NumPy not found. optimize_fingering falls back to per-chord best shapes.")
+
+# 低音弦 → 高音弦 の開放弦 MIDI 番号
+GUITAR_TUNINGS: Dict[str, Tuple[int, ...]] = {
+    "standard": (40, 45, 50, 55, 59, 64),        # E A D G B E
+    "half_step_down": (39, 44, 49, 54, 58, 63),  # Eb Ab Db Gb Bb Eb
+    "drop_d": (38, 45, 50, 55, 59, 64),          # D A D G B E
+    "dadgad": (38, 45, 50, 55, 57, 62),          # D A D G A D
+    "open_g": (38, 43, 50, 55, 59, 62),          # D G D G B D
+    "open_d": (38, 45, 50, 54, 57, 62),          # D A D F# A D
+    "standard_7": (35, 40, 45, 50, 55, 59, 64),  # B E A D G B E
+    "drop_a_7": (33, 40, 45, 50, 55, 59, 64),    # A E A D G B E
+}
+SEVEN_STRING_DEFAULTS: Dict[str, str] = {"standard": "standard_7", "drop_d": "drop_a_7"}
+
+DEFAULT_NUM_FRETS = 24
+DEFAULT_MAX_STRETCH = 3   # 押さえるフレットの最大差 (人差し指〜小指で 4 フレット分)
+DEFAULT_MAX_SHAPES = 16   # ピッチクラス集合ごとに保持するシェイプ数
+MAX_FINGERS = 4
+MUTED = -1
+
+# optimize_fingering の遷移コストの重み
+DEFAULT_POSITION_WEIGHT = 0.5  # ポジション (押さえるフレットの平均) の移動 1 フレットあたり
+DEFAULT_FINGER_WEIGHT = 0.3    # 押さえ直す弦 1 本あたり
+DEFAULT_OPEN_WEIGHT = 0.2      # 遷移先の開放弦 1 本あたりの減点 (開放弦は持ち替えの間も鳴らせる)
+
+PERFECT_FIFTH = 7
+
+
+def _popcount(mask: int) -> int:
+    return bin(mask).count("1")
+
+def pcs_mask(pcs: Iterable[int]) -> int:
+    mask = 0
+    for pc in pcs: mask |= 1 << (int(pc) % 12)
+    return mask
+
+def resolve_tuning(tuning: Union[str, Sequence[int], None] = "standard", num_strings: int = 6) -> Tuple[int, ...]:
+    """チューニング名 (または開放弦 MIDI 番号の列) を開放弦のタプルにする。7 弦なら対応する 7 弦チューニングを使う。"""
+    if tuning is not None and not isinstance(tuning, str):
+        return tuple(int(m) for m in tuning)
+    name = tuning or "standard"
+    if num_strings == 7 and name in SEVEN_STRING_DEFAULTS: name = SEVEN_STRING_DEFAULTS[name]
+    open_strings = GUITAR_TUNINGS.get(name)
+    if open_strings is None:
+        logger.warning(f"FretboardIndex: Unknown tuning '{tuning}'. Using standard.")
+        open_strings = GUITAR_TUNINGS[SEVEN_STRING_DEFAULTS["standard"] if num_strings == 7 else "standard"]
+    return open_strings
+
+
+class ShapeSet:
+    """
+    1つのピッチクラス集合に対する押さえ方の一覧 (弾きやすい順)。
+    frets は 弦数 × シェイプ数 のフラットな array ('b', ミュートは -1)、midis も同形 ('h', ミュートは -1)。
+    """
+    __slots__ = ("num_strings", "frets", "midis", "scores", "bass_midis", "_features")
+
+    def __init__(self, num_strings: int, shapes: Sequence[Tuple[float, Tuple[int, ...], Tuple[int, ...]]]):
+        self.num_strings = num_strings
+        self.frets = array("b"); self.midis = array("h"); self.scores = array("f"); self.bass_midis = array("h")
+        self._features = None
+        for score, frets, midis in shapes:
+            self.frets.extend(frets); self.midis.extend(midis); self.scores.append(score)
+            self.bass_midis.append(min(m for m in midis if m != MUTED))
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def shape_frets(self, idx: int) -> Tuple[int, ...]:
+        start = idx * self.num_strings
+        return tuple(self.frets[start:start + self.num_strings])
+
+    def shape_midis(self, idx: int) -> List[int]:
+        """シェイプ idx の鳴っている弦の MIDI 番号 (低音弦 → 高音弦の順)。"""
+        start = idx * self.num_strings
+        return [m for m in self.midis[start:start + self.num_strings] if m != MUTED]
+
+    def best_index(self, target_bass_midi: Optional[int] = None, register_weight: float = 0.1) -> int:
+        """弾きやすさのスコアから、最低音と target_bass_midi の距離 (半音あたり register_weight) を引いて最良のものを選ぶ。"""
+        if target_bass_midi is None or len(self.scores) <= 1: return 0
+        return max(range(len(self.scores)), key=lambda i: self.scores[i] - register_weight * abs(self.bass_midis[i] - target_bass_midi))
+
+    def features(self):
+        """(frets[K, 弦数], ポジション[K], 開放弦の数[K]) の NumPy 配列。ポジションは押さえるフレットの平均 (開放弦のみなら 0)。"""
+        if self._features is None:
+            frets = np.asarray(self.frets, dtype=np.int64).reshape(len(self.scores), self.num_strings)
+            fretted = frets > 0
+            n_fretted = fretted.sum(axis=1)
+            position = np.where(n_fretted > 0, (frets * fretted).sum(axis=1) / np.maximum(n_fretted, 1), 0.0)
+            self._features = (frets, position, (frets == 0).sum(axis=1))
+        return self._features
+
+
+class FretboardIndex:
+    """チューニング・フレット数・ストレッチごとの指板索引。get_fretboard_index で共有インスタンスを取得する。"""
+
+    def __init__(self, open_strings: Sequence[int], num_frets: int = DEFAULT_NUM_FRETS,
+                 max_stretch: int = DEFAULT_MAX_STRETCH, max_shapes: int = DEFAULT_MAX_SHAPES):
+        self.open_strings: Tuple[int, ...] = tuple(int(m) for m in open_strings)
+        self.num_strings = len(self.open_strings)
+        self.num_frets = int(num_frets)
+        self.max_stretch = int(max_stretch)
+        self.max_shapes = int(max_shapes)
+        # 弦 × フレット の MIDI 番号と、弦ごと・ピッチクラスごとのフレット一覧
+        self.midi_table: Tuple[Tuple[int, ...], ...] = tuple(tuple(o + f for f in range(self.num_frets + 1)) for o in self.open_strings)
+        self._frets_by_pc: Tuple[Tuple[Tuple[int, ...], ...], ...] = tuple(
+            tuple(tuple(f for f in range(self.num_frets + 1) if (o + f) % 12 == pc) for pc in range(12)) for o in self.open_strings)
+        self._shapes: Dict[Tuple[int, int, int], Optional[ShapeSet]] = {}
+
+    def shapes_for(self, pc_mask: int, root_pc: Optional[int] = None, max_sounding: Optional[int] = None) -> Optional[ShapeSet]:
+        """
+        ピッチクラス集合 (12bit マスク) の押さえ方を返す。2回目以降は辞書参照のみ。
+        全音を押さえられない場合は完全5度を省いた集合で探し、それでもなければ None。
+        """
+        root = -1 if root_pc is None else int(root_pc) % 12
+        limit = self.num_strings if max_sounding is None else max(1, min(int(max_sounding), self.num_strings))
+        key = (pc_mask & 0xFFF, root, limit)
+        if key in self._shapes: return self._shapes[key]
+        shape_set = self._build(key[0], root, limit)
+        if shape_set is None and root >= 0:
+            fifth_bit = 1 << ((root + PERFECT_FIFTH) % 12)
+            if key[0] & fifth_bit and _popcount(key[0]) > 2:
+                shape_set = self._build(key[0], root, limit, required_mask=key[0] & ~fifth_bit)
+        if shape_set is None:
+            logger.debug(f"FretboardIndex: No playable shape for pc mask {key[0]:012b} (root {root_pc}).")
+        self._shapes[key] = shape_set
+        return shape_set
+
+    def _build(self, pc_mask: int, root: int, max_sounding: int, required_mask: Optional[int] = None) -> Optional[ShapeSet]:
+        required = pc_mask if required_mask is None else required_mask
+        n_req = _popcount(required)
+        if n_req == 0 or n_req > max_sounding: return None
+        min_sounding = min(3, n_req, max_sounding) if n_req > 1 else 1
+        candidates_per_string = [
+            sorted(f for pc in range(12) if pc_mask >> pc & 1 for f in self._frets_by_pc[s][pc]) for s in range(self.num_strings)]
+        found: List[Tuple[float, Tuple[int, ...], Tuple[int, ...]]] = []
+        frets = [MUTED] * self.num_strings
+        n = self.num_strings; stretch = self.max_stretch
+
+        # 低音弦から順に深さ優先で列挙。鳴らす弦は連続させる (内側の弦はミュートしない)
+        def dfs(s: int, lo: int, hi: int, covered: int, sounding: int, ended: bool):
+            if s == n:
+                if sounding >= min_sounding and covered & required == required:
+                    scored = self._score(frets, root)
+                    if scored is not None: found.append(scored)
+                return
+            frets[s] = MUTED
+            dfs(s + 1, lo, hi, covered, sounding, ended or sounding > 0)
+            if ended or sounding >= max_sounding: return
+            for f in candidates_per_string[s]:
+                if f > 0:
+                    new_lo, new_hi = min(lo, f), max(hi, f)
+                    if new_hi - new_lo > stretch: continue
+                else:
+                    new_lo, new_hi = lo, hi
+                frets[s] = f
+                dfs(s + 1, new_lo, new_hi, covered | 1 << ((self.open_strings[s] + f) % 12), sounding + 1, False)
+            frets[s] = MUTED
+
+        dfs(0, self.num_frets + 1, -1, 0, 0, False)
+        if not found: return None
+        found.sort(key=lambda x: -x[0])
+        return ShapeSet(self.num_strings, found[:self.max_shapes])
+
+    def _score(self, frets: List[int], root: int) -> Optional[Tuple[float, Tuple[int, ...], Tuple[int, ...]]]:
+        fretted = [f for f in frets if f > 0]
+        if fretted:
+            low = min(fretted)
+            at_low = fretted.count(low)
+            # 最低フレットに2音以上あればセーハ (人差し指1本) とみなす
+            fingers = (1 + len(fretted) - at_low) if at_low >= 2 else len(fretted)
+            if fingers > MAX_FINGERS: return None
+            span = max(fretted) - low
+        else:
+            low = 0; span = 0
+        midis = tuple(self.open_strings[s] + f if f != MUTED else MUTED for s, f in enumerate(frets))
+        sounding = [m for m in midis if m != MUTED]
+        n_open = sum(1 for f in frets if f == 0)
+        # 隣の弦より低い音になる (弦の順と音高の順が逆転する) シェイプは響きが崩れるので減点
+        crossings = sum(1 for a, b in zip(sounding, sounding[1:]) if b < a)
+        score = 0.5 * len(sounding) + 0.3 * n_open - 0.15 * low - 0.4 * span - 1.0 * crossings
+        if root >= 0 and min(sounding) % 12 == root: score += 3.0
+        return score, tuple(frets), midis
+
+
+def _transition_costs(prev: ShapeSet, cur: ShapeSet, position_weight: float, finger_weight: float, open_weight: float):
+    """prev の各シェイプ → cur の各シェイプ の遷移コスト行列 [K_prev, K_cur]。"""
+    prev_frets, prev_pos, _ = prev.features()
+    cur_frets, cur_pos, cur_open = cur.features()
+    # 押さえ直す弦: 遷移先で押さえる弦のうち、フレットが変わるもの
+    refingered = ((prev_frets[:, None, :] != cur_frets[None, :, :]) & (cur_frets[None, :, :] > 0)).sum(axis=2)
+    return (position_weight * np.abs(prev_pos[:, None] - cur_pos[None, :])
+            + finger_weight * refingered
+            - open_weight * cur_open[None, :])
+
+def optimize_fingering(shape_sets: Sequence[Optional[ShapeSet]], target_bass_midi: Optional[int] = None,
+                       register_weight: float = 0.1,
+                       position_weight: float = DEFAULT_POSITION_WEIGHT,
+                       finger_weight: float = DEFAULT_FINGER_WEIGHT,
+                       open_weight: float = DEFAULT_OPEN_WEIGHT) -> List[Optional[int]]:
+    """
+    ブロック順のシェイプ候補列から、(弾きにくさ + 音域のずれ) と遷移コストの総和が最小になるシェイプ番号の列を返す (Viterbi)。
+    None のブロック (休符など) は None を返し、そこで手の位置の連続性は途切れる。NumPy がなければ各コード単独の最良シェイプ。
+    """
+    if not NUMPY_AVAILABLE:
+        return [ss.best_index(target_bass_midi, register_weight) if ss is not None and len(ss) else None for ss in shape_sets]
+    chosen: List[Optional[int]] = [None] * len(shape_sets)
+    run_start = 0
+    while run_start < len(shape_sets):
+        if shape_sets[run_start] is None or not len(shape_sets[run_start]):
+            run_start += 1; continue
+        run_end = run_start
+        while run_end < len(shape_sets) and shape_sets[run_end] is not None and len(shape_sets[run_end]): run_end += 1
+        run = shape_sets[run_start:run_end]
+        unary = [-np.asarray(ss.scores, dtype=float) + (register_weight * np.abs(np.asarray(ss.bass_midis, dtype=float) - target_bass_midi) if target_bass_midi is not None else 0.0) for ss in run]
+        cost = unary[0]
+        back_pointers = []
+        for step in range(1, len(run)):
+            total = cost[:, None] + _transition_costs(run[step - 1], run[step], position_weight, finger_weight, open_weight)
+            back = np.argmin(total, axis=0)
+            back_pointers.append(back)
+            cost = total[back, np.arange(total.shape[1])] + unary[step]
+        idx = int(np.argmin(cost))
+        path = [idx]
+        for back in reversed(back_pointers):
+            idx = int(back[idx]); path.append(idx)
+        chosen[run_start:run_end] = reversed(path)
+        run_start = run_end
+    return chosen
+
+
+@lru_cache(maxsize=32)
+def get_fretboard_index(tuning: Union[str, Tuple[int, ...], None] = "standard", num_strings: int = 6,
+                        num_frets: int = DEFAULT_NUM_FRETS, max_stretch: int = DEFAULT_MAX_STRETCH) -> FretboardIndex:
+    """チューニングごとの共有 FretboardIndex (キャッシュ済み)。"""
+    return FretboardIndex(resolve_tuning(tuning, num_strings), num_frets=num_frets, max_stretch=max_stretch)
+# --- END OF FILE generator/fretboard_index.py ---
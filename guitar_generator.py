@@ -1,8 +1,8 @@
 # --- START OF FILE generator/guitar_generator.py (ヒューマナイズ外部化版) ---
 import music21
 from typing import List, Dict, Optional, Tuple, Any, Sequence, Union
-from music21 import (stream, note, harmony, pitch, meter, duration,
-                     instrument as m21instrument, scale, interval, tempo, key,
+from music21 import (stream, note, harmony, pitch, duration,
+                     instrument as m21instrument, scale, interval, key,
                      chord as m21chord, articulations, volume as m21volume, expressions)
 import random
 import logging
@@ -10,22 +10,19 @@ import logging
 # import copy      # humanizer.py に移管
 
 # ユーティリティのインポート
+from utilities.core_music_utils import get_meter_info, MIN_NOTE_DURATION_QL
+from utilities.humanizer import apply_humanization_to_part, NUMPY_AVAILABLE, np # パート全体への適用を想定
+from utilities.event_buffer import NoteEventBuffer, ARTICULATION_STACCATISSIMO
+from utilities.tempo_map import MeterMap
+from utilities.chord_timeline import ChordTimeline
+from utilities.harmonic_context import WEIGHT_CHORD_TONE, row_pc_mask
+from utilities.rhythm_tiler import tile_pattern_events, resolve_tiling_policy, TILE_BAR # NumPy がなくても動く (ループ版)
+
 try:
-    from utilities.core_music_utils import MIN_NOTE_DURATION_QL, get_time_signature_object, sanitize_chord_label
-    from utilities.humanizer import apply_humanization_to_part, HUMANIZATION_TEMPLATES # パート全体への適用を想定
+    from .fretboard_index import get_fretboard_index, pcs_mask, optimize_fingering
 except ImportError:
-    logger_fallback = logging.getLogger(__name__ + ".fallback_utils")
-    logger_fallback.warning("GuitarGen: Could not import from utilities. Using fallbacks.")
-    MIN_NOTE_DURATION_QL = 0.125
-    def get_time_signature_object(ts_str: Optional[str]) -> meter.TimeSignature:
-        if not ts_str: ts_str = "4/4"; return meter.TimeSignature(ts_str)
-        try: return meter.TimeSignature(ts_str)
-        except: return meter.TimeSignature("4/4")
-    def sanitize_chord_label(label: Optional[str]) -> Optional[str]:
-        if not label or label.strip().lower() in ["rest", "n.c.", "nc", "none"]: return None
-        return label.strip()
-    def apply_humanization_to_part(part, template_name=None, custom_params=None): return part
-    HUMANIZATION_TEMPLATES = {}
+    get_fretboard_index = None # 指板索引なし: 旧来のオクターブ調整ボイシングのみ
+    def optimize_fingering(shape_sets, *args, **kwargs): return [None] * len(shape_sets)
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +32,7 @@ GUITAR_STRUM_DELAY_QL: float = 0.02
 MIN_STRUM_NOTE_DURATION_QL: float = 0.05
 STYLE_BLOCK_CHORD = "block_chord"; STYLE_STRUM_BASIC = "strum_basic"; STYLE_ARPEGGIO = "arpeggio"
 STYLE_POWER_CHORDS = "power_chords"; STYLE_MUTED_RHYTHM = "muted_rhythm"; STYLE_SINGLE_NOTE_LINE = "single_note_line"
+VOICING_FINGERING_OPTIMIZED = "fingering_optimized" # 進行全体で手の移動が最小になるシェイプを選ぶ voicing_style
 
 
 class GuitarGenerator:
@@ -42,7 +40,8 @@ class GuitarGenerator:
                  rhythm_library: Optional[Dict[str, Dict]] = None,
                  default_instrument=m21instrument.AcousticGuitar(),
                  global_tempo: int = 120,
-                 global_time_signature: str = "4/4"):
+                 global_time_signature: str = "4/4",
+                 rng: Optional[random.Random] = None):
         # (初期化ロジックは変更なし)
         self.rhythm_library = rhythm_library if rhythm_library else {}
         if "guitar_default_quarters" not in self.rhythm_library:
@@ -51,16 +50,96 @@ class GuitarGenerator:
         self.default_instrument = default_instrument
         self.global_tempo = global_tempo
         self.global_time_signature_str = global_time_signature
-        self.global_time_signature_obj = get_time_signature_object(global_time_signature)
+        self.global_meter = get_meter_info(global_time_signature)
+        self.rng = rng or random.Random()
+
+    # --- ストローク/ミュートの規則 (ノートごとの生成ループと配列版で共有) ---
+    @staticmethod
+    def _strum_delay_ql(guitar_params: Dict[str, Any]) -> float:
+        return float(guitar_params.get("strum_delay_ql") or GUITAR_STRUM_DELAY_QL)
+
+    @staticmethod
+    def _strum_velocity_adjustments(n_strings: int) -> List[int]:
+        """ストロークで i 番目に鳴る弦のベロシティ補正。ダウン/アップとも最初に鳴る弦が +5、最後が -5。"""
+        if n_strings <= 1: return [0] * n_strings
+        return [int((n_strings - 1 - i) / (n_strings - 1) * 10 - 5) for i in range(n_strings)]
+
+    def _mute_velocities(self, event_velocity: int, n_hits: int) -> List[int]:
+        """ミュートの各ヒットのベロシティ (ジェネレータの rng で ±5 揺らす)。"""
+        return [int(event_velocity * 0.6) + self.rng.randint(-5, 5) for _ in range(n_hits)]
 
     def _get_guitar_friendly_voicing(
+        self, m21_cs: harmony.ChordSymbol, num_strings: int = 6,
+        preferred_octave_bottom: int = 2, max_octave_top: int = 5,
+        voicing_style: str = "standard", tuning: Optional[str] = "standard", weights_row: Optional[Sequence[float]] = None
+    ) -> List[pitch.Pitch]:
+        """
+        指板索引 (fretboard_index) から実際に押さえられるシェイプを引き、鳴る弦の順 (低音弦 → 高音弦) でピッチを返す。
+        最低音が preferred_octave_bottom の C に近いシェイプを優先する。索引にシェイプがなければ旧来のオクターブ調整に戻る。
+        """
+        if not m21_cs or not m21_cs.pitches: return []
+        shape_set = self._lookup_shape_set(m21_cs, num_strings, voicing_style, tuning, weights_row)
+        if shape_set is not None:
+            # open: 開放弦を含むローポジションのシェイプ (索引の順位そのまま) を優先し、音域の寄せは弱くする
+            register_weight = 0.03 if voicing_style == "open" else 0.1
+            best = shape_set.best_index(12 * (preferred_octave_bottom + 1), register_weight)
+            return [pitch.Pitch(midi=m) for m in shape_set.shape_midis(best)]
+        return self._get_octave_shifted_voicing(m21_cs, num_strings, preferred_octave_bottom, max_octave_top, voicing_style)
+
+    def _lookup_shape_set(self, m21_cs: harmony.ChordSymbol, num_strings: int = 6,
+                          voicing_style: str = "standard", tuning: Optional[str] = "standard", weights_row: Optional[Sequence[float]] = None):
+        """
+        コードの候補シェイプ (ShapeSet) を指板索引から引く。索引が使えない、または押さえられなければ None。
+        weights_row (HarmonicContext.weights[blk_idx]) を渡すと、指板の音域 lo:hi のコードトーンからシェイプを引く。
+        """
+        if get_fretboard_index is None or not m21_cs or not m21_cs.pitches: return None
+        root = m21_cs.root()
+        fretboard = get_fretboard_index(tuning or "standard", 7 if num_strings == 7 else 6)
+        if voicing_style == "power_chord_root_fifth" and root:
+            return fretboard.shapes_for(pcs_mask([root.pitchClass, root.pitchClass + 7]), root.pitchClass, max_sounding=3)
+        if weights_row is not None:
+            lo_midi, hi_midi = min(fretboard.open_strings), max(fretboard.open_strings) + fretboard.num_frets
+            chord_mask = row_pc_mask(weights_row[lo_midi:hi_midi + 1], lo_midi, WEIGHT_CHORD_TONE)
+        else: chord_mask = pcs_mask(p.pitchClass for p in m21_cs.pitches)
+        return fretboard.shapes_for(chord_mask, root.pitchClass if root else None, max_sounding=num_strings)
+
+    def _plan_optimized_voicings(self, processed_chord_stream: List[Dict], chord_timeline: ChordTimeline) -> Dict[int, List[pitch.Pitch]]:
+        """
+        voicing_style が fingering_optimized のブロックについて、連続するブロックごとに optimize_fingering で
+        シェイプを選び、ブロック番号 → ピッチ (弦の順) を返す。チューニング/弦数が変わる所、他のスタイルや休符で区切る。
+        """
+        planned: Dict[int, List[pitch.Pitch]] = {}
+        weights = chord_timeline.harmonic_context().weights
+        segment: List[Tuple[int, Any]] = []; segment_key: Optional[Tuple[Any, ...]] = None
+
+        def flush():
+            if not segment: return
+            target_bass = 12 * (int(segment_key[2]) + 1)
+            picks = optimize_fingering([ss for _, ss in segment], target_bass)
+            for (b_idx, ss), pick in zip(segment, picks):
+                if pick is not None: planned[b_idx] = [pitch.Pitch(midi=m) for m in ss.shape_midis(pick)]
+            segment.clear()
+
+        for blk_idx, blk_data in enumerate(processed_chord_stream):
+            guitar_params = blk_data.get("part_params", {}).get("guitar", {})
+            if guitar_params.get("guitar_voicing_style") != VOICING_FINGERING_OPTIMIZED:
+                flush(); continue
+            key = (guitar_params.get("guitar_tuning", "standard"), guitar_params.get("guitar_num_strings", 6), guitar_params.get("guitar_target_octave", 3))
+            shape_set = self._lookup_shape_set(chord_timeline.chord_at(blk_idx), key[1], "standard", key[0], weights[blk_idx])
+            if shape_set is None or key != segment_key:
+                flush(); segment_key = key
+            if shape_set is not None: segment.append((blk_idx, shape_set))
+        flush()
+        logger.info(f"GuitarGen: Optimized fingering for {len(planned)} blocks.")
+        return planned
+
+    def _get_octave_shifted_voicing(
         self, m21_cs: harmony.ChordSymbol, num_strings: int = 6,
         preferred_octave_bottom: int = 2, max_octave_top: int = 5,
         voicing_style: str = "standard"
     ) -> List[pitch.Pitch]:
-        # (このメソッドのロジックは変更なし)
+        # 指板索引が使えない場合のフォールバック (旧来のボイシングロジック)
         if not m21_cs or not m21_cs.pitches: return []
-        # ... (前回のボイシングロジック) ...
         original_pitches = list(m21_cs.pitches); root = m21_cs.root()
         voiced_pitches: List[pitch.Pitch] = []
         if voicing_style == "power_chord_root_fifth" and root:
@@ -86,13 +165,13 @@ class GuitarGenerator:
             if p_cand.name not in selected_dict and pitch.Pitch(f"E{DEFAULT_GUITAR_OCTAVE_RANGE[0]-1}").ps <= p_cand.ps <= pitch.Pitch(f"G{DEFAULT_GUITAR_OCTAVE_RANGE[1]+1}").ps:
                 selected_dict[p_cand.name] = p_cand
         voiced_pitches = sorted(list(selected_dict.values()), key=lambda p:p.ps)
-        # ... (残りのボイシング調整ロジック) ...
         return voiced_pitches[:num_strings]
 
 
     def _create_notes_from_event(
         self, m21_cs: harmony.ChordSymbol, guitar_params: Dict[str, Any],
-        event_abs_offset: float, event_duration_ql: float, event_velocity: int
+        event_abs_offset: float, event_duration_ql: float, event_velocity: int,
+        planned_pitches: Optional[List[pitch.Pitch]] = None, weights_row: Optional[Sequence[float]] = None
     ) -> List[Union[note.Note, m21chord.Chord]]:
         # (このメソッドのロジックは変更なし、ヒューマナイズは呼び出し側で行う)
         notes_for_event: List[Union[note.Note, m21chord.Chord]] = []
@@ -120,7 +199,8 @@ class GuitarGenerator:
         num_strings = guitar_params.get("guitar_num_strings", 6)
         preferred_octave = guitar_params.get("guitar_target_octave", 3)
         voicing_style_name = guitar_params.get("guitar_voicing_style", "standard")
-        chord_pitches = self._get_guitar_friendly_voicing(m21_cs, num_strings, preferred_octave, voicing_style_name)
+        tuning_name = guitar_params.get("guitar_tuning", "standard")
+        chord_pitches = planned_pitches or self._get_guitar_friendly_voicing(m21_cs, num_strings, preferred_octave, voicing_style=voicing_style_name, tuning=tuning_name, weights_row=weights_row)
         if not chord_pitches: return []
 
         if style == STYLE_BLOCK_CHORD:
@@ -129,20 +209,22 @@ class GuitarGenerator:
             ch.offset = event_abs_offset # ★ 絶対オフセットを設定
             notes_for_event.append(ch)
         elif style == STYLE_STRUM_BASIC:
+            # chord_pitches は弦の順 (低音弦 → 高音弦)。ダウンストロークは低音弦から、アップは高音弦から鳴る
             is_down = guitar_params.get("strum_direction", "down").lower() == "down"
-            play_order = list(reversed(chord_pitches)) if is_down else chord_pitches
+            play_order = chord_pitches if is_down else list(reversed(chord_pitches))
+            strum_delay = self._strum_delay_ql(guitar_params)
+            vel_adjs = self._strum_velocity_adjustments(len(play_order))
             for i, p_obj in enumerate(play_order):
                 n = note.Note(p_obj)
                 n.duration = duration.Duration(quarterLength=max(MIN_STRUM_NOTE_DURATION_QL, event_duration_ql * 0.9))
-                n.offset = event_abs_offset + (i * GUITAR_STRUM_DELAY_QL) # ★ 絶対オフセット
-                vel_adj = int(((len(play_order)-1-i)/(len(play_order)-1)*10)-5) if is_down and len(play_order)>1 else (int((i/(len(play_order)-1)*10)-5) if len(play_order)>1 else 0)
-                n.volume = volume.Volume(velocity=max(1, min(127, event_velocity + vel_adj)))
+                n.offset = event_abs_offset + (i * strum_delay) # ★ 絶対オフセット
+                n.volume = m21volume.Volume(velocity=max(1, min(127, event_velocity + vel_adjs[i])))
                 notes_for_event.append(n)
         elif style == STYLE_ARPEGGIO:
             # ... (アルペジオロジック、各ノートに event_abs_offset を加算してオフセット設定) ...
             arp_pattern_type = guitar_params.get("arpeggio_type", "up")
             arp_note_dur_ql = guitar_params.get("arpeggio_note_duration_ql", 0.5)
-            ordered_arp_pitches = [chord_pitches[idx % len(chord_pitches)] for idx in arp_pattern_type] if isinstance(arp_pattern_type, list) else (list(reversed(chord_pitches)) if arp_pattern_type == "down" else chord_pitches) # 他のタイプも考慮
+            ordered_arp_pitches = [chord_pitches[idx % len(chord_pitches)] for idx in arp_pattern_type] if isinstance(arp_pattern_type, (list, tuple)) else (list(reversed(chord_pitches)) if arp_pattern_type == "down" else chord_pitches) # 他のタイプも考慮
             current_offset_in_event = 0.0; arp_idx = 0
             while current_offset_in_event < event_duration_ql and ordered_arp_pitches:
                 p_play = ordered_arp_pitches[arp_idx % len(ordered_arp_pitches)]
@@ -162,38 +244,79 @@ class GuitarGenerator:
                 if actual_mute_dur < MIN_NOTE_DURATION_QL / 8: break
                 n = note.Note(root_mute); n.articulations = [articulations.Staccatissimo()]
                 n.duration.quarterLength = actual_mute_dur
-                n.volume.velocity = int(event_velocity * 0.6) + random.randint(-5,5)
+                n.volume.velocity = self._mute_velocities(event_velocity, 1)[0]
                 n.offset = event_abs_offset + t_mute # ★ 絶対オフセット
                 notes_for_event.append(n)
                 t_mute += mute_interval
         return notes_for_event
 
 
-    def compose(self, processed_chord_stream: List[Dict]) -> stream.Part:
+    def _emit_event_arrays(
+        self, buffer: "NoteEventBuffer", chord_midis: Any, guitar_params: Dict[str, Any],
+        event_abs_offset: float, event_duration_ql: float, event_velocity: int
+    ) -> None:
+        """
+        _create_notes_from_event の配列版。1イベント分のオンセット・デュレーション・ベロシティを
+        (ストロークの弦ごとの遅れ、アルペジオの音の並び、ミュートのグリッド) まとめて計算し、buffer に追加する。
+        chord_midis は弦の順 (低音弦 → 高音弦) の MIDI 番号配列。
+        """
+        n_str = len(chord_midis)
+        if n_str == 0: return
+        style = guitar_params.get("guitar_style", STYLE_BLOCK_CHORD)
+        if style == STYLE_BLOCK_CHORD:
+            buffer.add_chord(event_abs_offset, event_duration_ql * 0.9, chord_midis, event_velocity)
+        elif style == STYLE_STRUM_BASIC:
+            # ダウンストロークは低音弦から、アップは高音弦から。最初に鳴る弦が +5、最後が -5
+            is_down = guitar_params.get("strum_direction", "down").lower() == "down"
+            play_order = chord_midis if is_down else chord_midis[::-1]
+            vel_adj = np.asarray(self._strum_velocity_adjustments(n_str), dtype=np.int64)
+            buffer.add_events(event_abs_offset + np.arange(n_str) * self._strum_delay_ql(guitar_params), max(MIN_STRUM_NOTE_DURATION_QL, event_duration_ql * 0.9),
+                              play_order, event_velocity + vel_adj)
+        elif style == STYLE_ARPEGGIO:
+            arp_pattern_type = guitar_params.get("arpeggio_type", "up")
+            arp_note_dur_ql = float(guitar_params.get("arpeggio_note_duration_ql", 0.5))
+            if isinstance(arp_pattern_type, (list, tuple)) and arp_pattern_type:
+                ordered = chord_midis[np.asarray(arp_pattern_type, dtype=np.int64) % n_str]
+            else:
+                ordered = chord_midis[::-1] if arp_pattern_type == "down" else chord_midis
+            onsets = np.arange(0.0, event_duration_ql, arp_note_dur_ql)
+            durs = np.minimum(arp_note_dur_ql, event_duration_ql - onsets)
+            keep = durs >= MIN_NOTE_DURATION_QL / 4
+            onsets, durs = onsets[keep], durs[keep]
+            buffer.add_events(event_abs_offset + onsets, durs * 0.95, ordered[np.arange(len(onsets)) % len(ordered)], event_velocity)
+        elif style == STYLE_MUTED_RHYTHM:
+            mute_note_dur = float(guitar_params.get("mute_note_duration_ql", 0.1))
+            mute_interval = float(guitar_params.get("mute_interval_ql", 0.25))
+            onsets = np.arange(0.0, event_duration_ql, mute_interval)
+            durs = np.minimum(mute_note_dur, event_duration_ql - onsets)
+            keep = durs >= MIN_NOTE_DURATION_QL / 8
+            onsets, durs = onsets[keep], durs[keep]
+            buffer.add_events(event_abs_offset + onsets, durs, chord_midis[0],
+                              np.asarray(self._mute_velocities(event_velocity, len(onsets)), dtype=np.int64), ARTICULATION_STACCATISSIMO)
+
+    def compose(self, processed_chord_stream: List[Dict], chord_timeline: Optional[ChordTimeline] = None) -> stream.Part:
         guitar_part = stream.Part(id="Guitar")
         # (初期設定は変更なし)
         guitar_part.insert(0, self.default_instrument)
-        guitar_part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-        guitar_part.insert(0, self.global_time_signature_obj.clone())
 
         if not processed_chord_stream: return guitar_part
         logger.info(f"GuitarGen: Starting for {len(processed_chord_stream)} blocks.")
+        if chord_timeline is None: chord_timeline = ChordTimeline.from_blocks(processed_chord_stream)
 
         all_generated_elements_for_part: List[Union[note.Note, m21chord.Chord]] = []
+        optimized_voicings = self._plan_optimized_voicings(processed_chord_stream, chord_timeline)
+        weights = chord_timeline.harmonic_context().weights # (ブロック数 × 128) の重み行列 (曲全体で一度だけ作られる)
+        # NumPy があればイベントは配列バッファに溜め、最後に一度だけ music21 オブジェクトにする
+        event_buffer = NoteEventBuffer() if NUMPY_AVAILABLE else None
 
         for blk_idx, blk_data in enumerate(processed_chord_stream):
-            # (パラメータ取得、m21_cs生成は変更なし)
+            # (パラメータ取得。m21_cs は ChordTimeline から取得)
             block_offset_ql = float(blk_data.get("offset", 0.0))
             block_duration_ql = float(blk_data.get("q_length", 4.0))
-            chord_label_str = blk_data.get("chord_label", "C")
             guitar_params = blk_data.get("part_params", {}).get("guitar", {})
             if not guitar_params: continue
 
-            sanitized_label = sanitize_chord_label(chord_label_str)
-            m21_cs: Optional[harmony.ChordSymbol] = None
-            if sanitized_label:
-                try: m21_cs = harmony.ChordSymbol(sanitized_label)
-                except: m21_cs = None
+            m21_cs: Optional[harmony.ChordSymbol] = chord_timeline.chord_at(blk_idx) # パース済み (共有オブジェクト)
             if not m21_cs or not m21_cs.pitches: continue
 
             rhythm_key = guitar_params.get("guitar_rhythm_key", "guitar_default_quarters")
@@ -201,19 +324,32 @@ class GuitarGenerator:
             if not rhythm_details or "pattern" not in rhythm_details: continue
             pattern_events = rhythm_details.get("pattern", [])
 
-            for event_def in pattern_events:
-                # (イベントパラメータ取得、絶対オフセット計算は変更なし)
-                event_offset_in_pattern = float(event_def.get("offset", 0.0))
-                event_duration_in_pattern = float(event_def.get("duration", 1.0))
-                event_velocity_factor = float(event_def.get("velocity_factor", 1.0))
-                abs_event_start_offset = block_offset_ql + event_offset_in_pattern
-                max_possible_event_dur = block_duration_ql - event_offset_in_pattern
-                actual_event_dur = min(event_duration_in_pattern, max_possible_event_dur)
-                if actual_event_dur < MIN_NOTE_DURATION_QL / 2: continue
+            block_chord_midis = None
+            if event_buffer is not None:
+                # ボイシングはブロック内で共通なので一度だけ決める
+                voiced = optimized_voicings.get(blk_idx) or self._get_guitar_friendly_voicing(
+                    m21_cs, guitar_params.get("guitar_num_strings", 6), guitar_params.get("guitar_target_octave", 3),
+                    voicing_style=guitar_params.get("guitar_voicing_style", "standard"), tuning=guitar_params.get("guitar_tuning", "standard"),
+                    weights_row=weights[blk_idx])
+                if not voiced: continue
+                block_chord_midis = np.array([p.midi for p in voiced], dtype=np.int64)
+
+            # パターンをブロックに敷き詰める (既定はブロックの拍子の小節ごとに繰り返し、半端な小節は小節末で切る)
+            blk_meter = get_meter_info(blk_data.get("time_signature") or self.global_meter.ts_str)
+            tiled = tile_pattern_events(
+                pattern_events, block_duration_ql, resolve_tiling_policy(guitar_params.get("guitar_rhythm_tiling"), TILE_BAR),
+                reference_duration_ql=rhythm_details.get("reference_duration_ql", blk_meter.bar_ql), bar_ql=blk_meter.bar_ql,
+                min_duration_ql=MIN_NOTE_DURATION_QL / 2)
+            for event_offset_in_block, actual_event_dur, event_velocity_factor, _, _ in tiled.rows():
+                abs_event_start_offset = block_offset_ql + event_offset_in_block
                 event_base_velocity = int(guitar_params.get("guitar_velocity", 70) * event_velocity_factor)
 
+                if event_buffer is not None:
+                    self._emit_event_arrays(event_buffer, block_chord_midis, guitar_params, abs_event_start_offset, actual_event_dur, event_base_velocity)
+                    continue
                 generated_elements = self._create_notes_from_event(
-                    m21_cs, guitar_params, abs_event_start_offset, actual_event_dur, event_base_velocity
+                    m21_cs, guitar_params, abs_event_start_offset, actual_event_dur, event_base_velocity,
+                    optimized_voicings.get(blk_idx), weights[blk_idx]
                 )
                 all_generated_elements_for_part.extend(generated_elements)
         
@@ -222,31 +358,34 @@ class GuitarGenerator:
         # This assumes humanization is applied part-wise with consistent settings.
         # For block-wise humanization, apply_humanization_to_element would be called inside the loop.
         global_guitar_params = processed_chord_stream[0].get("part_params", {}).get("guitar", {}) if processed_chord_stream else {}
-        if global_guitar_params.get("guitar_humanize", False):
-            h_template = global_guitar_params.get("guitar_humanize_style_template", "default_guitar_subtle")
-            # custom_params を構築 (DEFAULT_CONFIGのキー名と合わせる)
-            h_custom = {
-                k.replace("default_guitar_humanize_", "").replace("guitar_humanize_", ""): v
-                for k, v in global_guitar_params.items()
-                if (k.startswith("guitar_humanize_") or k.startswith("default_guitar_humanize_")) and not k.endswith("_template") and not k.endswith("humanize") # "guitar_humanize"自体は除く
-            }
+        h_template = global_guitar_params.get("guitar_humanize_style_template", "default_guitar_subtle")
+        # custom_params を構築 (DEFAULT_CONFIGのキー名と合わせる)
+        h_custom = {
+            k.replace("default_guitar_humanize_", "").replace("guitar_humanize_", ""): v
+            for k, v in global_guitar_params.items()
+            if (k.startswith("guitar_humanize_") or k.startswith("default_guitar_humanize_")) and not k.endswith("_template") and not k.endswith("humanize") # "guitar_humanize"自体は除く
+        }
+        if event_buffer is not None:
+            # バッファ全体を一括でヒューマナイズしてからパートに書き出す (アクセントはブロックごとの拍子と小節線で引く)
+            if global_guitar_params.get("guitar_humanize", False):
+                logger.info(f"GuitarGen: Humanizing guitar event buffer (template: {h_template}, custom: {h_custom})")
+                event_buffer.humanize(h_template, h_custom, self.global_meter.ts_str, MeterMap.from_blocks(processed_chord_stream, self.global_meter.ts_str))
+            event_buffer.to_part(guitar_part)
+        elif global_guitar_params.get("guitar_humanize", False):
             logger.info(f"GuitarGen: Humanizing guitar part (template: {h_template}, custom: {h_custom})")
             
             # apply_humanization_to_part を使うために、一度要素をパートに挿入する必要がある
-            temp_part_for_humanize = stream.Part()
+            temp_part_for_humanize = stream.Part(id="Guitar")
             for el in all_generated_elements_for_part:
                 temp_part_for_humanize.insert(el.offset, el) # el.offset は既に絶対オフセットのはず
             
-            guitar_part = apply_humanization_to_part(temp_part_for_humanize, template_name=h_template, custom_params=h_custom)
+            guitar_part = apply_humanization_to_part(temp_part_for_humanize, template_name=h_template, custom_params=h_custom,
+                                                     meter_map=MeterMap.from_blocks(processed_chord_stream, self.global_meter.ts_str))
             # apply_humanization_to_part が新しいIDを振るので、必要なら元に戻す
             guitar_part.id = "Guitar" 
             # グローバル要素を再度挿入（apply_humanization_to_partがコピーする場合）
-            if not guitar_part.getElementsByClass(instrument.Instrument).first():
+            if not guitar_part.getElementsByClass(m21instrument.Instrument).first():
                 guitar_part.insert(0, self.default_instrument)
-            if not guitar_part.getElementsByClass(tempo.MetronomeMark).first():
-                guitar_part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-            if not guitar_part.getElementsByClass(meter.TimeSignature).first():
-                guitar_part.insert(0, self.global_time_signature_obj.clone())
 
         else: # ヒューマナイズしない場合は、そのまま挿入
             for el in all_generated_elements_for_part:
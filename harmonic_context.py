@@ -0,0 +1,163 @@
+# --- START OF FILE utilities/harmonic_context.py ---
+"""harmonic_context.py
+曲全体の和声的な文脈を (ブロック数 × 128) の許容ピッチ重み行列として一度だけ作る。
+
+- 重みはコードトーン > テンション > その他のスケール音 > アボイド > スケール外 の順 (定数 WEIGHT_*)
+- ジェネレータは weights[blk_idx, lo:hi] でブロックと音域を引くだけで、マスクから重みを作り直さない
+- パートごとの音域制限は with_range で行列ごと一括でかける (音域ごとにキャッシュ)
+- NumPy がない場合、行列は同じ添字で引けるタプルの行のリストになる
+- ChordTimeline.harmonic_context() から取得すると、タイムラインごとに一度だけ作られる
+"""
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .scale_registry import get_scale_info
+    from .humanizer import NUMPY_AVAILABLE, np
+except ImportError:
+    from scale_registry import get_scale_info # type: ignore
+    from humanizer import NUMPY_AVAILABLE, np # type: ignore
+
+WEIGHT_CHORD_TONE = 1.0
+WEIGHT_TENSION = 0.6
+WEIGHT_SCALE = 0.3
+WEIGHT_AVOID = 0.05
+WEIGHT_OUTSIDE = 0.0
+
+
+def _pcs_mask(pcs) -> int:
+    mask = 0
+    for pc in pcs: mask |= 1 << (pc % 12)
+    return mask
+
+def _pc_weights(chord_mask: int, scale_mask: int, tension_mask: int, avoid_mask: int) -> List[float]:
+    # 優先度の低いものから順に上書きする (コードトーンが最優先)
+    w12 = [WEIGHT_OUTSIDE] * 12
+    for mask, weight in ((scale_mask, WEIGHT_SCALE), (avoid_mask, WEIGHT_AVOID), (tension_mask, WEIGHT_TENSION), (chord_mask, WEIGHT_CHORD_TONE)):
+        for pc in range(12):
+            if mask >> pc & 1: w12[pc] = weight
+    return w12
+
+def weight_row(chord_mask: int, scale_mask: int, tension_mask: int = 0, avoid_mask: int = 0) -> Tuple[float, ...]:
+    """マスクから 128 音分の重みの行を作る (HarmonicContext を持たない単発の呼び出し用)。"""
+    w12 = _pc_weights(chord_mask, scale_mask, tension_mask, avoid_mask)
+    return tuple(w12[m % 12] for m in range(128))
+
+def key_weight_row(chord_mask: int, tonic: Optional[str], mode: Optional[str]) -> Tuple[float, ...]:
+    """コードトーンのマスクとキーから 128 音分の重みの行を作る。"""
+    info = get_scale_info(tonic, mode)
+    return weight_row(chord_mask, info.mask, info.tension_mask, info.avoid_mask)
+
+def row_pc_mask(row: Sequence[float], lo_midi: int = 0, min_weight: float = WEIGHT_CHORD_TONE) -> int:
+    """lo_midi から始まる重みの行 (スライス) のうち、重みが min_weight 以上の音の 12bit ピッチクラスマスク。"""
+    return _pcs_mask(lo_midi + i for i, w in enumerate(row) if w >= min_weight)
+
+
+class _WeightRows:
+    """NumPy がない場合の重み行列。weights[blk_idx] / weights[blk_idx, lo:hi] をタプルで返す。"""
+    __slots__ = ("rows",)
+
+    def __init__(self, rows: Sequence[Tuple[float, ...]]):
+        self.rows: Tuple[Tuple[float, ...], ...] = tuple(rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            block_idx, cols = key
+            return self.rows[block_idx][cols]
+        return self.rows[key]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return (len(self.rows), 128)
+
+
+class HarmonicContext:
+    """ブロックごとのマスクと (ブロック数 × 128) の重み行列 (NumPy がない場合はタプルの行)。"""
+    __slots__ = ("chord_masks", "scale_masks", "tension_masks", "avoid_masks", "root_pcs", "weights", "_range_cache")
+
+    def __init__(self, chord_masks: Tuple[int, ...], scale_masks: Tuple[int, ...],
+                 tension_masks: Tuple[int, ...], avoid_masks: Tuple[int, ...], root_pcs: Tuple[Optional[int], ...]):
+        self.chord_masks = chord_masks
+        self.scale_masks = scale_masks
+        self.tension_masks = tension_masks
+        self.avoid_masks = avoid_masks
+        self.root_pcs = root_pcs
+        self.weights = self._build_matrix() if NUMPY_AVAILABLE else self._build_rows()
+        self._range_cache: Dict[Tuple[int, int], Any] = {}
+
+    @classmethod
+    def from_timeline(cls, timeline: Any) -> "HarmonicContext":
+        """ChordTimeline (chords / tonics / modes を持つ) から作る。"""
+        chord_masks: List[int] = []; scale_masks: List[int] = []; tension_masks: List[int] = []
+        avoid_masks: List[int] = []; root_pcs: List[Optional[int]] = []
+        for cs, tonic, mode in zip(timeline.chords, timeline.tonics, timeline.modes):
+            info = get_scale_info(tonic, mode)
+            chord_masks.append(_pcs_mask(p.pitchClass for p in cs.pitches) if cs is not None else 0)
+            root = cs.root() if cs is not None else None
+            root_pcs.append(root.pitchClass if root is not None else None)
+            scale_masks.append(info.mask); tension_masks.append(info.tension_mask); avoid_masks.append(info.avoid_mask)
+        ctx = cls(tuple(chord_masks), tuple(scale_masks), tuple(tension_masks), tuple(avoid_masks), tuple(root_pcs))
+        logger.debug(f"HarmonicContext: Built {len(chord_masks)} x 128 weight matrix.")
+        return ctx
+
+    def __len__(self) -> int:
+        return len(self.chord_masks)
+
+    def _build_matrix(self):
+        n = len(self.chord_masks)
+        bits = np.arange(12)
+        def to_bool(masks): return (np.asarray(masks, dtype=np.int64)[:, None] >> bits[None, :]) & 1 == 1
+        chord, scale_, tension, avoid = (to_bool(m) if n else np.zeros((0, 12), dtype=bool)
+                                         for m in (self.chord_masks, self.scale_masks, self.tension_masks, self.avoid_masks))
+        # 優先度の低いものから順に上書きする (コードトーンが最優先)
+        w12 = np.full((n, 12), WEIGHT_OUTSIDE, dtype=np.float32)
+        w12[scale_] = WEIGHT_SCALE
+        w12[avoid] = WEIGHT_AVOID
+        w12[tension] = WEIGHT_TENSION
+        w12[chord] = WEIGHT_CHORD_TONE
+        weights = np.tile(w12, (1, 11))[:, :128]
+        weights.setflags(write=False) # 全ジェネレータで共有するので読み取り専用
+        return weights
+
+    def _build_rows(self) -> _WeightRows:
+        # 同じマスクの組 (同じコード × 同じキー) の行は一度だけ作って共有する
+        rows_by_masks: Dict[Tuple[int, int, int, int], Tuple[float, ...]] = {}
+        rows = []
+        for masks in zip(self.chord_masks, self.scale_masks, self.tension_masks, self.avoid_masks):
+            row = rows_by_masks.get(masks)
+            if row is None: row = rows_by_masks[masks] = weight_row(*masks)
+            rows.append(row)
+        return _WeightRows(rows)
+
+    # --- ブロック単位の参照 ---
+    def row(self, block_idx: int):
+        """ブロックの 128 音分の重み (読み取り専用)。"""
+        return self.weights[block_idx]
+
+    def allowed_midis(self, block_idx: int, lo_midi: int = 0, hi_midi: int = 127, min_weight: float = WEIGHT_TENSION) -> List[int]:
+        """lo_midi..hi_midi のうち重みが min_weight 以上の MIDI 番号。"""
+        row = self.weights[block_idx, lo_midi:hi_midi + 1]
+        if NUMPY_AVAILABLE: return (np.flatnonzero(row >= min_weight) + lo_midi).tolist()
+        return [lo_midi + i for i, w in enumerate(row) if w >= min_weight]
+
+    def with_range(self, lo_midi: int, hi_midi: int):
+        """音域外を WEIGHT_OUTSIDE にした重み行列 (パートの音域ごとにキャッシュ)。"""
+        key = (max(0, int(lo_midi)), min(127, int(hi_midi)))
+        ranged = self._range_cache.get(key)
+        if ranged is None:
+            if NUMPY_AVAILABLE:
+                ranged = self.weights.copy()
+                ranged[:, :key[0]] = WEIGHT_OUTSIDE
+                ranged[:, key[1] + 1:] = WEIGHT_OUTSIDE
+                ranged.setflags(write=False)
+            else:
+                outside_lo = (WEIGHT_OUTSIDE,) * key[0]; outside_hi = (WEIGHT_OUTSIDE,) * (127 - key[1])
+                ranged = _WeightRows([outside_lo + row[key[0]:key[1] + 1] + outside_hi for row in self.weights.rows])
+            self._range_cache[key] = ranged
+        return ranged
+# --- END OF FILE utilities/harmonic_context.py ---
@@ -2,7 +2,7 @@
 import random
 import math
 import copy
-from typing import List, Dict, Any, Union, Optional # Optional を追加
+from typing import List, Dict, Any, Union, Optional, Tuple # Optional を追加
 from music21 import note, chord as m21chord, volume, duration, pitch, stream, instrument, tempo, meter, key, expressions, exceptions21
 
 # MIN_NOTE_DURATION_QL は core_music_utils からインポートすることを推奨
@@ -10,6 +10,10 @@ try:
     from .core_music_utils import MIN_NOTE_DURATION_QL
 except ImportError: # フォールバック
     MIN_NOTE_DURATION_QL = 0.125
+try:
+    from .metric_weights import metric_velocity_factors # NumPy がなくても動く (リストを返す)
+except ImportError:
+    from metric_weights import metric_velocity_factors # type: ignore
 
 import logging
 logger = logging.getLogger(__name__)
@@ -29,6 +33,11 @@ def generate_fractional_noise(length: int, hurst: float = 0.7, scale_factor: flo
         logger.debug(f"Humanizer (FBM): NumPy not available. Using Gaussian noise for length {length}.")
         return [random.gauss(0, scale_factor / 3) for _ in range(length)] # 標準偏差を調整
     if length <= 0: return []
+    return _fractional_noise_array(length, hurst, scale_factor).tolist()
+
+def _fractional_noise_array(length: int, hurst: float = 0.7, scale_factor: float = 1.0):
+    """generate_fractional_noise の NumPy 配列版 (NumPy 必須)。"""
+    if length <= 0: return np.zeros(0)
     # (NumPyを使ったFBM生成ロジックは変更なし)
     white_noise = np.random.randn(length)
     fft_white = np.fft.fft(white_noise)
@@ -41,7 +50,7 @@ def generate_fractional_noise(length: int, hurst: float = 0.7, scale_factor: flo
     std_dev = np.std(fbm_noise)
     if std_dev != 0: fbm_norm = scale_factor * (fbm_noise - np.mean(fbm_noise)) / std_dev
     else: fbm_norm = np.zeros(length)
-    return fbm_norm.tolist()
+    return fbm_norm
 
 HUMANIZATION_TEMPLATES: Dict[str, Dict[str, Any]] = {
     "default_subtle": {"time_variation": 0.01, "duration_percentage": 0.03, "velocity_variation": 5, "use_fbm_time": False},
@@ -108,13 +117,59 @@ def apply_humanization_to_element(
             
     return element_copy
 
+def humanize_event_arrays(
+    offsets: Any, durations: Any, velocities: Any,
+    template_name: Optional[str] = None,
+    custom_params: Optional[Dict[str, Any]] = None,
+    ts_str: Optional[str] = "4/4",
+    bar_offset: float = 0.0,
+    meter_map: Optional[Any] = None
+) -> Tuple[Any, Any, Any]:
+    """
+    オフセット・デュレーション・ベロシティの配列 (時間順) にまとめてヒューマナイズを適用し、新しい配列を返す。
+    apply_humanization_to_element と同じパラメータ解釈で、要素ごとの deepcopy や長さ1の FFT を避けるバッチ版。
+    FBM を使う場合はイベント列全体で1本のノイズを生成するので、連続したゆらぎになる。NumPy 必須。
+    パラメータ 'metric_accent_depth' > 0 なら、揺らす前のオフセットに対する ts_str のメトリック・ウェイトでベロシティを整形する。
+    小節頭は bar_offset。拍子が途中で変わる場合は meter_map (MeterMap) を渡す。
+    """
+    if not NUMPY_AVAILABLE or np is None:
+        raise RuntimeError("Humanizer: humanize_event_arrays requires NumPy.")
+    actual_template_name = template_name if template_name and template_name in HUMANIZATION_TEMPLATES else "default_subtle"
+    params = HUMANIZATION_TEMPLATES.get(actual_template_name, {}).copy()
+    if custom_params: params.update(custom_params)
+
+    offs = np.asarray(offsets, dtype=np.float64)
+    durs = np.asarray(durations, dtype=np.float64)
+    vels = np.asarray(velocities, dtype=np.int64)
+    n = offs.shape[0]
+    if n == 0: return offs.copy(), durs.copy(), vels.copy()
+
+    time_var = params.get('time_variation', 0.01)
+    dur_perc = params.get('duration_percentage', 0.03)
+    vel_var = int(params.get('velocity_variation', 5))
+    accent_depth = float(params.get('metric_accent_depth', 0.0))
+    if accent_depth:
+        vels = np.rint(vels * metric_velocity_factors(offs, accent_depth, ts_str, bar_offset, meter_map)).astype(np.int64)
+    if params.get('use_fbm_time', False):
+        time_shifts = _fractional_noise_array(n, hurst=params.get('fbm_hurst', 0.6), scale_factor=params.get('fbm_time_scale', 0.01))
+    else:
+        time_shifts = np.random.uniform(-time_var, time_var, n)
+
+    new_offs = np.maximum(0.0, offs + time_shifts)
+    new_durs = np.maximum(MIN_NOTE_DURATION_QL / 8, durs * (1.0 + np.random.uniform(-dur_perc, dur_perc, n)))
+    new_vels = np.clip(vels + np.random.randint(-vel_var, vel_var + 1, n), 1, 127)
+    return new_offs, new_durs, new_vels
+
 def apply_humanization_to_part(
     part_to_humanize: stream.Part, # 元のパートを直接変更しないようにコピーして操作
     template_name: Optional[str] = None,
-    custom_params: Optional[Dict[str, Any]] = None
+    custom_params: Optional[Dict[str, Any]] = None,
+    meter_map: Optional[Any] = None
 ) -> stream.Part:
     """
     Part内の全てのNoteとChordにヒューマナイゼーションを適用し、新しいPartを返す。
+    パラメータ 'metric_accent_depth' > 0 なら、meter_map (MeterMap) の拍子と小節線 (なければパートの拍子、それもなければ 4/4) の
+    メトリック・ウェイトでベロシティを先に整形する。
     """
     if not isinstance(part_to_humanize, stream.Part):
         logger.error("Humanizer: apply_humanization_to_part expects a music21.stream.Part object.")
@@ -137,12 +192,26 @@ def apply_humanization_to_part(
     # オフセット順にソートしてから処理すると、FBMノイズの連続性が保たれる（もし使うなら）
     elements_to_process.sort(key=lambda el: el.getOffsetInHierarchy(part_to_humanize))
 
+    params = HUMANIZATION_TEMPLATES.get(template_name, {}) if template_name else {}
+    accent_depth = float((custom_params or {}).get('metric_accent_depth', params.get('metric_accent_depth', 0.0)))
+    accent_by_id: Dict[int, float] = {}
+    if accent_depth:
+        ts_found = part_to_humanize.recurse().getElementsByClass(meter.TimeSignature).first()
+        sounding = [el for el in elements_to_process if isinstance(el, (note.Note, m21chord.Chord))]
+        factors = metric_velocity_factors([float(el.getOffsetInHierarchy(part_to_humanize)) for el in sounding], accent_depth, ts_found.ratioString if ts_found else "4/4", meter_map=meter_map)
+        accent_by_id = {id(el): float(f) for el, f in zip(sounding, factors)}
+
 
     for element in elements_to_process:
         original_hierarchical_offset = element.getOffsetInHierarchy(part_to_humanize)
         
         if isinstance(element, (note.Note, m21chord.Chord)):
             humanized_element = apply_humanization_to_element(element, template_name, custom_params)
+            accent = accent_by_id.get(id(element))
+            if accent is not None:
+                for n_acc in (humanized_element.notes if isinstance(humanized_element, m21chord.Chord) else [humanized_element]):
+                    if n_acc.volume is not None and n_acc.volume.velocity is not None:
+                        n_acc.volume.velocity = max(1, min(127, int(round(n_acc.volume.velocity * accent))))
             # apply_humanization_to_element でオフセットが変更されるので、
             # 元の階層的オフセットからの差分を考慮して新しいパートに挿入する。
             # ただし、apply_humanization_to_element が返すオフセットは、その要素自身のオフセットなので、
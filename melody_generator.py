@@ -7,19 +7,14 @@ from typing import Dict, List, Sequence, Any, Tuple, Optional, Union # Union を
 import random
 import logging
 
-from music21 import stream, note, harmony, tempo, meter, instrument as m21instrument, key # key を追加
+from music21 import stream, note, instrument as m21instrument, key, volume as m21volume # key を追加
 
 # melody_utils と humanizer をインポート
-try:
-    from .melody_utils import generate_melodic_pitches # 同じディレクトリなので相対インポート
-    from utilities.core_music_utils import MIN_NOTE_DURATION_QL, get_time_signature_object # utilitiesから
-    from utilities.humanizer import apply_humanization_to_part, HUMANIZATION_TEMPLATES
-except ImportError as e:
-    logger.error(f"MelodyGenerator: Failed to import required modules (melody_utils or humanizer or core_music_utils): {e}")
-    def generate_melodic_pitches(*args, **kwargs): return [] # Dummy
-    def apply_humanization_to_part(part, *args, **kwargs): return part # Dummy
-    MIN_NOTE_DURATION_QL = 0.125 # Dummy
-    def get_time_signature_object(ts_str): return meter.TimeSignature("4/4") # Dummy
+from .melody_utils import generate_ranked_melody_midis, DEFAULT_NUM_MELODY_CANDIDATES # 同じディレクトリなので相対インポート
+from utilities.core_music_utils import get_meter_info, MIN_NOTE_DURATION_QL # utilitiesから
+from utilities.humanizer import apply_humanization_to_part
+from utilities.tempo_map import MeterMap
+from utilities.chord_timeline import ChordTimeline
 
 
 logger = logging.getLogger(__name__)
@@ -39,7 +34,7 @@ class MelodyGenerator:
         self.default_instrument = default_instrument
         self.global_tempo = global_tempo
         self.global_time_signature_str = global_time_signature
-        self.global_time_signature_obj = get_time_signature_object(global_time_signature)
+        self.global_meter = get_meter_info(global_time_signature)
         self.global_key_tonic = global_key_signature_tonic
         self.global_key_mode = global_key_signature_mode
         self.rng = rng or random.Random()
@@ -63,40 +58,42 @@ class MelodyGenerator:
         logger.warning(f"MelodyGen: Rhythm key '{rhythm_key}' not found. Using default quarter grid.")
         return default_rhythm
 
-    def compose(self, processed_blocks: Sequence[Dict[str, Any]]) -> stream.Part:
+    def compose(self, processed_blocks: Sequence[Dict[str, Any]], chord_timeline: Optional[ChordTimeline] = None) -> stream.Part:
         melody_part = stream.Part(id="Melody")
         melody_part.insert(0, self.default_instrument)
-        melody_part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-        melody_part.insert(0, self.global_time_signature_obj.clone())
         # グローバルキーをパートの最初に設定
         melody_part.insert(0, key.Key(self.global_key_tonic, self.global_key_mode))
 
 
         current_total_offset = 0.0
+        if chord_timeline is None: chord_timeline = ChordTimeline.from_blocks(processed_blocks)
+        # 曲全体の (ブロック数 × 128) 重み行列。ブロックの音域をかけた行を melody_utils に渡す
+        harmonic_ctx = chord_timeline.harmonic_context()
+        prev_block_last_midi: Optional[int] = None # 前ブロック末尾の音 (候補の採点で跳躍を抑える)
 
         for blk_idx, blk_data in enumerate(processed_blocks):
+            # ブロックの絶対オフセットを優先する (ブロックを間引いて渡された場合も正しい位置に置く)
+            current_total_offset = float(blk_data.get("offset", current_total_offset))
             melody_params = blk_data.get("part_params", {}).get("melody", {})
             if melody_params.get("skip", False): # スキップフラグ
                 logger.debug(f"MelodyGenerator: Skipping melody for block {blk_idx+1} due to 'skip' flag.")
+                prev_block_last_midi = None
                 current_total_offset += blk_data.get("q_length", 0.0)
                 continue
             
             chord_label_str = blk_data.get("chord_label", "C")
             block_q_length = blk_data.get("q_length", 4.0)
             
-            try:
-                from utilities.core_music_utils import get_music21_chord_object
-                cs_current_block = get_music21_chord_object(chord_label_str)
-                if cs_current_block is None:
-                    logger.warning(f"MelodyGenerator: Could not parse chord '{chord_label_str}' for block {blk_idx+1}. Skipping melody notes for this block.")
-                    current_total_offset += block_q_length
-                    continue
-            except ImportError:
-                cs_current_block = harmony.ChordSymbol(chord_label_str)
+            cs_current_block = chord_timeline.chord_at(blk_idx) # パース済み (共有オブジェクト)
+            if cs_current_block is None:
+                logger.warning(f"MelodyGenerator: Could not parse chord '{chord_label_str}' for block {blk_idx+1}. Skipping melody notes for this block.")
+                current_total_offset += block_q_length
+                continue
 
 
             tonic_for_block = blk_data.get("tonic_of_section", self.global_key_tonic)
             mode_for_block = blk_data.get("mode", self.global_key_mode)
+            blk_meter = get_meter_info(blk_data.get("time_signature") or self.global_meter.ts_str)
             
             rhythm_key_for_block = melody_params.get("rhythm_key", "default_melody_rhythm")
             rhythm_details = self._get_rhythm_details(rhythm_key_for_block)
@@ -106,8 +103,8 @@ class MelodyGenerator:
             base_note_duration_ql = rhythm_details.get("note_duration_ql", 
                                                      melody_params.get("note_duration_ql", 0.5)) # 8分音符がデフォルト
 
-            # テンプレートの基準長 (通常4拍=1小節)
-            template_reference_duration = rhythm_details.get("reference_duration_ql", 4.0)
+            # テンプレートの基準長 (通常はブロックの拍子の1小節)
+            template_reference_duration = rhythm_details.get("reference_duration_ql", blk_meter.bar_ql)
             
             # beat_offsets をブロック長に合わせて伸縮・繰り返し
             stretched_beat_offsets: List[float] = []
@@ -181,23 +178,30 @@ class MelodyGenerator:
 
 
             octave_range_for_block = tuple(melody_params.get("octave_range", [4, 5]))
+            range_lo_midi, range_hi_midi = 12 * (int(octave_range_for_block[0]) + 1), 12 * (int(octave_range_for_block[1]) + 2) - 1
             
-            # --- melody_utils を使ってピッチリストを生成 ---
-            generated_notes = generate_melodic_pitches(
+            # --- melody_utils を使ってピッチ (MIDI 番号) のリストを生成 ---
+            # num_candidates 本を一括生成して採点し、最良の1本を使う (1 以下なら従来通り1本だけ生成)
+            generated_midis = generate_ranked_melody_midis(
                 chord=cs_current_block,
                 tonic=tonic_for_block,
                 mode=mode_for_block,
                 beat_offsets=final_beat_offsets_for_block, # ブロック内での絶対タイミング
                 octave_range=octave_range_for_block,
                 rnd=self.rng,
-                min_note_duration_ql=MIN_NOTE_DURATION_QL # 渡す
+                num_candidates=int(melody_params.get("num_candidates", DEFAULT_NUM_MELODY_CANDIDATES)),
+                prev_midi=prev_block_last_midi,
+                ts_str=blk_meter.ts_str,
+                weights_row=harmonic_ctx.with_range(range_lo_midi, range_hi_midi)[blk_idx]
             )
+            prev_block_last_midi = generated_midis[-1] if generated_midis else None
 
-            # --- 密度とデュレーションを適用 ---
+            # --- 密度とデュレーションを適用 (残すノートだけ music21 の Note にする) ---
             density_for_block = melody_params.get("density", 0.7)
             
-            for idx, n_obj in enumerate(generated_notes):
+            for idx, midi_val in enumerate(generated_midis):
                 if self.rng.random() <= density_for_block:
+                    n_obj = note.Note(midi_val)
                     # デュレーション設定: 次のノートの開始位置まで、または基本デュレーション
                     if idx < len(final_beat_offsets_for_block) - 1:
                         # 次のノートの開始位置までの長さをデュレーションとする
@@ -210,7 +214,7 @@ class MelodyGenerator:
                     n_obj.quarterLength = max(MIN_NOTE_DURATION_QL, min(note_actual_duration, base_note_duration_ql * stretch_factor if 'stretch_factor' in locals() else base_note_duration_ql))
                     
                     # ベロシティ設定 (オプション)
-                    n_obj.volume = m21instrument.Volume(velocity=melody_params.get("velocity", 80))
+                    n_obj.volume = m21volume.Volume(velocity=melody_params.get("velocity", 80))
                     
                     melody_part.insert(current_total_offset + final_beat_offsets_for_block[idx], n_obj)
 
@@ -222,7 +226,8 @@ class MelodyGenerator:
             h_template_mel = processed_blocks[0]["part_params"]["melody"].get("melody_humanize_style_template", "default_subtle")
             h_custom_mel = {k.replace("melody_humanize_",""):v for k,v in processed_blocks[0]["part_params"]["melody"].items() if k.startswith("melody_humanize_") and not k.endswith("_template")}
             logger.info(f"MelodyGenerator: Applying humanization with template '{h_template_mel}' and params {h_custom_mel}")
-            melody_part = apply_humanization_to_part(melody_part, template_name=h_template_mel, custom_params=h_custom_mel)
+            melody_part = apply_humanization_to_part(melody_part, template_name=h_template_mel, custom_params=h_custom_mel,
+                                                     meter_map=MeterMap.from_blocks(processed_blocks, self.global_meter.ts_str))
             
         return melody_part
 # --- END OF FILE generator/melody_generator.py ---
@@ -5,6 +5,7 @@ from __future__ import annotations
 """
 
 from typing import List, Sequence, Tuple, Optional
+from functools import lru_cache
 import random as _rand # random を _rand としてインポート
 import logging
 
@@ -28,106 +29,273 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+from utilities.harmonic_context import WEIGHT_CHORD_TONE, WEIGHT_TENSION, WEIGHT_OUTSIDE, key_weight_row
+
+try:
+    from utilities.metric_weights import metric_weights
+except ImportError:
+    metric_weights = None
+
+NUMPY_AVAILABLE = False
+np = None
+try:
+    import numpy
+    np = numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    logger.warning("MelodyUtils: NumPy not found. Candidate scoring falls back to the pure Python loop.")
+
 # --- (以降の定数、ヘルパー関数、generate_melodic_pitches は変更なし、SR.get の呼び出しは既に適切) ---
 # Constants / Config
 BEAT_STRENGTH_4_4 = {0.0: 1.0, 1.0: 0.6, 2.0: 0.9, 3.0: 0.4}
 _MARKOV_TABLE = {0: {0:0.2,2:0.4,-2:0.4}, 2: {2:0.3,0:0.2,-1:0.3,-2:0.2}, -2: {-2:0.3,0:0.2,1:0.3,2:0.2}, 1: {2:0.4,0:0.2,-1:0.4}, -1: {-2:0.4,0:0.2,1:0.4}}
 
 # Utility helpers
-def _weighted_choice(items_with_weight):
+def _beat_strengths(beat_offsets: Sequence[float], ts_str: Optional[str] = "4/4") -> List[float]:
+    """ブロック先頭を小節頭とした各オフセットの拍の強さ (拍子のメトリック・ウェイト表を一括参照)。"""
+    if metric_weights is None:
+        return [BEAT_STRENGTH_4_4.get(b % 4, 0.5) for b in beat_offsets]
+    return [float(w) for w in metric_weights(beat_offsets, ts_str)]
+
+def _weighted_choice(items_with_weight, rnd=None):
+    if not items_with_weight: return None
     total = sum(w for _,w in items_with_weight)
-    if total == 0: return items_with_weight[0][0] if items_with_weight else None # 重み合計0の場合のフォールバック
-    r = _rand.random() * total
+    if total == 0: return items_with_weight[0][0] # 重み合計0の場合のフォールバック
+    r = (rnd or _rand).random() * total
     upto = 0.0
     for item,w in items_with_weight:
         upto += w
         if upto >= r: return item
-    return items_with_weight[-1][0] if items_with_weight else None # フォールバック
+    return items_with_weight[-1][0] # フォールバック
 
-def _next_interval(prev_int: int) -> int:
+def _next_interval(prev_int: int, rnd=None) -> int:
     table = _MARKOV_TABLE.get(prev_int, _MARKOV_TABLE.get(0, {})) # prev_intがない場合、さらに0もない場合のフォールバック
     if not table: return 0 # テーブルが空なら動かない
-    return _weighted_choice(list(table.items()))
+    return _weighted_choice(list(table.items()), rnd)
+
+def _pcs_mask(pcs) -> int:
+    mask = 0
+    for pc in pcs: mask |= 1 << (pc % 12)
+    return mask
+
+def _key_weights(chord: harmony.ChordSymbol, tonic: Optional[str], mode: Optional[str]) -> Tuple[float, ...]:
+    """HarmonicContext の行が渡されない場合に、コードとキーから 128 音分の重みの行を作る。"""
+    return key_weight_row(_pcs_mask(p.pitchClass for p in chord.pitches), tonic, mode)
+
+def _range_weights(weights_row: Sequence[float], lo_midi: int, hi_midi: int) -> Tuple[float, ...]:
+    return tuple(float(w) for w in weights_row[lo_midi:hi_midi + 1])
+
+@lru_cache(maxsize=512)
+def _candidate_table(range_weights: Tuple[float, ...], lo_midi: int):
+    """
+    音域 lo_midi.. の重みの行 (テンション以上が候補) から、候補 MIDI 番号の配列とコードトーンかどうか、
+    直前の音 (0-127) ごとの距離の係数 dist_factor[prev_midi] を返す (prev_midi=128 は直前の音なし)。
+    """
+    w = np.asarray(range_weights)
+    idx = np.flatnonzero(w >= WEIGHT_TENSION)
+    cands = (idx + lo_midi).astype(np.int64)
+    is_chord = w[idx] >= WEIGHT_CHORD_TONE
+    prev = np.arange(129)[:, None]
+    dist_factor = np.maximum(0.1, 1.5 - np.abs(cands[None, :] - prev) / 8.0)
+    dist_factor[128, :] = 1.0
+    return cands, is_chord, dist_factor
+
+def _candidate_weights(is_chord, strength: float):
+    # 強拍ほどコードトーンを優先 (拍の強さ 1.0 でコードトーン:テンション = 6:2、弱拍 0.4 で 3.6:2)
+    return np.where(is_chord, 4.0 * (0.5 + strength), 2.0)
 
 # Public API
-def generate_melodic_pitches(
+def generate_melodic_midis(
     chord: harmony.ChordSymbol,
     tonic: str,
     mode: str,
     beat_offsets: Sequence[float],
     octave_range: Tuple[int, int] = (4, 5),
     rnd: Optional[random.Random] = None,
-    min_note_duration_ql: float = 0.125 # MIN_NOTE_DURATION_QL を引数で渡すか、ここで定義
-) -> List[note.Note]:
+    ts_str: Optional[str] = "4/4",
+    weights_row: Optional[Sequence[float]] = None,
+) -> List[int]:
+    """
+    各拍のメロディ音を MIDI 番号のリストで返す。候補は重みの行の音域 lo:hi のうちテンション以上の音で、
+    重み (コードトーン・テンション・直前音からの距離・拍の強さ) をまとめて計算し、累積和で抽選する。
+    weights_row に HarmonicContext の行 (weights[blk_idx] や with_range の行) を渡すとコードとキーからの再計算を省く。
+    """
     rnd = rnd or _rand
-    scale_obj = SR.get(tonic, mode)
-    # scale_obj が期待通り ConcreteScale であることを確認
-    if not hasattr(scale_obj, 'getPitches') or not hasattr(scale_obj, 'pitchFromDegree'):
-        logger.error(f"MelodyUtils: SR.get for {tonic} {mode} did not return a valid scale object. Returning empty notes.")
-        return []
-        
-    tensions_deg = SR.mode_tensions(mode)
-    avoid_deg = SR.avoid_degrees(mode)
-
-    chord_pcs = {p.pitchClass for p in chord.pitches}
-    tension_pcs = {
-        scale_obj.pitchFromDegree(d).pitchClass for d in tensions_deg if d not in avoid_deg and hasattr(scale_obj, 'pitchFromDegree')
-    }
+    octave_range = (int(octave_range[0]), int(octave_range[1]))
+    lo_midi, hi_midi = 12 * (octave_range[0] + 1), 12 * (octave_range[1] + 2) - 1
+    if weights_row is None: weights_row = _key_weights(chord, tonic, mode)
+    range_w = _range_weights(weights_row, lo_midi, hi_midi)
+    root_pc = chord.root().pitchClass if chord.root() else 0
 
-    notes_out: List[note.Note] = []
-    prev_pitch_obj: Optional[pitch.Pitch] = None
+    if NUMPY_AVAILABLE:
+        cands, is_chord, dist_factor = _candidate_table(range_w, lo_midi)
+        weights_by_strength = {}
+    midis_out: List[int] = []
+    prev_midi: Optional[int] = None
     prev_interval_val = 0
 
-    for beat_offset_val in beat_offsets:
-        strength = BEAT_STRENGTH_4_4.get(beat_offset_val % 4, 0.5)
-        candidate_pool: List[pitch.Pitch] = []
-
-        for p_chord in chord.pitches:
-            for octv_val in range(octave_range[0], octave_range[1] + 1):
-                candidate_pool.append(p_chord.transpose(12 * (octv_val - p_chord.octave)))
-        for pc_tension in tension_pcs:
-            # base_p_tension = pitch.Pitch() # pitch.Pitch(pc_tension) の方が直接的
-            # base_p_tension.midi = pc_tension
-            for octv_val in range(octave_range[0], octave_range[1] + 1):
-                candidate_pool.append(pitch.Pitch(pc_tension + octv_val * 12))
-        
-        if not candidate_pool: # 候補が全くない場合 (ありえないはずだが念のため)
-            logger.warning(f"MelodyUtils: Candidate pool empty for chord {chord.figure}. Using root.")
-            p_fallback = chord.root()
-            if p_fallback: candidate_pool.append(p_fallback.transpose((octave_range[0]-p_fallback.octave)*12))
-            else: continue # ルートもなければスキップ
-
-        weighted_candidate_pool: List[Tuple[pitch.Pitch, float]] = []
-        for p_cand in candidate_pool:
-            w = 1.0
-            if p_cand.pitchClass in chord_pcs: w *= 4.0
-            elif p_cand.pitchClass in tension_pcs: w *= 2.0
-            if prev_pitch_obj is not None:
-                ival_dist = abs(p_cand.midi - prev_pitch_obj.midi)
-                w *= max(0.1, 1.5 - ival_dist / 8.0)
-            w *= strength
-            weighted_candidate_pool.append((p_cand, w))
-        
-        if not weighted_candidate_pool: # 重み付け後も候補がない場合
-             chosen_pitch_obj = candidate_pool[0] if candidate_pool else chord.root().transpose((octave_range[0]-chord.root().octave)*12) if chord.root() else pitch.Pitch("C4")
-        else:
-            chosen_pitch_obj = _weighted_choice(weighted_candidate_pool)
-
-        if prev_pitch_obj is not None:
-            desired_interval_val = _next_interval(prev_interval_val)
-            candidate_next_pitch = prev_pitch_obj.transpose(desired_interval_val)
-            if octave_range[0] <= candidate_next_pitch.octave <= octave_range[1]:
-                chosen_pitch_obj = candidate_next_pitch
+    for beat_offset_val, strength in zip(beat_offsets, _beat_strengths(beat_offsets, ts_str)):
+        # 直前の音があればマルコフ表の音程を優先 (音域内に収まる場合)
+        if prev_midi is not None:
+            desired_interval_val = _next_interval(prev_interval_val, rnd)
+            if lo_midi <= prev_midi + desired_interval_val <= hi_midi:
+                prev_midi += desired_interval_val
                 prev_interval_val = desired_interval_val
-            else:
-                prev_interval_val = chosen_pitch_obj.midi - prev_pitch_obj.midi if chosen_pitch_obj and prev_pitch_obj else 0
+                midis_out.append(prev_midi)
+                continue
+
+        if NUMPY_AVAILABLE and len(cands):
+            base_w = weights_by_strength.get(strength)
+            if base_w is None: base_w = weights_by_strength[strength] = _candidate_weights(is_chord, strength)
+            cum_w = np.cumsum(base_w * dist_factor[prev_midi if prev_midi is not None else 128])
+            chosen = int(cands[min(len(cands) - 1, int(np.searchsorted(cum_w, rnd.random() * cum_w[-1], side='right')))])
         else:
-            prev_interval_val = 0
+            pool = [(lo_midi + i, (4.0 * (0.5 + strength) if w >= WEIGHT_CHORD_TONE else 2.0) * (max(0.1, 1.5 - abs(lo_midi + i - prev_midi) / 8.0) if prev_midi is not None else 1.0))
+                    for i, w in enumerate(range_w) if w >= WEIGHT_TENSION]
+            chosen = _weighted_choice(pool, rnd) if pool else None
+            if chosen is None:
+                logger.warning(f"MelodyUtils: Candidate pool empty for chord {chord.figure}. Using root.")
+                chosen = lo_midi + root_pc
+
+        prev_interval_val = chosen - prev_midi if prev_midi is not None else 0
+        prev_midi = chosen
+        midis_out.append(chosen)
+
+    return midis_out
+
+# --- 複数候補の一括生成とランキング ---
+DEFAULT_NUM_MELODY_CANDIDATES = 256
+
+@lru_cache(maxsize=1)
+def _markov_arrays():
+    """_MARKOV_TABLE を (状態数, 最大選択肢数) の音程配列と累積確率配列にする。表にない音程の状態は 0 の行を使う。"""
+    states = sorted(_MARKOV_TABLE)
+    width = max(len(v) for v in _MARKOV_TABLE.values())
+    ivs = np.zeros((len(states), width), dtype=np.int64)
+    cum = np.ones((len(states), width))
+    for r, st in enumerate(states):
+        items = list(_MARKOV_TABLE[st].items())
+        total = sum(w for _, w in items) or 1.0
+        acc = 0.0
+        for c, (iv, w) in enumerate(items):
+            acc += w / total; ivs[r, c] = iv; cum[r, c] = acc
+        ivs[r, len(items):] = items[-1][0]
+    # 音程 (-127..127) -> 状態行
+    state_of_interval = np.full(255, states.index(0) if 0 in states else 0, dtype=np.int64)
+    for r, st in enumerate(states): state_of_interval[st + 127] = r
+    return ivs, cum, state_of_interval
 
-        prev_pitch_obj = chosen_pitch_obj
-        n_new = note.Note(chosen_pitch_obj)
+def _sample_rows(cum_w, u):
+    """各行の累積重み cum_w (K, C) から一様乱数 u (K,) で列を選ぶ。"""
+    return np.minimum((cum_w < (u * cum_w[:, -1])[:, None]).sum(axis=1), cum_w.shape[1] - 1)
+
+def score_melody_candidates(lines, strengths: Sequence[float], weights_row: Sequence[float], octave_range: Tuple[int, int], prev_midi: Optional[int] = None):
+    """
+    候補メロディ (K, 拍数) を一括で採点する。大きいほど良い。
+    強拍のコードトーン率、スケール外音、同音反復、輪郭 (方向転換の多さ)、音域、前ブロック末尾からの跳躍を評価する。
+    コードトーン/スケール外の判定は 128 音分の重みの行を MIDI 番号で引く。
+    """
+    w = np.asarray(weights_row)[lines]
+    strengths_arr = np.asarray(strengths, dtype=float)
+    strong = strengths_arr >= 0.75 # 小節頭と小節中央 (メトリック・ウェイト表の準強拍以上)
+    in_chord = w >= WEIGHT_CHORD_TONE
+    in_scale = w > WEIGHT_OUTSIDE
+    score = np.zeros(lines.shape[0])
+    if strong.any():
+        score += 3.0 * in_chord[:, strong].mean(axis=1)
+    score += 1.0 * in_chord[:, 0] # ブロック先頭はコードトーンが望ましい
+    score -= 1.5 * (~in_scale).mean(axis=1)
+    if lines.shape[1] > 1:
+        diffs = np.diff(lines, axis=1)
+        score -= 1.0 * (diffs == 0).mean(axis=1) # 同音反復
+        signs = np.sign(diffs)
+        nz = signs != 0
+        if signs.shape[1] > 1:
+            turns = (signs[:, 1:] * signs[:, :-1] < 0) & nz[:, 1:] & nz[:, :-1]
+            score -= 1.0 * turns.mean(axis=1) # ジグザグな輪郭
+        score -= 0.15 * np.maximum(0, np.abs(diffs) - 5).mean(axis=1) # 大跳躍
+    span = lines.max(axis=1) - lines.min(axis=1)
+    score -= 0.1 * np.abs(span - 7) # 1ブロックで5度前後の幅を好む
+    center = 12 * (octave_range[0] + 1) + 6 * (octave_range[1] - octave_range[0] + 1)
+    score -= 0.05 * np.abs(lines.mean(axis=1) - center)
+    if prev_midi is not None:
+        score -= 0.1 * np.maximum(0, np.abs(lines[:, 0] - prev_midi) - 4)
+    return score
+
+def generate_ranked_melody_midis(
+    chord: harmony.ChordSymbol,
+    tonic: str,
+    mode: str,
+    beat_offsets: Sequence[float],
+    octave_range: Tuple[int, int] = (4, 5),
+    rnd: Optional[random.Random] = None,
+    num_candidates: int = DEFAULT_NUM_MELODY_CANDIDATES,
+    prev_midi: Optional[int] = None,
+    ts_str: Optional[str] = "4/4",
+    weights_row: Optional[Sequence[float]] = None,
+) -> List[int]:
+    """
+    generate_melodic_midis と同じ確率モデル (マルコフ音程表 + 候補重み) で num_candidates 本のメロディを一括生成し、
+    score_melody_candidates で最良のものを返す。NumPy がない場合や num_candidates <= 1 では1本だけ生成する。
+    weights_row は HarmonicContext の行 (省略時はコードとキーから作る)。
+    """
+    rnd = rnd or _rand
+    n_steps = len(beat_offsets)
+    if weights_row is None: weights_row = _key_weights(chord, tonic, mode)
+    if not NUMPY_AVAILABLE or num_candidates <= 1 or n_steps == 0:
+        return generate_melodic_midis(chord, tonic, mode, beat_offsets, octave_range, rnd, ts_str, weights_row)
+
+    octave_range = (int(octave_range[0]), int(octave_range[1]))
+    lo_midi, hi_midi = 12 * (octave_range[0] + 1), 12 * (octave_range[1] + 2) - 1
+    cands, is_chord, dist_factor = _candidate_table(_range_weights(weights_row, lo_midi, hi_midi), lo_midi)
+    if not len(cands):
+        return generate_melodic_midis(chord, tonic, mode, beat_offsets, octave_range, rnd, ts_str, weights_row)
+    m_ivs, m_cum, state_of_interval = _markov_arrays()
+    np_rng = np.random.default_rng(rnd.randrange(2 ** 32))
+    k = int(num_candidates)
+    strengths = _beat_strengths(beat_offsets, ts_str)
+
+    lines = np.empty((k, n_steps), dtype=np.int64)
+    prev = np.full(k, prev_midi if prev_midi is not None else -1, dtype=np.int64)
+    prev_iv = np.zeros(k, dtype=np.int64)
+    for step in range(n_steps):
+        chosen = np.zeros(k, dtype=np.int64)
+        use_markov = np.zeros(k, dtype=bool)
+        if step > 0 or prev_midi is not None:
+            # マルコフ表から音程を一括サンプリングし、音域内に収まる候補はそれを採用
+            state = state_of_interval[np.clip(prev_iv, -127, 127) + 127]
+            col = np.minimum((m_cum[state] < np_rng.random(k)[:, None]).sum(axis=1), m_cum.shape[1] - 1)
+            nxt = prev + m_ivs[state, col]
+            use_markov = (nxt >= lo_midi) & (nxt <= hi_midi)
+            chosen[use_markov] = nxt[use_markov]
+        need = ~use_markov
+        if need.any():
+            base_w = _candidate_weights(is_chord, strengths[step])
+            prev_rows = np.where(prev[need] >= 0, np.clip(prev[need], 0, 127), 128)
+            cum_w = np.cumsum(base_w[None, :] * dist_factor[prev_rows], axis=1)
+            chosen[need] = cands[_sample_rows(cum_w, np_rng.random(int(need.sum())))]
+        prev_iv = np.where(prev >= 0, chosen - prev, 0)
+        lines[:, step] = chosen
+        prev = chosen
+
+    scores = score_melody_candidates(lines, strengths, weights_row, octave_range, prev_midi)
+    best = int(np.argmax(scores + np_rng.uniform(0.0, 1e-6, size=k))) # 同点はランダムに
+    return [int(m) for m in lines[best]]
+
+def generate_melodic_pitches(
+    chord: harmony.ChordSymbol,
+    tonic: str,
+    mode: str,
+    beat_offsets: Sequence[float],
+    octave_range: Tuple[int, int] = (4, 5),
+    rnd: Optional[random.Random] = None,
+    min_note_duration_ql: float = 0.125, # MIN_NOTE_DURATION_QL を引数で渡すか、ここで定義
+    ts_str: Optional[str] = "4/4",
+) -> List[note.Note]:
+    notes_out: List[note.Note] = []
+    for midi_val in generate_melodic_midis(chord, tonic, mode, beat_offsets, octave_range, rnd, ts_str):
+        n_new = note.Note(midi_val)
         n_new.quarterLength = min_note_duration_ql # 呼び出し側で上書きされる想定
         notes_out.append(n_new)
-
     return notes_out
 # --- END OF FILE generator/melody_utils.py ---
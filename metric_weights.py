@@ -0,0 +1,158 @@
+# --- START OF FILE utilities/metric_weights.py ---
+"""metric_weights.py
+拍子ごとの階層的なメトリック・ウェイト (拍の強さ) テーブル。
+
+- 拍子とグリッド解像度 (4分音符あたりの tick 数) ごとに1小節分の重み配列を一度だけ作ってキャッシュ
+- 単純拍子 (2/4, 3/4, 4/4 ...)、複合拍子 (6/8, 9/8, 12/8)、変拍子 (5/8 = 2+3, 7/8 = 2+2+3 ...) に対応
+- 重みは 小節頭 1.0 > 偶数グループ拍子の小節中央 0.75 > 拍 (グループ頭) 0.5 > グループ内の各パルス 0.25 > 細分は階層ごとに半減
+- オフセットの配列をまとめて量子化し、一回の配列参照で重みを返す (metric_weights)
+"""
+import logging
+import math
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+NUMPY_AVAILABLE = False
+np = None
+try:
+    import numpy
+    np = numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    logger.warning("MetricWeights: NumPy not found. Lookups will return Python lists.")
+
+DEFAULT_TICKS_PER_QUARTER = 12 # 16分音符と3連符の両方を表せる解像度
+
+WEIGHT_DOWNBEAT = 1.0
+WEIGHT_HALF_BAR = 0.75
+WEIGHT_BEAT = 0.5
+
+
+def _parse_ts(ts_str: Optional[str]) -> Tuple[int, int]:
+    try:
+        num_str, den_str = (ts_str or "4/4").split("/")
+        num, den = int(num_str), int(den_str)
+        if num > 0 and den > 0 and den & (den - 1) == 0: return num, den
+    except (ValueError, AttributeError):
+        pass
+    logger.warning(f"MetricWeights: Invalid time signature '{ts_str}'. Using 4/4.")
+    return 4, 4
+
+def default_groupings(numerator: int, denominator: int) -> Tuple[int, ...]:
+    """
+    1小節を拍 (グループ) に分ける分母単位の個数。
+    単純拍子は (1, 1, ...)、複合拍子は 3 ずつ、8分/16分の変拍子は 2 を並べて最後を 3 にする (7/8 -> 2+2+3)。
+    """
+    if denominator >= 8 and numerator > 3:
+        if numerator % 3 == 0: return (3,) * (numerator // 3)
+        if numerator % 2 == 1: return (2,) * ((numerator - 3) // 2) + (3,)
+        return (2,) * (numerator // 2)
+    return (1,) * numerator
+
+
+@dataclass(frozen=True)
+class MetricWeightTable:
+    """1小節分のメトリック・ウェイト。weights[i] は小節頭から i tick 目の重み。"""
+    ts_str: str
+    ticks_per_quarter: int
+    groupings: Tuple[int, ...]
+    bar_ql: float
+    weights: Tuple[float, ...]
+    _array: Any = field(default=None, init=False, repr=False, compare=False, hash=False)
+
+    def __post_init__(self):
+        if NUMPY_AVAILABLE:
+            object.__setattr__(self, "_array", np.asarray(self.weights, dtype=float))
+
+    @property
+    def bar_ticks(self) -> int:
+        return len(self.weights)
+
+    def weight_at(self, offset: float, bar_offset: float = 0.0) -> float:
+        tick = int(round((offset - bar_offset) * self.ticks_per_quarter)) % self.bar_ticks
+        return self.weights[tick]
+
+    def lookup(self, offsets: Sequence[float], bar_offset: float = 0.0):
+        """オフセット列 (bar_offset を小節頭とする quarterLength) の重みを返す。NumPy があれば ndarray。"""
+        if NUMPY_AVAILABLE:
+            ticks = np.rint((np.asarray(offsets, dtype=float) - bar_offset) * self.ticks_per_quarter).astype(np.int64) % self.bar_ticks
+            return self._array[ticks]
+        return [self.weight_at(o, bar_offset) for o in offsets]
+
+
+def _build_weights(numerator: int, denominator: int, groupings: Tuple[int, ...], ticks_per_quarter: int) -> List[float]:
+    unit_ticks = ticks_per_quarter * 4 // denominator
+    if unit_ticks <= 0 or (ticks_per_quarter * 4) % denominator:
+        raise ValueError(f"MetricWeights: ticks_per_quarter={ticks_per_quarter} is too coarse for /{denominator}.")
+    # 偶数個 (4以上) のグループからなる小節は中央のグループ頭を準強拍にする
+    half_bar_group = len(groupings) // 2 if len(groupings) >= 4 and len(groupings) % 2 == 0 else -1
+    # 単純拍子では分母単位 = 拍なので、拍の裏は 1 段下。複合/変拍子ではグループ内のパルスがさらに 1 段入る
+    unit_level = 0 if all(g == 1 for g in groupings) else 1
+    weights: List[float] = []
+    for g_idx, g_len in enumerate(groupings):
+        for unit_idx in range(g_len):
+            for sub in range(unit_ticks):
+                if sub == 0 and unit_idx == 0:
+                    weights.append(WEIGHT_DOWNBEAT if g_idx == 0 else (WEIGHT_HALF_BAR if g_idx == half_bar_group else WEIGHT_BEAT))
+                elif sub == 0:
+                    weights.append(0.5 ** (unit_level + 1))
+                else:
+                    # 単位内の位置 sub/unit_ticks の既約分母で階層を決める (8分裏、16分/3連、...)
+                    level = math.ceil(math.log2(unit_ticks // math.gcd(sub, unit_ticks)))
+                    weights.append(0.5 ** (unit_level + level + 1))
+    return weights
+
+@lru_cache(maxsize=128)
+def get_metric_weight_table(ts_str: Optional[str] = "4/4",
+                            ticks_per_quarter: int = DEFAULT_TICKS_PER_QUARTER,
+                            groupings: Optional[Tuple[int, ...]] = None) -> MetricWeightTable:
+    """拍子 (と任意のグルーピング) のメトリック・ウェイト表を取得する (キャッシュ済み)。"""
+    numerator, denominator = _parse_ts(ts_str)
+    if groupings is None or sum(groupings) != numerator:
+        if groupings is not None:
+            logger.warning(f"MetricWeights: groupings {groupings} do not sum to {numerator} for '{ts_str}'. Using defaults.")
+        groupings = default_groupings(numerator, denominator)
+    weights = _build_weights(numerator, denominator, tuple(groupings), int(ticks_per_quarter))
+    return MetricWeightTable(ts_str=f"{numerator}/{denominator}", ticks_per_quarter=int(ticks_per_quarter),
+                             groupings=tuple(groupings), bar_ql=numerator * 4.0 / denominator, weights=tuple(weights))
+
+def metric_weights(offsets: Sequence[float], ts_str: Optional[str] = "4/4", bar_offset: float = 0.0,
+                   ticks_per_quarter: int = DEFAULT_TICKS_PER_QUARTER, groupings: Optional[Tuple[int, ...]] = None):
+    """オフセット列のメトリック・ウェイトを一括で返す (全呼び出し側の共通入口)。"""
+    return get_metric_weight_table(ts_str, ticks_per_quarter, groupings).lookup(offsets, bar_offset)
+
+def metric_velocity_factors(offsets: Sequence[float], depth: float, ts_str: Optional[str] = "4/4", bar_offset: float = 0.0,
+                            meter_map: Optional[Any] = None):
+    """
+    ベロシティに掛けるアクセント係数 1 + depth * (2w - 1)。拍 (w=0.5) は 1.0、小節頭は 1 + depth、細かい裏拍ほど小さくなる。
+    meter_map (tempo_map.MeterMap) を渡すと ts_str / bar_offset の代わりに、拍子の区間ごとに区間の頭を小節頭として引く。
+    """
+    if meter_map is not None and len(meter_map) > 1:
+        w = _mapped_metric_weights(offsets, meter_map)
+    else:
+        w = metric_weights(offsets, meter_map.initial.ts_str if meter_map is not None else ts_str, bar_offset)
+    if NUMPY_AVAILABLE:
+        return 1.0 + depth * (2.0 * w - 1.0)
+    return [1.0 + depth * (2.0 * x - 1.0) for x in w]
+
+def _mapped_metric_weights(offsets: Sequence[float], meter_map: Any):
+    # 区間 i (meter_map.offsets[i] から次の変化まで) のオフセットを meters[i] の表で、区間の頭を小節頭として引く
+    starts = list(meter_map.offsets)
+    if NUMPY_AVAILABLE:
+        offs = np.asarray(offsets, dtype=np.float64)
+        seg = np.maximum(np.searchsorted(np.asarray(starts, dtype=np.float64), offs, side="right") - 1, 0)
+        w = np.empty(offs.shape[0], dtype=np.float64)
+        for i in np.unique(seg).tolist():
+            sel = seg == i
+            w[sel] = metric_weights(offs[sel], meter_map.meters[i].ts_str, starts[i])
+        return w
+    result: List[float] = []
+    for o in offsets:
+        i = max(0, bisect_right(starts, o) - 1)
+        result.append(get_metric_weight_table(meter_map.meters[i].ts_str).weight_at(o, starts[i]))
+    return result
+# --- END OF FILE utilities/metric_weights.py ---
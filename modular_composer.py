@@ -5,14 +5,28 @@ import os
 import json
 import argparse
 import logging
-from music21 import stream, tempo, instrument as m21instrument, midi, meter, key
+import threading
+from music21 import stream, instrument as m21instrument, meter, key
 from pathlib import Path
-from typing import List, Dict, Optional, Any, cast, Sequence
+from typing import List, Dict, Optional, Any, cast, Sequence, Tuple, Mapping, NamedTuple
+from functools import lru_cache
+from collections import OrderedDict
+from types import MappingProxyType
 import random
 
 # --- ユーティリティとジェネレータクラスのインポート ---
 try:
-    from utilities.core_music_utils import get_time_signature_object, sanitize_chord_label
+    from utilities.core_music_utils import get_meter_info
+    from utilities.chord_timeline import ChordTimeline
+    from utilities.rhythm_library_compiler import load_rhythm_library, load_rhythm_library_data, rhythm_library_digest, CompiledRhythmLibrary, RhythmLibraryError
+    from utilities.event_buffer import NoteEventBuffer
+    from utilities.score_exporter import collect_score_events, render_formats, write_outputs, parse_formats, FORMAT_MIDI
+    from utilities.tempo_map import TempoMap, MeterMap, build_timing_maps, insert_timing_marks
+    from utilities.audio_renderer import stream_wav, LiveEventIndex
+    from utilities.humanizer import NUMPY_AVAILABLE
+    from utilities.section_dedup import plan_section_repeats, place_section_repeats
+    from utilities.part_params import intern_part_params, strip_lookup_tables, interned_count
+    from utilities.composer_config import compile_config, ComposerConfig, ConfigError
     # HUMANIZATION_TEMPLATES は humanizer.py から直接参照せず、各ジェネレータが内部で持つか、
     # あるいは humanizer.py の apply_humanization_to_part にテンプレート名を渡すだけで良い。
     # from utilities.humanizer import HUMANIZATION_TEMPLATES # 直接は使わない想定
@@ -23,12 +37,8 @@ try:
     )
 except ImportError as e:
     print(f"CRITICAL ERROR: Could not import modules: {e}")
-    sys.exit(1)
-except Exception as e_imp:
-    print(f"An unexpected error occurred during module import: {e_imp}")
-    sys.exit(1)
+    raise # ライブラリとして import された場合もプロセスは終了させない
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - [%(levelname)s] - %(module)s.%(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger("modular_composer")
 
 DEFAULT_CONFIG = {
@@ -45,16 +55,19 @@ DEFAULT_CONFIG = {
             "style_keyword_to_rhythm_key": {"piano_reflective_arpeggio_rh": "piano_flowing_arpeggio_eighths_rh", "piano_chordal_moving_rh": "piano_chordal_moving_rh_pattern", "piano_powerful_block_8ths_rh": "piano_powerful_block_8ths_rh", "simple_block_rh": "piano_block_quarters_simple", "piano_sustained_root_lh": "piano_sustained_root_lh", "piano_walking_bass_like_lh": "piano_walking_bass_like_lh", "piano_active_octave_bass_lh": "piano_active_octave_bass_lh", "simple_root_lh": "piano_lh_quarter_roots", "default_piano_rh_fallback_rhythm": "default_piano_quarters", "default_piano_lh_fallback_rhythm": "piano_lh_whole_notes"},
             "intensity_to_velocity_ranges": {"low": [50,60,55,65], "medium_low": [55,65,60,70], "medium": [60,70,65,75], "medium_high": [65,80,70,85], "high": [70,85,75,90], "high_to_very_high_then_fade": [75,95,80,100], "default": [60,70,65,75]},
             "default_apply_pedal": True, "default_arp_note_ql": 0.5, "default_rh_voicing_style": "closed", "default_lh_voicing_style": "closed", "default_rh_target_octave": 4, "default_lh_target_octave": 2, "default_rh_num_voices": 3, "default_lh_num_voices": 1,
+            "default_metric_accent": 0.15, # 拍子のメトリック・ウェイトによるベロシティのアクセント深さ (0 で無効)
+            "default_rhythm_tiling": "bar", # リズムパターンの敷き詰め方 (stretch / repeat / bar)
             "default_humanize": True, "default_humanize_rh": True, "default_humanize_lh": True, # ★ プレフィックスなしの humanize も追加
             "default_humanize_style_template": "piano_gentle_arpeggio", # ★ 共通のテンプレートキー
             "default_humanize_time_var": 0.01, "default_humanize_dur_perc": 0.02, "default_humanize_vel_var": 4,
             "default_humanize_fbm_time": False, "default_humanize_fbm_scale": 0.005, "default_humanize_fbm_hurst": 0.7
         },
         "drums": {
-            "instrument": "Percussion",
+            "instrument": "Percussion", "default_rhythm_category": "drum_patterns",
             "emotion_to_style_key": {"default_style": "default_drum_pattern", "quiet_pain_and_nascent_strength": "no_drums", "deep_regret_gratitude_and_realization": "ballad_soft_kick_snare_8th_hat", "acceptance_of_love_and_pain_hopeful_belief": "anthem_rock_chorus_16th_hat", "self_reproach_regret_deep_sadness": "no_drums_or_sparse_cymbal", "supported_light_longing_for_rebirth": "rock_ballad_build_up_8th_hat", "reflective_transition_instrumental_passage": "no_drums_or_gentle_cymbal_swell", "trial_cry_prayer_unbreakable_heart": "rock_ballad_build_up_8th_hat", "memory_unresolved_feelings_silence": "no_drums", "wavering_heart_gratitude_chosen_strength": "ballad_soft_kick_snare_8th_hat", "reaffirmed_strength_of_love_positive_determination": "anthem_rock_chorus_16th_hat", "hope_dawn_light_gentle_guidance": "no_drums_or_gentle_cymbal_swell", "nature_memory_floating_sensation_forgiveness": "no_drums_or_sparse_chimes", "future_cooperation_our_path_final_resolve_and_liberation": "anthem_rock_chorus_16th_hat"},
             "intensity_to_base_velocity": {"default": [70,80], "low": [55,65], "medium_low": [60,70], "medium": [70,80], "medium_high": [75,85], "high": [85,95], "high_to_very_high_then_fade": [90,105]},
             "default_fill_interval_bars": 4, "default_fill_keys": ["simple_snare_roll_half_bar", "chorus_end_fill"],
+            "default_metric_accent": 0.1, # 拍子のメトリック・ウェイトによるベロシティのアクセント深さ (0 で無効)
             "default_humanize": True, "default_humanize_style_template": "drum_loose_fbm", # ★ 共通キー
             "default_humanize_time_var": 0.015, "default_humanize_dur_perc": 0.03, "default_humanize_vel_var": 6,
             "default_humanize_fbm_time": True, "default_humanize_fbm_scale": 0.01, "default_humanize_fbm_hurst": 0.6
@@ -62,7 +75,7 @@ DEFAULT_CONFIG = {
         "guitar": {
             "instrument": "AcousticGuitar",
             "emotion_mode_to_style_map": {"default_default": {"style": "strum_basic", "voicing_style": "standard", "rhythm_key": "guitar_default_quarters"}, "ionian_希望": {"style": "strum_basic", "voicing_style": "open", "rhythm_key": "guitar_folk_strum_simple"}, "dorian_悲しみ": {"style": "arpeggio", "voicing_style": "standard", "arpeggio_type": "updown", "arpeggio_note_duration_ql": 0.5, "rhythm_key": "guitar_ballad_arpeggio"}, "aeolian_怒り": {"style": "muted_rhythm", "voicing_style": "power_chord_root_fifth", "rhythm_key": "guitar_rock_mute_16th"}},
-            "default_style": "strum_basic", "default_rhythm_category": "guitar_patterns", "default_rhythm_key": "guitar_default_quarters", "default_voicing_style": "standard", "default_num_strings": 6, "default_target_octave": 3, "default_velocity": 70, "default_arpeggio_type": "up", "default_arpeggio_note_duration_ql": 0.5, "default_strum_delay_ql": 0.02, "default_mute_note_duration_ql": 0.1, "default_mute_interval_ql": 0.25,
+            "default_style": "strum_basic", "default_rhythm_category": "guitar_patterns", "default_rhythm_key": "guitar_default_quarters", "default_voicing_style": "standard", "default_tuning": "standard", "default_rhythm_tiling": "bar", "default_num_strings": 6, "default_target_octave": 3, "default_velocity": 70, "default_arpeggio_type": "up", "default_arpeggio_note_duration_ql": 0.5, "default_strum_delay_ql": 0.02, "default_mute_note_duration_ql": 0.1, "default_mute_interval_ql": 0.25,
             "default_humanize": True, "default_humanize_style_template": "default_guitar_subtle", # ★ 共通キー
             "default_humanize_time_var": 0.015, "default_humanize_dur_perc": 0.04, "default_humanize_vel_var": 6,
             "default_humanize_fbm_time": False, "default_humanize_fbm_scale": 0.01, "default_humanize_fbm_hurst": 0.7
@@ -70,24 +83,31 @@ DEFAULT_CONFIG = {
         "vocal": {
             "instrument": "Vocalist",
             "data_paths": {"midivocal_data_path": "data/vocal_note_data_ore.json", "lyrics_text_path": "data/kasi_rist.json", "lyrics_timeline_path": "data/lyrics_timeline.json"},
-            "default_insert_breaths_opt": True, "default_breath_duration_ql_opt": 0.25,
+            "default_insert_breaths_opt": True, "default_breath_duration_ql_opt": 0.25, "default_monophonic_policy": "highest", # highest / lowest / closest
             "default_humanize_opt": True, "default_humanize_template_name": "vocal_ballad_smooth", # ★ 共通キー (humanize_opt は残す)
             "default_humanize_time_var": 0.02, "default_humanize_dur_perc": 0.04, "default_humanize_vel_var": 5,
             "default_humanize_fbm_time": True, "default_humanize_fbm_scale": 0.01, "default_humanize_fbm_hurst": 0.65
         },
         "bass": {
-            "instrument": "AcousticBass", "default_style": "simple_roots", "default_rhythm_key": "bass_quarter_notes",
+            "instrument": "AcousticBass", "default_rhythm_category": "bass_lines", "default_style": "simple_roots", "default_rhythm_key": "bass_quarter_notes",
+            "style_map": {"default": "simple_roots"}, "rhythm_key_map": {"default": "bass_quarter_notes"}, # 感情 → スタイル/リズムキー
             "default_octave": 2, "default_velocity": 70,
+            "default_lookahead_blocks": 4, "default_beam_width": 64, # style "walking_lookahead" 用
+            "default_rhythm_tiling": "stretch", # リズムパターンの敷き詰め方 (stretch / repeat / bar)
             "default_humanize": True, "default_humanize_style_template": "default_subtle", # ★ 共通キー
             "default_humanize_time_var": 0.01, "default_humanize_dur_perc": 0.03, "default_humanize_vel_var": 5
         },
         "melody": {
-            "instrument": "Flute", "default_rhythm_key": "default_melody_rhythm", "default_octave_range": [4,5], "default_density": 0.7, "default_velocity": 75,
+            "instrument": "Flute", "default_rhythm_category": "melody_rhythms", "rhythm_key_map": {"default": "default_melody_rhythm"}, "default_rhythm_key": "default_melody_rhythm", "default_octave_range": [4,5], "default_density": 0.7, "default_velocity": 75,
+            "default_num_candidates": 256, # ブロックごとに一括生成して採点する候補メロディ数 (1 で従来の単一生成)
             "default_humanize": True, "default_humanize_style_template": "default_subtle", # ★ 共通キー
             "default_humanize_time_var": 0.01, "default_humanize_dur_perc": 0.02, "default_humanize_vel_var": 4
         },
         "chords": {"instrument": "StringInstrument", "chord_voicing_style": "closed", "chord_target_octave": 3, "chord_num_voices": 4, "chord_velocity": 64}
     },
+    "section_dedup": { # 同じ内容の繰り返しセクションはパートごとに一度だけ生成し、時間をずらしたコピーで埋める
+        "enabled": True, "rehumanize_repeats": True, "rehumanize_template": "default_subtle"
+    },
     "output_filename_template": "output_{song_title}.mid"
 }
 
@@ -99,37 +119,60 @@ def load_json_file(file_path: Path, description: str) -> Optional[Dict | List]:
     except Exception as e: logger.error(f"Error loading {description} from {file_path}: {e}", exc_info=True); sys.exit(1)
     return None
 
-def _get_humanize_params(params_from_chordmap: Dict[str, Any], default_cfg_instrument: Dict[str, Any], instrument_prefix: str) -> Dict[str, Any]:
+def load_compiled_rhythm_library(file_path: Path, write_compiled: bool = True) -> Optional[Any]:
+    """リズムライブラリを検証済みのコンパイル版 (.rlib、JSON が変われば自動で再構築) として読み込む。"""
+    if not file_path.exists(): logger.error(f"Rhythm Library not found: {file_path}"); sys.exit(1)
+    try:
+        rhythm_lib = load_rhythm_library(file_path, write_compiled=write_compiled)
+        logger.info(f"Loaded Rhythm Library from: {file_path}"); return rhythm_lib
+    except RhythmLibraryError as e: logger.error(f"Invalid Rhythm Library {file_path}: {e}"); sys.exit(1)
+    except Exception as e: logger.error(f"Error loading Rhythm Library from {file_path}: {e}", exc_info=True); sys.exit(1)
+    return None
+
+class _HumanizeKeys(NamedTuple):
+    """楽器ごとのヒューマナイズ関連キー名 (ブロックごとに文字列を組み立てないよう一度だけ作る)。"""
+    flag: str
+    template: str
+    individual: Tuple[Tuple[str, str, str, str], ...] # (suffix, "{prefix}_humanize_{suffix}", "humanize_{suffix}", "default_humanize_{suffix}")
+
+_INDIVIDUAL_HUMANIZE_SUFFIXES = ("time_var", "dur_perc", "vel_var", "fbm_time", "fbm_scale", "fbm_hurst")
+
+@lru_cache(maxsize=None)
+def _humanize_keys(instrument_prefix: str) -> _HumanizeKeys:
+    return _HumanizeKeys(f"{instrument_prefix}_humanize", f"{instrument_prefix}_humanize_style_template",
+                         tuple((sfx, f"{instrument_prefix}_humanize_{sfx}", f"humanize_{sfx}", f"default_humanize_{sfx}") for sfx in _INDIVIDUAL_HUMANIZE_SUFFIXES))
+
+def _get_humanize_params(params_from_chordmap: Mapping[str, Any], default_cfg_instrument: Mapping[str, Any], instrument_prefix: str) -> Dict[str, Any]:
     """ヒューマナイズ関連のパラメータを解決するヘルパー関数"""
+    keys = _humanize_keys(instrument_prefix)
     humanize_final_params = {}
     # humanize_opt (または {instrument_prefix}_humanize)
-    humanize_flag = params_from_chordmap.get(f"{instrument_prefix}_humanize", params_from_chordmap.get("humanize", default_cfg_instrument.get(f"default_humanize", False)))
+    humanize_flag = params_from_chordmap.get(keys.flag, params_from_chordmap.get("humanize", default_cfg_instrument.get("default_humanize", False)))
     humanize_final_params["humanize_opt"] = bool(humanize_flag) # boolにキャスト
 
     if humanize_final_params["humanize_opt"]:
-        humanize_final_params["template_name"] = params_from_chordmap.get(f"{instrument_prefix}_humanize_style_template", default_cfg_instrument.get("default_humanize_style_template"))
+        humanize_final_params["template_name"] = params_from_chordmap.get(keys.template, default_cfg_instrument.get("default_humanize_style_template"))
         
         # 個別パラメータ (time_var, dur_perc, vel_var, fbm_time, fbm_scale, fbm_hurst)
-        individual_h_keys = ["time_var", "dur_perc", "vel_var", "fbm_time", "fbm_scale", "fbm_hurst"]
         custom_overrides = {}
-        for h_key_suffix in individual_h_keys:
+        for h_key_suffix, prefixed_key, plain_key, default_key in keys.individual:
             # params_from_chordmap から "guitar_humanize_time_var" のようなキーで探す
             # または、プレフィックスなしの "humanize_time_var" も見る (drumsのような場合)
-            val_from_map = params_from_chordmap.get(f"{instrument_prefix}_humanize_{h_key_suffix}", params_from_chordmap.get(f"humanize_{h_key_suffix}"))
+            val_from_map = params_from_chordmap.get(prefixed_key, params_from_chordmap.get(plain_key))
             if val_from_map is not None:
                 custom_overrides[h_key_suffix] = val_from_map
             else: # なければ DEFAULT_CONFIG から
-                custom_overrides[h_key_suffix] = default_cfg_instrument.get(f"default_humanize_{h_key_suffix}")
+                custom_overrides[h_key_suffix] = default_cfg_instrument.get(default_key)
         humanize_final_params["custom_params"] = custom_overrides
     return humanize_final_params
 
 
 def translate_keywords_to_params(
         musical_intent: Dict[str, Any], chord_block_specific_hints: Dict[str, Any],
-        default_instrument_params: Dict[str, Any], instrument_name_key: str,
+        default_instrument_params: Mapping[str, Any], instrument_name_key: str,
         rhythm_library_all_categories: Dict
 ) -> Dict[str, Any]:
-    params: Dict[str, Any] = default_instrument_params.copy()
+    params: Dict[str, Any] = strip_lookup_tables(default_instrument_params) # 感情→スタイル等の対応表は下で引くだけなのでブロックには持たせない
     emotion_key = musical_intent.get("emotion", "default").lower()
     intensity_key = musical_intent.get("intensity", "default").lower()
     mode_of_block = chord_block_specific_hints.get("mode_of_block", "major").lower()
@@ -146,13 +189,13 @@ def translate_keywords_to_params(
     logger.debug(f"Translating for {instrument_name_key}: Emo='{emotion_key}', Int='{intensity_key}', Mode='{mode_of_block}', InitialParams='{params}'")
 
     if instrument_name_key == "piano":
-        cfg_piano = DEFAULT_CONFIG["default_part_parameters"]["piano"] # 参照用
+        cfg_piano = default_instrument_params # 対応表を含むコンパイル済みのデフォルト (設定ファイルの上書きも反映済み)
         # スタイルとリズムキー (前回同様)
         if "piano_rh_style_keyword" not in params: params["piano_rh_style_keyword"] = cfg_piano.get("emotion_to_rh_style_keyword", {}).get(emotion_key, cfg_piano.get("emotion_to_rh_style_keyword", {}).get("default"))
         if "piano_lh_style_keyword" not in params: params["piano_lh_style_keyword"] = cfg_piano.get("emotion_to_lh_style_keyword", {}).get(emotion_key, cfg_piano.get("emotion_to_lh_style_keyword", {}).get("default"))
         # ... (リズムキー解決、ベロシティ解決は前回同様) ...
         # その他のピアノ固有パラメータ
-        for suffix in ["apply_pedal", "arp_note_ql", "rh_voicing_style", "lh_voicing_style", "rh_target_octave", "lh_target_octave", "rh_num_voices", "lh_num_voices"]:
+        for suffix in ["apply_pedal", "arp_note_ql", "rh_voicing_style", "lh_voicing_style", "rh_target_octave", "lh_target_octave", "rh_num_voices", "lh_num_voices", "metric_accent", "rhythm_tiling"]:
             param_name = f"piano_{suffix}"
             if param_name not in params: params[param_name] = cfg_piano.get(f"default_{suffix}")
         # ピアノ固有のヒューマナイズパラメータ (RH/LH別など) があればここでさらに解決
@@ -161,19 +204,20 @@ def translate_keywords_to_params(
 
 
     elif instrument_name_key == "drums":
-        cfg_drums = DEFAULT_CONFIG["default_part_parameters"]["drums"]
+        cfg_drums = default_instrument_params
         if "drum_style_key" not in params: params["drum_style_key"] = cfg_drums.get("emotion_to_style_key", {}).get(emotion_key, cfg_drums.get("emotion_to_style_key", {}).get("default_style"))
         # ... (リズムキー解決、ベロシティ解決は前回同様) ...
         if "drum_fill_interval_bars" not in params: params["drum_fill_interval_bars"] = cfg_drums.get("default_fill_interval_bars")
         if "drum_fill_keys" not in params: params["drum_fill_keys"] = cfg_drums.get("default_fill_keys")
+        if "drum_metric_accent" not in params: params["drum_metric_accent"] = cfg_drums.get("default_metric_accent", 0.0)
 
     elif instrument_name_key == "guitar":
-        cfg_guitar = DEFAULT_CONFIG["default_part_parameters"]["guitar"]
+        cfg_guitar = default_instrument_params
         emotion_mode_key = f"{mode_of_block}_{emotion_key}"
         style_map = cfg_guitar.get("emotion_mode_to_style_map", {})
         specific_style_config = style_map.get(emotion_mode_key, style_map.get(emotion_key, style_map.get(f"default_{mode_of_block}", style_map.get("default_default", {}))))
         # ... (ギター固有パラメータの解決は前回同様) ...
-        param_keys_guitar = ["guitar_style", "guitar_rhythm_key", "guitar_voicing_style", "guitar_num_strings", "guitar_target_octave", "guitar_velocity", "arpeggio_type", "arpeggio_note_duration_ql", "strum_delay_ql", "mute_note_duration_ql", "mute_interval_ql"]
+        param_keys_guitar = ["guitar_style", "guitar_rhythm_key", "guitar_voicing_style", "guitar_tuning", "guitar_rhythm_tiling", "guitar_num_strings", "guitar_target_octave", "guitar_velocity", "arpeggio_type", "arpeggio_note_duration_ql", "strum_delay_ql", "mute_note_duration_ql", "mute_interval_ql"]
         for p_key in param_keys_guitar:
             if p_key not in params:
                 specific_key = p_key.replace("guitar_", "")
@@ -181,29 +225,34 @@ def translate_keywords_to_params(
         # ... (リズムキーのフォールバック) ...
 
     elif instrument_name_key == "vocal":
-        cfg_vocal = DEFAULT_CONFIG["default_part_parameters"]["vocal"]
+        cfg_vocal = default_instrument_params
         # data_paths は run_composition で解決するのでここでは不要
-        vocal_param_keys = ["insert_breaths_opt", "breath_duration_ql_opt"] # ヒューマナイズ以外
+        vocal_param_keys = ["insert_breaths_opt", "breath_duration_ql_opt", "monophonic_policy"] # ヒューマナイズ以外
         for p_key_vocal in vocal_param_keys:
             if p_key_vocal not in params:
                 params[p_key_vocal] = cfg_vocal.get(f"default_{p_key_vocal}")
     
     elif instrument_name_key == "bass":
-        cfg_bass = DEFAULT_CONFIG["default_part_parameters"]["bass"]
+        cfg_bass = default_instrument_params
         if "style" not in params: params["style"] = cfg_bass.get("style_map",{}).get(emotion_key, cfg_bass.get("style_map",{}).get("default", "simple_roots")) # style は bass_generator が解釈
         if "rhythm_key" not in params: params["rhythm_key"] = cfg_bass.get("rhythm_key_map", {}).get(emotion_key, cfg_bass.get("rhythm_key_map", {}).get("default", "bass_quarter_notes"))
         # ... (リズムキーフォールバック、その他のベース固有パラメータ) ...
         if "octave" not in params: params["octave"] = cfg_bass.get("default_octave")
         if "velocity" not in params: params["velocity"] = cfg_bass.get("default_velocity")
+        if "rhythm_tiling" not in params: params["rhythm_tiling"] = cfg_bass.get("default_rhythm_tiling", "stretch")
+        if params.get("style") == "walking_lookahead":
+            if "lookahead_blocks" not in params: params["lookahead_blocks"] = cfg_bass.get("default_lookahead_blocks", 4)
+            if "beam_width" not in params: params["beam_width"] = cfg_bass.get("default_beam_width", 64)
 
 
     elif instrument_name_key == "melody":
-        cfg_melody = DEFAULT_CONFIG["default_part_parameters"]["melody"]
+        cfg_melody = default_instrument_params
         if "rhythm_key" not in params: params["rhythm_key"] = cfg_melody.get("rhythm_key_map", {}).get(emotion_key, cfg_melody.get("rhythm_key_map", {}).get("default", "default_melody_rhythm"))
         # ... (リズムキーフォールバック、その他のメロディ固有パラメータ) ...
         if "octave_range" not in params: params["octave_range"] = cfg_melody.get("default_octave_range")
         if "density" not in params: params["density"] = cfg_melody.get("default_density")
         if "velocity" not in params: params["velocity"] = cfg_melody.get("default_velocity")
+        if "num_candidates" not in params: params["num_candidates"] = cfg_melody.get("default_num_candidates", 256)
 
 
     # ブロック固有ヒントで最終上書き
@@ -215,16 +264,20 @@ def translate_keywords_to_params(
     logger.info(f"Final params for [{instrument_name_key}] (Emo: {emotion_key}, Int: {intensity_key}, Mode: {mode_of_block}) -> {params}")
     return params
 
-def prepare_processed_stream(chordmap_data: Dict, main_config: Dict, rhythm_lib_all: Dict) -> List[Dict]:
-    # (変更なし)
+def as_composer_config(cfg: Any) -> ComposerConfig:
+    """ComposerConfig はそのまま、dict なら DEFAULT_CONFIG に重ねて検証・コンパイルする (不正なら ConfigError)。"""
+    return cfg if isinstance(cfg, ComposerConfig) else compile_config(DEFAULT_CONFIG, cfg)
+
+def prepare_processed_stream(chordmap_data: Dict, main_config: Any, rhythm_lib_all: Dict) -> Tuple[List[Dict], ChordTimeline]:
+    # ブロックのリストと、全ジェネレータで共有する ChordTimeline (コード解析は曲全体で一度だけ) を返す
+    main_config = as_composer_config(main_config)
     processed_stream: List[Dict] = []
     current_abs_offset: float = 0.0
     g_settings = chordmap_data.get("global_settings", {})
-    ts_str = g_settings.get("time_signature", main_config["global_time_signature"])
-    ts_obj = get_time_signature_object(ts_str)
-    beats_per_measure = ts_obj.barDuration.quarterLength
-    g_key_t, g_key_m = g_settings.get("key_tonic", main_config["global_key_tonic"]), g_settings.get("key_mode", main_config["global_key_mode"])
+    ts_str, g_tempo = main_config.global_time_signature, float(main_config.global_tempo) # chordmap の global_settings は設定に反映済み (CLI が優先)
+    g_key_t, g_key_m = g_settings.get("key_tonic", main_config.global_key_tonic), g_settings.get("key_mode", main_config.global_key_mode)
     sorted_sections = sorted(chordmap_data.get("sections", {}).items(), key=lambda item: item[1].get("order", float('inf')))
+    enabled_parts = main_config.enabled_parts
     for sec_name, sec_info in sorted_sections:
         logger.info(f"Preparing section: {sec_name}")
         sec_intent = sec_info.get("musical_intent", {})
@@ -233,6 +286,12 @@ def prepare_processed_stream(chordmap_data: Dict, main_config: Dict, rhythm_lib_
         sec_len_meas = sec_info.get("length_in_measures")
         chord_prog = sec_info.get("chord_progression", [])
         if not chord_prog: logger.warning(f"Section '{sec_name}' no chords. Skip."); continue
+        # セクションごとのテンポ/拍子 (tempo_end があればセクション内のブロックで直線的に変える。リタルダンドなど)
+        sec_ts = sec_info.get("time_signature", ts_str)
+        beats_per_measure = get_meter_info(sec_ts).bar_ql
+        sec_tempo = float(sec_info.get("tempo", g_tempo)); sec_tempo_end = sec_info.get("tempo_end")
+        sec_start_offset = current_abs_offset
+        sec_total_beats = float(sec_len_meas) * beats_per_measure if sec_len_meas else None
         for c_idx, c_def in enumerate(chord_prog):
             c_lbl = c_def.get("label", "C")
             dur_b = float(c_def["duration_beats"]) if "duration_beats" in c_def else (float(sec_len_meas) * beats_per_measure) / len(chord_prog) if sec_len_meas and chord_prog else beats_per_measure
@@ -243,117 +302,296 @@ def prepare_processed_stream(chordmap_data: Dict, main_config: Dict, rhythm_lib_
             current_block_mode = c_def.get("mode", sec_m)
             blk_hints_for_translate["mode_of_block"] = current_block_mode
             for k_hint, v_hint in c_def.items():
-                if k_hint not in ["label","duration_beats","order","musical_intent","part_settings","tensions_to_add", "emotion", "intensity", "mode"]: blk_hints_for_translate[k_hint] = v_hint
-            blk_data = {"offset": current_abs_offset, "q_length": dur_b, "chord_label": c_lbl, "section_name": sec_name, "tonic_of_section": sec_t, "mode": current_block_mode, "tensions_to_add": c_def.get("tensions_to_add",[]), "is_first_in_section":(c_idx==0), "is_last_in_section":(c_idx==len(chord_prog)-1), "part_params":{}}
-            for p_key_name, generate_flag in main_config.get("parts_to_generate", {}).items():
-                if generate_flag:
-                    default_params_for_instrument = main_config["default_part_parameters"].get(p_key_name, {})
-                    blk_data["part_params"][p_key_name] = translate_keywords_to_params(blk_intent, blk_hints_for_translate, default_params_for_instrument, p_key_name, rhythm_lib_all)
+                if k_hint not in ["label","duration_beats","order","musical_intent","part_settings","tensions_to_add", "emotion", "intensity", "mode", "tempo", "time_signature"]: blk_hints_for_translate[k_hint] = v_hint
+            blk_tempo = sec_tempo
+            if sec_tempo_end is not None:
+                sec_span = sec_total_beats or sum(float(c.get("duration_beats", beats_per_measure)) for c in chord_prog)
+                blk_tempo = sec_tempo + (float(sec_tempo_end) - sec_tempo) * ((current_abs_offset - sec_start_offset) / sec_span if sec_span > 0 else 0.0)
+            blk_data = {"offset": current_abs_offset, "q_length": dur_b, "chord_label": c_lbl, "section_name": sec_name, "tonic_of_section": sec_t, "mode": current_block_mode, "tensions_to_add": c_def.get("tensions_to_add",[]), "is_first_in_section":(c_idx==0), "is_last_in_section":(c_idx==len(chord_prog)-1),
+                        "tempo": float(c_def.get("tempo", blk_tempo)), "time_signature": c_def.get("time_signature", sec_ts)}
+            blk_part_params: Dict[str, Any] = {}
+            for p_key_name in enabled_parts:
+                blk_part_params[p_key_name] = translate_keywords_to_params(blk_intent, blk_hints_for_translate, main_config.parts[p_key_name].params, p_key_name, rhythm_lib_all)
+            # 同じ内容のパラメータは不変の PartParams として全ブロックで共有する (パートごと・ブロック全体の両方)
+            blk_data["part_params"] = intern_part_params(blk_part_params)
             processed_stream.append(blk_data)
             current_abs_offset += dur_b
-    logger.info(f"Prepared {len(processed_stream)} blocks. Total duration: {current_abs_offset:.2f} beats.")
-    return processed_stream
+    logger.info(f"Prepared {len(processed_stream)} blocks. Total duration: {current_abs_offset:.2f} beats. Distinct parameter sets: {len({id(b['part_params']) for b in processed_stream})} blocks / {interned_count()} interned.")
+    chord_timeline = ChordTimeline.from_blocks(processed_stream, default_tonic=g_key_t, default_mode=g_key_m)
+    return processed_stream, chord_timeline
 
-def run_composition(cli_args: argparse.Namespace, main_cfg: Dict, chordmap: Dict, rhythm_lib_all: Dict):
-    logger.info("=== Running Main Composition Workflow ===")
-    final_score = stream.Score()
-    # (グローバル設定は変更なし)
-    final_score.insert(0, tempo.MetronomeMark(number=main_cfg["global_tempo"]))
-    try:
-        ts_obj_score = get_time_signature_object(main_cfg["global_time_signature"]); final_score.insert(0, ts_obj_score)
-        key_t, key_m = main_cfg["global_key_tonic"], main_cfg["global_key_mode"]
-        if chordmap.get("sections"):
-            try:
-                first_sec_name = sorted(chordmap.get("sections",{}).items(),key=lambda i:i[1].get("order",float('inf')))[0][0]
-                first_sec_info = chordmap["sections"][first_sec_name]
-                key_t,key_m = first_sec_info.get("tonic",key_t),first_sec_info.get("mode",key_m)
-            except IndexError: logger.warning("No sections for initial key.")
-        final_score.insert(0, key.Key(key_t, key_m.lower()))
-    except Exception as e: logger.error(f"Error setting score globals: {e}. Defaults.", exc_info=True)
-
-    proc_blocks = prepare_processed_stream(chordmap, main_cfg, rhythm_lib_all)
-    if not proc_blocks: logger.error("No blocks to process. Abort."); return
-    cv_inst = ChordVoicer(global_tempo=main_cfg["global_tempo"], global_time_signature=main_cfg["global_time_signature"])
-    gens: Dict[str, Any] = {}
-
-    # Instantiate generators (楽器設定の取得をより汎用的に)
-    for part_name, generate_flag in main_cfg.get("parts_to_generate", {}).items():
-        if not generate_flag: continue
-        
-        part_default_cfg = main_cfg["default_part_parameters"].get(part_name, {})
-        instrument_str = part_default_cfg.get("instrument", "Piano") # デフォルト楽器名
-        rhythm_category = part_default_cfg.get("default_rhythm_category", f"{part_name}_patterns") # 例: piano_patterns
+def chordmap_config_overrides(chordmap: Mapping[str, Any]) -> Dict[str, Any]:
+    """chordmap の global_settings (tempo / time_signature / key_tonic / key_mode) を設定の上書きに変換する。"""
+    cm_globals = chordmap.get("global_settings", {}) or {}
+    return {cfg_key: cm_globals[cm_key] for cm_key, cfg_key in (("tempo", "global_tempo"), ("time_signature", "global_time_signature"), ("key_tonic", "global_key_tonic"), ("key_mode", "global_key_mode")) if cm_key in cm_globals}
+
+def instrument_from_string(name: str) -> m21instrument.Instrument:
+    """楽器名から music21 の Instrument を作る。fromString が解釈できない "AcousticGuitar" のようなクラス名も受け付ける。"""
+    try: return m21instrument.fromString(name)
+    except m21instrument.InstrumentException: pass
+    inst_cls = getattr(m21instrument, name, None)
+    if isinstance(inst_cls, type) and issubclass(inst_cls, m21instrument.Instrument): return inst_cls()
+    logger.warning(f"Unknown instrument '{name}'. Using a generic instrument.")
+    inst = m21instrument.Instrument(); inst.instrumentName = name; inst.partName = name
+    return inst
+
+
+class CompositionResult(NamedTuple):
+    """compose の結果。score / events は keep_score / keep_events を指定した場合のみ。"""
+    midi_bytes: bytes # formats に "midi" がなければ空
+    config: ComposerConfig
+    generated_parts: Tuple[str, ...]
+    failed_parts: Mapping[str, str] # パート名 → エラーメッセージ (そのパートだけ飛ばして続行する)
+    score: Optional[stream.Score] = None
+    events: Optional[Mapping[str, NoteEventBuffer]] = None # パート名 → ノートイベント (ピアノは両手をまとめる)
+    outputs: Mapping[str, Mapping[str, bytes]] = MappingProxyType({}) # 形式 → {ファイル名の接尾辞: バイト列} (score_exporter)
+    tempo_map: Optional[TempoMap] = None # 拍 ↔ 秒の変換 (セクション/ブロックごとのテンポ変化を含む)
+    meter_map: Optional[MeterMap] = None
+
+
+class Composer:
+    """
+    ファイル I/O や sys.exit なしでメモリ上だけで作曲するためのエントリポイント。
+    コンパイル済みのリズムライブラリとジェネレータのインスタンスを呼び出しをまたいで使い回す (スレッドごとに1つ作ること)。
+    モジュールの compose() はスレッドごとの既定の Composer を使う。
+    """
+    MAX_CACHED_LIBRARIES = 4
+    MAX_CACHED_GENERATORS = 64
+
+    def __init__(self, settings: Optional[Mapping[str, Any]] = None):
+        self.base_config = compile_config(DEFAULT_CONFIG, settings)
+        self._libraries: "OrderedDict[str, Any]" = OrderedDict()
+        self._generators: "OrderedDict[Tuple[Any, ...], Any]" = OrderedDict()
+
+    # --- ウォームな状態 ---
+    def rhythm_library(self, rhythm_library: Mapping[str, Any]) -> Tuple[str, Any]:
+        """(内容のハッシュ, コンパイル済みライブラリ)。同じ内容なら前回のコンパイル結果を返す。"""
+        if isinstance(rhythm_library, CompiledRhythmLibrary) and rhythm_library.source_sha256:
+            digest = rhythm_library.source_sha256
+            self._libraries.setdefault(digest, rhythm_library)
+        else:
+            digest = rhythm_library_digest(rhythm_library)
+            if digest not in self._libraries: self._libraries[digest] = load_rhythm_library_data(rhythm_library, digest)
+        self._libraries.move_to_end(digest)
+        while len(self._libraries) > self.MAX_CACHED_LIBRARIES:
+            evicted, _ = self._libraries.popitem(last=False)
+            for gen_key in [k for k in self._generators if k[1] == evicted]: del self._generators[gen_key]
+        return digest, self._libraries[digest]
+
+    def _generator(self, part_name: str, cfg: ComposerConfig, library_digest: str, rhythm_lib_all: Mapping[str, Any]) -> Any:
+        part_cfg = cfg.parts[part_name]
+        gen_key = (part_name, library_digest, cfg.global_tempo, cfg.global_time_signature, cfg.global_key_tonic, cfg.global_key_mode,
+                   part_cfg.instrument, part_cfg.rhythm_category)
+        gen = self._generators.get(gen_key)
+        if gen is None:
+            gen = self._make_generator(part_name, cfg, rhythm_lib_all)
+            self._generators[gen_key] = gen
+            while len(self._generators) > self.MAX_CACHED_GENERATORS: self._generators.popitem(last=False)
+        else: self._generators.move_to_end(gen_key)
+        return gen
 
+    def _make_generator(self, part_name: str, cfg: ComposerConfig, rhythm_lib_all: Mapping[str, Any]) -> Any:
+        part_cfg = cfg.parts[part_name]
+        rhythm_lib = cast(Dict[str, Dict], rhythm_lib_all.get(part_cfg.rhythm_category, {})) # 例: piano_patterns
+        common = {"global_tempo": cfg.global_tempo, "global_time_signature": cfg.global_time_signature}
         if part_name == "piano":
-            gens[part_name] = PianoGenerator(rhythm_library=cast(Dict[str,Dict], rhythm_lib_all.get(rhythm_category, {})), chord_voicer_instance=cv_inst, global_tempo=main_cfg["global_tempo"], global_time_signature=main_cfg["global_time_signature"])
-        elif part_name == "drums":
-            gens[part_name] = DrumGenerator(drum_pattern_library=cast(Dict[str,Dict[str,Any]], rhythm_lib_all.get(rhythm_category, {})), global_tempo=main_cfg["global_tempo"], global_time_signature=main_cfg["global_time_signature"])
-        elif part_name == "guitar":
-            gens[part_name] = GuitarGenerator(rhythm_library=cast(Dict[str,Dict], rhythm_lib_all.get(rhythm_category, {})), default_instrument=m21instrument.fromString(instrument_str), global_tempo=main_cfg["global_tempo"], global_time_signature=main_cfg["global_time_signature"])
-        elif part_name == "vocal":
-            vocal_data_paths = part_default_cfg.get("data_paths", {})
-            midivocal_p = cli_args.vocal_mididata_path or chordmap.get("global_settings",{}).get("vocal_mididata_path", vocal_data_paths.get("midivocal_data_path"))
-            lyrics_p = cli_args.vocal_lyrics_path or chordmap.get("global_settings",{}).get("vocal_lyrics_path", vocal_data_paths.get("lyrics_text_path"))
-            midivocal_d = load_json_file(Path(midivocal_p), "Vocal MIDI Data") if midivocal_p else None
-            kasi_rist_d = load_json_file(Path(lyrics_p), "Lyrics List Data") if lyrics_p else None
-            if midivocal_d and kasi_rist_d:
-                gens[part_name] = VocalGenerator(default_instrument=m21instrument.fromString(instrument_str), global_tempo=main_cfg["global_tempo"], global_time_signature=main_cfg["global_time_signature"])
-            else: logger.error("Vocal generation skipped: Missing data."); main_cfg["parts_to_generate"][part_name] = False
-        elif part_name == "bass":
-            gens[part_name] = BassGenerator(rhythm_library=cast(Dict[str,Dict], rhythm_lib_all.get(rhythm_category, {})), default_instrument=m21instrument.fromString(instrument_str), global_tempo=main_cfg["global_tempo"], global_time_signature=main_cfg["global_time_signature"], global_key_tonic=main_cfg["global_key_tonic"], global_key_mode=main_cfg["global_key_mode"])
-        elif part_name == "melody":
-            gens[part_name] = MelodyGenerator(rhythm_library=cast(Dict[str,Dict], rhythm_lib_all.get(rhythm_category, {})), default_instrument=m21instrument.fromString(instrument_str), global_tempo=main_cfg["global_tempo"], global_time_signature=main_cfg["global_time_signature"], global_key_signature_tonic=main_cfg["global_key_tonic"], global_key_signature_mode=main_cfg["global_key_mode"])
-        elif part_name == "chords":
-            gens[part_name] = cv_inst
-
-    # パート生成ループ
-    for p_n, p_g_inst in gens.items():
-        if p_g_inst and main_cfg["parts_to_generate"].get(p_n):
+            return PianoGenerator(rhythm_library=rhythm_lib, chord_voicer_instance=ChordVoicer(**common), **common)
+        if part_name == "drums":
+            return DrumGenerator(drum_pattern_library=cast(Dict[str,Dict[str,Any]], rhythm_lib), **common)
+        if part_name == "guitar":
+            return GuitarGenerator(rhythm_library=rhythm_lib, default_instrument=instrument_from_string(part_cfg.instrument), **common)
+        if part_name == "vocal":
+            return VocalGenerator(default_instrument=instrument_from_string(part_cfg.instrument), **common)
+        if part_name == "bass":
+            return BassGenerator(rhythm_library=rhythm_lib, default_instrument=instrument_from_string(part_cfg.instrument), global_key_tonic=cfg.global_key_tonic, global_key_mode=cfg.global_key_mode, **common)
+        if part_name == "melody":
+            return MelodyGenerator(rhythm_library=rhythm_lib, default_instrument=instrument_from_string(part_cfg.instrument), global_key_signature_tonic=cfg.global_key_tonic, global_key_signature_mode=cfg.global_key_mode, **common)
+        if part_name == "chords":
+            return ChordVoicer(**common)
+        raise ConfigError(f"No generator for part '{part_name}'.", "parts_to_generate")
+
+    # --- 作曲 ---
+    def compose(self, chordmap: Mapping[str, Any], rhythm_library: Mapping[str, Any], settings: Optional[Mapping[str, Any]] = None,
+                vocal_data: Optional[List[Dict[str, Any]]] = None, lyrics: Optional[Dict[str, List[str]]] = None,
+                keep_score: bool = False, keep_events: bool = False, formats: Sequence[str] = (FORMAT_MIDI,)) -> CompositionResult:
+        """
+        chordmap / rhythm_library / settings (DEFAULT_CONFIG への上書き) からメモリ上で MIDI を作る。
+        設定の上書き順は Composer の settings < chordmap の global_settings < この呼び出しの settings。
+        不正な設定は ConfigError、不正なリズムライブラリは RhythmLibraryError、演奏するブロックがなければ ValueError。
+        """
+        cfg = compile_config(self.base_config, chordmap_config_overrides(chordmap), settings)
+        return self._compose(cfg, chordmap, rhythm_library, vocal_data, lyrics, keep_score, keep_events, formats)
+
+    def _compose(self, cfg: ComposerConfig, chordmap: Mapping[str, Any], rhythm_library: Mapping[str, Any],
+                 vocal_data: Optional[List[Dict[str, Any]]], lyrics: Optional[Dict[str, List[str]]],
+                 keep_score: bool, keep_events: bool, formats: Sequence[str] = (FORMAT_MIDI,),
+                 live_events: Optional[LiveEventIndex] = None) -> CompositionResult:
+        # live_events があれば、パートを生成し終わるたびにそのトラックを渡し、全パートの生成後 (書き出しの前) に close する
+        formats = parse_formats(formats) # 不正な形式は生成前に ValueError
+        library_digest, rhythm_lib_all = self.rhythm_library(rhythm_library)
+
+        proc_blocks, chord_timeline = prepare_processed_stream(cast(Dict, chordmap), cfg, cast(Dict, rhythm_lib_all))
+        if not proc_blocks: raise ValueError("The chordmap has no sections with chords to compose.")
+        tempo_map, meter_map = build_timing_maps(proc_blocks, cfg.global_tempo, cfg.global_time_signature)
+        final_score = self._score_header(cfg, chordmap, tempo_map, meter_map)
+        if live_events is not None: live_events.set_timing(tempo_map, meter_map)
+
+        gens: Dict[str, Any] = {}
+        for part_name in cfg.enabled_parts:
+            if part_name == "vocal" and not (vocal_data and lyrics):
+                # ライブラリ呼び出しでボーカルのデータを渡さないのは普通なので info (片方だけ渡された場合はエラー)
+                if vocal_data is None and lyrics is None: logger.info("Vocal generation skipped: No vocal data or lyrics were passed.")
+                else: logger.error("Vocal generation skipped: Missing data.")
+                continue
+            gens[part_name] = self._generator(part_name, cfg, library_digest, rhythm_lib_all)
+
+        # 繰り返しセクションの対応表 (パートごと)
+        dedup_cfg = cfg.section_dedup
+        repeat_plan = plan_section_repeats(proc_blocks, list(gens)) if dedup_cfg.enabled else None
+
+        # パート生成ループ
+        generated: Dict[str, stream.Stream] = {}
+        failed: Dict[str, str] = {}
+        for p_n, p_g_inst in gens.items():
             logger.info(f"Generating {p_n} part...")
             try:
                 part_obj: Optional[stream.Stream] = None # stream.Part or stream.Score
                 if p_n == "vocal":
-                    # VocalGeneratorのcomposeに必要なパラメータを構築
-                    # ★★★ translate_keywords_to_params で解決されたボーカルパラメータを使う ★★★
-                    # proc_blocks の各ブロックの part_params["vocal"] に必要な情報が入っている想定
-                    # ここでは、曲全体で一貫した設定を使うか、ブロックごとに変えるか設計による。
-                    # 一旦、最初のブロックのパラメータを代表として使う（または main_cfg から直接）
-                    vocal_params_for_compose = proc_blocks[0]["part_params"].get("vocal") if proc_blocks else main_cfg["default_part_parameters"].get("vocal", {})
-                    
+                    # 曲全体で一貫した設定を使う (最初のブロックで解決されたボーカルパラメータを代表とする)
+                    vocal_params_for_compose = proc_blocks[0]["part_params"].get("vocal") or cfg.part("vocal").params
                     part_obj = p_g_inst.compose(
-                        midivocal_data=cast(List[Dict], midivocal_data), # run_compositionスコープでロード済み
-                        kasi_rist_data=cast(Dict[str, List[str]], kasi_rist_data),
+                        midivocal_data=cast(List[Dict], vocal_data),
+                        kasi_rist_data=cast(Dict[str, List[str]], lyrics),
                         processed_chord_stream=proc_blocks,
+                        chord_timeline=chord_timeline,
                         insert_breaths_opt=vocal_params_for_compose.get("insert_breaths_opt", True),
                         breath_duration_ql_opt=vocal_params_for_compose.get("breath_duration_ql_opt", 0.25),
                         humanize_opt=vocal_params_for_compose.get("humanize_opt", True),
                         humanize_template_name=vocal_params_for_compose.get("humanize_template_name"),
-                        humanize_custom_params=vocal_params_for_compose.get("custom_params") # _get_humanize_params の戻り値に合わせる
+                        humanize_custom_params=vocal_params_for_compose.get("custom_params"), # _get_humanize_params の戻り値に合わせる
+                        monophonic_policy=vocal_params_for_compose.get("monophonic_policy", "highest")
                     )
+                elif repeat_plan is not None and repeat_plan.has_repeats(p_n):
+                    # 代表セクションのブロックだけ生成し、繰り返しは時間をずらしたコピーで埋める
+                    unique_idx = repeat_plan.unique_block_indices(p_n)
+                    timeline_kw = {} if p_n == "drums" else {"chord_timeline": chord_timeline.select(unique_idx)} # ドラムはコード情報を使わない
+                    part_obj = p_g_inst.compose([proc_blocks[i] for i in unique_idx], **timeline_kw)
+                    n_copied = place_section_repeats(part_obj, repeat_plan.repeats(p_n), rehumanize=dedup_cfg.rehumanize_repeats,
+                                                     template_name=dedup_cfg.rehumanize_template, ts_str=cfg.global_time_signature, meter_map=meter_map)
+                    logger.info(f"{p_n}: Generated {len(unique_idx)}/{len(proc_blocks)} blocks, copied {n_copied} elements into repeated sections.")
                 else:
-                    part_obj = p_g_inst.compose(proc_blocks)
-                
+                    part_obj = p_g_inst.compose(proc_blocks) if p_n == "drums" else p_g_inst.compose(proc_blocks, chord_timeline=chord_timeline)
+
                 if isinstance(part_obj, stream.Score) and part_obj.parts:
-                    for sub_part in part_obj.parts: 
+                    for sub_part in part_obj.parts:
                         if sub_part.flatten().notesAndRests: final_score.insert(0, sub_part)
                 elif isinstance(part_obj, stream.Part) and part_obj.flatten().notesAndRests:
-                    final_score.insert(0, part_obj) # ★ バグ修正: part_obj を使う
+                    final_score.insert(0, part_obj)
+                if part_obj is not None:
+                    generated[p_n] = part_obj
+                    if live_events is not None: live_events.add_tracks(collect_score_events(part_obj, tempo_map=tempo_map, meter_map=meter_map).tracks)
                 logger.info(f"{p_n} part generated.")
-            except Exception as e_gen: logger.error(f"Error in {p_n} generation: {e_gen}", exc_info=True)
+            except Exception as e_gen:
+                logger.error(f"Error in {p_n} generation: {e_gen}", exc_info=True)
+                failed[p_n] = f"{type(e_gen).__name__}: {e_gen}"
+
+        if live_events is not None: live_events.close() # ストリームは書き出しを待たずに始める
+
+        # 書き出しはスコアを一度だけ走査したイベント索引から、要求された形式をまとめて作る
+        outputs: Dict[str, Dict[str, bytes]] = {}
+        if final_score.parts and formats:
+            index = collect_score_events(final_score, tempo_map=tempo_map, meter_map=meter_map)
+            if index.tracks: outputs = render_formats(final_score, formats, index=index)
+        if not outputs: logger.warning("Score empty. Nothing to export.")
+        events = {p_n: NoteEventBuffer.from_stream(part_obj) for p_n, part_obj in generated.items()} if keep_events and NUMPY_AVAILABLE else None
+        return CompositionResult(outputs.get(FORMAT_MIDI, {}).get(".mid", b""), cfg, tuple(generated), MappingProxyType(failed),
+                                 final_score if keep_score else None, MappingProxyType(events) if events is not None else None,
+                                 MappingProxyType({fmt: MappingProxyType(files) for fmt, files in outputs.items()}), tempo_map, meter_map)
+
+    @staticmethod
+    def _score_header(cfg: ComposerConfig, chordmap: Mapping[str, Any], tempo_map: TempoMap, meter_map: MeterMap) -> stream.Score:
+        final_score = stream.Score()
+        insert_timing_marks(final_score, tempo_map, meter_map) # 曲頭と、セクション/ブロックごとのテンポ/拍子の変化点
+        try:
+            key_t, key_m = cfg.global_key_tonic, cfg.global_key_mode
+            if chordmap.get("sections"):
+                try:
+                    first_sec_name = sorted(chordmap.get("sections",{}).items(),key=lambda i:i[1].get("order",float('inf')))[0][0]
+                    first_sec_info = chordmap["sections"][first_sec_name]
+                    key_t,key_m = first_sec_info.get("tonic",key_t),first_sec_info.get("mode",key_m)
+                except IndexError: logger.warning("No sections for initial key.")
+            final_score.insert(0, key.Key(key_t, key_m.lower()))
+        except Exception as e: logger.error(f"Error setting score globals: {e}. Defaults.", exc_info=True)
+        return final_score
+
+
+_default_composers = threading.local() # Composer (とキャッシュしたジェネレータ) はスレッド間で共有できないので、スレッドごとに1つ
+
+def compose(chordmap: Mapping[str, Any], rhythm_library: Mapping[str, Any], settings: Optional[Mapping[str, Any]] = None,
+            vocal_data: Optional[List[Dict[str, Any]]] = None, lyrics: Optional[Dict[str, List[str]]] = None,
+            keep_score: bool = False, keep_events: bool = False, formats: Sequence[str] = (FORMAT_MIDI,)) -> CompositionResult:
+    """
+    呼び出したスレッドの既定の Composer で作曲する (リズムライブラリのコンパイル結果などは同じスレッドの呼び出しをまたいで再利用)。
+    スレッドごとに別の Composer を使うので、複数のスレッドから同時に呼んでよい。
+    """
+    composer: Optional[Composer] = getattr(_default_composers, "composer", None)
+    if composer is None: composer = _default_composers.composer = Composer()
+    return composer.compose(chordmap, rhythm_library, settings, vocal_data=vocal_data, lyrics=lyrics,
+                                     keep_score=keep_score, keep_events=keep_events, formats=formats)
+
+
+def run_composition(cli_args: argparse.Namespace, main_cfg: Any, chordmap: Dict, rhythm_lib_all: Dict):
+    # CLI 用: ボーカルのデータをファイルから読み、compose の結果 (--formats で指定した形式) を書き出す
+    logger.info("=== Running Main Composition Workflow ===")
+    main_cfg = as_composer_config(main_cfg)
+    midivocal_d = kasi_rist_d = None
+    if "vocal" in main_cfg.enabled_parts:
+        vocal_data_paths = main_cfg.part("vocal").params.get("data_paths", {})
+        midivocal_p = cli_args.vocal_mididata_path or chordmap.get("global_settings",{}).get("vocal_mididata_path", vocal_data_paths.get("midivocal_data_path"))
+        lyrics_p = cli_args.vocal_lyrics_path or chordmap.get("global_settings",{}).get("vocal_lyrics_path", vocal_data_paths.get("lyrics_text_path"))
+        midivocal_d = load_json_file(Path(midivocal_p), "Vocal MIDI Data") if midivocal_p else None
+        kasi_rist_d = load_json_file(Path(lyrics_p), "Lyrics List Data") if lyrics_p else None
+        if midivocal_d is None and kasi_rist_d is None: logger.error("Vocal generation skipped: Missing data (check the vocal data/lyrics paths).")
+    # 試聴用: 生成と並行して WAV を書くスレッドを先に始める ("-" なら stdout。プレイヤーにパイプすれば書き出しを待たずに聴ける)
+    stream_target = getattr(cli_args, "stream_wav", None)
+    live_events = LiveEventIndex() if stream_target else None
+    streamer = threading.Thread(target=_stream_wav_preview, args=(live_events, stream_target), name="stream_wav") if live_events is not None else None
+    if streamer is not None: streamer.start()
+    try: # main_cfg は chordmap / コマンドラインの上書きを解決済みなので、そのまま使う
+        result = Composer()._compose(main_cfg, chordmap, rhythm_lib_all, cast(Optional[List[Dict[str, Any]]], midivocal_d),
+                                     cast(Optional[Dict[str, List[str]]], kasi_rist_d), keep_score=False, keep_events=False,
+                                     formats=getattr(cli_args, "formats", (FORMAT_MIDI,)), live_events=live_events)
+    except ValueError as e:
+        logger.error(f"{e} Abort.")
+        if streamer is not None: live_events.close(); streamer.join()
+        return
+    finally:
+        if live_events is not None: live_events.close() # 途中で失敗してもストリームのスレッドを待たせたままにしない
 
-    # (MIDI書き出し部分は変更なし)
     title = chordmap.get("project_title","untitled").replace(" ","_").lower()
-    out_fname_template = main_cfg.get("output_filename_template", "output_{song_title}.mid")
-    actual_out_fname = cli_args.output_filename if cli_args.output_filename else out_fname_template.format(song_title=title)
+    actual_out_fname = cli_args.output_filename if cli_args.output_filename else main_cfg.output_filename_template.format(song_title=title)
     out_fpath = cli_args.output_dir / actual_out_fname
-    out_fpath.parent.mkdir(parents=True,exist_ok=True)
     try:
-        if final_score.flatten().notesAndRests: final_score.write('midi',fp=str(out_fpath)); logger.info(f"🎉 MIDI: {out_fpath}")
-        else: logger.warning(f"Score empty. No MIDI to {out_fpath}.")
-    except Exception as e_w: logger.error(f"MIDI write error: {e_w}", exc_info=True)
+        if result.outputs:
+            for written in write_outputs(dict(result.outputs), out_fpath.parent, out_fpath.stem): logger.info(f"🎉 Output: {written}")
+        else: logger.warning(f"Score empty. Nothing written for {out_fpath}.")
+    except Exception as e_w: logger.error(f"Output write error: {e_w}", exc_info=True)
+    if streamer is not None: streamer.join()
+
+def _stream_wav_preview(live_events: LiveEventIndex, stream_target: str) -> None:
+    # ブロックごとに合成しながら WAV を書く。生成済みパートの準備は作曲中に進め、全パートが揃ったら書き始める
+    try:
+        if stream_target == "-": n_frames = stream_wav(live_events, sys.stdout.buffer)
+        else:
+            Path(stream_target).parent.mkdir(parents=True, exist_ok=True) # 書き出し先のディレクトリより先に開くことがある
+            with open(stream_target, "wb") as wav_fp: n_frames = stream_wav(live_events, wav_fp)
+        logger.info(f"🎧 Streamed {n_frames} frames to {'stdout' if stream_target == '-' else stream_target}.")
+    except BrokenPipeError: logger.info("Audio stream closed by the reader.")
+    except Exception as e_s: logger.error(f"Audio stream error: {e_s}", exc_info=True)
 
 
 def main_cli():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - [%(levelname)s] - %(module)s.%(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     # (コマンドライン引数処理は前回提案から変更なし)
     parser = argparse.ArgumentParser(description="Modular Music Composer")
     parser.add_argument("chordmap_file", type=Path, help="Chordmap JSON.")
@@ -364,6 +602,10 @@ def main_cli():
     parser.add_argument("--tempo", type=int, help="Override global tempo.")
     parser.add_argument("--vocal-mididata-path", type=Path, help="Vocal MIDI data JSON path.")
     parser.add_argument("--vocal-lyrics-path", type=Path, help="Lyrics list JSON path.")
+    parser.add_argument("--no-section-dedup", action="store_true", help="Regenerate repeated sections instead of copying them.")
+    parser.add_argument("--formats", type=parse_formats, default=(FORMAT_MIDI,), help="Comma-separated output formats: midi,stems,json,musicxml,wav.")
+    parser.add_argument("--stream-wav", type=str, metavar="PATH", help="Also stream a WAV preview block by block to PATH ('-' for stdout).")
+    parser.add_argument("--no-compiled-rhythms", action="store_true", help="Do not write the compiled rhythm library (.rlib) next to the JSON.")
     default_parts = DEFAULT_CONFIG.get("parts_to_generate", {})
     for pk,ps in default_parts.items():
         arg_n = f"generate_{pk}"
@@ -371,30 +613,21 @@ def main_cli():
         else: parser.add_argument(f"--include-{pk}",action="store_true",dest=arg_n,help=f"Enable {pk}.")
     parser.set_defaults(**{f"generate_{k}":v for k,v in default_parts.items()})
     args = parser.parse_args()
-    effective_cfg = json.loads(json.dumps(DEFAULT_CONFIG))
-    if args.settings_file and args.settings_file.exists():
-        custom_s = load_json_file(args.settings_file, "Custom settings")
-        if custom_s and isinstance(custom_s, dict):
-            def _deep_update(t,s):
-                for k,v in s.items():
-                    if isinstance(v,dict) and k in t and isinstance(t[k],dict): _deep_update(t[k],v)
-                    else: t[k]=v
-            _deep_update(effective_cfg, custom_s)
-    for pk in default_parts.keys():
-        arg_n = f"generate_{pk}"
-        if hasattr(args, arg_n): effective_cfg["parts_to_generate"][pk] = getattr(args, arg_n)
-    if args.vocal_mididata_path: effective_cfg["default_part_parameters"]["vocal"]["data_paths"]["midivocal_data_path"] = str(args.vocal_mididata_path)
-    if args.vocal_lyrics_path: effective_cfg["default_part_parameters"]["vocal"]["data_paths"]["lyrics_text_path"] = str(args.vocal_lyrics_path)
+    custom_s = load_json_file(args.settings_file, "Custom settings") if args.settings_file and args.settings_file.exists() else None
     chordmap_d = load_json_file(args.chordmap_file, "Chordmap")
-    rhythm_lib_d = load_json_file(args.rhythm_library_file, "Rhythm Library")
+    # 上書きの順: DEFAULT_CONFIG < 設定ファイル < chordmap の global_settings < コマンドライン
+    chordmap_overrides = chordmap_config_overrides(chordmap_d) if isinstance(chordmap_d, dict) else None
+    cli_overrides: Dict[str, Any] = {"parts_to_generate": {pk: getattr(args, f"generate_{pk}") for pk in default_parts.keys() if hasattr(args, f"generate_{pk}")}}
+    vocal_path_overrides = {k: str(v) for k, v in (("midivocal_data_path", args.vocal_mididata_path), ("lyrics_text_path", args.vocal_lyrics_path)) if v}
+    if vocal_path_overrides: cli_overrides["default_part_parameters"] = {"vocal": {"data_paths": vocal_path_overrides}}
+    if args.tempo is not None: cli_overrides["global_tempo"] = args.tempo
+    if args.no_section_dedup: cli_overrides["section_dedup"] = {"enabled": False}
+    # 生成を始める前に設定全体を検証する (未知のキーや型の違う値はここで止める)
+    try: effective_cfg = compile_config(DEFAULT_CONFIG, custom_s, chordmap_overrides, cli_overrides)
+    except ConfigError as e: logger.critical(f"Invalid configuration: {e}"); sys.exit(1)
+    rhythm_lib_d = load_compiled_rhythm_library(args.rhythm_library_file, not args.no_compiled_rhythms)
     if not chordmap_d or not rhythm_lib_d: logger.critical("Data files missing. Exit."); sys.exit(1)
-    cm_globals = chordmap_d.get("global_settings", {})
-    effective_cfg["global_tempo"]=cm_globals.get("tempo",effective_cfg["global_tempo"])
-    effective_cfg["global_time_signature"]=cm_globals.get("time_signature",effective_cfg["global_time_signature"])
-    effective_cfg["global_key_tonic"]=cm_globals.get("key_tonic",effective_cfg["global_key_tonic"])
-    effective_cfg["global_key_mode"]=cm_globals.get("key_mode",effective_cfg["global_key_mode"])
-    if args.tempo is not None: effective_cfg["global_tempo"] = args.tempo
-    logger.info(f"Final Config: {json.dumps(effective_cfg, indent=2, ensure_ascii=False)}")
+    logger.info(f"Final Config: {json.dumps(effective_cfg.to_dict(), indent=2, ensure_ascii=False)}")
     try: run_composition(args, effective_cfg, cast(Dict,chordmap_d), cast(Dict,rhythm_lib_d))
     except SystemExit: raise
     except Exception as e: logger.critical(f"Critical error in main run: {e}", exc_info=True); sys.exit(1)
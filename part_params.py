@@ -0,0 +1,125 @@
+# --- START OF FILE utilities/part_params.py ---
+"""part_params.py
+ブロックごとに解決したパートパラメータを、不変 (frozen) で共有できる PartParams にまとめる。
+
+- PartParams は読み取り専用の Mapping (__slots__)。ジェネレータ側は従来どおり params.get(...) で読める
+- intern_part_params で内容が同じパラメータは同じオブジェクトになる (プロセス内でインターン)。
+  params_id はインターン時に振る番号で、同じ内容なら同じ番号 (プロセスをまたぐと変わる)
+- 値の dict は PartParams に、list は tuple に変換する (変更が必要なら to_dict() で普通の dict に戻す)
+- pickle では中身の dict だけを送り、受け取った側で再インターンするのでワーカープロセスへの転送も小さい
+- DEFAULT_CONFIG の感情 → スタイルなどの対応表 (値が dict のエントリ) は translate 時に引くだけなので、
+  strip_lookup_tables でブロックごとのパラメータからは外す
+"""
+import itertools
+import logging
+import weakref
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+_POOL: "weakref.WeakValueDictionary[Tuple[Any, ...], PartParams]" = weakref.WeakValueDictionary()
+_ID_COUNTER = itertools.count(1)
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, PartParams): return value
+    if isinstance(value, Mapping): return intern_part_params(value)
+    if isinstance(value, (list, tuple)): return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)): return frozenset(_freeze(v) for v in value)
+    return value
+
+def _thaw(value: Any) -> Any:
+    if isinstance(value, PartParams): return value.to_dict()
+    if isinstance(value, tuple): return [_thaw(v) for v in value]
+    if isinstance(value, frozenset): return set(_thaw(v) for v in value)
+    return value
+
+def _pool_key(items: Tuple[Tuple[Any, Any], ...]) -> Tuple[Any, ...]:
+    # 値がハッシュできない場合 (想定外の型) は repr で代用する
+    try:
+        hash(items); return items
+    except TypeError:
+        return tuple((k, v if _is_hashable(v) else ("__repr__", repr(v))) for k, v in items)
+
+def _is_hashable(value: Any) -> bool:
+    try:
+        hash(value); return True
+    except TypeError:
+        return False
+
+
+class PartParams(Mapping):
+    """インターン済みの不変パラメータ。直接作らず intern_part_params を使うこと。"""
+    __slots__ = ("_data", "_key", "params_id", "__weakref__")
+
+    def __init__(self, data: Dict[str, Any], key: Tuple[Any, ...], params_id: int):
+        object.__setattr__(self, "_data", data)
+        object.__setattr__(self, "_key", key)
+        object.__setattr__(self, "params_id", params_id)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("PartParams is immutable.")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("PartParams is immutable.")
+
+    def __getitem__(self, key: str) -> Any:
+        return self._data[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._data.get(key, default)
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, PartParams): return self is other or self._key == other._key
+        if isinstance(other, Mapping): return self._data == dict(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"PartParams#{self.params_id}({self._data!r})"
+
+    def __copy__(self) -> "PartParams":
+        return self
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "PartParams":
+        return self
+
+    def __reduce__(self):
+        return (intern_part_params, (self.to_dict(),))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """変更可能な普通の dict (入れ子も dict/list に戻す)。"""
+        return {k: _thaw(v) for k, v in self._data.items()}
+
+
+def intern_part_params(params: Mapping) -> PartParams:
+    """内容が同じなら同じ PartParams を返す。"""
+    if isinstance(params, PartParams): return params
+    frozen = {str(k): _freeze(v) for k, v in params.items()}
+    key = _pool_key(tuple(sorted(frozen.items(), key=lambda kv: kv[0])))
+    shared = _POOL.get(key)
+    if shared is None:
+        shared = PartParams(frozen, key, next(_ID_COUNTER))
+        _POOL[key] = shared
+    return shared
+
+def interned_count() -> int:
+    """プロセス内で現在生きている PartParams の数 (ログ/確認用)。"""
+    return len(_POOL)
+
+def strip_lookup_tables(default_params: Mapping) -> Dict[str, Any]:
+    """パートのデフォルト設定から対応表 (値が dict のエントリ) を除いたコピー。"""
+    return {k: v for k, v in default_params.items() if not isinstance(v, Mapping)}
+# --- END OF FILE utilities/part_params.py ---
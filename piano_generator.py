@@ -1,8 +1,8 @@
 # --- START OF FILE generator/piano_generator.py (ヒューマナイズ外部化版) ---
-from typing import cast, List, Dict, Optional, Tuple, Any, Sequence, Union
+from typing import cast, List, Dict, Optional, Tuple, Any, Sequence, Union, NamedTuple
 import music21
-from music21 import (stream, note, harmony, pitch, meter, duration,
-                     instrument as m21instrument, scale, interval, tempo, key,
+from music21 import (stream, note, harmony, pitch, duration,
+                     instrument as m21instrument, scale, interval, key,
                      chord as m21chord, expressions, volume as m21volume, exceptions21)
 import random
 import logging
@@ -11,23 +11,13 @@ import logging
 # import copy
 
 # ユーティリティのインポート
-try:
-    from utilities.core_music_utils import MIN_NOTE_DURATION_QL, get_time_signature_object, sanitize_chord_label
-    from utilities.humanizer import apply_humanization_to_part, HUMANIZATION_TEMPLATES # パート全体への適用を想定
-except ImportError:
-    logger_fallback = logging.getLogger(__name__ + ".fallback_utils")
-    logger_fallback.warning("PianoGen: Could not import from utilities. Using fallbacks.")
-    MIN_NOTE_DURATION_QL = 0.125
-    def get_time_signature_object(ts_str: Optional[str]) -> meter.TimeSignature:
-        if not ts_str: ts_str = "4/4"; return meter.TimeSignature(ts_str)
-        try: return meter.TimeSignature(ts_str)
-        except: return meter.TimeSignature("4/4")
-    def sanitize_chord_label(label: Optional[str]) -> Optional[str]:
-        if not label or label.strip().lower() in ["rest", "n.c.", "nc", "none"]: return None
-        return label.strip()
-    # ダミーのヒューマナイズ関数
-    def apply_humanization_to_part(part, template_name=None, custom_params=None): return part
-    HUMANIZATION_TEMPLATES = {}
+from utilities.core_music_utils import get_meter_info, MeterInfo, MIN_NOTE_DURATION_QL
+from utilities.humanizer import apply_humanization_to_part, NUMPY_AVAILABLE # パート全体への適用を想定
+from utilities.event_buffer import NoteEventBuffer
+from utilities.tempo_map import MeterMap
+from utilities.chord_timeline import ChordTimeline
+from utilities.rhythm_tiler import tile_pattern_events, resolve_tiling_policy, TILE_BAR # NumPy がなくても動く (ループ版)
+from utilities.metric_weights import metric_velocity_factors
 
 
 logger = logging.getLogger(__name__)
@@ -35,6 +25,22 @@ logger = logging.getLogger(__name__)
 DEFAULT_PIANO_LH_OCTAVE: int = 2
 DEFAULT_PIANO_RH_OCTAVE: int = 4
 
+class _PianoHandKeys(NamedTuple):
+    """手ごとの part_params のキー名 (ブロックごとに f-string で組み立てないよう事前に作っておく)。"""
+    rhythm_key: str
+    velocity: str
+    voicing_style: str
+    target_octave: str
+    num_voices: str
+    style_keyword: str
+    default_octave: int
+
+_HAND_KEYS: Dict[str, _PianoHandKeys] = {
+    hand: _PianoHandKeys(f"piano_{hand.lower()}_rhythm_key", f"piano_velocity_{hand.lower()}", f"piano_{hand.lower()}_voicing_style",
+                         f"piano_{hand.lower()}_target_octave", f"piano_{hand.lower()}_num_voices", f"piano_{hand.lower()}_style_keyword", default_octave)
+    for hand, default_octave in (("RH", DEFAULT_PIANO_RH_OCTAVE), ("LH", DEFAULT_PIANO_LH_OCTAVE))
+}
+
 # --- PianoGenerator クラス定義 ---
 class PianoGenerator:
     def __init__(self,
@@ -49,7 +55,7 @@ class PianoGenerator:
         # (デフォルトリズムの追加ロジックは変更なし)
         default_keys_to_add = {
             "default_piano_quarters": {"pattern": [{"offset": i, "duration": 1.0, "velocity_factor": 0.75-(i%2*0.05)} for i in range(4)], "description": "Default quarter notes"},
-            "piano_fallback_block": {"pattern": [{"offset":0.0, "duration": get_time_signature_object(global_time_signature).barDuration.quarterLength, "velocity_factor":0.7}], "description": "Fallback block chord"}
+            "piano_fallback_block": {"pattern": [{"offset":0.0, "duration": get_meter_info(global_time_signature).bar_ql, "velocity_factor":0.7}], "description": "Fallback block chord"}
         }
         for k, v in default_keys_to_add.items():
             if k not in self.rhythm_library: self.rhythm_library[k] = v; logger.info(f"PianoGen: Added '{k}' to rhythm_lib.")
@@ -59,7 +65,7 @@ class PianoGenerator:
         self.instrument_rh = default_instrument_rh
         self.instrument_lh = default_instrument_lh
         self.global_tempo = global_tempo
-        self.global_time_signature_obj = get_time_signature_object(global_time_signature)
+        self.global_meter = get_meter_info(global_time_signature)
 
     def _get_piano_chord_pitches(
             self, m21_cs: Optional[harmony.ChordSymbol],
@@ -100,42 +106,52 @@ class PianoGenerator:
             if off_time > on_time:
                 part_to_apply_pedal.insert(on_time, pedal_on); part_to_apply_pedal.insert(off_time, pedal_off)
 
-    def _generate_piano_hand_part_for_block(
-            self, hand_LR: str,
+    def _emit_piano_hand_events(
+            self, sink: Union[stream.Part, "NoteEventBuffer"], hand_LR: str,
             m21_cs_or_rest: Optional[music21.Music21Object],
             block_offset_ql: float, block_duration_ql: float,
             hand_specific_params: Dict[str, Any], # modular_composerから渡されるパラメータ
-            rhythm_patterns_for_piano: Dict[str, Any]
-    ) -> stream.Part: # ★ 戻り値を stream.Part に変更 ★
-        
-        hand_part = stream.Part(id=f"Piano{hand_LR}_temp") # 一時的なパート
+            rhythm_patterns_for_piano: Dict[str, Any],
+            block_meter: Optional[MeterInfo] = None # ブロックの拍子 (なければ曲全体の拍子)
+    ) -> bool:
+        """
+        片手分のブロックのイベントを、絶対オフセット (block_offset_ql + ブロック内オフセット) で sink に直接書き込む。
+        sink が NoteEventBuffer なら (オフセット, MIDI 番号, デュレーション, ベロシティ) の配列として追加し、
+        stream.Part なら Note / Chord をその場で coreInsert する (呼び出し側で coreElementsChanged を呼ぶこと)。
+        コードがパースできない/ボイシングできない場合は何も書かずに False を返す (休符はどちらの sink でも呼び出し側がパートに入れる)。
+        """
+        to_buffer = not isinstance(sink, stream.Stream)
 
-        # パラメータ取得 (変更なし)
-        rhythm_key = hand_specific_params.get(f"piano_{hand_LR.lower()}_rhythm_key")
-        velocity = int(hand_specific_params.get(f"piano_velocity_{hand_LR.lower()}", 64))
-        # ... (他のパラメータも同様)
-        voicing_style = hand_specific_params.get(f"piano_{hand_LR.lower()}_voicing_style", "closed")
-        target_octave = int(hand_specific_params.get(f"piano_{hand_LR.lower()}_target_octave", DEFAULT_PIANO_RH_OCTAVE if hand_LR == "RH" else DEFAULT_PIANO_LH_OCTAVE))
-        num_voices = hand_specific_params.get(f"piano_{hand_LR.lower()}_num_voices")
+        def emit(rel_offset: float, midis: Sequence[int], dur_ql: float, velocity_val: int) -> None:
+            velocity_val = max(1, min(127, int(velocity_val)))
+            if to_buffer:
+                sink.add_chord(block_offset_ql + rel_offset, dur_ql, midis, velocity_val)
+                return
+            el = m21chord.Chord([note.Note(m) for m in midis]) if len(midis) > 1 else note.Note(midis[0])
+            el.quarterLength = dur_ql
+            for n_vel in el.notes if isinstance(el, m21chord.Chord) else [el]: n_vel.volume = m21volume.Volume(velocity=velocity_val)
+            sink.coreInsert(block_offset_ql + rel_offset, el)
+
+        # パラメータ取得 (キー名は _HAND_KEYS に事前計算済み)
+        keys = _HAND_KEYS[hand_LR]
+        rhythm_key = hand_specific_params.get(keys.rhythm_key)
+        velocity = int(hand_specific_params.get(keys.velocity, 64))
+        voicing_style = hand_specific_params.get(keys.voicing_style, "closed")
+        target_octave = int(hand_specific_params.get(keys.target_octave, keys.default_octave))
+        num_voices = hand_specific_params.get(keys.num_voices)
         arp_note_ql = float(hand_specific_params.get("piano_arp_note_ql", 0.5))
-        perform_style_keyword = hand_specific_params.get(f"piano_{hand_LR.lower()}_style_keyword", "simple_block")
+        perform_style_keyword = hand_specific_params.get(keys.style_keyword, "simple_block")
+        metric_accent_depth = float(hand_specific_params.get("piano_metric_accent", 0.0) or 0.0)
+        blk_meter = block_meter or self.global_meter
 
-        if isinstance(m21_cs_or_rest, note.Rest):
-            rest_obj = note.Rest(quarterLength=block_duration_ql)
-            hand_part.insert(0, rest_obj) # オフセット0で挿入 (ブロック先頭からの相対)
-            return hand_part
-        
-        if not m21_cs_or_rest or not isinstance(m21_cs_or_rest, harmony.ChordSymbol) or not m21_cs_or_rest.pitches:
-            rest_obj = note.Rest(quarterLength=block_duration_ql)
-            hand_part.insert(0, rest_obj)
-            return hand_part
+        if not m21_cs_or_rest or isinstance(m21_cs_or_rest, note.Rest) or not isinstance(m21_cs_or_rest, harmony.ChordSymbol) or not m21_cs_or_rest.pitches:
+            return False
         
         m21_cs: harmony.ChordSymbol = cast(harmony.ChordSymbol, m21_cs_or_rest)
         base_voiced_pitches = self._get_piano_chord_pitches(m21_cs, num_voices, target_octave, voicing_style)
         if not base_voiced_pitches:
-            rest_obj = note.Rest(quarterLength=block_duration_ql)
-            hand_part.insert(0, rest_obj)
-            return hand_part
+            return False
+        base_midis = [int(p.midi) for p in base_voiced_pitches]
 
         rhythm_details = rhythm_patterns_for_piano.get(rhythm_key if rhythm_key else "")
         if not rhythm_details or "pattern" not in rhythm_details:
@@ -143,83 +159,88 @@ class PianoGenerator:
         
         pattern_events = rhythm_details.get("pattern", [])
         
-        # EDMスタイルや標準リズムパターンの適用ロジック (変更なし)
-        # ... (前回のコードの is_edm_bounce_style や標準リズム適用ループ) ...
-        # ただし、elements_with_offsets.append(...) の代わりに hand_part.insert(abs_offset, element) を使用
+        # EDMスタイルや標準リズムパターンの適用
         is_edm_bounce_style = "edm_bounce" in (rhythm_key or "").lower() or "bounce" in perform_style_keyword.lower()
         is_edm_spread_style = "edm_spread" in (rhythm_key or "").lower() or "spread" in perform_style_keyword.lower()
 
         if is_edm_bounce_style or is_edm_spread_style:
             edm_step = 0.5 if is_edm_bounce_style else 0.25
             num_steps = int(block_duration_ql / edm_step) if edm_step > 0 else 0
+            # ブロック先頭を小節頭とみなし、全ステップのアクセント係数を一度に引く
+            edm_accents = metric_velocity_factors([i * edm_step for i in range(num_steps)], metric_accent_depth, blk_meter.ts_str) if metric_accent_depth else None
+            current_edm_midis = [base_midis[j % len(base_midis)] for j in range(min(3, len(base_midis)))]
             for i in range(num_steps):
-                if not base_voiced_pitches: continue
-                current_edm_pitches = [base_voiced_pitches[j % len(base_voiced_pitches)] for j in range(min(3, len(base_voiced_pitches)))]
-                if not current_edm_pitches: continue
                 actual_edm_event_duration = min(edm_step, block_duration_ql - (i * edm_step))
                 if actual_edm_event_duration < MIN_NOTE_DURATION_QL / 4: continue
-                el_add = m21chord.Chord(current_edm_pitches) if len(current_edm_pitches) > 1 else note.Note(current_edm_pitches[0])
-                el_add.quarterLength = actual_edm_event_duration * 0.9
-                el_add.volume = m21volume.Volume(velocity=velocity + random.randint(-5,5))
-                hand_part.insert(i * edm_step, el_add) # ブロック先頭からの相対オフセット
-            return hand_part # EDMスタイルはここで終了
+                edm_vel = int(round(velocity * float(edm_accents[i]))) if edm_accents is not None else velocity
+                emit(i * edm_step, current_edm_midis, actual_edm_event_duration * 0.9, edm_vel + random.randint(-5,5))
+            return True # EDMスタイルはここで終了
 
-        for event_params in pattern_events:
-            event_offset = float(event_params.get("offset", 0.0))
-            event_dur = float(event_params.get("duration", self.global_time_signature_obj.beatDuration.quarterLength))
-            event_vf = float(event_params.get("velocity_factor", 1.0))
-            
-            abs_event_start_offset_in_block = event_offset # ブロック先頭からの相対オフセット
-            actual_event_duration = min(event_dur, block_duration_ql - event_offset)
-            if actual_event_duration < MIN_NOTE_DURATION_QL / 4.0: continue
+        # パターンをブロックに敷き詰める (既定は小節ごとに繰り返し、半端な小節は小節末で切る)
+        tiled_rows = tile_pattern_events(
+            pattern_events, block_duration_ql, resolve_tiling_policy(hand_specific_params.get("piano_rhythm_tiling"), TILE_BAR),
+            reference_duration_ql=rhythm_details.get("reference_duration_ql", blk_meter.bar_ql), bar_ql=blk_meter.bar_ql,
+            min_duration_ql=MIN_NOTE_DURATION_QL / 4.0, default_duration_ql=blk_meter.beat_ql).rows()
+        event_accents = metric_velocity_factors([row[0] for row in tiled_rows], metric_accent_depth, blk_meter.ts_str) if metric_accent_depth and tiled_rows else None
+        for row_idx, (abs_event_start_offset_in_block, actual_event_duration, event_vf, event_idx, _) in enumerate(tiled_rows):
+            event_params = pattern_events[event_idx]
             current_event_vel = int(velocity * event_vf)
+            if event_accents is not None: current_event_vel = max(1, min(127, int(round(current_event_vel * float(event_accents[row_idx])))))
 
-            if hand_LR == "RH" and "arpeggio" in perform_style_keyword.lower() and base_voiced_pitches:
-                # ... (アルペジオ生成ロジック、hand_part.insert を使用) ...
+            if hand_LR == "RH" and "arpeggio" in perform_style_keyword.lower():
                 arp_type = rhythm_details.get("arpeggio_type", "up")
-                ordered_arp_pitches = list(reversed(base_voiced_pitches)) if arp_type == "down" else (base_voiced_pitches + list(reversed(base_voiced_pitches[1:-1])) if arp_type == "up_down" and len(base_voiced_pitches)>2 else base_voiced_pitches)
+                ordered_arp_midis = list(reversed(base_midis)) if arp_type == "down" else (base_midis + list(reversed(base_midis[1:-1])) if arp_type == "up_down" and len(base_midis)>2 else base_midis)
                 current_offset_in_arp = 0.0; arp_idx = 0
-                while current_offset_in_arp < actual_event_duration and ordered_arp_pitches:
-                    p_arp = ordered_arp_pitches[arp_idx % len(ordered_arp_pitches)]
+                while current_offset_in_arp < actual_event_duration:
                     single_arp_dur = min(arp_note_ql, actual_event_duration - current_offset_in_arp)
                     if single_arp_dur < MIN_NOTE_DURATION_QL / 4.0: break
-                    arp_note_obj = note.Note(p_arp, quarterLength=single_arp_dur * 0.95)
-                    arp_note_obj.volume = m21volume.Volume(velocity=current_event_vel + random.randint(-3,3))
-                    hand_part.insert(abs_event_start_offset_in_block + current_offset_in_arp, arp_note_obj)
+                    emit(abs_event_start_offset_in_block + current_offset_in_arp, [ordered_arp_midis[arp_idx % len(ordered_arp_midis)]],
+                         single_arp_dur * 0.95, current_event_vel + random.randint(-3,3))
                     current_offset_in_arp += arp_note_ql; arp_idx += 1
             else:
-                # ... (ブロックコード/単音生成ロジック、hand_part.insert を使用) ...
-                pitches_to_play = []
+                midis_to_play: List[int] = []
                 if hand_LR == "LH":
                     lh_event_type = event_params.get("type", "root").lower()
-                    lh_root = min(base_voiced_pitches, key=lambda p:p.ps) if base_voiced_pitches else (m21_cs.root() if m21_cs else pitch.Pitch(f"C{DEFAULT_PIANO_LH_OCTAVE}"))
-                    if lh_event_type == "root" and lh_root: pitches_to_play.append(lh_root)
-                    elif lh_event_type == "octave_root" and lh_root: pitches_to_play.extend([lh_root, lh_root.transpose(12)])
-                    # ... (他のLHタイプ) ...
-                    elif base_voiced_pitches: pitches_to_play.append(min(base_voiced_pitches, key=lambda p:p.ps))
-                else: pitches_to_play = base_voiced_pitches
-                
-                if pitches_to_play:
-                    el = m21chord.Chord(pitches_to_play) if len(pitches_to_play) > 1 else note.Note(pitches_to_play[0])
-                    el.quarterLength = actual_event_duration * 0.9
-                    for n_chord in el.notes if isinstance(el, m21chord.Chord) else [el]: n_chord.volume = m21volume.Volume(velocity=current_event_vel)
-                    hand_part.insert(abs_event_start_offset_in_block, el)
-        
+                    lh_root = min(base_midis)
+                    if lh_event_type == "octave_root": midis_to_play = [lh_root, lh_root + 12]
+                    else: midis_to_play = [lh_root] # root (および未対応の LH タイプ) は最低音
+                else: midis_to_play = base_midis
+                emit(abs_event_start_offset_in_block, midis_to_play, actual_event_duration * 0.9, current_event_vel)
+        return True
+
+    def _generate_piano_hand_part_for_block(
+            self, hand_LR: str,
+            m21_cs_or_rest: Optional[music21.Music21Object],
+            block_offset_ql: float, block_duration_ql: float,
+            hand_specific_params: Dict[str, Any],
+            rhythm_patterns_for_piano: Dict[str, Any],
+            block_meter: Optional[MeterInfo] = None
+    ) -> stream.Part:
+        # 互換用: ブロック先頭からの相対オフセットで要素を持つ一時 Part を返す (compose は _emit_piano_hand_events を直接使う)
+        hand_part = stream.Part(id=f"Piano{hand_LR}_temp")
+        if not self._emit_piano_hand_events(hand_part, hand_LR, m21_cs_or_rest, 0.0, block_duration_ql, hand_specific_params, rhythm_patterns_for_piano, block_meter):
+            hand_part.coreInsert(0.0, note.Rest(quarterLength=block_duration_ql))
+        hand_part.coreElementsChanged()
         return hand_part
 
 
-    def compose(self, processed_chord_stream: List[Dict]) -> stream.Score:
+    def compose(self, processed_chord_stream: List[Dict], chord_timeline: Optional[ChordTimeline] = None) -> stream.Score:
         piano_score = stream.Score(id="PianoScore")
         piano_rh_part = stream.Part(id="PianoRH"); piano_rh_part.insert(0, self.instrument_rh)
         piano_lh_part = stream.Part(id="PianoLH"); piano_lh_part.insert(0, self.instrument_lh)
-        piano_score.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-        piano_score.insert(0, self.global_time_signature_obj.clone())
 
         if not processed_chord_stream:
             piano_score.append(piano_rh_part); piano_score.append(piano_lh_part)
             return piano_score
             
         logger.info(f"PianoGen: Starting for {len(processed_chord_stream)} blocks.")
+        if chord_timeline is None: chord_timeline = ChordTimeline.from_blocks(processed_chord_stream)
+
+        # NumPy があれば手ごとのイベントバッファに溜め、最後に一度だけ music21 オブジェクトにする
+        rh_buffer = NoteEventBuffer() if NUMPY_AVAILABLE else None
+        lh_buffer = NoteEventBuffer() if NUMPY_AVAILABLE else None
+        rh_sink = rh_buffer if rh_buffer is not None else piano_rh_part
+        lh_sink = lh_buffer if lh_buffer is not None else piano_lh_part
 
         # --- ブロックごとの処理 ---
         for blk_idx, blk_data in enumerate(processed_chord_stream):
@@ -227,48 +248,55 @@ class PianoGenerator:
             block_dur = float(blk_data.get("q_length", 4.0))
             chord_lbl_original = blk_data.get("chord_label", "C")
             piano_params = blk_data.get("part_params", {}).get("piano", {})
+            blk_meter = get_meter_info(blk_data.get("time_signature") or self.global_meter.ts_str)
             
             logger.debug(f"Piano Blk {blk_idx+1}: AbsOff={block_offset_abs}, Dur={block_dur}, Lbl='{chord_lbl_original}', Prms: {piano_params}")
 
-            cs_or_rest_obj: Optional[music21.Music21Object] = None
-            sanitized_label = sanitize_chord_label(chord_lbl_original)
-            if sanitized_label is None: cs_or_rest_obj = note.Rest(quarterLength=block_dur)
-            else:
-                try:
-                    cs_or_rest_obj = harmony.ChordSymbol(sanitized_label)
-                    if not cs_or_rest_obj.pitches: cs_or_rest_obj = note.Rest(quarterLength=block_dur)
-                except Exception: cs_or_rest_obj = note.Rest(quarterLength=block_dur)
+            cs_or_rest_obj: Optional[music21.Music21Object] = chord_timeline.chord_at(blk_idx) # パース済み (共有オブジェクト)
+            if cs_or_rest_obj is None: cs_or_rest_obj = note.Rest(quarterLength=block_dur)
             
-            # --- 各手のパートをブロックごとに生成 ---
-            # _generate_piano_hand_part_for_block はブロック先頭からの相対オフセットで要素を持つPartを返す
-            rh_block_part = self._generate_piano_hand_part_for_block("RH", cs_or_rest_obj, 0, block_dur, piano_params, self.rhythm_library)
-            lh_block_part = self._generate_piano_hand_part_for_block("LH", cs_or_rest_obj, 0, block_dur, piano_params, self.rhythm_library)
-
-            # --- 生成されたブロックパートをメインのRH/LHパートに絶対オフセットで追加 ---
-            for el_rh in rh_block_part.flatten().notesAndRests:
-                piano_rh_part.insert(block_offset_abs + el_rh.offset, el_rh)
-            for el_lh in lh_block_part.flatten().notesAndRests:
-                piano_lh_part.insert(block_offset_abs + el_lh.offset, el_lh)
+            # --- 各手のイベントを絶対オフセットでバッファ (またはパート) に直接書き込む ---
+            if isinstance(cs_or_rest_obj, note.Rest):
+                # 休符はバッファを通さずパートに直接入れる
+                piano_rh_part.coreInsert(block_offset_abs, note.Rest(quarterLength=block_dur))
+                piano_lh_part.coreInsert(block_offset_abs, note.Rest(quarterLength=block_dur))
+                continue
+            for hand_part, hand_sink, hand_LR in ((piano_rh_part, rh_sink, "RH"), (piano_lh_part, lh_sink, "LH")):
+                if not self._emit_piano_hand_events(hand_sink, hand_LR, cs_or_rest_obj, block_offset_abs, block_dur, piano_params, self.rhythm_library, blk_meter):
+                    hand_part.coreInsert(block_offset_abs, note.Rest(quarterLength=block_dur)) # ボイシングできないブロックも休符
             
-            if piano_params.get("piano_apply_pedal", True) and not isinstance(cs_or_rest_obj, note.Rest):
+            if piano_params.get("piano_apply_pedal", True):
                 self._apply_pedal_to_part(piano_lh_part, block_offset_abs, block_dur) # 絶対オフセットでペダル適用
 
         # --- パート全体にヒューマナイゼーションを適用 ---
         # modular_composer から渡されるパラメータに基づいて適用
         # ここでは、最初のブロックのパラメータを代表として使う（より洗練された方法も検討可）
         global_piano_params = processed_chord_stream[0].get("part_params", {}).get("piano", {}) if processed_chord_stream else {}
-        
-        if global_piano_params.get("piano_humanize_rh", global_piano_params.get("piano_humanize", False)):
-            rh_template = global_piano_params.get("piano_humanize_style_template", "piano_gentle_arpeggio")
-            rh_custom = {k.replace("piano_humanize_rh_", ""):v for k,v in global_piano_params.items() if k.startswith("piano_humanize_rh_") and not k.endswith("_template")}
-            logger.info(f"PianoGen: Humanizing RH part (template: {rh_template}, custom: {rh_custom})")
-            piano_rh_part = apply_humanization_to_part(piano_rh_part, template_name=rh_template, custom_params=rh_custom)
+        humanize_rh = global_piano_params.get("piano_humanize_rh", global_piano_params.get("piano_humanize", False))
+        humanize_lh = global_piano_params.get("piano_humanize_lh", global_piano_params.get("piano_humanize", False))
+        rh_template = global_piano_params.get("piano_humanize_style_template", "piano_gentle_arpeggio")
+        rh_custom = {k.replace("piano_humanize_rh_", ""):v for k,v in global_piano_params.items() if k.startswith("piano_humanize_rh_") and not k.endswith("_template")}
+        lh_template = global_piano_params.get("piano_humanize_style_template", "piano_block_chord") # LHは別のテンプレート例
+        lh_custom = {k.replace("piano_humanize_lh_", ""):v for k,v in global_piano_params.items() if k.startswith("piano_humanize_lh_") and not k.endswith("_template")}
 
-        if global_piano_params.get("piano_humanize_lh", global_piano_params.get("piano_humanize", False)):
-            lh_template = global_piano_params.get("piano_humanize_style_template", "piano_block_chord") # LHは別のテンプレート例
-            lh_custom = {k.replace("piano_humanize_lh_", ""):v for k,v in global_piano_params.items() if k.startswith("piano_humanize_lh_") and not k.endswith("_template")}
-            logger.info(f"PianoGen: Humanizing LH part (template: {lh_template}, custom: {lh_custom})")
-            piano_lh_part = apply_humanization_to_part(piano_lh_part, template_name=lh_template, custom_params=lh_custom)
+        meter_map = MeterMap.from_blocks(processed_chord_stream, self.global_meter.ts_str) # アクセントはブロックごとの拍子と小節線で引く
+        if rh_buffer is not None:
+            # バッファは配列のまま一括でヒューマナイズしてからパートに書き出す
+            if humanize_rh:
+                logger.info(f"PianoGen: Humanizing RH events (template: {rh_template}, custom: {rh_custom})")
+                rh_buffer.humanize(rh_template, rh_custom, self.global_meter.ts_str, meter_map)
+            if humanize_lh:
+                logger.info(f"PianoGen: Humanizing LH events (template: {lh_template}, custom: {lh_custom})")
+                lh_buffer.humanize(lh_template, lh_custom, self.global_meter.ts_str, meter_map)
+            rh_buffer.to_part(piano_rh_part); lh_buffer.to_part(piano_lh_part)
+        else:
+            piano_rh_part.coreElementsChanged(); piano_lh_part.coreElementsChanged()
+            if humanize_rh:
+                logger.info(f"PianoGen: Humanizing RH part (template: {rh_template}, custom: {rh_custom})")
+                piano_rh_part = apply_humanization_to_part(piano_rh_part, template_name=rh_template, custom_params=rh_custom, meter_map=meter_map)
+            if humanize_lh:
+                logger.info(f"PianoGen: Humanizing LH part (template: {lh_template}, custom: {lh_custom})")
+                piano_lh_part = apply_humanization_to_part(piano_lh_part, template_name=lh_template, custom_params=lh_custom, meter_map=meter_map)
 
         piano_score.append(piano_rh_part); piano_score.append(piano_lh_part)
         logger.info(f"PianoGen: Finished. RH notes: {len(piano_rh_part.flatten().notesAndRests)}, LH notes: {len(piano_lh_part.flatten().notesAndRests)}")
@@ -0,0 +1,363 @@
+# --- START OF FILE utilities/rhythm_library_compiler.py ---
+"""rhythm_library_compiler.py
+rhythm_library.json を検証済みのバイナリ (.rlib) にコンパイルし、mmap で読み込む。
+
+- 全パターン (とドラムのフィル) のイベントを1本の構造化配列 (offset / duration / velocity / velocity_factor と
+  type / instrument / strum_direction / articulation の文字列コード) に詰め、カテゴリ → キー の索引を付ける
+- 読み込みは mmap したファイル上のビューを返すだけで、イベント配列はパースしない
+- 不正なパターンはコンパイル時に RhythmLibraryError (カテゴリ / キー / イベント番号付き) になる
+- load_rhythm_library は JSON の SHA-256 を .rlib に記録し、JSON が変わっていれば自動で作り直す
+  (load_rhythm_library_data はメモリ上の辞書から同じものをファイルを介さずに作る)
+- CompiledRhythmLibrary は従来の辞書と同じように引ける (カテゴリ → キー → {"pattern": [...], ...})
+  パターンのイベントリストは pattern_event_arrays で配列として取り出せる
+"""
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+from collections.abc import Mapping, MutableMapping
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+NUMPY_AVAILABLE = False
+np = None
+try:
+    import numpy
+    np = numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    logger.warning("RhythmLibraryCompiler: NumPy not found. load_rhythm_library will return the validated JSON dict.")
+
+RLIB_MAGIC = b"RLIB"
+RLIB_VERSION = 1
+COMPILED_SUFFIX = ".rlib"
+_PREAMBLE = struct.Struct("<4sIQ") # magic, version, ヘッダ (JSON) のバイト数
+_ALIGN = 8
+
+NUMERIC_EVENT_FIELDS: Tuple[str, ...] = ("offset", "duration", "velocity", "velocity_factor")
+STRING_EVENT_FIELDS: Tuple[str, ...] = ("type", "instrument", "strum_direction", "articulation")
+MISSING_CODE = -1 # 文字列フィールドなし (数値フィールドなしは NaN)
+
+KIND_EVENTS = "events" # イベント辞書のリスト
+KIND_OFFSETS = "offsets" # オフセット (数値) のリスト (melody_rhythms)
+
+EVENT_DTYPE = np.dtype([("offset", "<f8"), ("duration", "<f8"), ("velocity", "<f8"), ("velocity_factor", "<f8"),
+                        ("type", "<i2"), ("instrument", "<i2"), ("strum_direction", "<i2"), ("articulation", "<i2")]) if NUMPY_AVAILABLE else None
+
+
+class RhythmLibraryError(ValueError):
+    """リズムライブラリ (JSON / .rlib) の不正。category / key / event_index で場所を示す。"""
+    def __init__(self, message: str, category: Optional[str] = None, key: Optional[str] = None,
+                 event_index: Optional[int] = None, fill: Optional[str] = None):
+        self.category = category; self.key = key; self.event_index = event_index; self.fill = fill
+        location = "/".join(str(p) for p in (category, key) if p is not None)
+        if fill is not None: location += f" (fill '{fill}')"
+        if event_index is not None: location += f" [event {event_index}]"
+        super().__init__(f"{location}: {message}" if location else message)
+
+
+# --- 検証 ---
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def _validate_events(events: Any, category: str, key: str, fill: Optional[str] = None) -> str:
+    """イベントリストを検証し、種類 (KIND_EVENTS / KIND_OFFSETS) を返す。"""
+    if not isinstance(events, list):
+        raise RhythmLibraryError(f"pattern must be a list, got {type(events).__name__}.", category, key, fill=fill)
+    if events and all(_is_number(ev) for ev in events):
+        for i, ev in enumerate(events):
+            if ev < 0: raise RhythmLibraryError(f"offset must be >= 0, got {ev}.", category, key, i, fill)
+        return KIND_OFFSETS
+    for i, ev in enumerate(events):
+        if not isinstance(ev, dict):
+            raise RhythmLibraryError(f"event must be an object (or the whole pattern a list of offsets), got {ev!r}.", category, key, i, fill)
+        unknown = set(ev) - set(NUMERIC_EVENT_FIELDS) - set(STRING_EVENT_FIELDS)
+        if unknown: raise RhythmLibraryError(f"unknown event field(s) {sorted(unknown)}.", category, key, i, fill)
+        if "offset" not in ev: raise RhythmLibraryError("event has no 'offset'.", category, key, i, fill)
+        for field_name in NUMERIC_EVENT_FIELDS:
+            if field_name not in ev: continue
+            value = ev[field_name]
+            if not _is_number(value): raise RhythmLibraryError(f"'{field_name}' must be a finite number, got {value!r}.", category, key, i, fill)
+            if field_name == "offset" and value < 0: raise RhythmLibraryError(f"offset must be >= 0, got {value}.", category, key, i, fill)
+            if field_name == "duration" and value <= 0: raise RhythmLibraryError(f"duration must be > 0, got {value}.", category, key, i, fill)
+            if field_name == "velocity" and not 0 <= value <= 127: raise RhythmLibraryError(f"velocity must be within 0..127, got {value}.", category, key, i, fill)
+            if field_name == "velocity_factor" and value < 0: raise RhythmLibraryError(f"velocity_factor must be >= 0, got {value}.", category, key, i, fill)
+        for field_name in STRING_EVENT_FIELDS:
+            if field_name in ev and not isinstance(ev[field_name], str):
+                raise RhythmLibraryError(f"'{field_name}' must be a string, got {ev[field_name]!r}.", category, key, i, fill)
+    return KIND_EVENTS
+
+def validate_rhythm_library(data: Any) -> None:
+    """リズムライブラリ全体を検証する。不正があれば最初の1件で RhythmLibraryError。"""
+    if not isinstance(data, dict): raise RhythmLibraryError(f"rhythm library must be an object, got {type(data).__name__}.")
+    for category, patterns in data.items():
+        if not isinstance(patterns, dict):
+            raise RhythmLibraryError(f"category must be an object of patterns, got {type(patterns).__name__}.", category)
+        for key, details in patterns.items():
+            if not isinstance(details, dict):
+                raise RhythmLibraryError(f"pattern definition must be an object, got {type(details).__name__}.", category, key)
+            if "pattern" not in details: raise RhythmLibraryError("pattern definition has no 'pattern'.", category, key)
+            _validate_events(details["pattern"], category, key)
+            fills = details.get("fill_ins", {})
+            if not isinstance(fills, dict): raise RhythmLibraryError("'fill_ins' must be an object.", category, key)
+            for fill_name, fill_events in fills.items():
+                if _validate_events(fill_events, category, key, fill_name) != KIND_EVENTS and fill_events:
+                    raise RhythmLibraryError("fill must be a list of events.", category, key, fill=fill_name)
+
+
+# --- コンパイル ---
+def _encode_events(events: Sequence[Any], kind: str, strings: Dict[str, int]) -> List[Tuple[Any, ...]]:
+    """イベントリストを EVENT_DTYPE の行タプルにする (strings は文字列 → コードの表で、必要に応じて追加される)。"""
+    if kind == KIND_OFFSETS:
+        return [(float(off), math.nan, math.nan, math.nan, MISSING_CODE, MISSING_CODE, MISSING_CODE, MISSING_CODE) for off in events]
+    rows: List[Tuple[Any, ...]] = []
+    for ev in events:
+        row: List[Any] = [float(ev[f]) if f in ev else math.nan for f in NUMERIC_EVENT_FIELDS]
+        for f in STRING_EVENT_FIELDS:
+            if f in ev: row.append(strings.setdefault(ev[f], len(strings)))
+            else: row.append(MISSING_CODE)
+        rows.append(tuple(row))
+    return rows
+
+def compile_rhythm_library(data: Dict[str, Any], source_sha256: str = "") -> bytes:
+    """検証してから .rlib のバイト列を作る。"""
+    if not NUMPY_AVAILABLE: raise RuntimeError("compile_rhythm_library requires NumPy.")
+    validate_rhythm_library(data)
+    strings: Dict[str, int] = {}
+    rows: List[Tuple[Any, ...]] = []
+    index: Dict[str, Dict[str, Any]] = {}
+    for category, patterns in data.items():
+        cat_index: Dict[str, Any] = {}
+        for key, details in patterns.items():
+            events = details["pattern"]
+            kind = KIND_OFFSETS if events and all(_is_number(ev) for ev in events) else KIND_EVENTS
+            entry: Dict[str, Any] = {"kind": kind, "start": len(rows), "count": len(events),
+                                     "meta": {k: v for k, v in details.items() if k not in ("pattern", "fill_ins")}}
+            rows.extend(_encode_events(events, kind, strings))
+            if "fill_ins" in details:
+                entry["fills"] = {}
+                for fill_name, fill_events in details["fill_ins"].items():
+                    entry["fills"][fill_name] = [len(rows), len(fill_events)]
+                    rows.extend(_encode_events(fill_events, KIND_EVENTS, strings))
+            cat_index[key] = entry
+        index[category] = cat_index
+    header = json.dumps({
+        "source_sha256": source_sha256, "event_count": len(rows), "dtype": [list(d) for d in EVENT_DTYPE.descr],
+        "strings": sorted(strings, key=strings.get), "categories": index,
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-(_PREAMBLE.size + len(header)) % _ALIGN) # イベント配列を 8 バイト境界に置く
+    events_array = np.array(rows, dtype=EVENT_DTYPE)
+    return _PREAMBLE.pack(RLIB_MAGIC, RLIB_VERSION, len(header)) + header + events_array.tobytes()
+
+def compile_rhythm_library_file(json_path: Union[str, Path], compiled_path: Optional[Union[str, Path]] = None) -> Path:
+    """JSON ファイルをコンパイルして .rlib を書き出す (一時ファイル経由で置き換える)。"""
+    json_path = Path(json_path)
+    compiled_path = Path(compiled_path) if compiled_path else json_path.with_suffix(COMPILED_SUFFIX)
+    raw = json_path.read_bytes()
+    try: data = json.loads(raw)
+    except json.JSONDecodeError as e: raise RhythmLibraryError(f"invalid JSON in {json_path}: {e}") from e
+    blob = compile_rhythm_library(data, hashlib.sha256(raw).hexdigest())
+    tmp_path = compiled_path.with_name(compiled_path.name + f".tmp{os.getpid()}")
+    try:
+        tmp_path.write_bytes(blob)
+        os.replace(tmp_path, compiled_path)
+    finally:
+        if tmp_path.exists(): tmp_path.unlink()
+    logger.info(f"RhythmLibraryCompiler: Compiled {json_path} -> {compiled_path} ({len(blob)} bytes).")
+    return compiled_path
+
+
+# --- 読み込み ---
+class RhythmPatternArrays(NamedTuple):
+    """1パターン分のイベント列 (コンパイル済みライブラリでは mmap 上のビュー)。数値なしは NaN、文字列なしは MISSING_CODE。"""
+    offsets: Any
+    durations: Any
+    velocities: Any
+    velocity_factors: Any
+    types: Any
+    instruments: Any
+    strum_directions: Any
+    articulations: Any
+    strings: Tuple[str, ...] # 文字列コード → 文字列
+
+    def durations_or(self, default: float):
+        return np.where(np.isnan(self.durations), default, self.durations)
+
+    def velocity_factors_or(self, default: float):
+        return np.where(np.isnan(self.velocity_factors), default, self.velocity_factors)
+
+    def names(self, codes: Any) -> List[Optional[str]]:
+        return [self.strings[c] if c != MISSING_CODE else None for c in codes.tolist()]
+
+def _arrays_from_records(records: Any, strings: Tuple[str, ...]) -> RhythmPatternArrays:
+    return RhythmPatternArrays(records["offset"], records["duration"], records["velocity"], records["velocity_factor"],
+                               records["type"], records["instrument"], records["strum_direction"], records["articulation"], strings)
+
+
+class CompiledEventList(list):
+    """コンパイル済みライブラリから作ったイベントリスト。arrays に同じイベントの配列を持つ (変更しないこと)。"""
+    __slots__ = ("arrays",)
+
+def _materialize_events(arrays: RhythmPatternArrays, kind: str) -> CompiledEventList:
+    if kind == KIND_OFFSETS:
+        events = CompiledEventList(arrays.offsets.tolist())
+    else:
+        numeric = list(zip(NUMERIC_EVENT_FIELDS, (arrays.offsets.tolist(), arrays.durations.tolist(), arrays.velocities.tolist(), arrays.velocity_factors.tolist())))
+        textual = list(zip(STRING_EVENT_FIELDS, (arrays.types.tolist(), arrays.instruments.tolist(), arrays.strum_directions.tolist(), arrays.articulations.tolist())))
+        events = CompiledEventList()
+        for i in range(len(arrays.offsets)):
+            ev: Dict[str, Any] = {f: col[i] for f, col in numeric if not math.isnan(col[i])}
+            ev.update((f, arrays.strings[col[i]]) for f, col in textual if col[i] != MISSING_CODE)
+            events.append(ev)
+    events.arrays = arrays
+    return events
+
+def pattern_event_arrays(events: Sequence[Any]) -> RhythmPatternArrays:
+    """パターン (またはフィル) のイベントリストを配列で返す。コンパイル済みならビューをそのまま返し、辞書のリストなら変換する。"""
+    arrays = getattr(events, "arrays", None)
+    if arrays is not None: return arrays
+    strings: Dict[str, int] = {}
+    kind = KIND_OFFSETS if events and all(_is_number(ev) for ev in events) else KIND_EVENTS
+    rows = _encode_events([ev for ev in events if kind == KIND_OFFSETS or isinstance(ev, dict)], kind, strings)
+    return _arrays_from_records(np.array(rows, dtype=EVENT_DTYPE), tuple(sorted(strings, key=strings.get)))
+
+
+class CompiledRhythmCategory(MutableMapping):
+    """1カテゴリ分のパターン (キー → パターン定義の辞書)。引いた時に初めて辞書を作る。追加/上書きはこのビューの中だけ。"""
+    def __init__(self, library: "CompiledRhythmLibrary", entries: Dict[str, Dict[str, Any]]):
+        self._library = library
+        self._entries = entries
+        self._items: Dict[str, Any] = {}
+        self._keys: List[str] = list(entries)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._items: return self._items[key]
+        entry = self._entries.get(key) if key in self._keys else None
+        if entry is None: raise KeyError(key)
+        details = dict(entry["meta"])
+        details["pattern"] = _materialize_events(self._library._slice(entry["start"], entry["count"]), entry["kind"])
+        if "fills" in entry:
+            details["fill_ins"] = {name: _materialize_events(self._library._slice(start, count), KIND_EVENTS)
+                                   for name, (start, count) in entry["fills"].items()}
+        self._items[key] = details
+        return details
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self._keys: self._keys.append(key)
+        self._items[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self._keys: raise KeyError(key)
+        self._keys.remove(key); self._items.pop(key, None)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._keys))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class CompiledRhythmLibrary(Mapping):
+    """.rlib の内容 (カテゴリ名 → CompiledRhythmCategory)。イベント配列は buffer (mmap / bytes) 上のビュー。"""
+    def __init__(self, buffer: Any, path: Optional[Path] = None):
+        if not NUMPY_AVAILABLE: raise RuntimeError("CompiledRhythmLibrary requires NumPy.")
+        self.path = path
+        if len(buffer) < _PREAMBLE.size: raise RhythmLibraryError(f"compiled rhythm library {path} is truncated.")
+        magic, version, header_len = _PREAMBLE.unpack_from(buffer, 0)
+        if magic != RLIB_MAGIC: raise RhythmLibraryError(f"{path} is not a compiled rhythm library.")
+        if version != RLIB_VERSION: raise RhythmLibraryError(f"{path} has format version {version}, expected {RLIB_VERSION}.")
+        try: header = json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + header_len]).decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e: raise RhythmLibraryError(f"{path} has a corrupt header: {e}") from e
+        if [tuple(d) for d in header.get("dtype", [])] != EVENT_DTYPE.descr:
+            raise RhythmLibraryError(f"{path} has an incompatible event layout.")
+        data_offset = _PREAMBLE.size + header_len
+        event_count = int(header["event_count"])
+        if len(buffer) < data_offset + event_count * EVENT_DTYPE.itemsize: raise RhythmLibraryError(f"{path} is truncated.")
+        self.source_sha256: str = header.get("source_sha256", "")
+        self.strings: Tuple[str, ...] = tuple(header["strings"])
+        self.events = np.frombuffer(buffer, dtype=EVENT_DTYPE, count=event_count, offset=data_offset)
+        self._index: Dict[str, Dict[str, Dict[str, Any]]] = header["categories"]
+        self._categories: Dict[str, CompiledRhythmCategory] = {}
+
+    @classmethod
+    def open(cls, path: Union[str, Path]) -> "CompiledRhythmLibrary":
+        path = Path(path)
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0: raise RhythmLibraryError(f"compiled rhythm library {path} is empty.")
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, path)
+
+    def _slice(self, start: int, count: int) -> RhythmPatternArrays:
+        return _arrays_from_records(self.events[start:start + count], self.strings)
+
+    def __getitem__(self, category: str) -> CompiledRhythmCategory:
+        view = self._categories.get(category)
+        if view is None:
+            view = CompiledRhythmCategory(self, self._index[category])
+            self._categories[category] = view
+        return view
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def pattern_arrays(self, category: str, key: str, fill: Optional[str] = None) -> RhythmPatternArrays:
+        """辞書を作らずにパターン (またはフィル) のイベント配列を引く。"""
+        entry = self._index[category][key]
+        if fill is not None:
+            start, count = entry["fills"][fill]
+            return self._slice(start, count)
+        return self._slice(entry["start"], entry["count"])
+
+
+def rhythm_library_digest(data: Mapping[str, Any]) -> str:
+    """辞書で渡されたリズムライブラリの SHA-256 (キー順を揃えた JSON から計算するので、同じ内容なら同じ値)。"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+def load_rhythm_library_data(data: Mapping[str, Any], source_sha256: Optional[str] = None) -> Union[CompiledRhythmLibrary, Dict[str, Any]]:
+    """メモリ上の辞書からリズムライブラリを作る (ファイルは読み書きしない)。NumPy がない場合は検証済みの辞書を返す。"""
+    if not NUMPY_AVAILABLE:
+        validate_rhythm_library(data)
+        return dict(data)
+    return CompiledRhythmLibrary(compile_rhythm_library(dict(data), source_sha256 or rhythm_library_digest(data)))
+
+def load_rhythm_library(json_path: Union[str, Path], compiled_path: Optional[Union[str, Path]] = None,
+                        write_compiled: bool = True) -> Union[CompiledRhythmLibrary, Dict[str, Any]]:
+    """
+    リズムライブラリを読み込む。JSON の SHA-256 が .rlib の記録と一致すればそのまま mmap し、
+    違えば (または .rlib が壊れていれば) コンパイルし直す。NumPy がない場合は検証済みの JSON 辞書を返す。
+    """
+    json_path = Path(json_path)
+    raw = json_path.read_bytes()
+    if not NUMPY_AVAILABLE:
+        try: data = json.loads(raw)
+        except json.JSONDecodeError as e: raise RhythmLibraryError(f"invalid JSON in {json_path}: {e}") from e
+        validate_rhythm_library(data)
+        return data
+    digest = hashlib.sha256(raw).hexdigest()
+    compiled_path = Path(compiled_path) if compiled_path else json_path.with_suffix(COMPILED_SUFFIX)
+    if compiled_path.exists():
+        try:
+            library = CompiledRhythmLibrary.open(compiled_path)
+            if library.source_sha256 == digest:
+                logger.info(f"RhythmLibraryCompiler: Loaded compiled rhythm library {compiled_path}.")
+                return library
+            logger.info(f"RhythmLibraryCompiler: {json_path} changed since {compiled_path} was built. Recompiling.")
+        except (RhythmLibraryError, OSError, ValueError) as e:
+            logger.warning(f"RhythmLibraryCompiler: Could not use {compiled_path} ({e}). Recompiling.")
+    if write_compiled:
+        try:
+            return CompiledRhythmLibrary.open(compile_rhythm_library_file(json_path, compiled_path))
+        except OSError as e:
+            logger.warning(f"RhythmLibraryCompiler: Could not write {compiled_path} ({e}). Using an in-memory compilation.")
+    try: data = json.loads(raw)
+    except json.JSONDecodeError as e: raise RhythmLibraryError(f"invalid JSON in {json_path}: {e}") from e
+    return CompiledRhythmLibrary(compile_rhythm_library(data, digest), json_path)
+# --- END OF FILE utilities/rhythm_library_compiler.py ---
@@ -0,0 +1,141 @@
+# --- START OF FILE utilities/rhythm_tiler.py ---
+"""rhythm_tiler.py
+リズムパターンを任意の長さのブロックに敷き詰める共通エンジン (ベース/ピアノ/ギター/ドラムで共有)。
+
+- TILE_STRETCH: パターン全体 (reference_duration_ql) をブロック長に伸縮する
+- TILE_REPEAT: パターンをブロック先頭から reference_duration_ql ごとに繰り返し、ブロック末尾で切る
+- TILE_BAR: 小節線ごとにパターンを頭から繰り返す。変拍子や半端な小節ではその小節の末尾で切る
+- 戻り値はブロック先頭からの相対オフセット/デュレーション/ベロシティ係数の配列と、元のパターンのイベント番号・タイル番号
+  (タイプなどその他の属性はイベント番号で引く)
+- tile_pattern_events はリズムライブラリのイベントリスト (コンパイル済みなら配列のビュー) をそのまま受け取る
+"""
+import logging
+import math
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .humanizer import NUMPY_AVAILABLE, np
+    from .rhythm_library_compiler import pattern_event_arrays
+except ImportError:
+    from humanizer import NUMPY_AVAILABLE, np # type: ignore
+    from rhythm_library_compiler import pattern_event_arrays # type: ignore
+
+TILE_STRETCH = "stretch"
+TILE_REPEAT = "repeat"
+TILE_BAR = "bar"
+TILING_POLICIES: Tuple[str, ...] = (TILE_STRETCH, TILE_REPEAT, TILE_BAR)
+
+_EPS = 1e-9
+
+
+class TiledPattern(NamedTuple):
+    """ブロック内に敷き詰めたイベント (時間順)。event_index は元のパターンでの番号、tile_index は何回目の繰り返しか。"""
+    offsets: Any
+    durations: Any
+    velocity_factors: Any
+    event_index: Any
+    tile_index: Any
+
+    def rows(self) -> List[Tuple[float, float, float, int, int]]:
+        """(offset, duration, velocity_factor, event_index, tile_index) のリスト (Python のループで使う場合)。"""
+        cols = [c.tolist() if hasattr(c, "tolist") else list(c) for c in self]
+        return list(zip(*cols))
+
+
+def resolve_tiling_policy(policy: Optional[str], default: str = TILE_BAR) -> str:
+    if policy in TILING_POLICIES: return policy
+    if policy is not None: logger.warning(f"RhythmTiler: Unknown tiling policy '{policy}'. Using '{default}'.")
+    return default
+
+def bar_spans(block_duration_ql: float, bar_ql: float, min_span_ql: float = 0.0) -> List[Tuple[float, float]]:
+    """ブロックを小節に分けた (ブロック内の開始位置, 長さ) のリスト。最後の半端な小節も含む (min_span_ql 未満は捨てる)。"""
+    if bar_ql <= 0 or block_duration_ql <= 0: return []
+    n_bars = max(1, math.ceil(block_duration_ql / bar_ql - _EPS))
+    spans = [(i * bar_ql, min(bar_ql, block_duration_ql - i * bar_ql)) for i in range(n_bars)]
+    return [(start, length) for start, length in spans if length >= min_span_ql]
+
+def tile_pattern(offsets: Sequence[float], durations: Sequence[float], block_duration_ql: float,
+                 policy: str = TILE_BAR, reference_duration_ql: Optional[float] = None, bar_ql: float = 4.0,
+                 min_duration_ql: float = 0.0, velocity_factors: Optional[Sequence[float]] = None) -> TiledPattern:
+    """
+    1ブロック分のイベント配列を作る。reference_duration_ql はパターン1周の長さ (省略時は bar_ql)。
+    デュレーションは繰り返しの区間 (REPEAT はブロック、BAR は小節) の末尾で切り、min_duration_ql 未満のイベントは捨てる。
+    """
+    if not NUMPY_AVAILABLE:
+        return _tile_pattern_py([float(o) for o in offsets], [float(d) for d in durations],
+                                [float(v) for v in velocity_factors] if velocity_factors is not None else [1.0] * len(offsets),
+                                float(block_duration_ql), policy, reference_duration_ql, float(bar_ql), min_duration_ql)
+    offs = np.asarray(offsets, dtype=np.float64)
+    durs = np.asarray(durations, dtype=np.float64)
+    vfs = np.asarray(velocity_factors, dtype=np.float64) if velocity_factors is not None else np.ones(offs.size)
+    ref = float(reference_duration_ql) if reference_duration_ql else float(bar_ql)
+    if offs.size == 0 or block_duration_ql <= 0 or ref <= 0:
+        empty_f = np.zeros(0, dtype=np.float64); empty_i = np.zeros(0, dtype=np.int64)
+        return TiledPattern(empty_f, empty_f, empty_f, empty_i, empty_i)
+
+    if policy == TILE_STRETCH:
+        scale = block_duration_ql / ref
+        tiled_offs = offs * scale
+        tiled_durs = np.minimum(durs * scale, block_duration_ql - tiled_offs)
+        keep = (tiled_offs < block_duration_ql - _EPS) & (tiled_durs >= min_duration_ql)
+        idx = np.flatnonzero(keep)
+        return TiledPattern(tiled_offs[idx], tiled_durs[idx], vfs[idx], idx, np.zeros(idx.size, dtype=np.int64))
+
+    # 繰り返す区間 (REPEAT はブロック全体、BAR は各小節) ごとに ref 間隔でタイルを置く
+    spans = [(0.0, float(block_duration_ql))] if policy == TILE_REPEAT else bar_spans(block_duration_ql, bar_ql)
+    tile_starts: List[float] = []; tile_ends: List[float] = []
+    for span_start, span_len in spans:
+        n_tiles = max(1, math.ceil(span_len / ref - _EPS))
+        tile_starts.extend(span_start + k * ref for k in range(n_tiles))
+        tile_ends.extend([span_start + span_len] * n_tiles)
+    starts = np.asarray(tile_starts, dtype=np.float64)[:, None]
+    ends = np.asarray(tile_ends, dtype=np.float64)[:, None]
+    tiled_offs = starts + offs[None, :]
+    tiled_durs = np.minimum(durs[None, :], ends - tiled_offs)
+    # 1周より後ろのイベントは次のタイルと重なるので使わない
+    keep = (offs[None, :] < ref - _EPS) & (tiled_offs < ends - _EPS) & (tiled_durs >= min_duration_ql)
+    tile_idx, event_idx = np.nonzero(keep)
+    order = np.argsort(tiled_offs[tile_idx, event_idx], kind="stable")
+    tile_idx, event_idx = tile_idx[order], event_idx[order]
+    return TiledPattern(tiled_offs[tile_idx, event_idx], tiled_durs[tile_idx, event_idx], vfs[event_idx], event_idx, tile_idx)
+
+def tile_pattern_events(pattern_events: Sequence[Any], block_duration_ql: float, policy: str = TILE_BAR,
+                        reference_duration_ql: Optional[float] = None, bar_ql: float = 4.0, min_duration_ql: float = 0.0,
+                        default_duration_ql: float = 1.0, default_velocity_factor: float = 1.0) -> TiledPattern:
+    """リズムライブラリのイベントリスト ({"offset", "duration", "velocity_factor", ...} のリスト) を tile_pattern にかける。"""
+    if NUMPY_AVAILABLE:
+        arrays = pattern_event_arrays(pattern_events)
+        return tile_pattern(arrays.offsets, arrays.durations_or(default_duration_ql), block_duration_ql, policy,
+                            reference_duration_ql, bar_ql, min_duration_ql, arrays.velocity_factors_or(default_velocity_factor))
+    return tile_pattern([float(ev.get("offset", 0.0)) for ev in pattern_events],
+                        [float(ev.get("duration", default_duration_ql)) for ev in pattern_events],
+                        block_duration_ql, policy, reference_duration_ql, bar_ql, min_duration_ql,
+                        [float(ev.get("velocity_factor", default_velocity_factor)) for ev in pattern_events])
+
+def _tile_pattern_py(offs: List[float], durs: List[float], vfs: List[float], block_duration_ql: float, policy: str,
+                     reference_duration_ql: Optional[float], bar_ql: float, min_duration_ql: float) -> TiledPattern:
+    # NumPy がない場合の同じ規則のループ版 (各列は Python のリスト)
+    ref = float(reference_duration_ql) if reference_duration_ql else bar_ql
+    rows: List[Tuple[float, float, float, int, int]] = []
+    if offs and block_duration_ql > 0 and ref > 0:
+        if policy == TILE_STRETCH:
+            scale = block_duration_ql / ref
+            for i, (off, dur) in enumerate(zip(offs, durs)):
+                t_off = off * scale; t_dur = min(dur * scale, block_duration_ql - t_off)
+                if t_off < block_duration_ql - _EPS and t_dur >= min_duration_ql: rows.append((t_off, t_dur, vfs[i], i, 0))
+        else:
+            spans = [(0.0, block_duration_ql)] if policy == TILE_REPEAT else bar_spans(block_duration_ql, bar_ql)
+            tile = 0
+            for span_start, span_len in spans:
+                for k in range(max(1, math.ceil(span_len / ref - _EPS))):
+                    for i, (off, dur) in enumerate(zip(offs, durs)):
+                        t_off = span_start + k * ref + off; t_dur = min(dur, span_start + span_len - t_off)
+                        if off < ref - _EPS and t_off < span_start + span_len - _EPS and t_dur >= min_duration_ql:
+                            rows.append((t_off, t_dur, vfs[i], i, tile))
+                    tile += 1
+            rows.sort(key=lambda r: r[0])
+    cols = list(zip(*rows)) if rows else [()] * 5
+    return TiledPattern(*(list(c) for c in cols))
+# --- END OF FILE utilities/rhythm_tiler.py ---
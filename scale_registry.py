@@ -1,10 +1,106 @@
 # --- START OF FILE utilities/scale_registry.py (確認・コメント追加版) ---
 import logging
-from typing import Optional, Dict, Any, List, Tuple # Tuple を追加
+from bisect import bisect_left, bisect_right
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple # Tuple を追加
 from music21 import pitch, scale
 
 logger = logging.getLogger(__name__)
 
+# --- 整数テーブル (12 トニック × 全モードをインポート時に一度だけ作る) ---
+# モードごとのトニックからの半音数。music21 のクラスが無いモードもここで定義できる
+MODE_INTERVALS: Dict[str, Tuple[int, ...]] = {
+    "major": (0, 2, 4, 5, 7, 9, 11), "dorian": (0, 2, 3, 5, 7, 9, 10), "phrygian": (0, 1, 3, 5, 7, 8, 10),
+    "lydian": (0, 2, 4, 6, 7, 9, 11), "mixolydian": (0, 2, 4, 5, 7, 9, 10), "minor": (0, 2, 3, 5, 7, 8, 10),
+    "locrian": (0, 1, 3, 5, 6, 8, 10),
+    "harmonic_minor": (0, 2, 3, 5, 7, 8, 11), "melodic_minor": (0, 2, 3, 5, 7, 9, 11),
+    "whole_tone": (0, 2, 4, 6, 8, 10), "chromatic": tuple(range(12)),
+    "major_pentatonic": (0, 2, 4, 7, 9), "minor_pentatonic": (0, 3, 5, 7, 10), "blues": (0, 3, 5, 6, 7, 10),
+}
+MODE_ALIASES: Dict[str, str] = {
+    "ionian": "major", "aeolian": "minor", "natural_minor": "minor",
+    "harmonicminor": "harmonic_minor", "melodicminor": "melodic_minor", "wholetone": "whole_tone",
+    "majorpentatonic": "major_pentatonic", "minorpentatonic": "minor_pentatonic",
+}
+# テンション / アボイドはスケール度数 (1 始まり、9/11/13 は 2/4/6 の1オクターブ上)
+_MODE_TENSION_DEGREES: Dict[str, Tuple[int, ...]] = {
+    "major": (2, 6, 9, 11, 13), "lydian": (2, 6, 9, 11, 13),
+    "minor": (2, 4, 6, 9, 11, 13), "dorian": (2, 4, 6, 9, 11, 13), "phrygian": (2, 4, 6, 9, 11, 13),
+    "mixolydian": (2, 4, 6, 9, 11, 13),
+}
+_DEFAULT_TENSION_DEGREES: Tuple[int, ...] = (2, 4, 6)
+_MODE_AVOID_DEGREES: Dict[str, Tuple[int, ...]] = {
+    "major": (4,), "phrygian": (2, 6), "mixolydian": (4,), "minor": (6,), "locrian": (1, 2, 3, 4, 5, 6, 7),
+}
+_PC_BY_NOTE_NAME: Dict[str, int] = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+class ScaleInfo(NamedTuple):
+    """1つのキー (トニック × モード) の整数テーブル。すべてタプル/整数なので共有して読み取り専用で使う。"""
+    tonic_pc: int
+    mode: str                           # 正規化されたモード名
+    mask: int                           # 構成音の 12bit ピッチクラスマスク
+    degree_pcs: Tuple[int, ...]         # 度数 (0 始まり) → ピッチクラス
+    tension_pcs: Tuple[int, ...]        # アボイドを除いたテンションのピッチクラス
+    tension_mask: int
+    avoid_pcs: Tuple[int, ...]
+    avoid_mask: int
+    midis: Tuple[int, ...]              # MIDI 0-127 のうちスケール構成音 (昇順)
+
+    def pc_of_degree(self, degree: int) -> int:
+        """1 始まりのスケール度数のピッチクラス (オクターブ上の度数も可)。"""
+        return self.degree_pcs[(degree - 1) % len(self.degree_pcs)]
+
+    def midis_between(self, lo_midi: int, hi_midi: int) -> Tuple[int, ...]:
+        """lo_midi 以上 hi_midi 以下の構成音 (二分探索でスライス)。"""
+        return self.midis[bisect_left(self.midis, lo_midi):bisect_right(self.midis, hi_midi)]
+
+
+def _pcs_to_mask(pcs) -> int:
+    mask = 0
+    for pc in pcs: mask |= 1 << (pc % 12)
+    return mask
+
+def _build_scale_info(tonic_pc: int, mode: str) -> ScaleInfo:
+    degree_pcs = tuple((tonic_pc + iv) % 12 for iv in MODE_INTERVALS[mode])
+    avoid_degrees = _MODE_AVOID_DEGREES.get(mode, ())
+    n = len(degree_pcs)
+    tension_pcs = tuple(dict.fromkeys(degree_pcs[(d - 1) % n] for d in _MODE_TENSION_DEGREES.get(mode, _DEFAULT_TENSION_DEGREES) if d not in avoid_degrees))
+    avoid_pcs = tuple(dict.fromkeys(degree_pcs[(d - 1) % n] for d in avoid_degrees))
+    mask = _pcs_to_mask(degree_pcs)
+    return ScaleInfo(tonic_pc, mode, mask, degree_pcs, tension_pcs, _pcs_to_mask(tension_pcs), avoid_pcs, _pcs_to_mask(avoid_pcs),
+                     tuple(m for m in range(128) if mask >> (m % 12) & 1))
+
+_SCALE_INFO: Dict[Tuple[int, str], ScaleInfo] = {(pc, mode): _build_scale_info(pc, mode) for pc in range(12) for mode in MODE_INTERVALS}
+# (トニック文字列, モード文字列) → ScaleInfo。表記ゆれの正規化は初回だけ
+_SCALE_INFO_BY_NAME: Dict[Tuple[Optional[str], Optional[str]], ScaleInfo] = {}
+
+def _canonical_mode(mode_str: Optional[str]) -> str:
+    mode_name = (mode_str or "major").lower()
+    mode_name = MODE_ALIASES.get(mode_name, mode_name)
+    if mode_name not in MODE_INTERVALS:
+        logger.warning(f"ScaleRegistry: Unknown mode '{mode_str}' for integer tables. Using major.")
+        return "major"
+    return mode_name
+
+def _tonic_pc(tonic_str: Optional[str]) -> int:
+    name = (tonic_str or "C").strip()
+    base = _PC_BY_NOTE_NAME.get(name[:1].upper())
+    if base is not None and all(ch in "#-b" for ch in name[1:]):
+        return (base + name.count("#") - name.count("-") - name.count("b")) % 12
+    try:
+        return pitch.Pitch(name).pitchClass
+    except Exception:
+        logger.error(f"ScaleRegistry: Invalid tonic '{tonic_str}'. Defaulting to C.")
+        return 0
+
+def get_scale_info(tonic_str: Optional[str], mode_str: Optional[str]) -> ScaleInfo:
+    """キーの整数テーブルを返す。同じ (トニック, モード) 文字列の2回目以降は辞書参照のみ。"""
+    info = _SCALE_INFO_BY_NAME.get((tonic_str, mode_str))
+    if info is None:
+        info = _SCALE_INFO[(_tonic_pc(tonic_str), _canonical_mode(mode_str))]
+        _SCALE_INFO_BY_NAME[(tonic_str, mode_str)] = info
+    return info
+
 # スケールオブジェクトをキャッシュするための辞書 (モジュールレベル)
 _scale_cache: Dict[Tuple[str, str], scale.ConcreteScale] = {}
 
@@ -37,9 +133,10 @@ def build_scale_object(tonic_str: Optional[str], mode_str: Optional[str]) -> sca
         "melodicminor": scale.MelodicMinorScale, "melodic_minor": scale.MelodicMinorScale,
         "wholetone": scale.WholeToneScale, "whole_tone": scale.WholeToneScale,
         "chromatic": scale.ChromaticScale,
-        "majorpentatonic": scale.MajorPentatonicScale, "major_pentatonic": scale.MajorPentatonicScale,
-        "minorpentatonic": scale.MinorPentatonicScale, "minor_pentatonic": scale.MinorPentatonicScale,
-        "blues": scale.BluesScale
+        # ペンタトニック/ブルースは music21 のバージョンによってクラスが存在しないので getattr で引く
+        "majorpentatonic": getattr(scale, "MajorPentatonicScale", None), "major_pentatonic": getattr(scale, "MajorPentatonicScale", None),
+        "minorpentatonic": getattr(scale, "MinorPentatonicScale", None), "minor_pentatonic": getattr(scale, "MinorPentatonicScale", None),
+        "blues": getattr(scale, "BluesScale", None)
     }
     
     scl_cls = mode_map.get(mode_name)
@@ -96,24 +193,23 @@ class ScaleRegistry:
 
 
     @staticmethod
-    def mode_tensions(mode: str) -> List[int]:
-        mode_lower = mode.lower()
-        # (この部分は前回と同様の簡易的な定義)
-        if mode_lower in ["major", "ionian", "lydian"]: return [2, 6, 9, 11, 13]
-        if mode_lower in ["minor", "aeolian", "dorian", "phrygian"]: return [2, 4, 6, 9, 11, 13]
-        if mode_lower == "mixolydian": return [2, 4, 6, 9, 11, 13]
-        return [2, 4, 6]
+    def info(tonic: Optional[str], mode: Optional[str]) -> ScaleInfo:
+        """キーの整数テーブル (マスク・度数表・テンション/アボイド・MIDI 範囲) を取得します。"""
+        return get_scale_info(tonic, mode)
+
+    @staticmethod
+    def scale_mask(tonic: Optional[str], mode: Optional[str]) -> int:
+        return get_scale_info(tonic, mode).mask
+
+    @staticmethod
+    def tension_mask(tonic: Optional[str], mode: Optional[str]) -> int:
+        return get_scale_info(tonic, mode).tension_mask
+
+    @staticmethod
+    def mode_tensions(mode: str) -> Tuple[int, ...]:
+        return _MODE_TENSION_DEGREES.get(get_scale_info("C", mode).mode, _DEFAULT_TENSION_DEGREES)
 
     @staticmethod
-    def avoid_degrees(mode: str) -> List[int]:
-        mode_lower = mode.lower()
-        # (この部分は前回と同様の簡易的な定義)
-        if mode_lower == "major": return [4]
-        if mode_lower == "dorian": return []
-        if mode_lower == "phrygian": return [2, 6]
-        if mode_lower == "lydian": return []
-        if mode_lower == "mixolydian": return [4]
-        if mode_lower == "aeolian": return [6]
-        if mode_lower == "locrian": return [1, 2, 3, 4, 5, 6, 7]
-        return []
+    def avoid_degrees(mode: str) -> Tuple[int, ...]:
+        return _MODE_AVOID_DEGREES.get(get_scale_info("C", mode).mode, ())
 # --- END OF FILE utilities/scale_registry.py ---
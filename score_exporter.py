@@ -0,0 +1,267 @@
+# --- START OF FILE utilities/score_exporter.py ---
+"""score_exporter.py
+生成済みの Score を一度だけ走査してトラックごとのイベント索引 (ScoreEventIndex) を作り、そこから各形式に書き出す。
+
+- 形式: "midi" (全トラックの SMF), "stems" (トラックごとの SMF), "json" (Web プレイヤー用のイベントリスト),
+  "musicxml" (譜面確認用。これだけは music21 の Score を量子化したコピーから書き出す), "wav" (audio_renderer による試聴用のミックス)
+- MIDI は music21 の midi.translate を通さず索引から直接書く (テンポ/拍子のコンダクタートラック + パートごとのトラック)。
+  テンポ/拍子の変化は索引の TempoMap / MeterMap (tempo_map.py) から書き、JSON の秒もそこからまとめて変換する
+- 各形式の結果は {ファイル名の接尾辞: バイト列} (例: ".mid", "_Bass.mid")。独立した形式はスレッドで並行して作る
+- export_score は out_dir に "{basename}{接尾辞}" で書き出す
+"""
+import json
+import logging
+import math
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from music21 import chord as m21chord, instrument as m21instrument, meter, note, stream, tempo
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .tempo_map import TempoMap, MeterMap, insert_timing_marks
+    from .audio_renderer import render_wav
+except ImportError:
+    from tempo_map import TempoMap, MeterMap, insert_timing_marks # type: ignore
+    from audio_renderer import render_wav # type: ignore
+
+FORMAT_MIDI = "midi"
+FORMAT_STEMS = "stems"
+FORMAT_JSON = "json"
+FORMAT_MUSICXML = "musicxml"
+FORMAT_WAV = "wav"
+EXPORT_FORMATS: Tuple[str, ...] = (FORMAT_MIDI, FORMAT_STEMS, FORMAT_JSON, FORMAT_MUSICXML, FORMAT_WAV)
+
+DEFAULT_TICKS_PER_QUARTER = 480
+PERCUSSION_CHANNEL = 9
+MUSICXML_QUANTIZE_DIVISORS = (4, 3)
+_EVENT_NOTE_OFF, _EVENT_LYRIC, _EVENT_NOTE_ON = 0, 1, 2 # 同じ tick ではノートオフ → 歌詞 → ノートオン の順
+
+
+class TrackEvents(NamedTuple):
+    """1トラック分のノート (オフセット順)。notes は (offset_ql, duration_ql, midi, velocity, lyric or None) のタプル。"""
+    name: str
+    program: int
+    channel: int
+    is_percussion: bool
+    notes: Tuple[Tuple[float, float, int, int, Optional[str]], ...]
+
+
+class ScoreEventIndex(NamedTuple):
+    tempo_map: TempoMap
+    meter_map: MeterMap
+    tracks: Tuple[TrackEvents, ...]
+
+    @property
+    def tempo_bpm(self) -> float:
+        """曲頭のテンポ。"""
+        return self.tempo_map.initial_bpm
+
+    @property
+    def time_signature(self) -> str:
+        """曲頭の拍子。"""
+        return self.meter_map.initial.ts_str
+
+    @property
+    def duration_ql(self) -> float:
+        return max((n[0] + n[1] for t in self.tracks for n in t.notes), default=0.0)
+
+    def seconds(self, offset_ql: float) -> float:
+        return self.tempo_map.seconds(offset_ql)
+
+
+def parse_formats(spec: Union[str, Iterable[str]]) -> Tuple[str, ...]:
+    """"midi,stems,json" のような指定を検証して重複なしのタプルにする。未知の形式は ValueError。"""
+    names = [s.strip().lower() for s in (spec.split(",") if isinstance(spec, str) else spec) if s and s.strip()]
+    unknown = [n for n in names if n not in EXPORT_FORMATS]
+    if unknown: raise ValueError(f"Unknown export format(s) {unknown}. Choose from {list(EXPORT_FORMATS)}.")
+    return tuple(dict.fromkeys(names))
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^0-9A-Za-z_.-]+", "_", name).strip("_") or "track"
+
+def collect_score_events(score: stream.Stream, tempo_bpm: Optional[float] = None, time_signature: Optional[str] = None,
+                         tempo_map: Optional[TempoMap] = None, meter_map: Optional[MeterMap] = None) -> ScoreEventIndex:
+    """
+    Score (または単独の Part) を一度だけ走査して ScoreEventIndex を作る。
+    テンポ/拍子は tempo_map/meter_map > tempo_bpm/time_signature (一定) > Score 内の MetronomeMark/TimeSignature の順。
+    """
+    parts = list(score.parts) if isinstance(score, stream.Score) else [score]
+    if tempo_map is None: tempo_map = TempoMap.constant(tempo_bpm) if tempo_bpm else TempoMap.from_stream(score)
+    if meter_map is None: meter_map = MeterMap.constant(time_signature) if time_signature else MeterMap.from_stream(score)
+    tracks: List[TrackEvents] = []
+    next_channel = 0
+    for part_idx, part in enumerate(parts):
+        flat = part.flatten()
+        notes: List[Tuple[float, float, int, int, Optional[str]]] = []
+        for el in flat.notes:
+            offset = float(el.offset); dur = float(el.quarterLength)
+            if dur <= 0: continue
+            members = list(el.notes) if isinstance(el, m21chord.Chord) else [el] if isinstance(el, note.Note) else []
+            lyric = el.lyric if isinstance(el, note.Note) and el.lyric else None
+            for n_obj in members:
+                vel_src = n_obj if n_obj.volume is not None and n_obj.volume.velocity is not None else el
+                vel = int(vel_src.volume.velocity) if vel_src.volume is not None and vel_src.volume.velocity is not None else 64
+                notes.append((offset, dur, int(n_obj.pitch.midi), max(1, min(127, vel)), lyric))
+                lyric = None # 和音でも歌詞は1回だけ
+        if not notes: continue
+        notes.sort(key=lambda n: (n[0], n[2]))
+        inst = flat.getElementsByClass(m21instrument.Instrument).first() or part.getInstrument(returnDefault=False)
+        is_percussion = isinstance(inst, m21instrument.Percussion) or getattr(inst, "midiChannel", None) == PERCUSSION_CHANNEL
+        if is_percussion: channel = PERCUSSION_CHANNEL
+        else:
+            channel = next_channel % 16
+            if channel == PERCUSSION_CHANNEL: channel = (channel + 1) % 16
+            next_channel = channel + 1
+        name = str(part.partName or part.id or f"Track{part_idx + 1}")
+        program = int(inst.midiProgram) if inst is not None and inst.midiProgram is not None else 0
+        tracks.append(TrackEvents(name, program, channel, is_percussion, tuple(notes)))
+    return ScoreEventIndex(tempo_map, meter_map, tuple(tracks))
+
+
+# --- MIDI (SMF format 1) ---
+def _vlq(value: int) -> bytes:
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80); value >>= 7
+    return bytes(reversed(out))
+
+def _chunk(events: Sequence[Tuple[int, bytes]]) -> bytes:
+    # events は (絶対 tick, イベント本体) で時間順
+    data = bytearray(); last = 0
+    for tick, body in events:
+        data += _vlq(tick - last); data += body; last = tick
+    data += b"\x00\xff\x2f\x00"
+    return b"MTrk" + struct.pack(">I", len(data)) + bytes(data)
+
+def _meta(meta_type: int, payload: bytes) -> bytes:
+    return bytes((0xFF, meta_type)) + _vlq(len(payload)) + payload
+
+def _conductor_track(index: ScoreEventIndex, tpq: int) -> bytes:
+    # 拍子 → テンポの順 (同じ tick では拍子を先に置く)
+    events: List[Tuple[int, int, bytes]] = []
+    for offset, mi in zip(index.meter_map.offsets, index.meter_map.meters):
+        events.append((TempoMap.ticks(offset, tpq), 0, _meta(0x58, bytes((mi.numerator, int(math.log2(mi.denominator)), 24, 8)))))
+    for i, offset in enumerate(index.tempo_map.offsets):
+        events.append((TempoMap.ticks(offset, tpq), 1, _meta(0x51, index.tempo_map.usec_per_quarter(i).to_bytes(3, "big"))))
+    events.sort(key=lambda e: (e[0], e[1]))
+    return _chunk([(tick, body) for tick, _, body in events])
+
+def _note_track(track: TrackEvents, tpq: int) -> bytes:
+    ch = track.channel
+    timed: List[Tuple[int, int, int, bytes]] = []
+    for offset, dur, midi_val, vel, lyric in track.notes:
+        on_tick = TempoMap.ticks(offset, tpq); off_tick = max(on_tick + 1, TempoMap.ticks(offset + dur, tpq))
+        if lyric: timed.append((on_tick, _EVENT_LYRIC, 0, _meta(0x05, lyric.encode("utf-8"))))
+        timed.append((on_tick, _EVENT_NOTE_ON, midi_val, bytes((0x90 | ch, midi_val, vel))))
+        timed.append((off_tick, _EVENT_NOTE_OFF, midi_val, bytes((0x80 | ch, midi_val, 0))))
+    timed.sort(key=lambda e: (e[0], e[1], e[2]))
+    head = [(0, _meta(0x03, track.name.encode("utf-8")))]
+    if not track.is_percussion: head.append((0, bytes((0xC0 | ch, track.program & 0x7F))))
+    return _chunk(head + [(tick, body) for tick, _, _, body in timed])
+
+def midi_file_bytes(index: ScoreEventIndex, tracks: Optional[Sequence[TrackEvents]] = None,
+                    ticks_per_quarter: int = DEFAULT_TICKS_PER_QUARTER) -> bytes:
+    """コンダクタートラック + 各トラックの SMF (format 1)。tracks を渡すとそのトラックだけ。"""
+    tracks = index.tracks if tracks is None else tracks
+    header = b"MThd" + struct.pack(">IHHH", 6, 1, len(tracks) + 1, ticks_per_quarter)
+    return header + _conductor_track(index, ticks_per_quarter) + b"".join(_note_track(t, ticks_per_quarter) for t in tracks)
+
+
+# --- 形式ごとの書き出し (結果は {接尾辞: バイト列}) ---
+def _render_midi(index: ScoreEventIndex, score: Optional[stream.Score]) -> Dict[str, bytes]:
+    return {".mid": midi_file_bytes(index)}
+
+def _render_stems(index: ScoreEventIndex, score: Optional[stream.Score]) -> Dict[str, bytes]:
+    stems: Dict[str, bytes] = {}
+    for track in index.tracks:
+        suffix = f"_{_safe_name(track.name)}.mid"
+        if suffix in stems: suffix = f"_{_safe_name(track.name)}_{track.channel + 1}.mid"
+        stems[suffix] = midi_file_bytes(index, [track])
+    return stems
+
+def event_list(index: ScoreEventIndex) -> Dict[str, Any]:
+    """Web プレイヤー向けのイベントリスト (秒とクォーター長の両方)。秒はトラックごとにまとめて変換する。"""
+    tmap = index.tempo_map
+    def track_notes(track: TrackEvents) -> List[Dict[str, Any]]:
+        starts = tmap.seconds_array([n[0] for n in track.notes])
+        ends = tmap.seconds_array([n[0] + n[1] for n in track.notes])
+        entries = []
+        for n, t_on, t_off in zip(track.notes, starts, ends):
+            entry = {"time": round(float(t_on), 6), "duration": round(float(t_off) - float(t_on), 6),
+                     "offset_ql": n[0], "duration_ql": n[1], "midi": n[2], "velocity": n[3]}
+            if n[4]: entry["lyric"] = n[4]
+            entries.append(entry)
+        return entries
+    return {
+        "tempo_bpm": index.tempo_bpm, "time_signature": index.time_signature,
+        "tempo_map": [{"offset_ql": o, "time": round(t, 6), "bpm": b} for o, t, b in zip(tmap.offsets, tmap.start_seconds, tmap.bpms)],
+        "meter_map": [{"offset_ql": o, "bar": bar, "time_signature": mi.ts_str} for o, bar, mi in zip(index.meter_map.offsets, index.meter_map.first_bars, index.meter_map.meters)],
+        "duration_ql": index.duration_ql, "duration_sec": round(index.seconds(index.duration_ql), 6),
+        "tracks": [{"name": t.name, "program": t.program, "channel": t.channel, "percussion": t.is_percussion,
+                    "notes": track_notes(t)} for t in index.tracks],
+    }
+
+def _render_json(index: ScoreEventIndex, score: Optional[stream.Score]) -> Dict[str, bytes]:
+    return {".json": json.dumps(event_list(index), ensure_ascii=False, separators=(",", ":")).encode("utf-8")}
+
+def _render_musicxml(index: ScoreEventIndex, score: Optional[stream.Score]) -> Dict[str, bytes]:
+    if score is None: raise ValueError("MusicXML export needs the Score.")
+    from music21.musicxml.m21ToXml import GeneralObjectExporter
+    # ヒューマナイズ後の長さは譜面にできないので、コピーを 16分/3連符の格子に量子化してから書く (元の Score は変えない)
+    engraved = score.quantize(quarterLengthDivisors=MUSICXML_QUANTIZE_DIVISORS, processOffsets=True, processDurations=True, inPlace=False, recurse=True)
+    # MusicXML は拍子/テンポを Part ごとに読むので、Score 直下の変化点の印を各 Part に置き直す
+    engraved.removeByClass([tempo.MetronomeMark, meter.TimeSignature])
+    for part in engraved.parts: insert_timing_marks(part, index.tempo_map, index.meter_map, replace=True)
+    return {".musicxml": GeneralObjectExporter(engraved).parse()}
+
+def _render_wav(index: ScoreEventIndex, score: Optional[stream.Score]) -> Dict[str, bytes]:
+    return {".wav": render_wav(index)}
+
+_RENDERERS: Dict[str, Callable[[ScoreEventIndex, Optional[stream.Score]], Dict[str, bytes]]] = {
+    FORMAT_MIDI: _render_midi, FORMAT_STEMS: _render_stems, FORMAT_JSON: _render_json, FORMAT_MUSICXML: _render_musicxml,
+    FORMAT_WAV: _render_wav,
+}
+
+def render_formats(score: Optional[stream.Score], formats: Union[str, Iterable[str]], index: Optional[ScoreEventIndex] = None,
+                   tempo_bpm: Optional[float] = None, time_signature: Optional[str] = None,
+                   max_workers: Optional[int] = None) -> Dict[str, Dict[str, bytes]]:
+    """形式ごとの {接尾辞: バイト列}。索引は一度だけ作り (index を渡せばそれを使う)、形式はスレッドで並行に作る。"""
+    fmts = parse_formats(formats)
+    if index is None:
+        if score is None: raise ValueError("render_formats needs a Score or a ScoreEventIndex.")
+        index = collect_score_events(score, tempo_bpm, time_signature)
+    if len(fmts) <= 1 or max_workers == 1:
+        return {fmt: _RENDERERS[fmt](index, score) for fmt in fmts}
+    with ThreadPoolExecutor(max_workers=max_workers or len(fmts), thread_name_prefix="score_export") as pool:
+        futures = {fmt: pool.submit(_RENDERERS[fmt], index, score) for fmt in fmts}
+        return {fmt: fut.result() for fmt, fut in futures.items()}
+
+def write_outputs(outputs: Dict[str, Dict[str, bytes]], out_dir: Union[str, Path], basename: str) -> List[Path]:
+    """render_formats の結果を out_dir/"{basename}{接尾辞}" に書き出す。"""
+    out_dir = Path(out_dir); out_dir.mkdir(parents=True, exist_ok=True)
+    written: List[Path] = []
+    for files in outputs.values():
+        for suffix, data in files.items():
+            path = out_dir / f"{basename}{suffix}"
+            path.write_bytes(data); written.append(path)
+    return written
+
+def export_score(score: stream.Score, formats: Union[str, Iterable[str]], out_dir: Union[str, Path], basename: str,
+                 tempo_bpm: Optional[float] = None, time_signature: Optional[str] = None,
+                 max_workers: Optional[int] = None) -> List[Path]:
+    """索引を一度だけ作り、形式ごとに「作って書き出す」をスレッドで並行に行う。"""
+    fmts = parse_formats(formats)
+    index = collect_score_events(score, tempo_bpm, time_signature)
+    def render_and_write(fmt: str) -> List[Path]:
+        return write_outputs({fmt: _RENDERERS[fmt](index, score)}, out_dir, basename)
+    with ThreadPoolExecutor(max_workers=max_workers or max(1, len(fmts)), thread_name_prefix="score_export") as pool:
+        paths = [p for written in pool.map(render_and_write, fmts) for p in written]
+    logger.info(f"ScoreExporter: Wrote {len(paths)} file(s) for {list(fmts)} to {out_dir}.")
+    return paths
+# --- END OF FILE utilities/score_exporter.py ---
@@ -0,0 +1,181 @@
+# --- START OF FILE utilities/section_dedup.py ---
+"""section_dedup.py
+繰り返しセクションを検出し、パートごとに一度だけ生成して残りは時間をずらしたコピーで埋める。
+
+- セクションのフィンガープリント = ブロックごとの (セクション内の相対位置, 長さ, コード, キー/モード, テンション, 先頭/末尾フラグ,
+  そのパートの解決済み part_params (リズムキーを含む。インターン済みなら params_id)) のハッシュ。セクション名と絶対オフセット、テンポは含めない
+- 出力が前後のセクションに依存するパート (CONTEXT_PARTS: ベースの次のコードへのアプローチ/先読みライン、
+  メロディの直前の音、ギターのブロックをまたぐ運指) は重複排除せず全ブロックを生成する。
+  代表セクションだけを渡すと、つなぎ目で隣が実際の隣のセクションではなくなるため
+- plan_section_repeats でパートごとに「各セクション → 最初に現れた同じセクション」の対応を作り、
+  ジェネレータには代表セクションのブロックだけを渡す (ChordTimeline.select で同じ順に絞ったタイムラインを使う)
+- place_section_repeats で代表セクションの要素を繰り返し位置へコピーする。rehumanize=True なら
+  コピーにだけ新しいヒューマナイズをかけ、完全な複製に聞こえないようにする
+"""
+import copy
+import hashlib
+import json
+import logging
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from music21 import chord as m21chord, expressions, note, stream, volume as m21volume
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .humanizer import humanize_event_arrays, NUMPY_AVAILABLE, np
+    from .part_params import PartParams
+except ImportError:
+    from humanizer import humanize_event_arrays, NUMPY_AVAILABLE, np # type: ignore
+    from part_params import PartParams # type: ignore
+
+CONTEXT_PARTS = frozenset({"bass", "melody", "guitar"}) # 前後のセクションで出力が変わるパート (重複排除の対象外)
+NON_BLOCK_PARTS = frozenset({"vocal"}) # ブロック単位で生成しないパート (重複排除の対象外)
+DEFAULT_BOUNDARY_TOLERANCE_QL = 0.0625 # ヒューマナイズで前にずれた音もそのセクションの要素として拾う幅
+_COPYABLE_CLASSES = ("GeneralNote", "TextExpression")
+_BLOCK_KEYS_EXCLUDED = ("offset", "section_name", "part_params", "tempo") # テンポは拍単位の出力を変えない
+
+
+class SectionSpan(NamedTuple):
+    """processed_blocks 上の1セクション (ブロック番号は end_block を含まない)。"""
+    name: Optional[str]
+    first_block: int
+    end_block: int
+    start_offset: float
+    end_offset: float
+
+
+def section_spans(processed_blocks: Sequence[Dict[str, Any]]) -> List[SectionSpan]:
+    """セクション名が変わる所 (または is_first_in_section) でブロック列を区切る。"""
+    spans: List[SectionSpan] = []
+    first = 0
+    for i, blk in enumerate(processed_blocks):
+        if i > first and (blk.get("is_first_in_section") or blk.get("section_name") != processed_blocks[first].get("section_name")):
+            spans.append(_make_span(processed_blocks, first, i)); first = i
+    if processed_blocks: spans.append(_make_span(processed_blocks, first, len(processed_blocks)))
+    return spans
+
+def _make_span(processed_blocks: Sequence[Dict[str, Any]], first: int, end: int) -> SectionSpan:
+    last = processed_blocks[end - 1]
+    start_offset = float(processed_blocks[first].get("offset", 0.0))
+    return SectionSpan(processed_blocks[first].get("section_name"), first, end, start_offset,
+                       float(last.get("offset", 0.0)) + float(last.get("q_length", 0.0)))
+
+def section_fingerprint(processed_blocks: Sequence[Dict[str, Any]], span: SectionSpan, part_name: str) -> str:
+    """そのパートの出力を決める情報だけからセクションのハッシュを作る。"""
+    items: List[Any] = []
+    for blk in processed_blocks[span.first_block:span.end_block]:
+        block_info = {k: v for k, v in blk.items() if k not in _BLOCK_KEYS_EXCLUDED}
+        block_info["relative_offset"] = round(float(blk.get("offset", 0.0)) - span.start_offset, 6)
+        part_params = blk.get("part_params", {}).get(part_name)
+        items.append((block_info, part_params.params_id if isinstance(part_params, PartParams) else part_params))
+    payload = json.dumps(items, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class SectionRepeatPlan:
+    """パートごとの セクション番号 → 代表セクション番号 (同じフィンガープリントで最初に現れたもの)。"""
+    __slots__ = ("sections", "canonical")
+
+    def __init__(self, sections: Sequence[SectionSpan], canonical: Dict[str, Tuple[int, ...]]):
+        self.sections: Tuple[SectionSpan, ...] = tuple(sections)
+        self.canonical = canonical
+
+    def has_repeats(self, part_name: str) -> bool:
+        mapping = self.canonical.get(part_name)
+        return mapping is not None and any(src != i for i, src in enumerate(mapping))
+
+    def unique_block_indices(self, part_name: str) -> List[int]:
+        """代表セクションのブロック番号 (時間順)。ジェネレータにはこのブロックだけを渡す。"""
+        mapping = self.canonical.get(part_name, tuple(range(len(self.sections))))
+        return [b for i, span in enumerate(self.sections) if mapping[i] == i for b in range(span.first_block, span.end_block)]
+
+    def repeats(self, part_name: str) -> List[Tuple[SectionSpan, SectionSpan]]:
+        """(コピー元の代表セクション, コピー先のセクション) のリスト。"""
+        mapping = self.canonical.get(part_name, ())
+        return [(self.sections[src], self.sections[i]) for i, src in enumerate(mapping) if src != i]
+
+
+def plan_section_repeats(processed_blocks: Sequence[Dict[str, Any]], part_names: Iterable[str]) -> SectionRepeatPlan:
+    spans = section_spans(processed_blocks)
+    canonical: Dict[str, Tuple[int, ...]] = {}
+    for part_name in part_names:
+        if part_name in NON_BLOCK_PARTS or part_name in CONTEXT_PARTS: continue
+        first_by_fp: Dict[str, int] = {}
+        canonical[part_name] = tuple(first_by_fp.setdefault(section_fingerprint(processed_blocks, span, part_name), i) for i, span in enumerate(spans))
+        n_unique = len(first_by_fp)
+        if n_unique < len(spans): logger.info(f"SectionDedup: {part_name}: {len(spans)} sections, {n_unique} unique.")
+    return SectionRepeatPlan(spans, canonical)
+
+
+def _copy_note(n_obj: note.Note) -> note.Note:
+    copied = note.Note(n_obj.pitch.midi, quarterLength=n_obj.quarterLength)
+    if n_obj.volume is not None and n_obj.volume.velocity is not None: copied.volume = m21volume.Volume(velocity=n_obj.volume.velocity)
+    if n_obj.articulations: copied.articulations = [type(a)() for a in n_obj.articulations]
+    return copied
+
+def _copy_element(el: Any) -> Any:
+    """ジェネレータが作る単純な要素は作り直してコピーする (deepcopy より速い)。それ以外は deepcopy。"""
+    if isinstance(el, note.Note) and el.tie is None and not el.expressions and not el.lyrics and el.pitch.microtone.cents == 0:
+        return _copy_note(el)
+    if isinstance(el, m21chord.Chord) and el.tie is None and not el.expressions and all(n.tie is None for n in el.notes):
+        copied = m21chord.Chord([_copy_note(n) for n in el.notes], quarterLength=el.quarterLength)
+        if el.articulations: copied.articulations = [type(a)() for a in el.articulations]
+        return copied
+    if isinstance(el, note.Rest): return note.Rest(quarterLength=el.quarterLength)
+    if type(el) is expressions.TextExpression: return expressions.TextExpression(el.content)
+    return copy.deepcopy(el)
+
+def _rehumanize_copies(copies: List[Tuple[float, Any]], template_name: Optional[str], custom_params: Optional[Dict[str, Any]], ts_str: str,
+                       meter_map: Optional[Any] = None) -> List[Tuple[float, Any]]:
+    # ノート/和音だけをまとめて揺らす (休符やテキストはそのまま)
+    idx = [i for i, (_, el) in enumerate(copies) if isinstance(el, (note.Note, m21chord.Chord))]
+    if not idx: return copies
+    idx.sort(key=lambda i: copies[i][0])
+    def velocity_of(el: Any) -> int:
+        n_obj = el.notes[0] if isinstance(el, m21chord.Chord) else el
+        return int(n_obj.volume.velocity) if n_obj.volume is not None and n_obj.volume.velocity is not None else 64
+    offs = np.array([copies[i][0] for i in idx], dtype=np.float64)
+    durs = np.array([copies[i][1].quarterLength for i in idx], dtype=np.float64)
+    vels = np.array([velocity_of(copies[i][1]) for i in idx], dtype=np.int64)
+    new_offs, new_durs, new_vels = humanize_event_arrays(offs, durs, vels, template_name=template_name, custom_params=custom_params, ts_str=ts_str, meter_map=meter_map)
+    result = list(copies)
+    for j, i in enumerate(idx):
+        el = copies[i][1]
+        el.quarterLength = float(new_durs[j])
+        delta = int(new_vels[j]) - int(vels[j])
+        for n_obj in (el.notes if isinstance(el, m21chord.Chord) else [el]):
+            base = n_obj.volume.velocity if n_obj.volume is not None and n_obj.volume.velocity is not None else 64
+            n_obj.volume = m21volume.Volume(velocity=max(1, min(127, int(base) + delta)))
+        result[i] = (float(new_offs[j]), el)
+    return result
+
+def place_section_repeats(generated: stream.Stream, repeats: Sequence[Tuple[SectionSpan, SectionSpan]],
+                          rehumanize: bool = False, template_name: Optional[str] = None,
+                          custom_params: Optional[Dict[str, Any]] = None, ts_str: str = "4/4",
+                          tolerance_ql: float = DEFAULT_BOUNDARY_TOLERANCE_QL, meter_map: Optional[Any] = None) -> int:
+    """
+    代表セクションの要素 (ノート/休符/テキスト) を、繰り返し位置へ時間をずらしてコピーする。
+    generated が Score なら各 Part に適用する。コピーした要素数を返す。
+    再ヒューマナイズのアクセントは、曲の MeterMap (meter_map) があればコピー先の拍子と小節線で、なければ ts_str で引く。
+    """
+    parts = list(generated.parts) if isinstance(generated, stream.Score) else [generated]
+    n_copied = 0
+    for part in parts:
+        copies: List[Tuple[float, Any]] = []
+        for src, dst in repeats:
+            shift = dst.start_offset - src.start_offset
+            # 終端は含まない (次のセクションの頭の音は拾わない)。前にずれた音だけ tolerance_ql 分さかのぼって拾う
+            for el in part.getElementsByOffset(src.start_offset - tolerance_ql, src.end_offset,
+                                               includeEndBoundary=False, mustBeginInSpan=True, classList=_COPYABLE_CLASSES):
+                copies.append((float(el.offset) + shift, _copy_element(el)))
+        if not copies: continue
+        if rehumanize:
+            if NUMPY_AVAILABLE: copies = _rehumanize_copies(copies, template_name, custom_params, ts_str, meter_map)
+            else: logger.debug("SectionDedup: NumPy not available. Repeats are placed without re-humanization.")
+        for offset_val, el in copies:
+            part.coreInsert(max(0.0, offset_val), el)
+        part.coreElementsChanged()
+        n_copied += len(copies)
+    return n_copied
+# --- END OF FILE utilities/section_dedup.py ---
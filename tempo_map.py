@@ -0,0 +1,261 @@
+# --- START OF FILE utilities/tempo_map.py ---
+"""tempo_map.py
+曲中のテンポ/拍子の変化を区分的なマップとして持ち、拍 (quarterLength) ↔ 秒 ↔ tick を変換する。
+
+- TempoMap: (開始オフセット, BPM) の区分定数マップ。各区間の開始時刻 (秒) は構築時に一度だけ有理数で累積して
+  丸めるので、テンポ変化が数百あっても誤差が溜まらない。変換は bisect による O(log n)
+- seconds_array / offsets_array でイベント配列をまとめて変換する (np.searchsorted。NumPy がなければリスト)
+- tick は拍に比例する (SMF ではテンポ変化はテンポイベントで表す) ので ticks() は拍 × 分解能
+- MeterMap: (開始オフセット, 拍子) のマップ。小節番号 (0 始まり) と小節内の位置を O(log n) で返す。
+  小節の途中で拍子が変わった場合はその位置から新しい小節を数える
+- build_timing_maps で processed_blocks の "tempo" / "time_signature" (セクション/ブロック単位) から両方を作る。
+  from_stream は Score 内の MetronomeMark / TimeSignature から作る
+"""
+import logging
+from bisect import bisect_right
+from fractions import Fraction
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+from music21 import meter, stream, tempo
+
+logger = logging.getLogger(__name__)
+
+try:
+    from .core_music_utils import MeterInfo, get_meter_info
+except ImportError:
+    from core_music_utils import MeterInfo, get_meter_info # type: ignore
+
+NUMPY_AVAILABLE = False
+np = None
+try:
+    import numpy
+    np = numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    logger.warning("TempoMap: NumPy not found. Array conversions will return Python lists.")
+
+DEFAULT_TEMPO_BPM = 120.0
+DEFAULT_TIME_SIGNATURE = "4/4"
+_EPS = 1e-9
+
+
+def _changes(points: Iterable[Tuple[float, Any]], default: Any) -> Tuple[Tuple[float, ...], Tuple[Any, ...]]:
+    # オフセット順に並べ、同じ位置は後のものを優先、値が変わらない点は捨てる。先頭は必ず 0.0
+    by_offset: Dict[float, Any] = {}
+    for offset, value in points:
+        by_offset[max(0.0, float(offset))] = value
+    if 0.0 not in by_offset: by_offset[0.0] = default
+    offsets: List[float] = []; values: List[Any] = []
+    for offset in sorted(by_offset):
+        if values and by_offset[offset] == values[-1]: continue
+        offsets.append(offset); values.append(by_offset[offset])
+    return tuple(offsets), tuple(values)
+
+def _offset_in_score(el: Any, score: stream.Stream) -> float:
+    try:
+        return float(el.getOffsetInHierarchy(score))
+    except Exception:
+        return float(el.offset)
+
+
+class TempoMap:
+    """区分定数のテンポマップ。offsets[i] から次の変化までは bpms[i]。"""
+    __slots__ = ("offsets", "bpms", "start_seconds", "_sec_per_ql")
+
+    def __init__(self, changes: Iterable[Tuple[float, float]], default_bpm: float = DEFAULT_TEMPO_BPM):
+        offsets, bpms = _changes(((o, float(b)) for o, b in changes), float(default_bpm))
+        bad = [b for b in bpms if not b > 0]
+        if bad: raise ValueError(f"TempoMap: tempo must be positive, got {bad}.")
+        self.offsets: Tuple[float, ...] = offsets
+        self.bpms: Tuple[float, ...] = bpms
+        self._sec_per_ql: Tuple[float, ...] = tuple(60.0 / b for b in bpms)
+        # 区間ごとの開始時刻を有理数で累積し、最後に一度だけ float に丸める (誤差が区間数に比例して溜まらない)
+        acc = Fraction(0); starts: List[float] = []
+        for i, offset in enumerate(offsets):
+            if i: acc += (Fraction(offset) - Fraction(offsets[i - 1])) * 60 / Fraction(bpms[i - 1])
+            starts.append(float(acc))
+        self.start_seconds: Tuple[float, ...] = tuple(starts)
+
+    @classmethod
+    def constant(cls, bpm: float) -> "TempoMap":
+        return cls((), bpm)
+
+    @classmethod
+    def from_stream(cls, score: stream.Stream, default_bpm: float = DEFAULT_TEMPO_BPM) -> "TempoMap":
+        """Score 内の MetronomeMark から作る (なければ default_bpm の一定テンポ)。"""
+        changes = []
+        for mm in score.recurse().getElementsByClass(tempo.MetronomeMark):
+            bpm = mm.getQuarterBPM()
+            if bpm: changes.append((_offset_in_score(mm, score), float(bpm)))
+        return cls(changes, default_bpm)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __repr__(self) -> str:
+        return f"TempoMap({list(zip(self.offsets, self.bpms))!r})"
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, TempoMap) and self.offsets == other.offsets and self.bpms == other.bpms
+
+    @property
+    def initial_bpm(self) -> float:
+        return self.bpms[0]
+
+    @property
+    def is_constant(self) -> bool:
+        return len(self.offsets) == 1
+
+    def changes(self) -> List[Tuple[float, float]]:
+        return list(zip(self.offsets, self.bpms))
+
+    # --- スカラー変換 (O(log n)) ---
+    def _segment(self, offset_ql: float) -> int:
+        return max(0, bisect_right(self.offsets, offset_ql) - 1)
+
+    def bpm_at(self, offset_ql: float) -> float:
+        return self.bpms[self._segment(offset_ql)]
+
+    def seconds(self, offset_ql: float) -> float:
+        """曲頭からの拍位置 → 秒。"""
+        i = self._segment(offset_ql)
+        return self.start_seconds[i] + (offset_ql - self.offsets[i]) * self._sec_per_ql[i]
+
+    def duration_seconds(self, offset_ql: float, duration_ql: float) -> float:
+        """offset_ql から duration_ql 拍の長さ (途中のテンポ変化を含む)。"""
+        return self.seconds(offset_ql + duration_ql) - self.seconds(offset_ql)
+
+    def offset_at(self, seconds: float) -> float:
+        """秒 → 拍位置。"""
+        i = max(0, bisect_right(self.start_seconds, seconds) - 1)
+        return self.offsets[i] + (seconds - self.start_seconds[i]) / self._sec_per_ql[i]
+
+    @staticmethod
+    def ticks(offset_ql: float, ticks_per_quarter: int) -> int:
+        return int(round(offset_ql * ticks_per_quarter))
+
+    def seconds_at_tick(self, tick: int, ticks_per_quarter: int) -> float:
+        return self.seconds(tick / ticks_per_quarter)
+
+    def tick_at_seconds(self, seconds: float, ticks_per_quarter: int) -> int:
+        return self.ticks(self.offset_at(seconds), ticks_per_quarter)
+
+    def usec_per_quarter(self, index: int) -> int:
+        """i 番目の区間の SMF テンポ値 (4分音符あたりのマイクロ秒)。"""
+        return max(1, min(0xFFFFFF, int(round(60_000_000 / self.bpms[index]))))
+
+    # --- 配列変換 (イベント配列をまとめて) ---
+    def seconds_array(self, offsets_ql: Sequence[float]) -> Any:
+        if not NUMPY_AVAILABLE or np is None: return [self.seconds(float(o)) for o in offsets_ql]
+        q = np.asarray(offsets_ql, dtype=np.float64)
+        if self.is_constant: return q * self._sec_per_ql[0]
+        idx = np.clip(np.searchsorted(np.asarray(self.offsets), q, side="right") - 1, 0, None)
+        return np.asarray(self.start_seconds)[idx] + (q - np.asarray(self.offsets)[idx]) * np.asarray(self._sec_per_ql)[idx]
+
+    def offsets_array(self, seconds: Sequence[float]) -> Any:
+        if not NUMPY_AVAILABLE or np is None: return [self.offset_at(float(s)) for s in seconds]
+        s = np.asarray(seconds, dtype=np.float64)
+        idx = np.clip(np.searchsorted(np.asarray(self.start_seconds), s, side="right") - 1, 0, None)
+        return np.asarray(self.offsets)[idx] + (s - np.asarray(self.start_seconds)[idx]) / np.asarray(self._sec_per_ql)[idx]
+
+    def ticks_array(self, offsets_ql: Sequence[float], ticks_per_quarter: int) -> Any:
+        if not NUMPY_AVAILABLE or np is None: return [self.ticks(float(o), ticks_per_quarter) for o in offsets_ql]
+        return np.rint(np.asarray(offsets_ql, dtype=np.float64) * ticks_per_quarter).astype(np.int64)
+
+
+class MeterMap:
+    """拍子のマップ。offsets[i] から次の変化までは meters[i]。first_bars[i] はその区間の最初の小節番号。"""
+    __slots__ = ("offsets", "meters", "first_bars")
+
+    def __init__(self, changes: Iterable[Tuple[float, str]], default_ts: str = DEFAULT_TIME_SIGNATURE):
+        offsets, ts_strs = _changes(((o, get_meter_info(ts).ts_str) for o, ts in changes), get_meter_info(default_ts).ts_str)
+        self.offsets: Tuple[float, ...] = offsets
+        self.meters: Tuple[MeterInfo, ...] = tuple(get_meter_info(ts) for ts in ts_strs)
+        first_bars: List[int] = []
+        for i, offset in enumerate(offsets):
+            if not i: first_bars.append(0); continue
+            span = offset - offsets[i - 1]; bar_ql = self.meters[i - 1].bar_ql
+            n_bars = int(span // bar_ql + _EPS)
+            if span - n_bars * bar_ql > _EPS:
+                n_bars += 1; logger.debug(f"MeterMap: Time signature change at {offset} is not on a bar line. Starting a new bar there.")
+            first_bars.append(first_bars[-1] + n_bars)
+        self.first_bars: Tuple[int, ...] = tuple(first_bars)
+
+    @classmethod
+    def constant(cls, ts_str: str) -> "MeterMap":
+        return cls((), ts_str)
+
+    @classmethod
+    def from_stream(cls, score: stream.Stream, default_ts: str = DEFAULT_TIME_SIGNATURE) -> "MeterMap":
+        """Score 内の TimeSignature から作る (なければ default_ts)。"""
+        return cls([(_offset_in_score(ts, score), ts.ratioString) for ts in score.recurse().getElementsByClass(meter.TimeSignature)], default_ts)
+
+    @classmethod
+    def from_blocks(cls, processed_blocks: Sequence[Dict[str, Any]], default_ts: str = DEFAULT_TIME_SIGNATURE) -> "MeterMap":
+        """ブロックの "time_signature" (なければ default_ts) から作る。"""
+        return cls([(float(blk.get("offset", 0.0)), blk.get("time_signature") or default_ts) for blk in processed_blocks], default_ts)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __repr__(self) -> str:
+        return f"MeterMap({[(o, m.ts_str) for o, m in zip(self.offsets, self.meters)]!r})"
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, MeterMap) and self.offsets == other.offsets and [m.ts_str for m in self.meters] == [m.ts_str for m in other.meters]
+
+    @property
+    def initial(self) -> MeterInfo:
+        return self.meters[0]
+
+    def changes(self) -> List[Tuple[float, str]]:
+        return [(o, m.ts_str) for o, m in zip(self.offsets, self.meters)]
+
+    def meter_at(self, offset_ql: float) -> MeterInfo:
+        return self.meters[max(0, bisect_right(self.offsets, offset_ql) - 1)]
+
+    def measure_at(self, offset_ql: float) -> Tuple[int, float]:
+        """(小節番号 (0 始まり), 小節頭からの位置 ql)。"""
+        i = max(0, bisect_right(self.offsets, offset_ql) - 1)
+        rel = offset_ql - self.offsets[i]; bar_ql = self.meters[i].bar_ql
+        n = int(rel // bar_ql + _EPS)
+        return self.first_bars[i] + n, max(0.0, rel - n * bar_ql)
+
+    def bar_offset(self, bar_number: int) -> float:
+        """小節番号 → 小節頭の拍位置。"""
+        i = max(0, bisect_right(self.first_bars, bar_number) - 1)
+        return self.offsets[i] + (bar_number - self.first_bars[i]) * self.meters[i].bar_ql
+
+    def bar_offsets(self, end_ql: float) -> List[float]:
+        """end_ql までの全小節の頭の位置。"""
+        bars: List[float] = []
+        for i, start in enumerate(self.offsets):
+            stop = self.offsets[i + 1] if i + 1 < len(self.offsets) else end_ql
+            pos = start
+            while pos < min(stop, end_ql) - _EPS:
+                bars.append(pos); pos += self.meters[i].bar_ql
+        return bars
+
+
+def build_timing_maps(processed_blocks: Sequence[Dict[str, Any]], default_bpm: float = DEFAULT_TEMPO_BPM,
+                      default_ts: str = DEFAULT_TIME_SIGNATURE) -> Tuple[TempoMap, MeterMap]:
+    """ブロックの "tempo" / "time_signature" (なければ既定値) から TempoMap と MeterMap を作る。"""
+    tempos = [(float(blk.get("offset", 0.0)), float(blk.get("tempo") or default_bpm)) for blk in processed_blocks]
+    tempo_map, meter_map = TempoMap(tempos, default_bpm), MeterMap.from_blocks(processed_blocks, default_ts)
+    if len(tempo_map) > 1 or len(meter_map) > 1:
+        logger.info(f"TimingMaps: {len(tempo_map)} tempo segment(s), {len(meter_map)} meter segment(s).")
+    return tempo_map, meter_map
+
+def insert_timing_marks(target: stream.Stream, tempo_map: TempoMap, meter_map: MeterMap, replace: bool = False) -> None:
+    """
+    テンポ/拍子の変化点に MetronomeMark / TimeSignature を target (Score または Part) へ挿入する。
+    replace なら target 内の既存の MetronomeMark / TimeSignature を先に取り除く。
+    """
+    if replace:
+        for old in list(target.recurse().getElementsByClass([tempo.MetronomeMark, meter.TimeSignature])):
+            if old.activeSite is not None: old.activeSite.remove(old)
+    for offset, bpm in tempo_map.changes():
+        target.insert(offset, tempo.MetronomeMark(number=bpm))
+    for offset, meter_info in zip(meter_map.offsets, meter_map.meters):
+        target.insert(offset, meter_info.to_time_signature())
+# --- END OF FILE utilities/tempo_map.py ---
@@ -0,0 +1,16 @@
+# --- START OF FILE tests/conftest.py ---
+"""conftest.py
+リポジトリ直下のモジュールを utilities パッケージとして読み込めるようにする (ジェネレータは utilities.* を絶対インポートする)。
+"""
+import importlib.util
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+if "utilities" not in sys.modules:
+    _spec = importlib.util.spec_from_file_location("utilities", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)])
+    _package = importlib.util.module_from_spec(_spec)
+    sys.modules["utilities"] = _package
+    _spec.loader.exec_module(_package)
+# --- END OF FILE tests/conftest.py ---
@@ -0,0 +1,144 @@
+# --- START OF FILE tests/test_rhythm_library_compiler.py ---
+"""load_rhythm_library の .rlib 自動コンパイル/再構築と、検証エラー。"""
+import hashlib
+import json
+
+import pytest
+
+from utilities import rhythm_library_compiler as rlc
+from utilities.rhythm_library_compiler import (COMPILED_SUFFIX, RhythmLibraryError, load_rhythm_library, load_rhythm_library_data,
+                                               validate_rhythm_library)
+
+LIBRARY = {
+    "piano_patterns": {
+        "quarters": {"description": "4分音符", "pattern": [{"offset": i, "duration": 1.0, "velocity_factor": 0.9} for i in range(4)],
+                     "reference_duration_ql": 4.0},
+        "offsets_only": {"pattern": [0.0, 1.5, 3.0]},
+    },
+    "drum_patterns": {
+        "basic_rock": {"pattern": [{"offset": 0.0, "duration": 0.25, "instrument": "kick", "velocity": 100},
+                                   {"offset": 1.0, "duration": 0.25, "instrument": "snare"}],
+                       "fill_ins": {"short": [{"offset": 3.0, "duration": 0.5, "instrument": "tom1"}]}},
+    },
+}
+
+needs_numpy = pytest.mark.skipif(not rlc.NUMPY_AVAILABLE, reason="NumPy is not installed.")
+
+
+def _write(path, data) -> None:
+    path.write_text(json.dumps(data), encoding="utf-8")
+
+
+@needs_numpy
+def test_first_load_compiles_and_second_load_reuses(tmp_path, monkeypatch):
+    json_path = tmp_path / "rhythm_library.json"
+    _write(json_path, LIBRARY)
+    library = load_rhythm_library(json_path)
+    compiled_path = json_path.with_suffix(COMPILED_SUFFIX)
+    assert compiled_path.exists()
+    assert library.source_sha256 == hashlib.sha256(json_path.read_bytes()).hexdigest()
+    assert library["piano_patterns"]["quarters"]["pattern"] == LIBRARY["piano_patterns"]["quarters"]["pattern"]
+    assert library["piano_patterns"]["quarters"]["reference_duration_ql"] == 4.0
+    assert library["piano_patterns"]["offsets_only"]["pattern"] == [0.0, 1.5, 3.0]
+    assert library["drum_patterns"]["basic_rock"]["fill_ins"]["short"] == [{"offset": 3.0, "duration": 0.5, "instrument": "tom1"}]
+
+    # JSON が変わっていなければコンパイルし直さない
+    def fail(*args, **kwargs): raise AssertionError("recompiled an up-to-date library")
+    monkeypatch.setattr(rlc, "compile_rhythm_library_file", fail)
+    again = load_rhythm_library(json_path)
+    assert again.path == compiled_path
+    assert dict(again["drum_patterns"]["basic_rock"]["pattern"][0]) == {"offset": 0.0, "duration": 0.25, "instrument": "kick", "velocity": 100}
+
+
+@needs_numpy
+def test_changed_json_is_recompiled(tmp_path):
+    json_path = tmp_path / "rhythm_library.json"
+    _write(json_path, LIBRARY)
+    load_rhythm_library(json_path)
+    changed = json.loads(json.dumps(LIBRARY))
+    changed["piano_patterns"]["quarters"]["pattern"][0]["velocity_factor"] = 0.5
+    changed["piano_patterns"]["new_key"] = {"pattern": [0.0]}
+    _write(json_path, changed)
+    library = load_rhythm_library(json_path)
+    assert library.source_sha256 == hashlib.sha256(json_path.read_bytes()).hexdigest()
+    assert library["piano_patterns"]["quarters"]["pattern"][0]["velocity_factor"] == 0.5
+    assert "new_key" in library["piano_patterns"]
+
+
+@needs_numpy
+@pytest.mark.parametrize("corrupt", [b"", b"RLIB", b"NOPE" + b"\x00" * 32])
+def test_corrupt_compiled_file_is_rebuilt(tmp_path, corrupt):
+    json_path = tmp_path / "rhythm_library.json"
+    _write(json_path, LIBRARY)
+    json_path.with_suffix(COMPILED_SUFFIX).write_bytes(corrupt)
+    library = load_rhythm_library(json_path)
+    assert len(library["piano_patterns"]["quarters"]["pattern"]) == 4
+    assert json_path.with_suffix(COMPILED_SUFFIX).read_bytes()[:4] == b"RLIB"
+
+
+@needs_numpy
+def test_write_compiled_false_leaves_no_file(tmp_path):
+    json_path = tmp_path / "rhythm_library.json"
+    _write(json_path, LIBRARY)
+    library = load_rhythm_library(json_path, write_compiled=False)
+    assert not json_path.with_suffix(COMPILED_SUFFIX).exists()
+    assert library.pattern_arrays("drum_patterns", "basic_rock", "short").offsets.tolist() == [3.0]
+
+
+def test_load_from_data_matches_file(tmp_path):
+    json_path = tmp_path / "rhythm_library.json"
+    _write(json_path, LIBRARY)
+    from_file = load_rhythm_library(json_path, write_compiled=False)
+    from_data = load_rhythm_library_data(LIBRARY)
+    for category, patterns in LIBRARY.items():
+        for key in patterns:
+            assert list(from_data[category][key]["pattern"]) == list(from_file[category][key]["pattern"])
+
+
+def test_without_numpy_returns_the_validated_dict(tmp_path, monkeypatch):
+    monkeypatch.setattr(rlc, "NUMPY_AVAILABLE", False)
+    json_path = tmp_path / "rhythm_library.json"
+    _write(json_path, LIBRARY)
+    assert load_rhythm_library(json_path) == LIBRARY
+    assert not json_path.with_suffix(COMPILED_SUFFIX).exists()
+    assert load_rhythm_library_data(LIBRARY) == LIBRARY
+
+
+@pytest.mark.parametrize("category, key, event, event_index, message", [
+    ("piano_patterns", "quarters", {"offset": -1.0}, 1, "offset must be >= 0"),
+    ("piano_patterns", "quarters", {"offset": 1.0, "duration": 0}, 1, "duration must be > 0"),
+    ("piano_patterns", "quarters", {"offset": 1.0, "velocity": 200}, 1, "velocity must be within 0..127"),
+    ("piano_patterns", "quarters", {"offset": 1.0, "velocity_factor": "loud"}, 1, "'velocity_factor' must be a finite number"),
+    ("piano_patterns", "quarters", {"offset": 1.0, "swing": 0.6}, 1, "unknown event field"),
+    ("drum_patterns", "basic_rock", {"duration": 1.0}, 1, "has no 'offset'"),
+])
+def test_invalid_events_report_their_location(category, key, event, event_index, message):
+    data = json.loads(json.dumps(LIBRARY))
+    data[category][key]["pattern"][event_index] = event
+    with pytest.raises(RhythmLibraryError) as info:
+        validate_rhythm_library(data)
+    err = info.value
+    assert (err.category, err.key, err.event_index) == (category, key, event_index)
+    assert message in str(err)
+    assert f"{category}/{key}" in str(err) and f"[event {event_index}]" in str(err)
+
+
+def test_invalid_structure():
+    with pytest.raises(RhythmLibraryError):
+        validate_rhythm_library([])
+    with pytest.raises(RhythmLibraryError, match="has no 'pattern'"):
+        validate_rhythm_library({"piano_patterns": {"broken": {"description": "no events"}}})
+    with pytest.raises(RhythmLibraryError) as info:
+        validate_rhythm_library({"drum_patterns": {"rock": {"pattern": [0.0], "fill_ins": {"f": [{"offset": -2}]}}}})
+    assert info.value.fill == "f"
+
+
+@pytest.mark.parametrize("numpy_available", [True, False])
+def test_invalid_json_raises(tmp_path, monkeypatch, numpy_available):
+    if not numpy_available: monkeypatch.setattr(rlc, "NUMPY_AVAILABLE", False)
+    elif not rlc.NUMPY_AVAILABLE: pytest.skip("NumPy is not installed.")
+    json_path = tmp_path / "rhythm_library.json"
+    json_path.write_text("{not json", encoding="utf-8")
+    with pytest.raises(RhythmLibraryError, match="invalid JSON"):
+        load_rhythm_library(json_path)
+# --- END OF FILE tests/test_rhythm_library_compiler.py ---
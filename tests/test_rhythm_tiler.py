@@ -0,0 +1,89 @@
+# --- START OF FILE tests/test_rhythm_tiler.py ---
+"""tile_pattern の3つのポリシー (stretch / repeat / bar) と、NumPy 版とループ版の一致。"""
+import pytest
+
+from utilities import rhythm_tiler
+from utilities.rhythm_tiler import TILE_BAR, TILE_REPEAT, TILE_STRETCH, TILING_POLICIES, bar_spans, tile_pattern, tile_pattern_events
+
+# 1小節 (4拍) のパターン: 4分音符3つ + 最後に長い音
+OFFSETS = [0.0, 1.0, 2.0, 3.0]
+DURATIONS = [1.0, 1.0, 1.0, 2.0]
+VELOCITY_FACTORS = [1.0, 0.8, 0.9, 0.7]
+
+
+def _rows(tiled):
+    return [(pytest.approx(o), pytest.approx(d), pytest.approx(v), int(e), int(t)) for o, d, v, e, t in tiled.rows()]
+
+
+def test_stretch_scales_the_whole_pattern():
+    tiled = tile_pattern(OFFSETS, DURATIONS, 8.0, TILE_STRETCH, reference_duration_ql=4.0, velocity_factors=VELOCITY_FACTORS)
+    assert tiled.rows() == _rows(tiled) # rows() は Python の値
+    assert [r[0] for r in tiled.rows()] == pytest.approx([0.0, 2.0, 4.0, 6.0])
+    # 最後の音は伸ばすとブロックをはみ出すので末尾で切る
+    assert [r[1] for r in tiled.rows()] == pytest.approx([2.0, 2.0, 2.0, 2.0])
+    assert [int(t) for t in tiled.tile_index] == [0, 0, 0, 0]
+
+
+def test_repeat_cuts_at_the_block_end():
+    tiled = tile_pattern(OFFSETS, DURATIONS, 5.5, TILE_REPEAT, reference_duration_ql=4.0)
+    assert [r[0] for r in tiled.rows()] == pytest.approx([0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+    # デュレーションはブロック末尾でだけ切る (4拍目の2拍の音は次のタイルと重なってもそのまま)
+    assert [r[1] for r in tiled.rows()] == pytest.approx([1.0, 1.0, 1.0, 2.0, 1.0, 0.5])
+    assert [int(e) for e in tiled.event_index] == [0, 1, 2, 3, 0, 1]
+    assert [int(t) for t in tiled.tile_index] == [0, 0, 0, 0, 1, 1]
+
+
+def test_bar_restarts_the_pattern_at_each_bar():
+    # 3/4 の小節で 4/4 のパターン: 小節頭から繰り返し、小節末で切る
+    tiled = tile_pattern(OFFSETS, DURATIONS, 6.0, TILE_BAR, reference_duration_ql=4.0, bar_ql=3.0)
+    assert [r[0] for r in tiled.rows()] == pytest.approx([0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+    assert [int(e) for e in tiled.event_index] == [0, 1, 2, 0, 1, 2]
+    assert [int(t) for t in tiled.tile_index] == [0, 0, 0, 1, 1, 1]
+
+
+def test_bar_keeps_a_partial_last_bar():
+    assert bar_spans(10.0, 4.0) == [(0.0, 4.0), (4.0, 4.0), (8.0, 2.0)]
+    tiled = tile_pattern(OFFSETS, DURATIONS, 10.0, TILE_BAR, bar_ql=4.0)
+    assert [r[0] for r in tiled.rows()][-2:] == pytest.approx([8.0, 9.0])
+
+
+def test_min_duration_drops_short_events():
+    tiled = tile_pattern([0.0, 3.75], [1.0, 1.0], 4.0, TILE_BAR, bar_ql=4.0, min_duration_ql=0.5)
+    assert [r[0] for r in tiled.rows()] == pytest.approx([0.0])
+
+
+def test_empty_pattern():
+    assert tile_pattern([], [], 4.0, TILE_BAR).rows() == []
+
+
+CASES = [
+    (OFFSETS, DURATIONS, 6.0, 4.0, 4.0),
+    (OFFSETS, DURATIONS, 7.0, 4.0, 3.0),
+    ([0.0, 0.5, 1.5, 2.25, 3.5], [0.5, 1.0, 0.75, 1.25, 1.0], 9.5, 4.0, 3.5),
+    ([0.0, 0.75, 1.5], [0.75, 0.75, 0.5], 5.0, 2.0, 2.5), # パターン1周 (2拍) が小節より短い
+    ([0.0, 1.0, 2.0, 5.0], [1.0, 1.0, 3.0, 1.0], 4.0, 4.0, 4.0), # 1周より後ろのイベントは使わない
+]
+
+@pytest.mark.parametrize("policy", TILING_POLICIES)
+@pytest.mark.parametrize("offsets, durations, block_ql, ref_ql, bar_ql", CASES)
+def test_numpy_and_python_paths_agree(monkeypatch, policy, offsets, durations, block_ql, ref_ql, bar_ql):
+    if not rhythm_tiler.NUMPY_AVAILABLE: pytest.skip("NumPy is not installed.")
+    vfs = [1.0 - 0.1 * i for i in range(len(offsets))]
+    with_numpy = tile_pattern(offsets, durations, block_ql, policy, ref_ql, bar_ql, 0.1, vfs).rows()
+    monkeypatch.setattr(rhythm_tiler, "NUMPY_AVAILABLE", False)
+    looped = tile_pattern(offsets, durations, block_ql, policy, ref_ql, bar_ql, 0.1, vfs)
+    assert isinstance(looped.offsets, list)
+    assert len(looped.rows()) == len(with_numpy)
+    for got, expected in zip(looped.rows(), with_numpy):
+        assert got[:3] == pytest.approx(expected[:3])
+        assert got[3:] == expected[3:]
+
+
+@pytest.mark.parametrize("numpy_available", [True, False])
+def test_tile_pattern_events_reads_library_events(monkeypatch, numpy_available):
+    if not numpy_available: monkeypatch.setattr(rhythm_tiler, "NUMPY_AVAILABLE", False)
+    elif not rhythm_tiler.NUMPY_AVAILABLE: pytest.skip("NumPy is not installed.")
+    events = [{"offset": 0.0, "duration": 1.5, "velocity_factor": 0.9}, {"offset": 2.0}]
+    rows = tile_pattern_events(events, 4.0, TILE_BAR, default_duration_ql=0.5, default_velocity_factor=0.7).rows()
+    assert [r[:3] for r in rows] == [pytest.approx((0.0, 1.5, 0.9)), pytest.approx((2.0, 0.5, 0.7))]
+# --- END OF FILE tests/test_rhythm_tiler.py ---
@@ -0,0 +1,99 @@
+# --- START OF FILE tests/test_score_exporter_midi.py ---
+"""midi_file_bytes の SMF を music21 の MidiFile.readstr で読み戻して確かめる。"""
+from music21 import midi
+
+from utilities.score_exporter import PERCUSSION_CHANNEL, ScoreEventIndex, TrackEvents, collect_score_events, midi_file_bytes
+from utilities.tempo_map import MeterMap, TempoMap
+
+TPQ = 480
+
+
+def _read(data: bytes) -> midi.MidiFile:
+    mf = midi.MidiFile()
+    mf.readstr(data)
+    return mf
+
+def _timed_events(track: midi.MidiTrack):
+    """(絶対 tick, MidiEvent) のリスト (ファイル内の順)。"""
+    tick = 0; out = []
+    for ev in track.events:
+        if isinstance(ev, midi.DeltaTime): tick += ev.time
+        else: out.append((tick, ev))
+    return out
+
+def _index(tracks, tempo_changes=(), meter_changes=()) -> ScoreEventIndex:
+    return ScoreEventIndex(TempoMap(tempo_changes, 120.0), MeterMap(meter_changes, "4/4"), tuple(tracks))
+
+def _track(name, channel, notes, is_percussion=False, program=0) -> TrackEvents:
+    return TrackEvents(name, program, channel, is_percussion, tuple((o, d, m, 90, None) for o, d, m in notes))
+
+
+def test_header_and_track_count():
+    mf = _read(midi_file_bytes(_index([_track("Piano", 0, [(0.0, 1.0, 60)])])))
+    assert mf.format == 1
+    assert mf.ticksPerQuarterNote == TPQ
+    assert len(mf.tracks) == 2 # コンダクター + 1 パート
+
+
+def test_percussion_track_uses_channel_10_without_program_change():
+    index = _index([_track("Piano", 0, [(0.0, 1.0, 60)]), _track("Drums", PERCUSSION_CHANNEL, [(0.0, 0.5, 36), (0.5, 0.5, 38)], is_percussion=True)])
+    mf = _read(midi_file_bytes(index))
+    drum_events = [ev for _, ev in _timed_events(mf.tracks[2]) if ev.isNoteOn() or ev.isNoteOff()]
+    assert drum_events and all(ev.channel == 10 for ev in drum_events)
+    assert not any(ev.type == midi.ChannelVoiceMessages.PROGRAM_CHANGE for _, ev in _timed_events(mf.tracks[2]))
+    piano_events = [ev for _, ev in _timed_events(mf.tracks[1]) if ev.isNoteOn()]
+    assert all(ev.channel == 1 for ev in piano_events)
+
+
+def test_collect_score_events_routes_percussion_to_channel_10():
+    from music21 import instrument, note, stream
+    score = stream.Score()
+    for inst in (instrument.Piano(), instrument.Percussion()):
+        part = stream.Part(); part.insert(0, inst); part.insert(0, note.Note(60, quarterLength=1.0))
+        score.insert(0, part)
+    index = collect_score_events(score, tempo_bpm=120, time_signature="4/4")
+    assert [t.channel for t in index.tracks] == [0, PERCUSSION_CHANNEL]
+    assert index.tracks[1].is_percussion
+
+
+def test_note_off_precedes_note_on_at_the_same_tick():
+    # 同じ音の連打: 1拍目のノートオフと2拍目のノートオンが同じ tick
+    mf = _read(midi_file_bytes(_index([_track("Piano", 0, [(0.0, 1.0, 60), (1.0, 1.0, 60), (2.0, 1.0, 60)])])))
+    at_beat = [ev for tick, ev in _timed_events(mf.tracks[1]) if tick == TPQ and (ev.isNoteOn() or ev.isNoteOff())]
+    assert [ev.isNoteOff() for ev in at_beat] == [True, False]
+    # 全体でも鳴っている音は常に 0 か 1 (重ならない)
+    sounding = 0
+    for _, ev in _timed_events(mf.tracks[1]):
+        if ev.isNoteOn(): sounding += 1
+        elif ev.isNoteOff(): sounding -= 1
+        assert sounding in (0, 1)
+
+
+def test_tempo_and_time_signature_meta_events_at_change_points():
+    index = _index([_track("Piano", 0, [(0.0, 4.0, 60), (8.0, 3.0, 62)])], tempo_changes=[(0.0, 100.0), (8.0, 70.0)],
+                   meter_changes=[(0.0, "4/4"), (8.0, "3/4")])
+    events = _timed_events(_read(midi_file_bytes(index)).tracks[0])
+    tempos = [(tick, int.from_bytes(ev.data, "big")) for tick, ev in events if ev.type == midi.MetaEvents.SET_TEMPO]
+    meters = [(tick, ev.data[0], 2 ** ev.data[1]) for tick, ev in events if ev.type == midi.MetaEvents.TIME_SIGNATURE]
+    assert tempos == [(0, 600000), (8 * TPQ, round(60_000_000 / 70))]
+    assert meters == [(0, 4, 4), (8 * TPQ, 3, 4)]
+    # 同じ tick では拍子がテンポより先
+    change_types = [ev.type for tick, ev in events if tick == 8 * TPQ and ev.type != midi.MetaEvents.END_OF_TRACK]
+    assert change_types == [midi.MetaEvents.TIME_SIGNATURE, midi.MetaEvents.SET_TEMPO]
+
+
+def test_more_than_16_tracks():
+    from music21 import instrument, note, stream
+    score = stream.Score()
+    for i in range(18):
+        part = stream.Part(id=f"P{i}"); part.insert(0, instrument.Piano()); part.insert(0, note.Note(48 + i, quarterLength=1.0))
+        score.insert(0, part)
+    index = collect_score_events(score, tempo_bpm=120, time_signature="4/4")
+    assert len(index.tracks) == 18
+    # 旋律楽器はチャンネル 10 (index 9) を飛ばして 16 チャンネルを巡回する
+    assert all(t.channel != PERCUSSION_CHANNEL and 0 <= t.channel < 16 for t in index.tracks)
+    mf = _read(midi_file_bytes(index))
+    assert len(mf.tracks) == 19
+    pitches = [[ev.pitch for _, ev in _timed_events(t) if ev.isNoteOn()] for t in mf.tracks[1:]]
+    assert pitches == [[48 + i] for i in range(18)]
+# --- END OF FILE tests/test_score_exporter_midi.py ---
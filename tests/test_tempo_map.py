@@ -0,0 +1,74 @@
+# --- START OF FILE tests/test_tempo_map.py ---
+"""TempoMap / MeterMap の拍 ↔ 秒 ↔ tick 変換。"""
+import pytest
+
+from utilities import tempo_map as tm
+from utilities.tempo_map import MeterMap, TempoMap
+
+
+def test_constant_tempo_seconds():
+    tmap = TempoMap.constant(120)
+    assert tmap.is_constant
+    assert tmap.seconds(4.0) == pytest.approx(2.0)
+    assert tmap.offset_at(2.0) == pytest.approx(4.0)
+
+
+def test_seconds_across_tempo_changes():
+    # 0-8 拍: 120 BPM (4 秒), 8-14 拍: 60 BPM (6 秒), 以降 240 BPM
+    tmap = TempoMap([(0.0, 120.0), (8.0, 60.0), (14.0, 240.0)])
+    assert tmap.start_seconds == pytest.approx((0.0, 4.0, 10.0))
+    assert tmap.seconds(10.0) == pytest.approx(6.0)
+    assert tmap.seconds(16.0) == pytest.approx(10.5)
+    assert tmap.duration_seconds(6.0, 4.0) == pytest.approx(1.0 + 2.0)
+    assert tmap.bpm_at(7.999) == 120.0 and tmap.bpm_at(8.0) == 60.0
+
+
+@pytest.mark.parametrize("offset", [0.0, 0.5, 7.75, 8.0, 9.25, 13.999, 14.0, 31.5])
+def test_offset_seconds_round_trip(offset):
+    tmap = TempoMap([(0.0, 97.0), (8.0, 63.5), (14.0, 181.0)])
+    assert tmap.offset_at(tmap.seconds(offset)) == pytest.approx(offset)
+
+
+def test_many_changes_do_not_accumulate_error():
+    changes = [(float(i), 90.0 + (i % 7) * 10.0) for i in range(500)]
+    tmap = TempoMap(changes)
+    expected = sum(60.0 / bpm for _, bpm in changes)
+    assert tmap.seconds(500.0) == pytest.approx(expected, abs=1e-9)
+    assert tmap.offset_at(expected) == pytest.approx(500.0, abs=1e-9)
+
+
+def test_changes_are_normalized():
+    tmap = TempoMap([(8.0, 90.0), (4.0, 120.0), (4.0, 100.0), (12.0, 90.0)], default_bpm=80.0)
+    # 先頭は既定テンポ、同じ位置は後のもの、値が変わらない点は捨てる
+    assert tmap.changes() == [(0.0, 80.0), (4.0, 100.0), (8.0, 90.0)]
+    with pytest.raises(ValueError):
+        TempoMap([(0.0, 0.0)])
+
+
+def test_ticks_and_usec_per_quarter():
+    tmap = TempoMap([(0.0, 100.0), (8.0, 70.0)])
+    assert TempoMap.ticks(1.5, 480) == 720
+    assert tmap.usec_per_quarter(0) == 600000
+    assert tmap.usec_per_quarter(1) == round(60_000_000 / 70)
+    assert tmap.tick_at_seconds(tmap.seconds_at_tick(5000, 480), 480) == 5000
+
+
+@pytest.mark.parametrize("numpy_available", [True, False])
+def test_array_conversions_match_scalar(monkeypatch, numpy_available):
+    if not numpy_available: monkeypatch.setattr(tm, "NUMPY_AVAILABLE", False)
+    elif not tm.NUMPY_AVAILABLE: pytest.skip("NumPy is not installed.")
+    tmap = TempoMap([(0.0, 120.0), (8.0, 60.0), (14.0, 240.0)])
+    offsets = [0.0, 3.0, 8.0, 10.5, 14.0, 20.0]
+    seconds = [float(s) for s in tmap.seconds_array(offsets)]
+    assert seconds == pytest.approx([tmap.seconds(o) for o in offsets])
+    assert [float(o) for o in tmap.offsets_array(seconds)] == pytest.approx(offsets)
+    assert [int(t) for t in tmap.ticks_array(offsets, 480)] == [TempoMap.ticks(o, 480) for o in offsets]
+
+
+def test_meter_map_measures_restart_at_meter_change():
+    mmap = MeterMap([(0.0, "4/4"), (8.0, "3/4"), (14.0, "6/8")])
+    assert mmap.meter_at(9.0).ts_str == "3/4"
+    assert mmap.measure_at(9.0) == (2, pytest.approx(1.0))
+    assert mmap.measure_at(14.0) == (4, pytest.approx(0.0))
+    assert mmap.bar_offsets(20.0)[:6] == pytest.approx([0.0, 4.0, 8.0, 11.0, 14.0, 17.0])
+# --- END OF FILE tests/test_tempo_map.py ---
@@ -0,0 +1,73 @@
+# --- START OF FILE tests/test_vocal_utils.py ---
+"""reduce_to_monophonic (スカイラインによる単旋律化)。"""
+import pytest
+
+from utilities.vocal_utils import (DEFAULT_ONSET_TOLERANCE_QL, SKYLINE_POLICY_CLOSEST, SKYLINE_POLICY_HIGHEST, SKYLINE_POLICY_LOWEST,
+                                   reduce_to_monophonic)
+
+
+def test_already_monophonic_line_is_unchanged():
+    line = reduce_to_monophonic([0.0, 1.0, 2.5], [60, 62, 64], [1.0, 1.5, 0.5])
+    assert line.indices == [0, 1, 2]
+    assert line.lengths == [1.0, 1.5, 0.5]
+    assert (line.dropped, line.trimmed) == (0, 0)
+
+
+def test_empty_input():
+    line = reduce_to_monophonic([], [], [])
+    assert (line.indices, line.lengths, line.dropped, line.trimmed) == ([], [], 0, 0)
+
+
+@pytest.mark.parametrize("policy, expected", [
+    (SKYLINE_POLICY_HIGHEST, [1, 3]),
+    (SKYLINE_POLICY_LOWEST, [0, 4]),
+])
+def test_chord_groups_keep_one_note(policy, expected):
+    offsets = [0.0, 0.0, 1.0, 1.0, 1.0]
+    midis = [60, 67, 64, 72, 55]
+    line = reduce_to_monophonic(offsets, midis, [1.0] * 5, policy)
+    assert line.indices == expected
+    assert line.dropped == 3
+
+
+def test_closest_follows_the_previous_note():
+    # 最初のグループは最高音、以降は直前の音に最も近い音 (同距離なら高い方)
+    offsets = [0.0, 0.0, 1.0, 1.0, 2.0, 2.0]
+    midis = [60, 67, 69, 52, 65, 73]
+    line = reduce_to_monophonic(offsets, midis, [1.0] * 6, SKYLINE_POLICY_CLOSEST)
+    assert [midis[i] for i in line.indices] == [67, 69, 73]
+
+
+def test_onsets_within_tolerance_are_simultaneous():
+    tol = DEFAULT_ONSET_TOLERANCE_QL
+    line = reduce_to_monophonic([0.0, tol / 2, 0.5], [60, 64, 62], [0.5, 0.5, 0.5])
+    assert line.indices == [1, 2]
+    line = reduce_to_monophonic([0.0, 0.01, 0.5], [60, 64, 62], [0.5, 0.5, 0.5], onset_tolerance=0.02)
+    assert line.indices == [1, 2]
+    line = reduce_to_monophonic([0.0, 0.01, 0.5], [60, 64, 62], [0.5, 0.5, 0.5])
+    assert line.indices == [0, 1, 2]
+
+
+def test_overlaps_are_trimmed_to_the_next_onset():
+    line = reduce_to_monophonic([0.0, 1.0, 1.5], [60, 62, 64], [2.0, 0.25, 1.0])
+    assert line.lengths == [1.0, 0.25, 1.0]
+    assert line.trimmed == 1
+
+
+def test_unsorted_input_is_sorted_stably():
+    offsets = [2.0, 0.0, 1.0, 0.0]
+    midis = [64, 60, 62, 67]
+    line = reduce_to_monophonic(offsets, midis, [1.0] * 4)
+    assert line.indices == [3, 2, 0]
+    assert line.dropped == 1
+
+
+def test_unknown_policy_falls_back_to_highest():
+    line = reduce_to_monophonic([0.0, 0.0], [60, 64], [1.0, 1.0], "median")
+    assert line.indices == [1]
+
+
+def test_mismatched_lengths_raise():
+    with pytest.raises(ValueError):
+        reduce_to_monophonic([0.0, 1.0], [60], [1.0, 1.0])
+# --- END OF FILE tests/test_vocal_utils.py ---
@@ -2,7 +2,8 @@
 import music21
 from typing import List, Dict, Optional, Any, Tuple, Union
 from music21 import (stream, note, pitch, meter, duration, instrument as m21instrument,
-                     tempo, key, expressions, volume as m21volume, articulations, dynamics) # dynamics を追加
+                     key, expressions, volume as m21volume, articulations, dynamics, # dynamics を追加
+                     chord as m21chord)
 import logging
 import json
 import re
@@ -10,6 +11,11 @@ import copy
 import random
 import math # For Gaussian fallback
 
+# ユーティリティのインポート
+from .vocal_utils import reduce_to_monophonic, SKYLINE_POLICY_HIGHEST # 同じディレクトリなので相対インポート
+from utilities.core_music_utils import get_meter_info
+from utilities.chord_timeline import ChordTimeline
+
 # NumPy import attempt and flag
 NUMPY_AVAILABLE = False
 np = None
@@ -107,7 +113,7 @@ def apply_humanization_to_notes(
             if hasattr(element_copy, 'volume') and element_copy.volume is not None:
                 element_copy.volume.velocity = final_vel
             else:
-                element_copy.volume = volume.Volume(velocity=final_vel)
+                element_copy.volume = m21volume.Volume(velocity=final_vel)
         humanized_elements.append(element_copy)
         
     return humanized_elements
@@ -122,24 +128,25 @@ class VocalGenerator:
         self.default_instrument = default_instrument
         self.global_tempo = global_tempo
         self.global_time_signature_str = global_time_signature
-        self.global_time_signature_obj = get_time_signature_object(global_time_signature)
+        self.global_meter = get_meter_info(global_time_signature)
 
     def _parse_midivocal_data(self, midivocal_data: List[Dict]) -> List[Dict]:
         # (No significant changes from previous, seems robust enough for now)
         parsed_notes = []
         for item_idx, item in enumerate(midivocal_data):
             try:
-                offset = float(item["Offset"])
-                pitch_name = str(item["Pitch"])
-                length = float(item["Length"])
-                velocity = int(item.get("Velocity", 70)) # Velocity from data if available
+                # vocal_note_data_ore.json は小文字キー ("offset"/"pitch"/"length") なので両方を受け付ける
+                offset = float(item["Offset"] if "Offset" in item else item["offset"])
+                pitch_name = str(item["Pitch"] if "Pitch" in item else item["pitch"])
+                length = float(item["Length"] if "Length" in item else item["length"])
+                velocity = int(item.get("Velocity", item.get("velocity", 70))) # Velocity from data if available
 
                 if not pitch_name: logger.warning(f"Vocal note #{item_idx+1} empty pitch. Skip."); continue
-                try: pitch.Pitch(pitch_name)
+                try: midi_val = pitch.Pitch(pitch_name).midi
                 except Exception as e_p: logger.warning(f"Skip vocal #{item_idx+1} invalid pitch: '{pitch_name}' ({e_p})"); continue
                 if length <= 0: logger.warning(f"Skip vocal #{item_idx+1} non-positive length: {length}"); continue
                 
-                parsed_notes.append({"offset": offset, "pitch_str": pitch_name, "q_length": length, "velocity": velocity})
+                parsed_notes.append({"offset": offset, "pitch_str": pitch_name, "midi": midi_val, "q_length": length, "velocity": velocity})
             except KeyError as ke: logger.error(f"Skip vocal item #{item_idx+1} missing key: {ke} in {item}")
             except ValueError as ve: logger.error(f"Skip vocal item #{item_idx+1} ValueError: {ve} in {item}")
             except Exception as e: logger.error(f"Unexpected error parsing vocal item #{item_idx+1}: {e} in {item}", exc_info=True)
@@ -148,10 +155,37 @@ class VocalGenerator:
         logger.info(f"Parsed {len(parsed_notes)} valid notes from midivocal_data.")
         return parsed_notes
 
-    def _get_section_for_note_offset(self, note_offset: float, processed_stream: List[Dict]) -> Optional[str]:
+    def _reduce_to_monophonic(self, parsed_notes: List[Dict], policy: str) -> List[Dict]:
+        """
+        同時発音を含むボーカルデータを単旋律に縮約する (vocal_utils.reduce_to_monophonic)。
+        parsed_notes はオフセット順にソート済みであること。
+        """
+        line = reduce_to_monophonic(
+            [n["offset"] for n in parsed_notes],
+            [n["midi"] for n in parsed_notes],
+            [n["q_length"] for n in parsed_notes],
+            policy=policy,
+        )
+        if line.dropped or line.trimmed:
+            logger.info(f"VocalGen: Monophonic reduction ({policy}) dropped {line.dropped} simultaneous notes and trimmed {line.trimmed} overlapping durations ({len(line.indices)} notes kept).")
+        reduced_notes: List[Dict] = []
+        for idx, new_length in zip(line.indices, line.lengths):
+            note_data = parsed_notes[idx]
+            if new_length != note_data["q_length"]:
+                note_data = dict(note_data, q_length=new_length)
+            reduced_notes.append(note_data)
+        return reduced_notes
+
+    def _get_section_for_note_offset(self, note_offset: float, processed_stream: List[Dict], chord_timeline: Optional[Any] = None) -> Optional[str]:
         """
-        Determines the song section for a given note offset based on the processed_chord_stream.
+        Determines the song section for a given note offset based on the processed_chord_stream
+        (binary search on the ChordTimeline when one is given, linear scan otherwise).
         """
+        if chord_timeline is not None:
+            if chord_timeline.index_at(note_offset) is not None:
+                return chord_timeline.section_at(note_offset)
+            logger.warning(f"VocalGen: No section found in processed_stream for note offset {note_offset:.2f}")
+            return None
         for block in processed_stream:
             block_start = block.get("offset", 0.0)
             block_end = block_start + block.get("q_length", 0.0)
@@ -167,7 +201,7 @@ class VocalGenerator:
         output_elements: List[Union[note.Note, note.Rest]] = []
         
         for i, current_note in enumerate(notes_with_lyrics):
-            original_offset = current_note.offset
+            original_offset = float(current_note.offset) # Fraction だと :.2f で書式化できない
             original_duration_ql = current_note.duration.quarterLength
             
             # Determine if a breath should be inserted AFTER this note
@@ -206,13 +240,13 @@ class VocalGenerator:
 
             # Add the breath if flagged
             if insert_breath_flag:
-                breath_offset = current_note.offset + current_note.duration.quarterLength # After (shortened) note
+                breath_offset = float(current_note.offset + current_note.duration.quarterLength) # After (shortened) note
                 # Check for overlap with the *next original* note's start time
                 can_add_breath = True
                 if i + 1 < len(notes_with_lyrics):
                     if breath_offset + breath_duration_ql > notes_with_lyrics[i+1].offset + 0.001:
                         can_add_breath = False
-                        logger.debug(f"Breath at {breath_offset:.2f} would overlap next note at {notes_with_lyrics[i+1].offset:.2f}. Skipping.")
+                        logger.debug(f"Breath at {breath_offset:.2f} would overlap next note at {float(notes_with_lyrics[i+1].offset):.2f}. Skipping.")
                 
                 if can_add_breath:
                     breath_rest = note.Rest(quarterLength=breath_duration_ql)
@@ -231,13 +265,13 @@ class VocalGenerator:
                 breath_duration_ql_opt: float = DEFAULT_BREATH_DURATION_QL,
                 humanize_opt: bool = True,
                 humanize_template_name: Optional[str] = "vocal_ballad_smooth",
-                humanize_custom_params: Optional[Dict[str, Any]] = None
+                humanize_custom_params: Optional[Dict[str, Any]] = None,
+                monophonic_policy: Optional[str] = SKYLINE_POLICY_HIGHEST, # None で縮約しない
+                chord_timeline: Optional[Any] = None # セクション検索用 (O(log n))。None なら processed_chord_stream から構築
                 ) -> stream.Part:
 
         vocal_part = stream.Part(id="Vocal")
         vocal_part.insert(0, self.default_instrument)
-        vocal_part.append(tempo.MetronomeMark(number=self.global_tempo))
-        vocal_part.append(self.global_time_signature_obj.clone())
         # Key signature can be added if needed, but vocals often adapt
 
         parsed_vocal_notes_data = self._parse_midivocal_data(midivocal_data)
@@ -245,6 +279,12 @@ class VocalGenerator:
             logger.warning("VocalGen: No valid notes parsed from midivocal_data. Returning empty part.")
             return vocal_part
 
+        # 歌詞割り当て・ブレス挿入の前に単旋律化しておく (同時発音による歌詞スキップを防ぐ)
+        if monophonic_policy:
+            parsed_vocal_notes_data = self._reduce_to_monophonic(parsed_vocal_notes_data, monophonic_policy)
+
+        if chord_timeline is None: chord_timeline = ChordTimeline.from_blocks(processed_chord_stream)
+
         notes_with_lyrics: List[note.Note] = []
         current_section_name: Optional[str] = None
         current_lyrics_for_section: List[str] = []
@@ -259,7 +299,7 @@ class VocalGenerator:
             note_velocity = note_data.get("velocity", 70) # Get velocity from parsed data
 
             # Determine section for this note using processed_chord_stream
-            section_for_this_note = self._get_section_for_note_offset(note_offset, processed_chord_stream)
+            section_for_this_note = self._get_section_for_note_offset(note_offset, processed_chord_stream, chord_timeline)
 
             if section_for_this_note != current_section_name:
                 if current_section_name and current_lyric_idx < len(current_lyrics_for_section):
@@ -273,7 +313,7 @@ class VocalGenerator:
 
             try:
                 m21_n = note.Note(note_pitch_str, quarterLength=note_q_length)
-                m21_n.volume = volume.Volume(velocity=note_velocity) # Set velocity
+                m21_n.volume = m21volume.Volume(velocity=note_velocity) # Set velocity
             except Exception as e:
                 logger.error(f"VocalGen: Failed to create Note for {note_pitch_str} at {note_offset}: {e}")
                 continue
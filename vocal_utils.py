@@ -0,0 +1,97 @@
+# --- START OF FILE generator/vocal_utils.py ---
+"""vocal_utils.py
+Low-level helpers for *vocal line preparation*.
+
+ボーカル MIDI データ (vocal_note_data_ore.json など) には同一オフセットに
+複数の音が並ぶ箇所があるため、歌詞割り当てやブレス挿入の前に
+単旋律 (スカイライン) へ縮約するスイープライン処理をここにまとめる。
+"""
+from __future__ import annotations
+
+from typing import List, NamedTuple, Optional, Sequence
+import logging
+
+logger = logging.getLogger(__name__)
+
+SKYLINE_POLICY_HIGHEST = "highest"
+SKYLINE_POLICY_LOWEST = "lowest"
+SKYLINE_POLICY_CLOSEST = "closest" # 直前に採用した音に最も近い音
+SKYLINE_POLICIES = (SKYLINE_POLICY_HIGHEST, SKYLINE_POLICY_LOWEST, SKYLINE_POLICY_CLOSEST)
+
+DEFAULT_ONSET_TOLERANCE_QL: float = 1e-3 # これ以下のオフセット差は同時発音とみなす
+
+
+class MonophonicLine(NamedTuple):
+    indices: List[int]    # 採用したノートの (入力配列上の) インデックス。時間順
+    lengths: List[float]  # 重なりをトリムした後のデュレーション (indices と同順)
+    dropped: int          # 同時発音のため捨てたノート数
+    trimmed: int          # 次の音との重なりのためデュレーションを短縮したノート数
+
+
+def reduce_to_monophonic(
+    offsets: Sequence[float],
+    midis: Sequence[int],
+    lengths: Sequence[float],
+    policy: str = SKYLINE_POLICY_HIGHEST,
+    onset_tolerance: float = DEFAULT_ONSET_TOLERANCE_QL,
+) -> MonophonicLine:
+    """
+    並列配列 (offset / MIDI番号 / 長さ) で与えたノート列を単旋律に縮約する。
+    オフセット順に一度だけ走査し、同時発音グループごとに policy で1音を選び、
+    次に採用する音の開始位置でデュレーションを切り詰める。入力は通常ソート済みで、
+    そうでない場合のみ安定ソートする。
+    """
+    n = len(offsets)
+    if not (len(midis) == n and len(lengths) == n):
+        raise ValueError(f"VocalUtils: offsets/midis/lengths must have the same length ({n}, {len(midis)}, {len(lengths)}).")
+    if policy not in SKYLINE_POLICIES:
+        logger.warning(f"VocalUtils: Unknown skyline policy '{policy}'. Using '{SKYLINE_POLICY_HIGHEST}'.")
+        policy = SKYLINE_POLICY_HIGHEST
+    if n == 0:
+        return MonophonicLine([], [], 0, 0)
+
+    is_sorted = all(offsets[i] <= offsets[i + 1] for i in range(n - 1))
+    order: Sequence[int] = range(n) if is_sorted else sorted(range(n), key=offsets.__getitem__)
+
+    kept: List[int] = []
+    prev_midi: Optional[int] = None
+    pos = 0
+    while pos < n:
+        first = order[pos]
+        group_onset = offsets[first]
+        best = first
+        best_midi = midis[first]
+        pos += 1
+        # 同時発音グループ内で policy に従って1音を選ぶ
+        while pos < n and offsets[order[pos]] - group_onset <= onset_tolerance:
+            cand = order[pos]
+            cand_midi = midis[cand]
+            if policy == SKYLINE_POLICY_LOWEST:
+                better = cand_midi < best_midi
+            elif policy == SKYLINE_POLICY_CLOSEST and prev_midi is not None:
+                d_cand, d_best = abs(cand_midi - prev_midi), abs(best_midi - prev_midi)
+                better = d_cand < d_best or (d_cand == d_best and cand_midi > best_midi)
+            else: # highest (closest の最初の音も最高音から始める)
+                better = cand_midi > best_midi
+            if better:
+                best, best_midi = cand, cand_midi
+            pos += 1
+        kept.append(best)
+        prev_midi = best_midi
+
+    trimmed_lengths: List[float] = []
+    trimmed = 0
+    last = len(kept) - 1
+    for k, idx in enumerate(kept):
+        length = lengths[idx]
+        if k < last:
+            gap = offsets[kept[k + 1]] - offsets[idx]
+            if length > gap:
+                length = gap
+                trimmed += 1
+        trimmed_lengths.append(length)
+
+    dropped = n - len(kept)
+    logger.debug(f"VocalUtils: Skyline ({policy}) kept {len(kept)}/{n} notes (dropped {dropped}, trimmed {trimmed}).")
+    return MonophonicLine(kept, trimmed_lengths, dropped, trimmed)
+# --- END OF FILE generator/vocal_utils.py ---